@@ -0,0 +1,43 @@
+import time
+
+import mantrap
+import numpy as np
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    num_runs = 3
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    scenarios = {"avoid": mantrap_evaluation.scenarios.custom_avoid,
+                 "surrounding": mantrap_evaluation.scenarios.custom_surrounding,
+                 "passing": mantrap_evaluation.scenarios.custom_passing}
+
+    for scenario_name, scenario in scenarios.items():
+        env, goal, _ = scenario(env_type=mantrap.environment.PotentialFieldEnvironment)
+
+        for solver_class in [mantrap.solver.IPOPTSolver, mantrap.solver.AugmentedLagrangianSolver]:
+            torch.manual_seed(0)
+            solver = solver_class(env=env, goal=goal, modules=modules, is_logging=False)
+            z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+
+            run_times, objectives, violations = [], [], []
+            for _ in range(num_runs):
+                start_time = time.time()
+                try:
+                    z_opt = solver.optimize(z0, tag=mantrap.constants.TAG_OPTIMIZATION)
+                except Exception as e:  # e.g. IPOPT not installed
+                    print(f"{scenario_name:>12} - {solver.name:>20}: failed ({e})")
+                    break
+                run_times.append(time.time() - start_time)
+
+                z_opt = z_opt.flatten().detach().numpy()
+                objectives.append(solver.objective(z_opt, ado_ids=env.ado_ids))
+                violations.append(solver.constraints(z_opt, ado_ids=env.ado_ids, return_violation=True)[1])
+
+            if len(run_times) > 0:
+                print(f"{scenario_name:>12} - {solver.name:>20}: runtime = {np.mean(run_times) * 1000:.1f} ms, "
+                      f"objective = {np.mean(objectives):.3f}, violation = {np.mean(violations):.4f}")
@@ -0,0 +1,43 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    num_scenes = 200
+    time_steps = 10
+
+    for env_class in [mantrap.environment.KalmanEnvironment,
+                      mantrap.environment.PotentialFieldEnvironment,
+                      mantrap.environment.SocialForcesEnvironment]:
+        torch.manual_seed(0)
+        envs = [mantrap_evaluation.scenarios.random(env_type=env_class, num_ados=int(torch.randint(1, 6, (1, ))))[0]
+                for _ in range(num_scenes)]
+        ego_controls = torch.rand((num_scenes, time_steps, 2)) * 2 - 1
+
+        # Predicting every scene on its own, one after another.
+        start_time = time.time()
+        for s, env in enumerate(envs):
+            env.predict_w_controls(ego_controls[s])
+        run_time_sequential = time.time() - start_time
+
+        # Predicting all scenes at once, in lockstep.
+        start_time = time.time()
+        env_batched = mantrap.environment.BatchedEnvironment(envs)
+        init_time = time.time() - start_time
+        start_time = time.time()
+        env_batched.predict_w_controls(ego_controls)
+        run_time_batched = time.time() - start_time
+
+        # Stepping all scenes at once, i.e. a full closed-loop rollout.
+        start_time = time.time()
+        for t in range(time_steps):
+            env_batched.step(ego_controls[:, t, :])
+        run_time_steps = time.time() - start_time
+
+        print(f"{env_class.__name__:>26}: prediction = {run_time_sequential * 1000:.1f} ms (sequential) -> "
+              f"{run_time_batched * 1000:.1f} ms (batched, init = {init_time * 1000:.1f} ms), "
+              f"rollout = {run_time_steps * 1000:.1f} ms ({num_scenes} scenes, {time_steps} steps)")
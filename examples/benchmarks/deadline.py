@@ -0,0 +1,36 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    env_class = mantrap.environment.PotentialFieldEnvironment
+    env, goal, _ = mantrap_evaluation.scenarios.custom_surrounding(env_type=env_class)
+    time_steps = 10
+
+    for solver_class in [mantrap.solver.IPOPTSolver,
+                         mantrap.solver.AugmentedLagrangianSolver,
+                         mantrap.solver.ILQRSolver]:
+        for step_budget in [None, env.dt, env.dt / 4]:
+            torch.manual_seed(0)
+            solver = solver_class(env=env, goal=goal, modules=modules, t_planning=10, is_logging=False)
+
+            start_time = time.time()
+            try:
+                ego_trajectory, _ = solver.solve(time_steps=time_steps, step_budget=step_budget,
+                                                 warm_start_method=mantrap.constants.WARM_START_ZEROS)
+            except Exception as e:  # e.g. IPOPT not installed
+                print(f"{solver.name:>20} [budget = {step_budget}]: failed ({e})")
+                continue
+            num_steps = ego_trajectory.shape[0] - 1
+            run_time = (time.time() - start_time) / num_steps
+
+            goal_distance = torch.norm(ego_trajectory[-1, 0:2] - goal)
+            print(f"{solver.name:>20} [budget = {step_budget}]: runtime/step = {run_time * 1000:.1f} ms, "
+                  f"deadline misses = {solver.deadline_misses}/{num_steps}, final goal distance = {goal_distance:.2f}")
@@ -0,0 +1,54 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    env, goal, _ = mantrap_evaluation.scenarios.custom_haruki(env_type=mantrap.environment.SocialForcesEnvironment)
+    ego_controls = torch.ones((10, 2)) * 0.5
+    seed = 0
+
+    def parameters(controls: torch.Tensor) -> torch.Tensor:
+        torch.manual_seed(seed)
+        dist_dict = env.compute_distributions(env.ego.unroll_trajectory(controls, dt=env.dt))
+        return torch.stack((dist_dict.mean, dist_dict.stddev))
+
+    # Reference jacobian by back-propagating through the prediction.
+    start_time = time.time()
+    jacobian = torch.autograd.functional.jacobian(parameters, ego_controls, vectorize=True)
+    jacobian = jacobian.view(*jacobian.shape[:-2], -1)
+    print(f"{'auto-grad':>30}: runtime = {(time.time() - start_time) * 1000:.1f} ms")
+
+    # Finite differences, batched with common random numbers, sequentially and distributed over processes.
+    for num_workers in [1, 4]:
+        torch.manual_seed(0)
+        seed = int(torch.randint(2 ** 31, size=(1, )).item())
+        jacobian = torch.autograd.functional.jacobian(parameters, ego_controls, vectorize=True)
+        jacobian = jacobian.view(*jacobian.shape[:-2], -1)
+
+        torch.manual_seed(0)
+        start_time = time.time()
+        _, mean_jacobian, _ = env.compute_jacobian_finite_differences(ego_controls, num_workers=num_workers)
+        run_time = time.time() - start_time
+        error = torch.max(torch.abs(mean_jacobian - jacobian[0])).item()
+        print(f"{'finite-differences (' + str(num_workers) + ' workers)':>30}: runtime = {run_time * 1000:.1f} ms, "
+              f"max error = {error:.5f}")
+
+    # Finite differences with independent random numbers, i.e. one coordinate perturbed at a time.
+    step = mantrap.constants.ENV_FINITE_DIFFERENCE_STEP
+    start_time = time.time()
+    mean_jacobian = torch.zeros(jacobian[0].shape)
+    with torch.no_grad():
+        for i in range(ego_controls.numel()):
+            perturbation = torch.zeros(ego_controls.numel())
+            perturbation[i] = step
+            perturbation = perturbation.view(ego_controls.shape)
+            mean_plus = env.compute_distributions(env.ego.unroll_trajectory(ego_controls + perturbation, dt=env.dt))
+            mean_minus = env.compute_distributions(env.ego.unroll_trajectory(ego_controls - perturbation, dt=env.dt))
+            mean_jacobian[..., i] = (mean_plus.mean - mean_minus.mean) / (2 * step)
+    run_time = time.time() - start_time
+    error = torch.max(torch.abs(mean_jacobian - jacobian[0])).item()
+    print(f"{'finite-differences (serial)':>30}: runtime = {run_time * 1000:.1f} ms, max error = {error:.5f}")
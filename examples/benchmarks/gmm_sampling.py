@@ -0,0 +1,39 @@
+import time
+
+import mantrap
+import numpy as np
+import torch
+
+
+def rsample_one_hot(gmm: mantrap.utility.maths.VGMM2D, sample_shape: torch.Size) -> torch.Tensor:
+    """Reference: sample from every component and select one of them by a one-hot selector (previous method)."""
+    samples = torch.randn(size=sample_shape + gmm.mus.shape).unsqueeze(dim=-1)
+    mvn_samples = gmm.mus + torch.matmul(gmm.L, samples).squeeze(dim=-1)
+    component_cat_samples = gmm.pis_cat_dist.sample(sample_shape)
+    selector = torch.eye(gmm.components)[component_cat_samples].unsqueeze(dim=-1)
+    return torch.sum(mvn_samples * selector, dim=-2, keepdim=True)
+
+
+if __name__ == '__main__':
+    num_runs = 5
+    num_ados, t_horizon, num_modes = 5, 20, 25
+
+    torch.manual_seed(0)
+    gmm = mantrap.utility.maths.VGMM2D(mus=torch.rand((num_ados, t_horizon, num_modes, 2)),
+                                       log_pis=torch.rand((num_ados, t_horizon, num_modes)),
+                                       log_sigmas=torch.rand((num_ados, t_horizon, num_modes, 2)),
+                                       corrs=torch.rand((num_ados, t_horizon, num_modes)) * 0.5)
+
+    for num_samples in [10, 100, 1000, 5000]:
+        run_times = {"one-hot": [], "gather": []}
+        for _ in range(num_runs):
+            start_time = time.time()
+            rsample_one_hot(gmm, torch.Size([num_samples]))
+            run_times["one-hot"].append(time.time() - start_time)
+
+            start_time = time.time()
+            gmm.rsample(torch.Size([num_samples]))
+            run_times["gather"].append(time.time() - start_time)
+
+        print(f"{num_samples:>5} samples: one-hot = {np.mean(run_times['one-hot']) * 1000:.1f} ms, "
+              f"gather = {np.mean(run_times['gather']) * 1000:.1f} ms")
@@ -0,0 +1,62 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+num_prediction_calls = 0
+num_iterations = 0
+
+
+def count_prediction_calls(function):
+    def wrapper(*args, **kwargs):
+        global num_prediction_calls
+        num_prediction_calls += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+def count_iterations(function):
+    def wrapper(*args, **kwargs):
+        global num_iterations
+        num_iterations += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+if __name__ == '__main__':
+    env_class = mantrap.environment.PotentialFieldEnvironment
+    env_class.compute_distributions = count_prediction_calls(env_class.compute_distributions)
+    env_class.compute_distributions_with_jacobian = count_prediction_calls(
+        env_class.compute_distributions_with_jacobian)
+    mantrap.solver.ipopt.IPOPTProblem.intermediate = count_iterations(mantrap.solver.ipopt.IPOPTProblem.intermediate)
+
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    for scenario in [mantrap_evaluation.scenarios.custom_avoid,
+                     mantrap_evaluation.scenarios.custom_surrounding,
+                     mantrap_evaluation.scenarios.custom_passing]:
+        env, goal, _ = scenario(env_type=env_class)
+
+        for gauss_newton_hessian in [False, True]:
+            torch.manual_seed(0)
+            solver = mantrap.solver.IPOPTSolver(env=env, goal=goal, modules=modules, t_planning=10, is_logging=False)
+            z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+
+            num_prediction_calls = num_iterations = 0
+            start_time = time.time()
+            try:
+                z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids, max_cpu_time=20.0,
+                                                gauss_newton_hessian=gauss_newton_hessian)
+            except Exception as e:  # e.g. IPOPT not installed
+                print(f"[{scenario.__name__:>20}] gauss-newton = {gauss_newton_hessian}: failed ({e})")
+                continue
+            run_time = time.time() - start_time
+
+            objective = solver.objective(z_opt.flatten().detach().numpy(), ado_ids=env.ado_ids)
+            print(f"[{scenario.__name__:>20}] gauss-newton = {gauss_newton_hessian}: "
+                  f"runtime = {run_time * 1000:.1f} ms, iterations = {num_iterations}, "
+                  f"prediction calls = {num_prediction_calls}, objective = {objective:.3f}")
@@ -0,0 +1,50 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+num_iterations = 0
+
+
+def count_iterations(function):
+    def wrapper(*args, **kwargs):
+        global num_iterations
+        num_iterations += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+if __name__ == '__main__':
+    mantrap.solver.ipopt.IPOPTProblem.intermediate = count_iterations(mantrap.solver.ipopt.IPOPTProblem.intermediate)
+
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    time_steps = 10
+    for scenario in [mantrap_evaluation.scenarios.custom_avoid,
+                     mantrap_evaluation.scenarios.custom_surrounding,
+                     mantrap_evaluation.scenarios.custom_passing]:
+        env, goal, _ = scenario(env_type=mantrap.environment.KalmanEnvironment)
+
+        for warm_start_dual in [False, True]:
+            torch.manual_seed(0)
+            solver = mantrap.solver.IPOPTSolver(env=env, goal=goal, modules=modules, t_planning=10, is_logging=False)
+
+            num_iterations = 0
+            start_time = time.time()
+            try:
+                ego_trajectory, _ = solver.solve(time_steps=time_steps,
+                                                 warm_start_method=mantrap.constants.WARM_START_ZEROS,
+                                                 warm_start_dual=warm_start_dual)
+            except Exception as e:  # e.g. IPOPT not installed
+                print(f"[{scenario.__name__:>20}] dual warm-start = {warm_start_dual}: failed ({e})")
+                continue
+            run_time = time.time() - start_time
+            num_steps = ego_trajectory.shape[0] - 1
+
+            print(f"[{scenario.__name__:>20}] dual warm-start = {warm_start_dual}: "
+                  f"runtime/step = {run_time / num_steps * 1000:.1f} ms, "
+                  f"iterations/step = {num_iterations / num_steps:.1f}")
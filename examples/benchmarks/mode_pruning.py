@@ -0,0 +1,44 @@
+import time
+
+import mantrap
+import numpy as np
+import torch
+
+
+def objective(distribution: mantrap.utility.maths.MultiAgentDistribution, means_wo: torch.Tensor,
+              num_modes: int = None, mass: float = None) -> torch.Tensor:
+    """Interaction probability objective core (see `InteractionProbabilityModule`)."""
+    if num_modes is not None or mass is not None:
+        distribution, modes = distribution.prune_modes(num_modes=num_modes, mass=mass)
+        means_wo = torch.gather(means_wo, dim=2, index=modes.unsqueeze(dim=-1).expand(*modes.shape, 2))
+    return - torch.sum(distribution.log_prob(means_wo))
+
+
+if __name__ == '__main__':
+    num_runs = 10
+    num_ados, t_horizon, num_modes = 20, 20, 25  # Trajectron-like output distribution
+
+    # Most of the mode weight is concentrated in a few modes, as usual for Trajectron's output.
+    torch.manual_seed(0)
+    mus = torch.rand((num_ados, t_horizon, num_modes, 2), requires_grad=True)
+    log_pis = torch.randn((num_ados, t_horizon, num_modes)) * 3
+    log_sigmas = torch.rand((num_ados, t_horizon, num_modes, 2)) - 1
+    corrs = torch.rand((num_ados, t_horizon, num_modes)) * 0.5
+    means_wo = torch.rand((num_ados, t_horizon, num_modes, 2))
+    ado_ids = [f"{i}" for i in range(num_ados)]
+
+    objective_full = None
+    for kwargs in [{}, {"num_modes": 10}, {"num_modes": 5}, {"num_modes": 2}, {"mass": 0.99}, {"mass": 0.9}]:
+        run_times = []
+        for _ in range(num_runs):
+            start_time = time.time()
+            gmm = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=log_sigmas, corrs=corrs)
+            distribution = mantrap.utility.maths.MultiAgentDistribution(gmm, agent_ids=ado_ids)
+            objective_value = objective(distribution, means_wo=means_wo, **kwargs)
+            torch.autograd.grad(objective_value, mus)
+            run_times.append(time.time() - start_time)
+
+        objective_full = float(objective_value.detach()) if objective_full is None else objective_full
+        error = abs(float(objective_value.detach()) - objective_full) / abs(objective_full)
+        print(f"{str(kwargs):>18}: objective + gradient = {np.mean(run_times) * 1000:.2f} ms, "
+              f"relative objective error = {error * 100:.2f} %")
@@ -0,0 +1,37 @@
+import time
+
+import mantrap
+import numpy as np
+import torch
+
+
+if __name__ == '__main__':
+    num_runs = 5
+    num_attended = 2
+
+    for env_type in [mantrap.environment.PotentialFieldEnvironment, mantrap.environment.SocialForcesEnvironment]:
+        for num_ados in [2, 5, 10, 20]:
+            torch.manual_seed(0)
+            env = env_type(ego_position=torch.zeros(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+            for _ in range(num_ados):
+                env.add_ado(position=torch.rand(2) * 20 - 10, velocity=torch.rand(2) * 2 - 1)
+            ego_trajectory = env.ego.unroll_trajectory(torch.ones((10, 2)), dt=env.dt)
+
+            # Attend to the ados closest to the robot, similar to the closest-k attention module.
+            _, ado_states = env.states()
+            distances = torch.norm(ado_states[:, 0:2] - env.ego.position, dim=1)
+            ado_ids = [env.ado_ids[m] for m in torch.argsort(distances)[:num_attended]]
+
+            run_times = {"full": [], "partial": []}
+            for _ in range(num_runs):
+                start_time = time.time()
+                env.compute_distributions(ego_trajectory)
+                run_times["full"].append(time.time() - start_time)
+
+                start_time = time.time()
+                env.compute_distributions(ego_trajectory, ado_ids=ado_ids)
+                run_times["partial"].append(time.time() - start_time)
+
+            print(f"{env.name:>16} [{num_ados:>2} ados]: full = {np.mean(run_times['full']) * 1000:.1f} ms, "
+                  f"partial = {np.mean(run_times['partial']) * 1000:.1f} ms "
+                  f"({len(env.interacting_ado_ids(ado_ids))} simulated)")
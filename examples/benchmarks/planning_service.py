@@ -0,0 +1,43 @@
+import asyncio
+
+import mantrap
+import numpy as np
+
+import mantrap_evaluation.replay
+import mantrap_evaluation.scenarios
+
+
+async def replay(service: mantrap.solver.PlanningService, duration: float):
+    _, ego_trajectory = await asyncio.gather(
+        service.run(),
+        mantrap_evaluation.replay.eth_replay(service, duration=duration)
+    )
+    return ego_trajectory
+
+
+if __name__ == '__main__':
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+
+    for solver_class in [mantrap.solver.IPOPTSolver,
+                         mantrap.solver.AugmentedLagrangianSolver,
+                         mantrap.solver.ILQRSolver]:
+        try:
+            env, goal, _ = mantrap_evaluation.scenarios.eth(env_type=mantrap.environment.KalmanEnvironment)
+        except (FileNotFoundError, OSError) as e:  # e.g. dataset not downloaded
+            print(f"ETH dataset not available ({e})")
+            break
+        solver = solver_class(env=env, goal=goal, modules=modules, t_planning=10, is_logging=False)
+        service = mantrap.solver.PlanningService(solver, step_budget=0.3)
+
+        try:
+            ego_trajectory = asyncio.run(replay(service, duration=10.0))
+        except Exception as e:  # e.g. IPOPT not installed
+            print(f"{solver.name:>20}: failed ({e})")
+            continue
+
+        latencies = np.array(service.latencies) * 1000
+        print(f"{solver.name:>20}: plans = {latencies.size}, latency = {np.mean(latencies):.1f} ms "
+              f"(p95 = {np.percentile(latencies, 95):.1f} ms, max = {np.max(latencies):.1f} ms), "
+              f"deadline misses = {solver.deadline_misses}, ego steps = {ego_trajectory.shape[0] - 1}")
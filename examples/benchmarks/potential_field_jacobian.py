@@ -0,0 +1,46 @@
+import time
+
+import mantrap
+import numpy as np
+import torch
+
+
+if __name__ == '__main__':
+    num_runs = 5
+    t_horizon = 10
+
+    for num_ados in [1, 5, 10, 20]:
+        torch.manual_seed(0)
+        env = mantrap.environment.PotentialFieldEnvironment(ego_position=torch.tensor([1.0, 0.0]),
+                                                            ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+        for _ in range(num_ados):
+            env.add_ado(position=torch.rand(2) * 6 - 3, velocity=torch.rand(2) * 2 - 1)
+        module = mantrap.modules.InteractionProbabilityModule(env=env, t_horizon=t_horizon)
+        ego_controls = torch.rand((t_horizon, 2)) * 0.4 - 0.2
+
+        run_times = {"auto-grad": [], "analytic": []}
+        for _ in range(num_runs):
+            # Previous behaviour: build the computation graph and back-propagate through it.
+            start_time = time.time()
+            controls = ego_controls.detach().clone().requires_grad_(True)
+            ego_trajectory = env.ego.unroll_trajectory(controls, dt=env.dt)
+            objective = module._objective_core(ego_trajectory, ado_ids=env.ado_ids, tag="benchmark")
+            module.compute_gradient_auto_grad(objective, grad_wrt=controls)
+            run_times["auto-grad"].append(time.time() - start_time)
+
+            start_time = time.time()
+            ego_trajectory = env.ego.unroll_trajectory(ego_controls, dt=env.dt)
+            module.compute_gradient_analytically(ego_trajectory, grad_wrt=ego_controls, ado_ids=env.ado_ids,
+                                                 tag="benchmark")
+            run_times["analytic"].append(time.time() - start_time)
+
+        print(f"[{num_ados:>2} ados]: auto-grad = {np.mean(run_times['auto-grad']) * 1000:.1f} ms, "
+              f"analytic = {np.mean(run_times['analytic']) * 1000:.1f} ms")
+
+    # Reference: particle-based simulation (one agent object per particle, previous prediction).
+    env_particles = env.copy()
+    start_time = time.time()
+    for _ in range(num_runs):
+        ego_trajectory = env_particles.ego.unroll_trajectory(ego_controls, dt=env_particles.dt)
+        mantrap.environment.base.ParticleEnvironment._compute_distributions(env_particles, ego_trajectory)
+    print(f"particle-based prediction [{env.num_ados} ados] = {(time.time() - start_time) / num_runs * 1000:.1f} ms")
@@ -0,0 +1,59 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+num_prediction_calls = 0
+
+
+def count_prediction_calls(function):
+    def wrapper(*args, **kwargs):
+        global num_prediction_calls
+        num_prediction_calls += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+
+if __name__ == '__main__':
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+
+    for env_class in [mantrap.environment.PotentialFieldEnvironment,
+                      mantrap.environment.SocialForcesEnvironment,
+                      mantrap.environment.Trajectron]:
+        env_class.compute_distributions = count_prediction_calls(env_class.compute_distributions)
+        env_class.compute_distributions_with_jacobian = count_prediction_calls(
+            env_class.compute_distributions_with_jacobian)
+        try:
+            env, goal, _ = mantrap_evaluation.scenarios.custom_avoid(env_type=env_class)
+        except Exception as e:  # e.g. Trajectron model not available
+            print(f"{env_class.__name__}: failed ({e})")
+            continue
+
+        for solver_class in [mantrap.solver.IPOPTSolver,
+                             mantrap.solver.AugmentedLagrangianSolver,
+                             mantrap.solver.SQPSolver]:
+            torch.manual_seed(0)
+            solver = solver_class(env=env, goal=goal, modules=modules, t_planning=10, is_logging=False)
+            z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+
+            num_prediction_calls = 0
+            start_time = time.time()
+            try:
+                z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids, max_cpu_time=60.0)
+            except Exception as e:  # e.g. IPOPT not installed
+                print(f"{env_class.__name__:>25} {solver.name:>20}: failed ({e})")
+                continue
+            run_time = time.time() - start_time
+            num_calls = num_prediction_calls
+
+            z_opt = z_opt.flatten().detach().numpy()
+            torch.manual_seed(0)
+            objective = solver.objective(z_opt, ado_ids=env.ado_ids)
+            _, violation = solver.constraints(z_opt, ado_ids=env.ado_ids, return_violation=True)
+            print(f"{env_class.__name__:>25} {solver.name:>20}: runtime = {run_time * 1000:.1f} ms, "
+                  f"prediction calls = {num_calls}, objective = {objective:.3f}, violation = {violation:.4f}")
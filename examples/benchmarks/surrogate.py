@@ -0,0 +1,47 @@
+import time
+
+import mantrap
+import torch
+
+import mantrap_evaluation.distillation
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    modules = [mantrap.modules.GoalNormModule,
+               mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+
+    for env_class in [mantrap.environment.PotentialFieldEnvironment,
+                      mantrap.environment.SocialForcesEnvironment,
+                      mantrap.environment.Trajectron]:
+        try:
+            model = mantrap_evaluation.distillation.distill(env_class, seeds=list(range(20)), directory="")
+        except Exception as e:  # e.g. Trajectron model not available
+            print(f"{env_class.__name__}: failed ({e})")
+            continue
+
+        # Prediction error and throughput on unseen random scenarios.
+        results = mantrap_evaluation.distillation.evaluate_surrogate(env_class, model, seeds=list(range(100, 105)))
+        print(f"{env_class.__name__:>25}: mean error = {results['mean_error']:.3f} m/s, "
+              f"std error = {results['std_error']:.3f} m/s, throughput = {results['teacher_throughput']:.1f} -> "
+              f"{results['surrogate_throughput']:.1f} predictions/s")
+
+        # Solving with the surrogate warm-start in comparison to without (zeros) warm-start.
+        env, goal, _ = mantrap_evaluation.scenarios.custom_avoid(env_type=env_class)
+        for warm_start_method in [mantrap.constants.WARM_START_ZEROS, mantrap.constants.WARM_START_SURROGATE]:
+            torch.manual_seed(0)
+            solver = mantrap.solver.AugmentedLagrangianSolver(env=env, goal=goal, modules=modules, t_planning=10,
+                                                              is_logging=False)
+            start_time = time.time()
+            z0 = solver.warm_start(method=warm_start_method)
+            warm_start_time = time.time() - start_time
+            z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids)
+            run_time = time.time() - start_time
+
+            z_opt = z_opt.flatten().detach().numpy()
+            objective = solver.objective(z_opt, ado_ids=env.ado_ids)
+            _, violation = solver.constraints(z_opt, ado_ids=env.ado_ids, return_violation=True)
+            print(f"{env_class.__name__:>25} {warm_start_method:>10}: runtime = {run_time * 1000:.1f} ms "
+                  f"(warm-start = {warm_start_time * 1000:.1f} ms), objective = {objective:.3f}, "
+                  f"violation = {violation:.4f}")
@@ -0,0 +1,42 @@
+import os
+import sys
+import tempfile
+
+import mantrap
+import numpy as np
+
+import mantrap_evaluation.scenarios
+
+sys.path.append(mantrap.utility.io.build_os_path(mantrap.constants.WARM_START_PRE_COMPUTATION_DIRECTORY))
+import pre_compute  # noqa: E402
+
+
+class CountingIPOPTSolver(mantrap.solver.IPOPTSolver):
+    """IPOPT solver counting the number of objective evaluations."""
+    num_evaluations = 0
+
+    def objective(self, z: np.ndarray, ado_ids=None, tag: str = mantrap.constants.TAG_OPTIMIZATION) -> float:
+        self.num_evaluations += 1
+        return super(CountingIPOPTSolver, self).objective(z, ado_ids=ado_ids, tag=tag)
+
+
+if __name__ == '__main__':
+    num_scenarios = 400
+    scenarios = [mantrap_evaluation.scenarios.custom_avoid,
+                 mantrap_evaluation.scenarios.custom_surrounding,
+                 mantrap_evaluation.scenarios.custom_passing]
+    database_directory = tempfile.mkdtemp()
+
+    for version in [1, 2]:
+        directory = os.path.join(database_directory, f"v{version}")
+        pre_compute.pre_compute(num_scenarios, num_ados=[1, 2, 4], encoding_version=version, output_directory=directory)
+
+        num_evaluations = []
+        for scenario in scenarios:
+            env, goal, _ = scenario(env_type=mantrap.environment.PotentialFieldEnvironment)
+            solver = CountingIPOPTSolver(env=env, goal=goal, is_logging=False)
+            z0 = solver._warm_start_encoding(directory=directory)
+            solver.optimize(z0=z0.detach(), tag=mantrap.constants.TAG_OPTIMIZATION)
+            num_evaluations.append(solver.num_evaluations)
+        print(f"encoding version {version}: mean objective evaluations = {np.mean(num_evaluations):.1f} "
+              f"({', '.join(str(n) for n in num_evaluations)})")
@@ -0,0 +1,33 @@
+import time
+
+import mantrap
+import numpy as np
+
+import mantrap_evaluation.scenarios
+
+
+if __name__ == '__main__':
+    num_runs = 10
+    env, goal, _ = mantrap_evaluation.scenarios.custom_avoid(env_type=mantrap.environment.PotentialFieldEnvironment)
+
+    for method in [mantrap.constants.WARM_START_HARD, mantrap.constants.WARM_START_STRAIGHT]:
+        solver = mantrap.solver.IPOPTSolver(env=env, goal=goal, is_logging=False)
+
+        run_times = []
+        for _ in range(num_runs):
+            start_time = time.time()
+            solver.warm_start(method=method)
+            run_times.append(time.time() - start_time)
+
+        # The first hard warm-start additionally builds the sub-solver, which is re-used afterwards.
+        print(f"{method:>10}: first = {run_times[0] * 1000:.1f} ms, "
+              f"mean (cached) = {np.mean(run_times[1:]) * 1000:.1f} ms")
+
+    # Reference: building a new hard sub-solver for every warm-start (previous behaviour).
+    solver = mantrap.solver.IPOPTSolver(env=env, goal=goal, is_logging=False)
+    run_times = []
+    for _ in range(num_runs):
+        start_time = time.time()
+        solver._warm_start_optimization(env=solver.env, modules=solver.module_hard(), cache_key=None)
+        run_times.append(time.time() - start_time)
+    print(f"{'uncached':>10}: mean = {np.mean(run_times) * 1000:.1f} ms")
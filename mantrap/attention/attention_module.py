@@ -39,6 +39,9 @@ class AttentionModule(abc.ABC):
     ###########################################################################
     # Utility #################################################################
     ###########################################################################
+    def reset_env(self, env: mantrap.environment.base.GraphBasedEnvironment):
+        self._env = env
+
     def _return_filtered(self, ids_filtered: typing.List[str]) -> typing.List[str]:
         self._ids_current = ids_filtered
         return self._ids_current
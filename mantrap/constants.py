@@ -44,6 +44,10 @@ ENV_VAR_INITIAL = 1e-6  # variance of initial distribution at t = t0.
 
 ENV_NUM_PARTICLES = 5  # number of particles for estimating velocity distribution for particle based predictions.
 ENV_PARTICLE_NOISE = 1e-6  # velocity noise to avoid running into troubles in case of otherwise zero-variance.
+ENV_PARTICLE_VAR_MIN = 1e-14  # lower bound of particle variance (noise can vanish in float precision).
+ENV_GMM_SAMPLE_CHUNK = 1000  # maximal number of samples drawn from a GMM at once (bounds sampling memory).
+ENV_FINITE_DIFFERENCE_STEP = 1e-2  # perturbation of ego controls for finite-difference prediction jacobian.
+ENV_FINITE_DIFFERENCE_NUM_WORKERS = 1  # number of processes for batched predictions (1 = no multiprocessing).
 
 KALMAN_ADDITIVE_NOISE = 0.2  # additive noise per prediction time-step (Q in Kalman equations).
 
@@ -52,6 +56,7 @@ SOCIAL_FORCES_DEFAULT_V0 = 4.0, 1.0  # [m2s-2] repulsive field constant (mean, v
 SOCIAL_FORCES_DEFAULT_SIGMA = 0.9, 0.3  # [m] repulsive field exponent constant (mean, variance).
 SOCIAL_FORCES_MAX_GOAL_DISTANCE = 0.3  # [m] maximal distance to goal to have zero goal traction force.
 SOCIAL_FORCES_MAX_INTERACTION_DISTANCE = 2.0  # [m] maximal distance between agents for interaction force.
+SOCIAL_FORCES_NEIGHBOUR_DISTANCE = 4.0  # [m] maximal distance for simulating ados as neighbours (partial).
 
 POTENTIAL_FIELD_V0_DEFAULT = 2.0, 1.0  # [m2s-2] repulsive field constant (mean/variance).
 POTENTIAL_FIELD_MAX_THETA = 30.0  # [deg] maximal attention angle to be influenced by robot
@@ -61,27 +66,79 @@ TRAJECTRON_DEFAULT_HISTORY_LENGTH = 5
 
 SGAN_MODEL = "models/sgan-models/eth_8_model.pt"
 
+SURROGATE_DIRECTORY = "third_party/surrogate"  # directory of distilled surrogate models ({teacher}.pt).
+SURROGATE_TEACHER_DEFAULT = "trajectron"  # environment surrogate model is distilled from by default.
+SURROGATE_HORIZON = 20  # maximal prediction horizon of surrogate model.
+SURROGATE_HISTORY = 4  # number of (past and current) ado velocities as surrogate model input.
+SURROGATE_HIDDEN_SIZE = 64  # number of neurons per hidden layer of surrogate model.
+SURROGATE_LEARNING_RATE = 1e-3  # learning rate for distilling surrogate model.
+SURROGATE_EPOCHS = 100  # number of training epochs for distilling surrogate model.
+SURROGATE_BATCH_SIZE = 256  # number of (per-ado) samples per training batch.
+SURROGATE_SAMPLES_PER_SCENE = 50  # number of random ego trajectories per scene in distillation dataset.
+
 #######################################
 # solver parameters ###################
 #######################################
 SOLVER_HORIZON_DEFAULT = 5  # number of future time-steps to be taken into account
 SOLVER_CONSTRAINT_LIMIT = 1e-3  # limit of sum of constraints to be fulfilled
 SOLVER_GOAL_END_DISTANCE = 0.5  # [m] maximal distance to goal to finish optimization.
+SOLVER_DEADLINE_MARGIN = 0.03  # [s] safety margin for returning from the optimization before the deadline.
 
 WARM_START_HARD = "hard"  # warm-starting methods
 WARM_START_ENCODING = "encoding"
 WARM_START_SOFT = "soft"
 WARM_START_POTENTIAL = "potential"
 WARM_START_ZEROS = "zeros"
+WARM_START_STRAIGHT = "straight"
+WARM_START_SURROGATE = "surrogate"
 
 WARM_START_PRE_COMPUTATION_NUM = 100  # number of randomly pre-computed scenarios.
 WARM_START_PRE_COMPUTATION_HORIZON = 10  # pre-computed time-horizon.
 WARM_START_PRE_COMPUTATION_FILE = ("encoding.pt", "solution.pt")
+WARM_START_PRE_COMPUTATION_DIRECTORY = "third_party/warm_start"
+WARM_START_PRE_COMPUTATION_INDEX_FILE = "index.pt"  # meta-data of pre-computed scenarios (env type, #ados).
+WARM_START_PRE_COMPUTATION_SHARD_SIZE = 50  # number of scenarios solved and checkpointed per process job.
+WARM_START_ENCODING_VERSION = 2  # scene encoding version (1 = closest ado, 2 = k-closest ados).
+WARM_START_ENCODING_NUM_ADOS = 3  # number of closest ados in scene encoding (version 2).
+WARM_START_ENCODING_PADDING = 20.0  # [m] encoded position of missing ados (less ados in scene than encoded).
 
 IPOPT_MAX_CPU_TIME_DEFAULT = 2.0  # [s] maximal IPOPT solver CPU time.
 IPOPT_OPTIMALITY_TOLERANCE = 0.1  # maximal optimality error to return solution (see IPOPT documentation).
 IPOPT_AUTOMATIC_JACOBIAN = "finite-difference-values"  # method for Jacobian approximation (if flag is True).
+IPOPT_EXACT_JACOBIAN = "exact"  # use Jacobian callback (if approximation flag is False).
 IPOPT_AUTOMATIC_HESSIAN = "limited-memory"  # method for Hessian approximation.
+IPOPT_EXACT_HESSIAN = "exact"  # use Hessian callback (Gauss-Newton approximation of modules, if flag is True).
+IPOPT_MU_INIT_DEFAULT = 0.1  # initial barrier parameter (IPOPT's default).
+IPOPT_WARM_START_MU_INIT = 1e-4  # initial barrier parameter when warm-starting primal and dual variables.
+IPOPT_WARM_START_PUSH = 1e-6  # bound push/fraction of initial point and multipliers when warm-starting.
+IPOPT_STATUS_SOLVED = [0, 1]  # IPOPT return status (solved to (acceptable) optimality), other = not converged.
+
+AUGLAG_MAX_CPU_TIME_DEFAULT = 2.0  # [s] maximal augmented lagrangian solver CPU time.
+AUGLAG_MAX_OUTER_ITERATIONS = 10  # maximal number of multiplier updates.
+AUGLAG_MAX_INNER_ITERATIONS = 30  # maximal number of projected L-BFGS iterations per multiplier update.
+AUGLAG_LBFGS_HISTORY = 10  # number of stored curvature pairs for L-BFGS hessian approximation.
+AUGLAG_OPTIMALITY_TOLERANCE = 1e-3  # maximal projected gradient (inf-norm) to terminate inner minimization.
+AUGLAG_MIN_STEP_SIZE = 1e-4  # minimal step size of backtracking line search.
+AUGLAG_PENALTY_INITIAL = 10.0  # initial penalty parameter of augmented lagrangian.
+AUGLAG_PENALTY_GROWTH = 10.0  # penalty parameter growth factor, if violation is not decreasing sufficiently.
+AUGLAG_VIOLATION_DECREASE = 0.25  # minimal relative decrease of constraint violation per multiplier update.
+
+ILQR_MAX_ITERATIONS = 20  # maximal number of iLQR iterations per multiplier update.
+ILQR_REGULARIZATION_INITIAL = 1e-3  # initial (Levenberg-Marquardt) regularization of control hessian.
+ILQR_REGULARIZATION_MIN = 1e-6  # lower bound of control hessian regularization.
+ILQR_REGULARIZATION_MAX = 1e3  # upper bound of control hessian regularization (terminate when exceeded).
+ILQR_REGULARIZATION_FACTOR = 10.0  # regularization increase/decrease factor after rejected/accepted iterations.
+ILQR_LINE_SEARCH_STEPS = 6  # number of (halving) step sizes of line search.
+ILQR_CONVERGENCE_TOLERANCE = 1e-5  # minimal relative merit improvement per iLQR iteration.
+
+SQP_MAX_ITERATIONS = 10  # maximal number of (trust region) iterations, i.e. linearizations of the prediction.
+SQP_TRUST_REGION_INITIAL = 1.0  # initial trust region radius (inf-norm in controls).
+SQP_TRUST_REGION_MIN = 1e-3  # minimal trust region radius (terminate when undershot).
+SQP_TRUST_REGION_MAX = 10.0  # maximal trust region radius.
+SQP_ACCEPTANCE_RATIO = 0.1  # minimal ratio of actual to predicted merit decrease to accept a step.
+SQP_EXPANSION_RATIO = 0.75  # minimal ratio of actual to predicted merit decrease to expand the trust region.
+SQP_MERIT_PENALTY = 10.0  # weight of (l1) constraint violation in merit function.
+SQP_CONVERGENCE_TOLERANCE = 1e-4  # minimal relative merit decrease predicted by local problem.
 
 SEARCH_MAX_CPU_TIME = 0.5  # [s] maximal CPU time of search algorithm.
 MCTS_NUMBER_BREADTH_SAMPLES = 2  # number of samples in breadth (i.e. z-values to estimate value from).
@@ -3,5 +3,7 @@ import mantrap.environment.base
 from mantrap.environment.social_forces import SocialForcesEnvironment
 from mantrap.environment.trajectron import Trajectron
 from mantrap.environment.sgan import SGAN
+from mantrap.environment.surrogate import SurrogateEnvironment
+from mantrap.environment.batched import BatchedEnvironment
 from mantrap.environment.simplified.kalman import KalmanEnvironment
 from mantrap.environment.simplified.potential_field import PotentialFieldEnvironment
@@ -1,5 +1,6 @@
 import abc
 import logging
+import multiprocessing
 import typing
 
 import numpy as np
@@ -11,6 +12,9 @@ import mantrap.constants
 import mantrap.utility.shaping
 
 
+_BATCH_PREDICTIONS = {}  # environment and arguments of batched prediction, shared with worker processes by forking
+
+
 class GraphBasedEnvironment(abc.ABC):
     """General environment engine for obstacle-free, interaction-aware, probabilistic and multi-modal agent
     environments. As used in a robotics use-case the environment separates between the ego-agent (the robot) and
@@ -187,7 +191,7 @@ class GraphBasedEnvironment(abc.ABC):
 
         # Otherwise predict the conditioned distribution and draw samples from them.
         dist_dict = self.compute_distributions(ego_trajectory=ego_trajectory)
-        samples = torch.stack([dist_dict[ado_id].sample((num_samples, )) for ado_id in self.ado_ids])
+        samples = dist_dict.sample((num_samples, ))
         assert mantrap.utility.shaping.check_ado_samples(samples, t_horizon, self.num_ados, num_samples)
 
         # Integrate velocity samples to positions (trajectory).
@@ -212,7 +216,7 @@ class GraphBasedEnvironment(abc.ABC):
 
         # Otherwise predict the un_conditioned distribution and draw samples from them.
         dist_dict = self.compute_distributions_wo_ego(t_horizon=t_horizon)
-        samples = torch.stack([dist_dict[ado_id].sample((num_samples,)) for ado_id in self.ado_ids])
+        samples = dist_dict.sample((num_samples, ))
         assert mantrap.utility.shaping.check_ado_samples(samples, t_horizon, self.num_ados, num_samples)
 
         # Integrate velocity samples to positions (trajectory).
@@ -253,7 +257,7 @@ class GraphBasedEnvironment(abc.ABC):
 
         # Otherwise predict the un_conditioned distribution and draw samples from them.
         dist_dict = self.compute_distributions(ego_trajectory=ego_trajectory)
-        means = torch.stack([dist_dict[ado_id].mean for ado_id in self.ado_ids])
+        means = dist_dict.mean
 
         # Integrate velocity means to positions (trajectory).
         _, ado_states = self.states()
@@ -277,7 +281,7 @@ class GraphBasedEnvironment(abc.ABC):
 
         # Otherwise predict the un_conditioned distribution and draw samples from them.
         dist_dict = self.compute_distributions_wo_ego(t_horizon=t_horizon)
-        means = torch.stack([dist_dict[ado_id].mean for ado_id in self.ado_ids])
+        means = dist_dict.mean
 
         # Integrate velocity means to positions (trajectory).
         _, ado_states = self.states()
@@ -359,8 +363,9 @@ class GraphBasedEnvironment(abc.ABC):
     ###########################################################################
     # Simulation graph ########################################################
     ###########################################################################
-    def compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True, **kwargs
-                              ) -> typing.Dict[str, torch.distributions.Distribution]:
+    def compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True,
+                              ado_ids: typing.List[str] = None, **kwargs
+                              ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a dictionary of velocity distributions for every ado as it would be with the presence
         of a robot in the scene.
 
@@ -369,20 +374,35 @@ class GraphBasedEnvironment(abc.ABC):
         by building the dictionary using PyTorch, a computational graph is built in the background which can later
         be used for automatically differentiate between its inputs and outputs.
 
+        When only the distributions of some ados are required, e.g. the ones filtered by an attention module,
+        the prediction can be restricted to these ados by passing their `ado_ids`. Then only these ados and the
+        ados they are interacting with (see `interacting_ado_ids()`) are simulated.
+
         :param ego_trajectory: ego's trajectory (t_horizon, 5).
         :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for, by default all ados in the scene.
         :kwargs: additional graph building arguments.
-        :return: dictionary over every state of every agent in the scene for t in [0, t_horizon].
+        :return: batched distribution of every ado (in the order of `ado_ids`) for t in [0, t_horizon], which can
+                 be used as ado_id-keyed distribution dictionary as well.
         """
         assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory, pos_and_vel_only=True)
         assert self.ego is not None
-        dist_dict = self._compute_distributions(ego_trajectory=ego_trajectory, vel_dist=vel_dist, **kwargs)
-        assert self.check_distribution(dist_dict, t_horizon=ego_trajectory.shape[0] - 1)
+        if ado_ids is None:
+            dist_dict = self._compute_distributions(ego_trajectory=ego_trajectory, vel_dist=vel_dist, **kwargs)
+            assert self.check_distribution(dist_dict, t_horizon=ego_trajectory.shape[0] - 1)
+            return dist_dict
+
+        # Partial prediction, environments may return the distributions of the interacting ados as well.
+        assert all([ado_id in self.ado_ids for ado_id in ado_ids])
+        dist_dict = self._compute_distributions(ego_trajectory=ego_trajectory, vel_dist=vel_dist,
+                                                ado_ids=self.interacting_ado_ids(ado_ids), **kwargs)
+        dist_dict = dist_dict.subset(ado_ids)
+        assert self.check_distribution(dist_dict, t_horizon=ego_trajectory.shape[0] - 1, ado_ids=ado_ids)
         return dist_dict
 
     @abc.abstractmethod
     def _compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True, **kwargs
-                               ) -> typing.Dict[str, torch.distributions.Distribution]:
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph based on the ego's trajectory.
 
         The graph should span over the time-horizon of the length of the ego's trajectory and contain the
@@ -390,21 +410,187 @@ class GraphBasedEnvironment(abc.ABC):
         possible the graph should be differentiable, such that finding some gradient between the outputted ado
         states and the inputted ego trajectory is determinable.
 
+        If an `ado_ids` keyword argument is passed, it is sufficient to compute the distributions for these ados
+        only, which already include all ados they are interacting with.
+
         :param ego_trajectory: ego's trajectory (t_horizon, 5).
         :param vel_dist: return velocity (True) or positional distribution (False).
         :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
         """
         raise NotImplementedError
 
+    def compute_distributions_with_jacobian(self, ego_controls: torch.Tensor, vel_dist: bool = True,
+                                            ado_ids: typing.List[str] = None, finite_differences: bool = False,
+                                            **kwargs
+                                            ) -> typing.Union[typing.Tuple[mantrap.utility.maths.MultiAgentDistribution,
+                                                                           torch.Tensor, torch.Tensor], None]:
+        """Build the distributions conditioned on the ego's controls, together with the jacobian of their means
+        and scales w.r.t. the ego's controls.
+
+        In contrast to `compute_distributions()` no computation graph is built, since the jacobian is derived
+        analytically by the environment. Since this is not possible for every environment (e.g. for learned
+        prediction models), None is returned if the environment does not support it. If demanded, the
+        jacobian of uni-modal environments is approximated by finite differences instead (see
+        `compute_jacobian_finite_differences()`), which requires 4 * t_horizon + 1 predictions.
+
+        :param ego_controls: ego's control inputs (t_horizon, 2).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for, by default all ados in the scene.
+        :param finite_differences: approximate the jacobian by finite differences, if it cannot be derived
+                                   analytically (uni-modal environments only).
+        :kwargs: additional graph building arguments.
+        :return: batched distribution of every ado (in the order of `ado_ids`) for t in [0, t_horizon].
+        :return: jacobian of distribution means w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        :return: jacobian of distribution scales w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        """
+        assert mantrap.utility.shaping.check_ego_controls(ego_controls)
+        assert self.ego is not None
+        ado_ids = self.ado_ids if ado_ids is None else ado_ids
+        assert all([ado_id in self.ado_ids for ado_id in ado_ids])
+
+        output = self._compute_distributions_with_jacobian(ego_controls, vel_dist=vel_dist, ado_ids=ado_ids, **kwargs)
+        if output is None and finite_differences and self.num_modes == 1:
+            output = self.compute_jacobian_finite_differences(ego_controls, vel_dist=vel_dist, ado_ids=ado_ids,
+                                                              **kwargs)
+        if output is None:
+            return None
+        dist_dict, mean_jacobian, scale_jacobian = output
+        t_horizon, num_controls = ego_controls.shape[0], ego_controls.numel()
+        assert self.check_distribution(dist_dict, t_horizon=t_horizon, ado_ids=ado_ids)
+        assert mean_jacobian.shape == (len(ado_ids), t_horizon, 1, 2, num_controls)
+        assert scale_jacobian.shape == (len(ado_ids), t_horizon, 1, 2, num_controls)
+        return dist_dict, mean_jacobian, scale_jacobian
+
+    def _compute_distributions_with_jacobian(self, ego_controls: torch.Tensor, vel_dist: bool = True,
+                                             ado_ids: typing.List[str] = None, **kwargs):
+        """Build the distributions conditioned on the ego's controls and their analytic jacobian w.r.t. the
+        ego's controls, for the given ados only (see `compute_distributions_with_jacobian()`).
+
+        By default the jacobian cannot be derived analytically, therefore return None.
+        """
+        return None
+
+    def compute_jacobian_finite_differences(
+        self, ego_controls: torch.Tensor, vel_dist: bool = True, ado_ids: typing.List[str] = None,
+        step: float = mantrap.constants.ENV_FINITE_DIFFERENCE_STEP,
+        num_workers: int = mantrap.constants.ENV_FINITE_DIFFERENCE_NUM_WORKERS, **kwargs
+    ) -> typing.Tuple[mantrap.utility.maths.MultiAgentDistribution, torch.Tensor, torch.Tensor]:
+        """Build the distributions conditioned on the ego's controls, together with the jacobian of their means
+        and scales w.r.t. the ego's controls, approximated by central finite differences.
+
+        Instead of perturbing one control at a time (and predicting sequentially), the ego trajectories for all
+        2 * t_horizon * 2 perturbed controls are predicted within one batched prediction call (see
+        `compute_distributions_batched()`), based on common random numbers. Thereby the differences of the
+        (sampling-based) predictions are solely due to the perturbations, not due to sampling noise.
+
+        :param ego_controls: ego's control inputs (t_horizon, 2).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for, by default all ados in the scene.
+        :param step: perturbation of every control input.
+        :param num_workers: number of worker processes for the batched prediction (1 = no multiprocessing).
+        :kwargs: additional graph building arguments.
+        :return: distribution of every ado (in the order of `ado_ids`) for t in [0, t_horizon].
+        :return: jacobian of distribution means w.r.t. controls (num_ados, t_horizon, num_modes, 2, t_horizon * 2).
+        :return: jacobian of distribution scales w.r.t. controls (num_ados, t_horizon, num_modes, 2, t_horizon * 2).
+        """
+        assert mantrap.utility.shaping.check_ego_controls(ego_controls)
+        num_controls = ego_controls.numel()
+
+        with torch.no_grad():
+            perturbations = torch.eye(num_controls) * step
+            perturbations = torch.cat((torch.zeros((1, num_controls)), perturbations, -perturbations))
+            controls = ego_controls.detach().flatten().unsqueeze(dim=0) + perturbations
+            controls = controls.view(-1, *ego_controls.shape)
+            ego_trajectories = torch.stack([self.ego.unroll_trajectory(u, dt=self.dt) for u in controls])
+            dist_dicts = self.compute_distributions_batched(ego_trajectories, vel_dist=vel_dist, ado_ids=ado_ids,
+                                                            num_workers=num_workers, **kwargs)
+
+            means = torch.stack([dist_dict.mean for dist_dict in dist_dicts[1:]], dim=-1)
+            scales = torch.stack([dist_dict.stddev for dist_dict in dist_dicts[1:]], dim=-1)
+            mean_jacobian = (means[..., :num_controls] - means[..., num_controls:]) / (2 * step)
+            scale_jacobian = (scales[..., :num_controls] - scales[..., num_controls:]) / (2 * step)
+
+        return dist_dicts[0], mean_jacobian, scale_jacobian
+
+    def compute_distributions_batched(self, ego_trajectories: torch.Tensor, vel_dist: bool = True,
+                                      ado_ids: typing.List[str] = None,
+                                      num_workers: int = mantrap.constants.ENV_FINITE_DIFFERENCE_NUM_WORKERS,
+                                      **kwargs) -> typing.List[mantrap.utility.maths.MultiAgentDistribution]:
+        """Build the distributions conditioned on each of several ego trajectories (see `compute_distributions()`).
+
+        All predictions are based on common random numbers, i.e. each prediction starts from the same state of
+        the random number generator, so that the predictions of sampling-based environments merely differ due
+        to the different ego trajectories. The global random number generator merely is advanced once.
+
+        :param ego_trajectories: ego's trajectories (batch_size, t_horizon + 1, 5).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for, by default all ados in the scene.
+        :param num_workers: number of worker processes (1 = no multiprocessing, None = number of cores).
+        :kwargs: additional graph building arguments.
+        :return: batched distribution of every ado for every ego trajectory.
+        """
+        assert len(ego_trajectories.shape) == 3
+        assert all([mantrap.utility.shaping.check_ego_trajectory(x, pos_and_vel_only=True) for x in ego_trajectories])
+        assert self.ego is not None
+        ado_ids_sim = None if ado_ids is None else self.interacting_ado_ids(ado_ids)
+        assert ado_ids is None or all([ado_id in self.ado_ids for ado_id in ado_ids])
+
+        seed = int(torch.randint(2 ** 31, size=(1, )).item())
+        dist_dicts = self._compute_distributions_batched(ego_trajectories, vel_dist=vel_dist, ado_ids=ado_ids_sim,
+                                                         seed=seed, num_workers=num_workers, **kwargs)
+        assert len(dist_dicts) == ego_trajectories.shape[0]
+
+        t_horizon = ego_trajectories.shape[1] - 1
+        if ado_ids is not None:
+            dist_dicts = [dist_dict.subset(ado_ids) for dist_dict in dist_dicts]
+        assert all([self.check_distribution(x, t_horizon=t_horizon, ado_ids=ado_ids) for x in dist_dicts])
+        return dist_dicts
+
+    def _compute_distributions_batched(self, ego_trajectories: torch.Tensor, vel_dist: bool = True,
+                                       ado_ids: typing.List[str] = None, seed: int = 0, num_workers: int = 1,
+                                       **kwargs) -> typing.List[mantrap.utility.maths.MultiAgentDistribution]:
+        """Build the distributions conditioned on each of several ego trajectories, based on common random
+        numbers (see `compute_distributions_batched()`), for the given (interacting) ados.
+
+        By default every trajectory is predicted individually, re-seeding the random number generator with the
+        `seed` before every prediction, either sequentially or distributed over a (forked) process pool.
+        Environments which can predict a batch of ego trajectories at once should override this method.
+        """
+        _BATCH_PREDICTIONS["args"] = (self, vel_dist, ado_ids, seed, kwargs)
+        try:
+            with torch.random.fork_rng():
+                if num_workers == 1:
+                    dist_dicts = [_predict_batch_element(x) for x in ego_trajectories]
+                else:
+                    pool_kwargs = {"initializer": torch.set_num_threads, "initargs": (1, )}  # avoid over-subscription
+                    with multiprocessing.get_context("fork").Pool(processes=num_workers, **pool_kwargs) as pool:
+                        dist_dicts = pool.map(_predict_batch_element, ego_trajectories)
+        finally:
+            del _BATCH_PREDICTIONS["args"]
+        return dist_dicts
+
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """Determine the ados that have to be simulated in order to predict the behaviour of the given ados,
+        i.e. the given ados themselves and all ados they are interacting with.
+
+        By default every ado might interact with every other ado in the scene, so that all ados are returned.
+        Environments with local (or without) interactions between ados should override this method.
+
+        :param ado_ids: ids of ados to predict.
+        :return: ids of ados to simulate, in the order of the internal ado list.
+        """
+        return self.ado_ids
+
     def compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                     ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                     ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a dictionary of velocity distributions for every ado as it would be without the presence
         of a robot in the scene.
 
         :param t_horizon: number of prediction time-steps.
         :param vel_dist: return velocity (True) or positional distribution (False).
         :kwargs: additional graph building arguments.
-        :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
+        :return: batched velocity distribution of every ado for times [0, t_horizon], which can be used as
+                 ado_id-keyed distribution dictionary as well.
         """
         assert t_horizon > 0
         dist_dict = self._compute_distributions_wo_ego(t_horizon, vel_dist=vel_dist, **kwargs)
@@ -413,7 +599,7 @@ class GraphBasedEnvironment(abc.ABC):
 
     @abc.abstractmethod
     def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                      ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph over `t_horizon` time-steps for ados only (exclude robot).
 
         The graph should span over the time-horizon of the inputted number of time-steps and contain the
@@ -427,11 +613,15 @@ class GraphBasedEnvironment(abc.ABC):
         """
         raise NotImplementedError
 
-    def check_distribution(self, distribution: typing.Dict[str, torch.distributions.Distribution], t_horizon: int):
-        """Check the distribution dictionary for correctness."""
-        assert all([ado_id in distribution.keys() for ado_id in self.ado_ids])
-        assert all([distribution[ado_id].mean.shape[0] == t_horizon for ado_id in self.ado_ids])
-        assert all([distribution[ado_id].mean.shape[-1] == 2 for ado_id in self.ado_ids])
+    def check_distribution(self, distribution: mantrap.utility.maths.MultiAgentDistribution, t_horizon: int,
+                           ado_ids: typing.List[str] = None):
+        """Check the distribution for correctness (for the given ados, by default all ados), i.e. whether it
+        describes exactly the given ados in the given order."""
+        ado_ids = self.ado_ids if ado_ids is None else ado_ids
+        assert isinstance(distribution, mantrap.utility.maths.MultiAgentDistribution)
+        assert distribution.ids == ado_ids
+        assert distribution.mean.shape[1] == t_horizon
+        assert distribution.mean.shape[-1] == 2
         return True
 
     def detach(self):
@@ -444,7 +634,7 @@ class GraphBasedEnvironment(abc.ABC):
     ###########################################################################
     # Operators ###############################################################
     ###########################################################################
-    def copy(self, env_type: 'GraphBasedEnvironment'.__class__ = None) -> 'GraphBasedEnvironment':
+    def copy(self, env_type: 'GraphBasedEnvironment'.__class__ = None, **env_kwargs) -> 'GraphBasedEnvironment':
         """Create copy of environment.
 
         However just using deepcopy is not supported for tensors that are not detached from the PyTorch
@@ -453,7 +643,8 @@ class GraphBasedEnvironment(abc.ABC):
 
         While copying the environment-type can be defined by the user, which is possible due to standardized
         class interface of every environment-type. When no environment is defined, the default environment
-        will be used which is the type of the executing class object.
+        will be used which is the type of the executing class object. Additional keyword arguments are passed
+        to the constructor of the environment copy (environment-type specific parameters).
         """
         env_type = env_type if env_type is not None else self.__class__
 
@@ -469,7 +660,8 @@ class GraphBasedEnvironment(abc.ABC):
                 history = self.ego.history
                 ego_kwargs = {"ego_position": position, "ego_velocity": velocity, "ego_history": history}
 
-            env_copy = env_type(**ego_kwargs, ego_type=ego_type, dt=self.dt, time=self.time, **self._env_params)
+            env_copy = env_type(**ego_kwargs, ego_type=ego_type, dt=self.dt, time=self.time, **self._env_params,
+                                **env_kwargs)
 
             # Add internal ado agents to newly created environment.
             for ado in self.ados:
@@ -480,6 +672,39 @@ class GraphBasedEnvironment(abc.ABC):
         assert env_copy.sanity_check()
         return env_copy
 
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        """Capture the current state of the environment, in order to be able to rewind it later on (`restore()`).
+
+        In contrast to `copy()` neither the environment nor its agents are re-created, merely the state
+        tensors (states and histories of all agents, environment time) are stored, so that creating a snapshot
+        and restoring it is cheap, in the order of the size of the state.
+
+        :returns: environment snapshot, to be passed to `restore()`.
+        """
+        def agent_snapshot(agent: mantrap.agents.base.DTAgent) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+            return agent.state_with_time.detach().clone(), agent.history.detach().clone()
+
+        return {"time": self._time,
+                "ego": agent_snapshot(self._ego) if self._ego is not None else None,
+                "ados": [agent_snapshot(ado) for ado in self._ados],
+                "ado_list": list(self._ados),
+                "ado_ids": list(self._ado_ids)}
+
+    def restore(self, snapshot: typing.Dict[str, typing.Any]):
+        """Restore the environment to the state captured in the `snapshot` (see `snapshot()`).
+
+        :param snapshot: environment snapshot, created by this environment's `snapshot()` method.
+        """
+        self._time = snapshot["time"]
+        self._ados = list(snapshot["ado_list"])
+        self._ado_ids = list(snapshot["ado_ids"])
+
+        if snapshot["ego"] is not None:
+            self._ego.reset(state=snapshot["ego"][0].clone(), history=snapshot["ego"][1].clone())
+        for ado, (state, history) in zip(self._ados, snapshot["ados"]):
+            ado.reset(state=state.clone(), history=history.clone())
+        assert self.sanity_check()
+
     def same_initial_conditions(self, other: 'GraphBasedEnvironment'):
         """Similar to __eq__() function, but not enforcing parameters of environment to be completely equivalent,
         merely enforcing the initial conditions to be equal, such as states of agents in scene. Hence, all prediction
@@ -636,3 +861,13 @@ class GraphBasedEnvironment(abc.ABC):
     @property
     def is_differentiable_wrt_ego(self) -> bool:
         raise NotImplementedError
+
+
+def _predict_batch_element(ego_trajectory: torch.Tensor) -> mantrap.utility.maths.MultiAgentDistribution:
+    """Predict a single element of a batched prediction (see `_compute_distributions_batched()`)."""
+    env, vel_dist, ado_ids, seed, kwargs = _BATCH_PREDICTIONS["args"]
+    torch.manual_seed(seed)
+    if ado_ids is not None:
+        kwargs = {**kwargs, "ado_ids": ado_ids}
+    with torch.no_grad():
+        return env._compute_distributions(ego_trajectory, vel_dist=vel_dist, **kwargs)
@@ -6,6 +6,7 @@ import torch.distributions
 
 import mantrap.agents
 import mantrap.constants
+import mantrap.utility.maths
 import mantrap.utility.shaping
 
 from .graph_based import GraphBasedEnvironment
@@ -18,6 +19,7 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
                          num_particles: int,
                          param_dicts: typing.Dict[str, typing.Dict[str, typing.Dict]] = None,
                          const_dicts: typing.Dict[str, typing.Dict[str, typing.Any]] = None,
+                         ado_ids: typing.List[str] = None,
                          **particle_kwargs
                          ) -> typing.Tuple[typing.List[typing.List[mantrap.agents.IntegratorDTAgent]], torch.Tensor]:
         """Create particles from internal parameter distribution.
@@ -34,13 +36,13 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
                             {param_name: {ado_id: (mean, variance)}, ....}
         :param const_dicts: dictionary mapping ado-wise constant parameters to parameter name.
                             {ado_id: {param_name: values}, ....}
-        :return: list of N = num_particles for every ado in the scene.
+        :param ado_ids: ids of ados to create particles for, by default all ados in the scene. The parameters
+                        are sampled for every ado nevertheless, to be independent from the selection.
+        :return: list of N = num_particles for every (selected) ado in the scene.
         :return: probability (pdf) of each particle (num_ados, num_particles).
         """
         particles = []
-        num_params = len(param_dicts.keys())
-        samples = torch.zeros((self.num_ados, num_params, num_particles))
-        pdfs = torch.zeros((self.num_ados, num_params, num_particles))
+        samples, particle_pdf = self.sample_parameters(num_particles, param_dicts=param_dicts)
         for m_ado, ado in enumerate(self.ados):
             ado_id = ado.id
 
@@ -50,19 +52,10 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
                 assert ado_id in const_dicts.keys()
                 const_params = const_dicts[ado_id]
 
-            # Build and sample from parameter distribution for each parameter assigned to the current ado.
-            for ip, (p_key, p_dict) in enumerate(param_dicts.items()):
-                assert all([ado_id in p_dict.keys() for ado_id in self.ado_ids])
-                p_values = p_dict[ado_id]
-                assert len(p_values) == 2  # (mean, variance) of distribution
-                loc, scale = p_values
-                distribution = torch.distributions.Normal(loc=loc, scale=scale)
-                sample_n = distribution.sample((num_particles, ))
-                samples[m_ado, ip, :] = sample_n
-                pdfs[m_ado, ip, :] = distribution.cdf(sample_n)
-
             # Initialize ado particles. Unfortunately, this operation cannot be further batched  since the
             # particle initialization __init__ call does only allow to create one class object.
+            if ado_ids is not None and ado_id not in ado_ids:
+                continue
             ado_particles = []
             for n in range(num_particles):
                 particle_params = {p_key: samples[m_ado, ip, n] for ip, p_key in enumerate(param_dicts.keys())}
@@ -73,10 +66,39 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
                 ado_particles.append(particle)
             particles.append(ado_particles)
 
+        return particles, particle_pdf
+
+    def sample_parameters(self, num_particles: int, param_dicts: typing.Dict[str, typing.Dict[str, typing.Dict]]
+                          ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Sample particle parameters from the internal (independent, uni-modal Gaussian) parameter distributions,
+        for every ado in the scene.
+
+        :param num_particles: number of particles per ado.
+        :param param_dicts: parameter dictionaries for varying parameters between particles.
+                            {param_name: {ado_id: (mean, variance)}, ....}
+        :return: sampled parameters (num_ados, num_params, num_particles), in the order of the `param_dicts`.
+        :return: probability (pdf) of each particle (num_ados, num_particles).
+        """
+        num_params = len(param_dicts.keys())
+        samples = torch.zeros((self.num_ados, num_params, num_particles))
+        pdfs = torch.zeros((self.num_ados, num_params, num_particles))
+        for m_ado, ado_id in enumerate(self.ado_ids):
+
+            # Build and sample from parameter distribution for each parameter assigned to the current ado.
+            for ip, (p_key, p_dict) in enumerate(param_dicts.items()):
+                assert all([ado_id in p_dict.keys() for ado_id in self.ado_ids])
+                p_values = p_dict[ado_id]
+                assert len(p_values) == 2  # (mean, variance) of distribution
+                loc, scale = p_values
+                distribution = torch.distributions.Normal(loc=loc, scale=scale)
+                sample_n = distribution.sample((num_particles, ))
+                samples[m_ado, ip, :] = sample_n
+                pdfs[m_ado, ip, :] = distribution.cdf(sample_n)
+
         # Under the assumption of independence of parameters (which is given by independent sampling here, just
         # assuming the parameters itself are independent), we calculate each particles pdf by multiplying their
         # parameters probability densities.
-        return particles, torch.prod(pdfs, dim=1)
+        return samples, torch.prod(pdfs, dim=1)
 
     @abc.abstractmethod
     def simulate_particle(self,
@@ -97,8 +119,8 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
     ###########################################################################
     def _compute_distributions(self, ego_trajectory: typing.Union[typing.List, torch.Tensor],
                                num_particles: int = mantrap.constants.ENV_NUM_PARTICLES,
-                               vel_dist: bool = True, **kwargs
-                               ) -> typing.Dict[str, torch.distributions.Distribution]:
+                               vel_dist: bool = True, ado_ids: typing.List[str] = None, **kwargs
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph based on the ego's trajectory.
 
         The graph should span over the time-horizon of the length of the ego's trajectory and contain the
@@ -128,16 +150,22 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
         note: however the mean values are the same anyway, which are used for computing the subsequent distributions
         (https://stats.stackexchange.com/questions/186463/distribution-of-difference-between-two-normal-distributions).
 
+        When only a subset of ados is simulated (`ado_ids`), the remaining ados are assumed to keep their
+        current velocity, as they might still be required to simulate the interactions with the simulated ados.
+
         :param ego_trajectory: ego's trajectory (t_horizon, 5).
         :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to simulate, by default all ados in the scene.
         :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
         """
         if not all([x is None for x in ego_trajectory]):
             assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory, pos_and_vel_only=True)
         t_horizon = len(ego_trajectory) - 1  # works for list and torch.Tensor (!)
+        ado_ids = self.ado_ids if ado_ids is None else ado_ids
+        sim_indices = [m_ado for m_ado, ado_id in enumerate(self.ado_ids) if ado_id in ado_ids]
 
         # Create particles using the environment-specific method.
-        particles, particle_pdf = self.create_particles(num_particles=num_particles, **kwargs)
+        particles, particle_pdf = self.create_particles(num_particles=num_particles, ado_ids=ado_ids, **kwargs)
         particle_pdf = (particle_pdf / torch.norm(particle_pdf, dim=0)).unsqueeze(dim=2).detach()  # normalize
 
         # For each time-step predict the next distribution by simulating several particles and averaging
@@ -151,14 +179,14 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
         for t in range(t_horizon - 1):
             ego_state_t = ego_trajectory[t]
             ado_states_t = mus[:, t, 0, :]
-            velocities_t = torch.zeros((self.num_ados, num_particles, 2))
+            velocities_t = mus[:, t, 0, 2:4].unsqueeze(dim=1).repeat(1, num_particles, 1)  # constant velocity
 
-            # Simulate and update the particles for each ado in the scene and the current time-step.
-            for m_ado in range(self.num_ados):
-                particles_ado = particles[m_ado]
+            # Simulate and update the particles for each (simulated) ado in the scene and the current time-step.
+            for i_sim, m_ado in enumerate(sim_indices):
+                particles_ado = particles[i_sim]
                 for m_particle, particle in enumerate(particles_ado):
-                    particles[m_ado][m_particle] = self.simulate_particle(particle, ado_states_t, ego_state_t)
-                    velocities_t[m_ado, m_particle, :] = particles[m_ado][m_particle].velocity
+                    particles[i_sim][m_particle] = self.simulate_particle(particle, ado_states_t, ego_state_t)
+                    velocities_t[m_ado, m_particle, :] = particles[i_sim][m_particle].velocity
 
             # By adding a tiny amount of white gaussian noise we avoid troubles with zero variance
             # (e.g. in Potential Field Environment with uni-directional interactions).
@@ -168,22 +196,22 @@ class ParticleEnvironment(GraphBasedEnvironment, abc.ABC):
             # all updated particles. Then compute the mean of the velocity distribution from that.
             # Weight the position estimate of each particle with their probability occurring in the initial
             # distribution they have been sampled from.
-            velocities_t_pdf = velocities_t * particle_pdf
+            velocities_t_pdf = velocities_t.clone()
+            velocities_t_pdf[sim_indices] = velocities_t[sim_indices] * particle_pdf[sim_indices]
 
             mus[:, t + 1, 0, 2:4] = torch.mean(velocities_t_pdf, dim=1)
             mus[:, t + 1, 0, 0:2] = mus[:, t, 0, 0:2] + mus[:, t, 0, 2:4] * self.dt  # single integrator (!)
-            sigmas[:, t + 1, 0, :] = torch.var(velocities_t_pdf, dim=1)
+            sigmas_t = torch.var(velocities_t_pdf, dim=1)
+            sigmas[:, t + 1, 0, :] = sigmas_t.clamp(min=mantrap.constants.ENV_PARTICLE_VAR_MIN)
 
-        # Transform mus and sigmas to velocity gaussian distribution objects dictionary
+        # Transform mus and sigmas to a batched velocity gaussian distribution of the simulated ados
         # (hint: same order of ado_ids and ados() have been ensured in sanity_check() !).
-        means = mus[:, :, :, 2:4] if vel_dist else mus[:, :, :, 0:2]
-        dist_dict = {ado_id: torch.distributions.Normal(loc=means[m_ado, :, :, :], scale=sigmas[m_ado, :, :, :])
-                     for m_ado, ado_id in enumerate(self.ado_ids)}
-
-        return dist_dict
+        means = mus[sim_indices, :, :, 2:4] if vel_dist else mus[sim_indices, :, :, 0:2]
+        distribution = torch.distributions.Normal(loc=means, scale=sigmas[sim_indices])
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, [self.ado_ids[m] for m in sim_indices])
 
     def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                      ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a dictionary of velocity distributions for every ado as it would be without the presence
         of a robot in the scene.
 
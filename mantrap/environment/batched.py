@@ -0,0 +1,432 @@
+import math
+import typing
+
+import torch
+import torch.distributions
+
+import mantrap.agents
+import mantrap.constants
+import mantrap.utility.shaping
+
+from .base import GraphBasedEnvironment
+from .social_forces import SocialForcesEnvironment
+from .simplified.kalman import KalmanEnvironment
+from .simplified.potential_field import PotentialFieldEnvironment
+
+
+class BatchedEnvironment:
+    """Lockstep simulation of multiple independent scenes in shared tensors.
+
+    Every environment method of the `GraphBasedEnvironment` assumes a single ego and a single list of ados, so that
+    evaluating over many scenes means simulating one scene after another. The batched environment instead stores
+    the states of S scenes of the same environment type in shared tensors, the ados padded to the maximal number
+    of ados over all scenes (with a mask marking the actual ados), and steps and predicts all scenes at once.
+
+    The predictions are equivalent to the predictions of the respective environment types, vectorized over the
+    scenes, ados and particles (see `_compute_kalman()`, `_compute_potential_field()` and `_compute_social_forces()`),
+    however the random parameters and noise are drawn for all scenes at once, so that the results are equal in
+    distribution, but not sample by sample. Padded ados neither interact with other agents, nor are they
+    predicted (zero mean, initial variance).
+
+    The state histories are stored while stepping, so that every scene can be converted back to an environment
+    at any point, e.g. for visualization or re-solving single scenes (see `environments()`). The passed
+    environments themselves are not altered by the batched environment.
+
+    :param envs: scenes to simulate, all of the same environment type and with the same time-step and ego type.
+    """
+    def __init__(self, envs: typing.List[GraphBasedEnvironment]):
+        assert len(envs) > 0
+        env_type = envs[0].__class__
+        assert env_type in [KalmanEnvironment, PotentialFieldEnvironment, SocialForcesEnvironment]
+        assert all([env.__class__ == env_type for env in envs])
+        assert all([env.dt == envs[0].dt for env in envs])
+        assert all([env.ego is not None and env.ego.__class__ == envs[0].ego.__class__ for env in envs])
+
+        # Initial scenes, which are not copied since copying thousands of scenes is expensive. Instead their
+        # initial state is captured, to convert the scenes back to environments (see `environments()`).
+        self._envs = envs
+        self._snapshots = [env.snapshot() for env in envs]
+        self._ado_ids = [list(env.ado_ids) for env in envs]
+        self._env_type = env_type
+        self._ego = envs[0].ego  # reference ego for dynamics and control limits only (state-independent)
+        self._dt = envs[0].dt
+
+        # Shared state tensors, with padded ados (zero state, pedestrian speed limit and goal at current position).
+        num_scenes = len(envs)
+        num_ados_max = max([env.num_ados for env in envs])
+        self._ego_states = torch.zeros((num_scenes, 5))
+        self._ado_states = torch.zeros((num_scenes, num_ados_max, 5))
+        self._ado_mask = torch.zeros((num_scenes, num_ados_max), dtype=torch.bool)
+        self._ado_speed_max = torch.ones((num_scenes, num_ados_max)) * mantrap.constants.PED_SPEED_MAX
+        self._ado_goals = torch.zeros((num_scenes, num_ados_max, 2))
+        for s, env in enumerate(envs):
+            ego_state, ado_states = env.states()
+            self._ego_states[s] = ego_state.detach()
+            self._ado_states[s, :env.num_ados] = ado_states.detach()
+            self._ado_mask[s, :env.num_ados] = True
+            for m_ado, ado in enumerate(env.ados):
+                self._ado_speed_max[s, m_ado] = ado.speed_limits[1]
+                goal = ado.params.get("goal", None)
+                self._ado_goals[s, m_ado] = goal.detach() if goal is not None else ado.position.detach()
+
+        self._ego_history = self._ego_states.unsqueeze(dim=1)  # (num_scenes, 1, 5)
+        self._ado_history = self._ado_states.unsqueeze(dim=2)  # (num_scenes, num_ados_max, 1, 5)
+
+    ###########################################################################
+    # Simulation step #########################################################
+    ###########################################################################
+    def step(self, ego_actions: torch.Tensor) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Run environment step (time-step = dt) in every scene.
+
+        Equivalent to `GraphBasedEnvironment.step()`, the ego actions are made feasible and executed, then
+        the ados are updated by sampling from their conditioned velocity distribution, clipped to their
+        speed limits (as in `update_inverse()` of single integrator agents).
+
+        :param ego_actions: planned ego control input for current time step in every scene (num_scenes, 2).
+        :returns: ado_states (num_scenes, num_ados_max, 5), ego_next_states (num_scenes, 5) in next time step.
+        """
+        assert ego_actions.shape == (self.num_scenes, 2)
+        ego_actions = self._ego.make_controls_feasible(ego_actions.detach())
+        self._ego_states = self._ego_dynamics(self._ego_states, ego_actions)
+
+        # Sample the ado velocities conditioned on the (updated) ego, as the single-scene step does.
+        ego_trajectories = self.unroll_trajectories(ego_actions.unsqueeze(dim=1))
+        velocities = self.compute_distributions(ego_trajectories).sample()[:, :, 0, 0, :]
+        speeds = torch.norm(velocities, dim=-1, keepdim=True)
+        speed_max = self._ado_speed_max.unsqueeze(dim=2)
+        velocities = torch.div(velocities, speeds.clamp(min=1e-6)) * torch.min(speeds, speed_max)
+        positions = self._ado_states[:, :, 0:2] + velocities * self.dt
+        times = self._ado_states[:, :, 4:5] + self.dt
+        ado_states = torch.cat((positions, velocities, times), dim=2)
+        self._ado_states = torch.where(self._ado_mask.unsqueeze(dim=2), ado_states, self._ado_states)
+
+        self._ego_history = torch.cat((self._ego_history, self._ego_states.unsqueeze(dim=1)), dim=1)
+        self._ado_history = torch.cat((self._ado_history, self._ado_states.unsqueeze(dim=2)), dim=2)
+        return self._ado_states.clone(), self._ego_states.clone()
+
+    def unroll_trajectories(self, ego_controls: torch.Tensor) -> torch.Tensor:
+        """Unroll the ego trajectories of every scene, equivalent to `unroll_trajectory()` of the ego, i.e.
+        without checking the controls for feasibility.
+
+        :param ego_controls: ego control inputs in every scene (num_scenes, t_horizon, 2).
+        :returns: ego trajectories (num_scenes, t_horizon + 1, 5).
+        """
+        assert ego_controls.dim() == 3 and ego_controls.shape[0] == self.num_scenes
+        trajectories = [self._ego_states]
+        for t in range(ego_controls.shape[1]):
+            trajectories.append(self._ego_dynamics(trajectories[-1], ego_controls[:, t, :].float()))
+        return torch.stack(trajectories, dim=1)
+
+    def _ego_dynamics(self, states: torch.Tensor, actions: torch.Tensor) -> torch.Tensor:
+        A, B, T = self._ego.dynamics_matrices(dt=self.dt)
+        return torch.matmul(states, A.t()) + torch.matmul(actions, B.t()) + T
+
+    ###########################################################################
+    # Prediction ##############################################################
+    ###########################################################################
+    def compute_distributions(self, ego_trajectories: torch.Tensor, vel_dist: bool = True, **kwargs
+                              ) -> torch.distributions.Normal:
+        """Predict the (uni-modal) distribution of every ado in every scene, conditioned on the ego trajectories.
+
+        :param ego_trajectories: ego trajectory in every scene (num_scenes, t_horizon + 1, 5).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :kwargs: additional prediction arguments, depending on the environment type.
+        :return: distributions for times [0, t_horizon], with shape (num_scenes, num_ados_max, t_horizon, 1, 2).
+        """
+        assert ego_trajectories.dim() == 3 and ego_trajectories.shape[0] == self.num_scenes
+        assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectories[0], pos_and_vel_only=True)
+        t_horizon = ego_trajectories.shape[1] - 1
+        return self._build_distribution(ego_trajectories.detach(), t_horizon=t_horizon, vel_dist=vel_dist, **kwargs)
+
+    def compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
+                                     ) -> torch.distributions.Normal:
+        """Predict the (uni-modal) distribution of every ado in every scene, without ego in the scenes.
+
+        :param t_horizon: number of prediction time-steps.
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :kwargs: additional prediction arguments, depending on the environment type.
+        :return: distributions for times [0, t_horizon], with shape (num_scenes, num_ados_max, t_horizon, 1, 2).
+        """
+        return self._build_distribution(None, t_horizon=t_horizon, vel_dist=vel_dist, **kwargs)
+
+    def predict_w_controls(self, ego_controls: torch.Tensor) -> torch.Tensor:
+        """Predict the ado path distribution means conditioned on the ego controls, in every scene.
+
+        :param ego_controls: ego control inputs in every scene (num_scenes, t_horizon, 2).
+        :return: predicted ado paths (num_scenes, num_ados_max, t_horizon + 1, 1, 2).
+        """
+        ego_trajectories = self.unroll_trajectories(ego_controls)
+        return self._integrate_means(self.compute_distributions(ego_trajectories).mean)
+
+    def predict_wo_ego(self, t_horizon: int) -> torch.Tensor:
+        """Predict the ado path distribution means without ego, in every scene.
+
+        :param t_horizon: prediction horizon, number of discrete time-steps.
+        :return: predicted ado paths (num_scenes, num_ados_max, t_horizon + 1, 1, 2).
+        """
+        return self._integrate_means(self.compute_distributions_wo_ego(t_horizon=t_horizon).mean)
+
+    def _integrate_means(self, means: torch.Tensor) -> torch.Tensor:
+        positions = self._ado_states[:, :, 0:2].view(self.num_scenes, -1, 1, 1, 2)
+        positions = torch.cat((positions, positions + torch.cumsum(means * self.dt, dim=2)), dim=2)
+        return positions * self._ado_mask.view(self.num_scenes, -1, 1, 1, 1)
+
+    def _build_distribution(self, ego_trajectories: typing.Union[torch.Tensor, None], t_horizon: int,
+                            vel_dist: bool, **kwargs) -> torch.distributions.Normal:
+        if self._env_type == KalmanEnvironment:
+            mus, sigmas = self._compute_kalman(t_horizon=t_horizon, **kwargs)
+        elif self._env_type == PotentialFieldEnvironment:
+            mus, sigmas = self._compute_potential_field(ego_trajectories, t_horizon=t_horizon, **kwargs)
+        else:
+            mus, sigmas = self._compute_social_forces(ego_trajectories, t_horizon=t_horizon, **kwargs)
+
+        means = mus[..., 2:4] if vel_dist else mus[..., 0:2]
+        sigmas = sigmas[..., 2:4] if vel_dist else sigmas[..., 0:2]
+        mask = self._ado_mask.view(self.num_scenes, -1, 1, 1)
+        means = torch.where(mask, means, torch.zeros_like(means))
+        sigmas = torch.where(mask, sigmas, torch.ones_like(sigmas) * mantrap.constants.ENV_VAR_INITIAL)
+        return torch.distributions.Normal(loc=means.unsqueeze(dim=3), scale=sigmas.unsqueeze(dim=3))
+
+    ###########################################################################
+    # Environment dynamics ####################################################
+    ###########################################################################
+    def _compute_kalman(self, t_horizon: int, noise_additive: float = mantrap.constants.KALMAN_ADDITIVE_NOISE,
+                        **unused) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Closed-form Kalman propagation of all ados in all scenes, see `KalmanEnvironment`.
+
+        :returns: means of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        :returns: scales of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        """
+        F_k, G_k, p_k_d = KalmanEnvironment.propagation_coefficients(self.dt, t_horizon, noise_additive)
+        ado_states = self._ado_states[:, :, 0:4]
+        mus = torch.einsum("tij,smj->smti", F_k, ado_states) + torch.einsum("tij,smj->smti", G_k, ado_states[..., 2:4])
+        sigmas = p_k_d.view(1, 1, t_horizon, 4).expand(*mus.shape)
+        return mus, sigmas
+
+    def _compute_potential_field(self, ego_trajectories: typing.Union[torch.Tensor, None], t_horizon: int,
+                                 num_particles: int = mantrap.constants.ENV_NUM_PARTICLES,
+                                 v0: typing.Tuple[float, float] = mantrap.constants.POTENTIAL_FIELD_V0_DEFAULT,
+                                 **unused) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Particle simulation of all ados in all scenes at once, see `PotentialFieldEnvironment._simulate_particles()`.
+
+        :param v0: parameter v0 gaussian distribution (mean, variance), shared by all ados.
+        :returns: means of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        :returns: variances of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        """
+        samples, particle_pdf = self._sample_parameters(num_particles, params=[v0])
+        v0 = torch.clamp(samples[0], min=1e-3).unsqueeze(dim=3)  # (num_scenes, num_ados_max, num_particles, 1)
+        theta_attention = mantrap.constants.POTENTIAL_FIELD_MAX_THETA / 180.0 * math.pi
+
+        def update(positions: torch.Tensor, velocities: torch.Tensor, t: int, **unused_state) -> torch.Tensor:
+            if ego_trajectories is not None:
+                delta = ego_trajectories[:, t, 0:2].view(self.num_scenes, 1, 1, 2) - positions
+
+                # Only consider the effects of the robot, if inside attention angle.
+                theta_self = torch.atan2(velocities[..., 1], velocities[..., 0])  # particle orientation
+                theta_robot = torch.atan2(delta[..., 1], delta[..., 0])  # angle to robot
+                is_attentive = (torch.abs(theta_self - theta_robot) < theta_attention).unsqueeze(dim=3).float()
+                velocities = velocities - v0 * torch.sign(delta) * torch.exp(- torch.abs(delta)) * is_attentive
+            return velocities
+
+        return self._simulate_particles(update, t_horizon=t_horizon, num_particles=num_particles,
+                                        particle_pdf=particle_pdf)
+
+    def _compute_social_forces(self, ego_trajectories: typing.Union[torch.Tensor, None], t_horizon: int,
+                               num_particles: int = mantrap.constants.ENV_NUM_PARTICLES,
+                               v0: typing.Tuple[float, float] = mantrap.constants.SOCIAL_FORCES_DEFAULT_V0,
+                               sigma: typing.Tuple[float, float] = mantrap.constants.SOCIAL_FORCES_DEFAULT_SIGMA,
+                               tau: float = mantrap.constants.SOCIAL_FORCES_DEFAULT_TAU,
+                               **unused) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Particle simulation of all ados in all scenes at once, see `SocialForcesEnvironment.simulate_particle()`.
+
+        Instead of differentiating the repulsive potential field for every pair of agents by back-propagation,
+        its gradient w.r.t. the relative position r (with relative velocity u) is evaluated in closed form:
+
+        .. math:: \\nabla_r V = - \\frac{V}{\\sigma} \\frac{b_1}{4 b}
+                  (\\frac{r}{||r||} + \\frac{r - u dt}{||r - u dt||})
+
+        with b_1 = ||r|| + ||r - u dt|| and b = 0.5 \\sqrt{b_1^2 - (||u|| dt)^2}.
+
+        :param v0: parameter v0 gaussian distribution (mean, variance), shared by all ados.
+        :param sigma: parameter sigma gaussian distribution (mean, variance), shared by all ados.
+        :param tau: tau parameter, shared by all ados.
+        :returns: means of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        :returns: variances of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        """
+        samples, particle_pdf = self._sample_parameters(num_particles, params=[v0, sigma])
+        p_v0, p_sigma = samples[0].unsqueeze(dim=3), samples[1].unsqueeze(dim=3)  # (S, M, num_particles, 1)
+        speed_max = self._ado_speed_max.view(self.num_scenes, -1, 1, 1)
+
+        def repulsive_force(relative_distance: torch.Tensor, relative_velocity: torch.Tensor,
+                            v0_p: torch.Tensor, sigma_p: torch.Tensor, v_max: torch.Tensor) -> torch.Tensor:
+            relative_diff = relative_distance - relative_velocity * self.dt
+            norm_relative_distance = torch.norm(relative_distance, dim=-1, keepdim=True)
+            norm_diff_position = torch.norm(relative_diff, dim=-1, keepdim=True)
+            b1 = norm_relative_distance + norm_diff_position
+            b2 = self.dt * torch.norm(relative_velocity, dim=-1, keepdim=True)
+            b = 0.5 * torch.sqrt(b1 ** 2 - b2 ** 2)
+            v = v0_p * torch.exp(-b / sigma_p)
+            db_dr = b1 / (4 * b) * (relative_distance / norm_relative_distance + relative_diff / norm_diff_position)
+            force = torch.max(torch.min(- v / sigma_p * db_dr, v_max), -v_max)
+            is_nan = torch.any(torch.isnan(force), dim=-1, keepdim=True)
+            return torch.where(is_nan, torch.zeros_like(force), force)
+
+        def update(positions: torch.Tensor, velocities: torch.Tensor, t: int, means_t: torch.Tensor
+                   ) -> torch.Tensor:
+            # Destination force - Force pulling the ado to its assigned goal position.
+            direction = self._ado_goals.unsqueeze(dim=2) - positions
+            goal_distance = torch.norm(direction, dim=-1, keepdim=True)
+            speeds = torch.norm(velocities, dim=-1, keepdim=True)
+            destination_force = (direction / goal_distance * speeds - velocities) / tau
+            is_at_goal = torch.lt(goal_distance, mantrap.constants.SOCIAL_FORCES_MAX_GOAL_DISTANCE)
+            destination_force = torch.where(is_at_goal, torch.zeros_like(destination_force), destination_force)
+
+            # Interactive force - Repulsive potential field by every other (actual) ado in the scene, within
+            # the interaction distance, with the particles in the second and the other ados in the fourth dimension.
+            relative_distance = positions.unsqueeze(dim=3) - means_t[:, None, None, :, 0:2]
+            relative_velocity = velocities.unsqueeze(dim=3) - means_t[:, None, None, :, 2:4]
+            forces = repulsive_force(relative_distance, relative_velocity, p_v0.unsqueeze(dim=3),
+                                     p_sigma.unsqueeze(dim=3), speed_max.unsqueeze(dim=3))
+            num_ados_max = self.num_ados_max
+            is_other = ~torch.eye(num_ados_max, dtype=torch.bool).view(1, num_ados_max, 1, num_ados_max)
+            is_interacting = is_other & self._ado_mask.view(self.num_scenes, 1, 1, num_ados_max)
+            is_close = torch.norm(relative_distance, dim=-1) <= mantrap.constants.SOCIAL_FORCES_MAX_INTERACTION_DISTANCE
+            interaction_force = - torch.sum(forces * (is_interacting & is_close).unsqueeze(dim=4).float(), dim=3)
+
+            # Interactive force w.r.t. ego - Repulsive potential field.
+            ego_force = torch.zeros_like(velocities)
+            if ego_trajectories is not None:
+                ego_state_t = ego_trajectories[:, t, :].view(self.num_scenes, 1, 1, -1)
+                ego_force = - repulsive_force(positions - ego_state_t[..., 0:2], velocities - ego_state_t[..., 2:4],
+                                              p_v0, p_sigma, speed_max)
+
+            return destination_force + interaction_force + ego_force
+
+        return self._simulate_particles(update, t_horizon=t_horizon, num_particles=num_particles,
+                                        particle_pdf=particle_pdf)
+
+    def _sample_parameters(self, num_particles: int, params: typing.List[typing.Tuple[float, float]]
+                           ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Sample the particle parameters from independent gaussian distributions, equivalent to
+        `ParticleEnvironment.sample_parameters()`, however shared by all ados in all scenes.
+
+        :param num_particles: number of particles per ado.
+        :param params: (mean, variance) of every parameter distribution.
+        :return: sampled parameters (num_params, num_scenes, num_ados_max, num_particles).
+        :return: normalized probability of each particle (num_scenes, num_ados_max, num_particles, 1).
+        """
+        samples, pdfs = [], []
+        for loc, scale in params:
+            distribution = torch.distributions.Normal(loc=loc, scale=scale)
+            sample_n = distribution.sample((self.num_scenes, self.num_ados_max, num_particles))
+            samples.append(sample_n)
+            pdfs.append(distribution.cdf(sample_n))
+        particle_pdf = torch.prod(torch.stack(pdfs), dim=0) * self._ado_mask.unsqueeze(dim=2)
+
+        # Normalize the particle pdfs over the (actual) ados of each scene, as in the `ParticleEnvironment`.
+        particle_pdf = particle_pdf / torch.norm(particle_pdf, dim=1, keepdim=True).clamp(min=1e-12)
+        return torch.stack(samples), particle_pdf.unsqueeze(dim=3)
+
+    def _simulate_particles(self, update: typing.Callable, t_horizon: int, num_particles: int,
+                            particle_pdf: torch.Tensor) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Simulate the particles of all ados in all scenes and merge them to a uni-modal gaussian for every ado
+        and time-step, equivalent to the `ParticleEnvironment`.
+
+        :param update: function determining the particle's controls (velocities before clipping) given the particle
+                       positions, velocities (num_scenes, num_ados_max, num_particles, 2), the time-step t and
+                       the ado distribution means at time t (num_scenes, num_ados_max, 4).
+        :param t_horizon: number of prediction time-steps.
+        :param num_particles: number of particles per ado.
+        :param particle_pdf: normalized probability of each particle (num_scenes, num_ados_max, num_particles, 1).
+        :returns: means of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        :returns: variances of positions and velocities (num_scenes, num_ados_max, t_horizon, 4).
+        """
+        num_scenes, num_ados_max = self.num_scenes, self.num_ados_max
+        speed_max = self._ado_speed_max.view(num_scenes, num_ados_max, 1, 1)
+        positions = self._ado_states[:, :, 0:2].unsqueeze(dim=2).repeat(1, 1, num_particles, 1)
+        velocities = self._ado_states[:, :, 2:4].unsqueeze(dim=2).repeat(1, 1, num_particles, 1)
+
+        mus = torch.zeros((num_scenes, num_ados_max, t_horizon, 4))
+        mus[:, :, 0, :] = self._ado_states[:, :, 0:4]
+        sigmas = torch.ones((num_scenes, num_ados_max, t_horizon, 2)) * mantrap.constants.ENV_VAR_INITIAL
+
+        for t in range(t_horizon - 1):
+            velocities = update(positions, velocities, t=t, means_t=mus[:, :, t, :])
+
+            # Make the velocities feasible, by scaling them to the particle's speed limit (while keeping their
+            # direction), equivalently to `make_controls_feasible()`.
+            speeds = torch.norm(velocities, dim=-1, keepdim=True)
+            velocities = torch.div(velocities, speeds.clamp(min=1e-6)) * torch.min(speeds, speed_max)
+            positions = positions + velocities * self.dt
+
+            noise = torch.rand((num_scenes, num_ados_max, num_particles, 2)) * mantrap.constants.ENV_PARTICLE_NOISE
+            velocities_pdf = (velocities + noise) * particle_pdf
+            mus[:, :, t + 1, 2:4] = torch.mean(velocities_pdf, dim=2)
+            mus[:, :, t + 1, 0:2] = mus[:, :, t, 0:2] + mus[:, :, t, 2:4] * self.dt  # single integrator (!)
+            sigmas[:, :, t + 1, :] = torch.var(velocities_pdf, dim=2).clamp(min=mantrap.constants.ENV_PARTICLE_VAR_MIN)
+
+        return mus, torch.cat((sigmas, sigmas), dim=3)
+
+    ###########################################################################
+    # Scenes ##################################################################
+    ###########################################################################
+    def states(self) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Return the current states of the egos (num_scenes, 5) and ados (num_scenes, num_ados_max, 5),
+        including the temporal dimension, padded ados with zero state."""
+        return self._ego_states.clone(), self._ado_states.clone()
+
+    def trajectories(self) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Return the state histories since initialization, i.e. the ego trajectories (num_scenes, K, 5) and
+        ado trajectories (num_scenes, num_ados_max, K, 1, 5) for K - 1 executed steps."""
+        return self._ego_history.clone(), self._ado_history.unsqueeze(dim=3).clone()
+
+    def environments(self) -> typing.List[GraphBasedEnvironment]:
+        """Convert the current state of every scene back to an environment of the original type, by resetting
+        a copy of the initial scene to every state in the history (see `step_reset()`). The passed scenes are
+        rewound to their initial state for copying, and restored afterwards."""
+        envs = []
+        for s, env_initial in enumerate(self._envs):
+            snapshot = env_initial.snapshot()
+            env_initial.restore(self._snapshots[s])
+            env = env_initial.copy()
+            env_initial.restore(snapshot)
+            for k in range(1, self._ego_history.shape[1]):
+                env.step_reset(ego_next=self._ego_history[s, k], ado_next=self._ado_history[s, :env.num_ados, k])
+            envs.append(env)
+        return envs
+
+    ###########################################################################
+    # Simulation parameters ###################################################
+    ###########################################################################
+    @property
+    def env_type(self) -> GraphBasedEnvironment.__class__:
+        return self._env_type
+
+    @property
+    def ego_type(self) -> mantrap.agents.base.DTAgent.__class__:
+        return self._ego.__class__
+
+    @property
+    def dt(self) -> float:
+        return self._dt
+
+    @property
+    def num_scenes(self) -> int:
+        return self._ado_mask.shape[0]
+
+    @property
+    def num_ados_max(self) -> int:
+        return self._ado_mask.shape[1]
+
+    @property
+    def ado_mask(self) -> torch.Tensor:
+        return self._ado_mask.clone()
+
+    @property
+    def ado_ids(self) -> typing.List[typing.List[str]]:
+        return self._ado_ids
+
+    @property
+    def ados(self) -> typing.List[typing.List[mantrap.agents.base.DTAgent]]:
+        """Ados of every (initial) scene, e.g. for their (state-independent) speed limits."""
+        return [env.ados for env in self._envs]
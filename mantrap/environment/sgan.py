@@ -7,6 +7,7 @@ import torch
 import torch.distributions
 
 import mantrap.utility.io
+import mantrap.utility.maths
 import mantrap.utility.shaping
 
 from .base import GraphBasedEnvironment
@@ -69,13 +70,20 @@ class SGAN(GraphBasedEnvironment):
         :param history: ado state history (if None then just stacked current state).
         :param ado_kwargs: addition kwargs for ado initialization.
         """
+        history = self._build_history(position, velocity=velocity, history=history)
+        return super(SGAN, self).add_ado(position, velocity=velocity, history=history, **ado_kwargs)
+
+    def _build_history(self, position: torch.Tensor, velocity: torch.Tensor, history: torch.Tensor = None
+                       ) -> torch.Tensor:
+        """Build agent history by stacking the given (position, velocity) state over multiple time-steps,
+        if no history (or merely the current state) is given."""
         if history is None or history.shape[0] == 1:
             position, velocity = position.float(), velocity.float()
             history = torch.stack([torch.cat(
                 (position + velocity * self.dt * t, velocity, torch.ones(1) * self.time + self.dt * t))
                 for t in range(-mantrap.constants.TRAJECTRON_DEFAULT_HISTORY_LENGTH, 1)
             ])
-        return super(SGAN, self).add_ado(position, velocity=velocity, history=history, **ado_kwargs)
+        return history
 
     ###########################################################################
     # Prediction - Samples ####################################################
@@ -96,9 +104,14 @@ class SGAN(GraphBasedEnvironment):
         assert self.sanity_check(check_ego=True)
         t_horizon = ego_trajectory.shape[0] - 1
 
-        self.add_ado(self.ego.position, velocity=self.ego.velocity, history=self.ego.history)
-        samples = self.sample_wo_ego(t_horizon=t_horizon, num_samples=num_samples)
-        self._ados = self.ados[:-1]
+        # If no ado agent is in the scene, then return None.
+        if self.num_ados == 0:
+            return None
+
+        # Include the ego as additional pedestrian in the scene, by appending its history to the ado histories.
+        ego_history = self._build_history(self.ego.position, velocity=self.ego.velocity, history=self.ego.history)
+        histories = torch.cat((self._ado_histories(), ego_history[:, 0:2].unsqueeze(dim=1)), dim=1)
+        samples = self._sample_histories(histories, t_horizon=t_horizon, num_samples=num_samples)
         return samples[:-1]
 
     def sample_wo_ego(self, t_horizon: int, num_samples: int = 1) -> typing.Union[torch.Tensor, None]:
@@ -111,36 +124,58 @@ class SGAN(GraphBasedEnvironment):
         :return: predicted ado paths (num_ados, num_samples, prediction_horizon+1, num_modes=1, 2).
                  if no ado in scene, return None instead.
         """
+        # If no ado agent is in the scene, then return None.
+        if self.num_ados == 0:
+            return None
+
+        samples = self._sample_histories(self._ado_histories(), t_horizon=t_horizon, num_samples=num_samples)
+        assert mantrap.utility.shaping.check_ado_samples(samples, t_horizon=t_horizon + 1, num_samples=num_samples)
+        return samples
+
+    def _ado_histories(self) -> torch.Tensor:
+        """Get ado position histories in SGAN shape (time_steps, num_ados, 2 = x, y)."""
+        return torch.stack([ado.history[:, 0:2] for ado in self.ados], dim=1)
+
+    def _sample_histories(self, histories: torch.Tensor, t_horizon: int, num_samples: int) -> torch.Tensor:
+        """Sample trajectories for the pedestrians with the given histories from the SGAN generator.
+
+        Instead of calling the generator once for every sample, the scene is replicated `num_samples` times
+        along the batch dimension, each replica forming an independent sequence (`seq_start_end`), so that all
+        samples are drawn within a single forward pass.
+
+        :param histories: pedestrian position histories (time_steps, num_peds, 2).
+        :param t_horizon: prediction horizon, number of discrete time-steps.
+        :param num_samples: number of samples to return.
+        :return: sampled paths (num_peds, num_samples, t_horizon + 1, num_modes=1, 2).
+        """
         assert 0 < t_horizon < 8  # 8 = sample length sgan was trained on
+        num_peds = histories.shape[1]
 
-        # Get ado histories and relative histories (aka velocities for dt=1.0)
-        # SGAN shape: (time_steps, num_ados, 2 = x, y)
-        ado_histories = torch.stack([ado.history[:, 0:2] for ado in self.ados], dim=1)
-        ado_histories_rel = self.absolute_to_relative(ado_histories)
-        ado_start_pos = ado_histories[-1, :, 0:2]
-        seq_start_end = torch.tensor([0, self.num_ados]).view(1, 2)
+        # Get relative histories (aka velocities for dt=1.0) and replicate the scene for every sample.
+        histories_rel = self.absolute_to_relative(histories)
+        histories = histories.repeat(1, num_samples, 1)
+        histories_rel = histories_rel.repeat(1, num_samples, 1)
+        start_pos = histories[-1, :, 0:2]
+        seq_start = torch.arange(num_samples) * num_peds
+        seq_start_end = torch.stack((seq_start, seq_start + num_peds), dim=1)
 
         # Predict trajectory samples from SGAN generator.
-        samples = torch.zeros((self.num_ados, num_samples, t_horizon + 1, 1, 2))
-        for n in range(num_samples):
-            ado_samples_rel = self._sgan(ado_histories, ado_histories_rel, seq_start_end)
-            ado_samples = self.relative_to_abs(ado_samples_rel, start_pos=ado_start_pos)
-
-            # (time-steps, num_ados, 2) -> (num_ados, num_samples, time_steps, 2).
-            samples[:, n, :, 0, :] = ado_samples[:t_horizon + 1, :, :].permute(1, 0, 2)
+        samples_rel = self._sgan(histories, histories_rel, seq_start_end)
+        samples_abs = self.relative_to_abs(samples_rel, start_pos=start_pos)
 
-        assert mantrap.utility.shaping.check_ado_samples(samples, t_horizon=t_horizon + 1, num_samples=num_samples)
-        return samples
+        # (time-steps, num_samples * num_peds, 2) -> (num_peds, num_samples, time_steps, 1, 2).
+        samples_abs = samples_abs[:t_horizon + 1].view(t_horizon + 1, num_samples, num_peds, 2)
+        return samples_abs.permute(2, 1, 0, 3).unsqueeze(dim=3)
 
     ###########################################################################
     # Simulation graph ########################################################
     ###########################################################################
     def _compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True, **kwargs
-                               ) -> typing.Dict[str, torch.distributions.Distribution]:
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
         raise NotImplementedError
 
     def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                      ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
         raise NotImplementedError
 
     ###########################################################################
@@ -3,11 +3,16 @@ import typing
 import torch
 import torch.distributions
 
+import mantrap.agents
 import mantrap.constants
+import mantrap.utility.maths
 
 from ..base.graph_based import GraphBasedEnvironment
 
 
+_PROPAGATION_COEFFICIENTS = {}  # closed-form propagation coefficients, keyed by (dt, t_horizon, noise)
+
+
 class KalmanEnvironment(GraphBasedEnvironment):
     """Kalman (Filter) - based Environment.
 
@@ -37,8 +42,8 @@ class KalmanEnvironment(GraphBasedEnvironment):
 
     def _compute_distributions(self, ego_trajectory: typing.Union[typing.List, torch.Tensor],
                                noise_additive: float = mantrap.constants.KALMAN_ADDITIVE_NOISE,
-                               vel_dist: bool = True, **kwargs
-                               ) -> typing.Dict[str, torch.distributions.Distribution]:
+                               vel_dist: bool = True, ado_ids: typing.List[str] = None, **kwargs
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph based on the ego's trajectory.
 
         The graph should span over the time-horizon of the length of the ego's trajectory and contain the
@@ -52,49 +57,34 @@ class KalmanEnvironment(GraphBasedEnvironment):
 
         :param ego_trajectory: ego's trajectory (t_horizon, 5).
         :param noise_additive: additive noise per prediction time-step (Q = diag(noise_additive)).
+        :param ado_ids: ids of ados to predict, by default all ados in the scene.
         :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
         """
         t_horizon = len(ego_trajectory) - 1  # works for tensor and list !
-        dist_dict = {}
+        ado_ids = self.ado_ids if ado_ids is None else [ado_id for ado_id in self.ado_ids if ado_id in ado_ids]
+        _, ado_states = self.states()
+        ado_states = ado_states[[self.index_ado_id(ado_id) for ado_id in ado_ids], 0:4].detach()
 
         # Since the agents are not connected with each other anyway in the computation graph, we can not
         # compute any (inter-agent) gradient. Therefore we can simply completely detach the full computation
-        # to massively speed up the computation.
+        # to massively speed up the computation. As the state space matrices and the control inputs (velocities)
+        # are constant, the propagated means and covariances only depend on powers of F, so that they can be
+        # computed for every ado and time-step at once, using pre-computed coefficients.
         with torch.no_grad():
-            for ado in self.ados:
-                mus = torch.zeros((t_horizon, 1, 2))  # t_horizon, num_modes, 2 (=dims)
-                sigmas = torch.zeros((t_horizon, 1, 2))  # variance will be diagonal for sure (!)
-
-                u_constant = ado.velocity.clone().detach()
-                x_k1 = ado.state.clone().detach()  # notation: x_k1 = "x_{k minus 1}"
-
-                # Using the assumptions above (H = eye(), R = 0) the Kalman equations can be vastly simplified,
-                # by insertion we get K = eye() and x_k = x_k_k1 for all k.
-                F, B, _ = ado.dynamics_matrices(dt=self.dt, x=ado.state)
-                F, B = F[0:4, 0:4], B[0:4, :]   # positions and velocities only
-                FT = torch.transpose(F, 0, 1)
-                Q = torch.eye(x_k1.numel()) * noise_additive
-                p_k1 = torch.eye(x_k1.numel()) * mantrap.constants.ENV_VAR_INITIAL
-                p_k1_d = p_k1.diagonal()
-
-                mus[0, 0, :] = x_k1[2:4] if vel_dist else x_k1[0:2]
-                sigmas[0, 0, :] = p_k1_d[2:4] if vel_dist else p_k1_d[0:2]
-                for t in range(t_horizon - 1):
-                    x_k = torch.matmul(F, x_k1) + torch.matmul(B, u_constant)
-                    p_k = torch.matmul(torch.matmul(F, p_k1), FT) + Q
-                    p_k_d = p_k.diagonal()
-
-                    mus[t + 1, 0, :] = x_k[2:4] if vel_dist else x_k[0:2]
-                    sigmas[t + 1, 0, :] = p_k_d[2:4] if vel_dist else p_k_d[0:2]
-                    x_k1 = x_k
-                    p_k1 = p_k
-
-                dist_dict[ado.id] = torch.distributions.Normal(loc=mus, scale=sigmas)
-
-        return dist_dict
+            F_k, G_k, p_k_d = self.propagation_coefficients(self.dt, t_horizon=t_horizon, noise_additive=noise_additive)
+            u_constant = ado_states[:, 2:4]
+            x_k = torch.einsum("tij,aj->ati", F_k, ado_states) + torch.einsum("tij,aj->ati", G_k, u_constant)
+
+            mus = x_k[:, :, 2:4] if vel_dist else x_k[:, :, 0:2]
+            sigmas = p_k_d[:, 2:4] if vel_dist else p_k_d[:, 0:2]
+            mus = mus.unsqueeze(dim=2)  # num_ados, t_horizon, num_modes, 2 (=dims)
+            sigmas = sigmas.view(1, t_horizon, 1, 2).repeat(len(ado_ids), 1, 1, 1)  # diagonal variance (!)
+
+        distribution = torch.distributions.Normal(loc=mus, scale=sigmas)
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=ado_ids)
 
     def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                      ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a dictionary of velocity distributions for every ado as it would be without the presence
         of a robot in the scene.
 
@@ -108,6 +98,67 @@ class KalmanEnvironment(GraphBasedEnvironment):
         """
         return self._compute_distributions(ego_trajectory=[None] * (t_horizon + 1), vel_dist=vel_dist, **kwargs)
 
+    def _compute_distributions_with_jacobian(self, ego_controls: torch.Tensor, vel_dist: bool = True,
+                                             ado_ids: typing.List[str] = None, **kwargs
+                                             ) -> typing.Tuple[mantrap.utility.maths.MultiAgentDistribution,
+                                                               torch.Tensor, torch.Tensor]:
+        """Build the distributions conditioned on the ego's controls, together with their jacobian with respect
+        to the ego's controls. As the ados are not affected by the ego, the jacobian is zero (so that it does
+        not have to be approximated by finite differences).
+
+        :param ego_controls: ego's control inputs (t_horizon, 2).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for.
+        :return: distribution of every ado (in the order of `ado_ids`) for t in [0, t_horizon].
+        :return: jacobian of distribution means w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        :return: jacobian of distribution scales w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        """
+        t_horizon = ego_controls.shape[0]
+        dist_dict = self._compute_distributions([None] * (t_horizon + 1), vel_dist=vel_dist, ado_ids=ado_ids, **kwargs)
+        jacobian = torch.zeros((len(dist_dict.ids), t_horizon, 1, 2, ego_controls.numel()))
+        return dist_dict, jacobian, jacobian.clone()
+
+    @staticmethod
+    def propagation_coefficients(dt: float, t_horizon: int, noise_additive: float
+                                 ) -> typing.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Determine the coefficients of the closed-form Kalman propagation for single integrator ados.
+
+        With constant state space matrices and control inputs the Kalman equations (as described above)
+        can be written in closed form, as
+
+        .. math:: x_k = F^k x_0 + \\sum_{j=0}^{k-1} F^j B u = F_k x_0 + G_k u
+
+        .. math:: P_k = F^k P_0 (F^k)^T + \\sum_{j=0}^{k-1} F^j Q (F^j)^T
+
+        while the covariance matrices do not depend on the ado's states at all. The coefficients are shared
+        by all environments, cached by their parameters.
+
+        :param dt: time-step of the prediction.
+        :param t_horizon: number of prediction time-steps.
+        :param noise_additive: additive noise per prediction time-step (Q = diag(noise_additive)).
+        :returns: F_k (t_horizon, 4, 4), G_k (t_horizon, 4, 2) and the diagonal of P_k (t_horizon, 4).
+        """
+        key = (dt, t_horizon, noise_additive)
+        if key not in _PROPAGATION_COEFFICIENTS:
+            F, B, _ = mantrap.agents.IntegratorDTAgent._dynamics_matrices(dt=dt)
+            F, B = F[0:4, 0:4].float(), B[0:4, :].float()   # positions and velocities only
+            Q = torch.eye(4) * noise_additive
+
+            F_k = torch.zeros((t_horizon, 4, 4))
+            G_k = torch.zeros((t_horizon, 4, 2))
+            p_k_d = torch.zeros((t_horizon, 4))
+            F_power, G, p_k = torch.eye(4), torch.zeros((4, 2)), torch.eye(4) * mantrap.constants.ENV_VAR_INITIAL
+            for t in range(t_horizon):
+                F_k[t], G_k[t], p_k_d[t] = F_power, G, p_k.diagonal()
+                F_power, G = torch.matmul(F, F_power), torch.matmul(F, G) + B
+                p_k = torch.matmul(torch.matmul(F, p_k), F.t()) + Q
+            _PROPAGATION_COEFFICIENTS[key] = (F_k, G_k, p_k_d)
+        return _PROPAGATION_COEFFICIENTS[key]
+
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """As there is no interaction between the ados, merely the given ados have to be predicted."""
+        return [ado_id for ado_id in self.ado_ids if ado_id in ado_ids]
+
     ###########################################################################
     # Simulation parameters ###################################################
     ###########################################################################
@@ -6,6 +6,8 @@ import torch
 
 import mantrap.agents
 import mantrap.constants
+import mantrap.utility.maths
+import mantrap.utility.shaping
 
 from ..base.particle import ParticleEnvironment
 
@@ -30,6 +32,7 @@ class PotentialFieldEnvironment(ParticleEnvironment):
     def create_particles(self,
                          num_particles: int,
                          v0_dict: typing.Dict[str, typing.Tuple[float, float]] = None,
+                         ado_ids: typing.List[str] = None,
                          **particle_kwargs
                          ) -> typing.Tuple[typing.List[typing.List[mantrap.agents.IntegratorDTAgent]], torch.Tensor]:
         """Create particles from internal parameter distribution.
@@ -43,6 +46,7 @@ class PotentialFieldEnvironment(ParticleEnvironment):
         :param v0_dict: parameter v0 gaussian distribution (mean, variance) by ado_id, if None then gaussian
                         with mean, variance = `mantrap.constants.POTENTIAL_FIELD_V0_DEFAULT`
                         similarly for each ado.
+        :param ado_ids: ids of ados to create particles for, by default all ados in the scene.
         :return: list of N = num_particles for every ado in the scene.
         :return: probability (pdf) of each particle (num_ados, num_particles).
         """
@@ -50,7 +54,8 @@ class PotentialFieldEnvironment(ParticleEnvironment):
             v0_default, v0_variance = mantrap.constants.POTENTIAL_FIELD_V0_DEFAULT
             v0_dict = {ado_id: (v0_default, v0_variance) for ado_id in self.ado_ids}
 
-        return super(PotentialFieldEnvironment, self).create_particles(num_particles, param_dicts={"v0": v0_dict})
+        return super(PotentialFieldEnvironment, self).create_particles(num_particles, param_dicts={"v0": v0_dict},
+                                                                       ado_ids=ado_ids)
 
     def simulate_particle(self,
                           particle: mantrap.agents.IntegratorDTAgent,
@@ -87,6 +92,205 @@ class PotentialFieldEnvironment(ParticleEnvironment):
         logging.debug(f"particle {particle.id} impact = {ego_impact}")
         return particle
 
+    ###########################################################################
+    # Simulation Graph over time-horizon ######################################
+    ###########################################################################
+    def _compute_distributions(self, ego_trajectory: typing.Union[typing.List, torch.Tensor],
+                               num_particles: int = mantrap.constants.ENV_NUM_PARTICLES,
+                               vel_dist: bool = True, ado_ids: typing.List[str] = None,
+                               v0_dict: typing.Dict[str, typing.Tuple[float, float]] = None, **kwargs
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
+        """Build a connected graph based on the ego's trajectory.
+
+        Equivalent to the particle-based simulation of the `ParticleEnvironment`, however since the particles
+        of the potential field are that simple, instead of simulating every particle as individual agent, all
+        particles of all ados are simulated at once in closed form (see `_simulate_particles()`).
+
+        :param ego_trajectory: ego's trajectory (t_horizon, 5).
+        :param num_particles: number of particles per ado.
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to simulate, by default all ados in the scene.
+        :param v0_dict: parameter v0 gaussian distribution (mean, variance) by ado_id (see `create_particles()`).
+        :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
+        """
+        if not all([x is None for x in ego_trajectory]):
+            assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory, pos_and_vel_only=True)
+        mus, sigmas, sim_ids = self._simulate_particles(ego_trajectory, num_particles, ado_ids=ado_ids,
+                                                        v0_dict=v0_dict)
+        means = mus[:, :, 2:4] if vel_dist else mus[:, :, 0:2]
+        distribution = torch.distributions.Normal(loc=means.unsqueeze(dim=2), scale=sigmas.unsqueeze(dim=2))
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=sim_ids)
+
+    def _compute_distributions_with_jacobian(self, ego_controls: torch.Tensor, vel_dist: bool = True,
+                                             ado_ids: typing.List[str] = None,
+                                             num_particles: int = mantrap.constants.ENV_NUM_PARTICLES, **kwargs
+                                             ) -> typing.Tuple[mantrap.utility.maths.MultiAgentDistribution,
+                                                               torch.Tensor, torch.Tensor]:
+        """Build the distributions conditioned on the ego's controls, together with their jacobian with respect
+        to the ego's controls.
+
+        The jacobian is derived in closed form (see `_simulate_particles()`), so that no computation graph has
+        to be built and back-propagated through.
+
+        :param ego_controls: ego's control inputs (t_horizon, 2).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to compute the distributions for.
+        :param num_particles: number of particles per ado.
+        :return: distribution of every ado (in the order of `ado_ids`) for t in [0, t_horizon].
+        :return: jacobian of distribution means w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        :return: jacobian of distribution scales w.r.t. controls (num_ados, t_horizon, 1, 2, t_horizon * 2).
+        """
+        with torch.no_grad():
+            ego_trajectory = self.ego.unroll_trajectory(ego_controls, dt=self.dt)
+            mus, sigmas, sim_ids, mus_jacobian, sigmas_jacobian = self._simulate_particles(
+                ego_trajectory, num_particles, ado_ids=ado_ids, with_jacobian=True, **kwargs
+            )
+            rows = [sim_ids.index(ado_id) for ado_id in ado_ids]
+            means = mus[rows, :, 2:4] if vel_dist else mus[rows, :, 0:2]
+            means_jacobian = mus_jacobian[rows, :, 2:4] if vel_dist else mus_jacobian[rows, :, 0:2]
+            sigmas, sigmas_jacobian = sigmas[rows], sigmas_jacobian[rows]
+
+            # Chain rule with the derivative of the ego positions w.r.t. the ego controls.
+            t_horizon = ego_controls.shape[0]
+            dx_du = self.ego.dx_du(ego_controls, dt=self.dt).view(t_horizon + 1, self.ego.state_size, -1)
+            de_du = dx_du[:, 0:2, :]  # positions only
+            means_jacobian = torch.einsum("atikj,kju->atiu", means_jacobian, de_du).unsqueeze(dim=2)
+            sigmas_jacobian = torch.einsum("atikj,kju->atiu", sigmas_jacobian, de_du).unsqueeze(dim=2)
+
+        distribution = torch.distributions.Normal(loc=means.unsqueeze(dim=2), scale=sigmas.unsqueeze(dim=2))
+        distribution = mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=ado_ids)
+        return distribution, means_jacobian, sigmas_jacobian
+
+    def _simulate_particles(self, ego_trajectory: typing.Union[typing.List, torch.Tensor], num_particles: int,
+                            ado_ids: typing.List[str] = None,
+                            v0_dict: typing.Dict[str, typing.Tuple[float, float]] = None,
+                            with_jacobian: bool = False):
+        """Simulate the particles of all ados at once, in closed form.
+
+        As described in `simulate_particle()` every particle is pushed away by the ego, if it is inside its
+        attention angle, i.e. for particle velocity v, position p and ego position e:
+
+        .. math:: v_{t+1} = clip(v_t - v_0 sign(e_t - p_t) \\exp(-|e_t - p_t|))
+
+        .. math:: p_{t+1} = p_t + v_{t+1} dt
+
+        with the ego impact being computed element-wise and the clipping scaling the velocity to the particle's
+        speed limits. Outside of the measure-zero boundaries of the attention angle and the sign function, the
+        derivative of the velocity update w.r.t. the ego position e_k is
+
+        .. math:: \\frac{dv_{t+1}}{de_k} = C_t (\\frac{dv_t}{de_k} + v_0 \\exp(-|e_t - p_t|)
+                  (\\delta_{tk} - \\frac{dp_t}{de_k}))
+
+        with C_t being the derivative of the clipping operation, which is propagated forward in time, together
+        with the simulation itself. The particles are merged to a single Gaussian for every ado and time-step,
+        as in the `ParticleEnvironment`.
+
+        :param ego_trajectory: ego's trajectory (t_horizon, 5) or list of None (no ego).
+        :param num_particles: number of particles per ado.
+        :param ado_ids: ids of ados to simulate, by default all ados in the scene.
+        :param v0_dict: parameter v0 gaussian distribution (mean, variance) by ado_id.
+        :param with_jacobian: additionally return the derivatives w.r.t. the ego positions.
+        :return: means of positions and velocities (num_sim_ados, t_horizon, 4).
+        :return: variances of velocities (num_sim_ados, t_horizon, 2).
+        :return: ids of simulated ados.
+        :return: jacobian of the means w.r.t. the ego positions (num_sim_ados, t_horizon, 4, t_horizon + 1, 2).
+        :return: jacobian of the variances w.r.t. the ego positions (num_sim_ados, t_horizon, 2, t_horizon + 1, 2).
+        """
+        t_horizon = len(ego_trajectory) - 1  # works for list and torch.Tensor (!)
+        is_ego = not all([x is None for x in ego_trajectory])
+        ado_ids = self.ado_ids if ado_ids is None else ado_ids
+        sim_indices = [m_ado for m_ado, ado_id in enumerate(self.ado_ids) if ado_id in ado_ids]
+        num_sim = len(sim_indices)
+
+        # Sample the particle parameters, for every ado in the scene (see `create_particles()`).
+        if v0_dict is None:
+            v0_default, v0_variance = mantrap.constants.POTENTIAL_FIELD_V0_DEFAULT
+            v0_dict = {ado_id: (v0_default, v0_variance) for ado_id in self.ado_ids}
+        samples, particle_pdf = self.sample_parameters(num_particles, param_dicts={"v0": v0_dict})
+        particle_pdf = (particle_pdf / torch.norm(particle_pdf, dim=0)).unsqueeze(dim=2).detach()  # normalize
+        particle_pdf = particle_pdf[sim_indices]
+        v0 = torch.clamp(samples[sim_indices, 0, :], min=1e-3).unsqueeze(dim=2)  # (num_sim, num_particles, 1)
+        v_max = torch.tensor([self.ados[m_ado].speed_limits[1] for m_ado in sim_indices]).view(-1, 1, 1)
+        theta_attention = mantrap.constants.POTENTIAL_FIELD_MAX_THETA / 180.0 * math.pi
+
+        _, ado_states = self.states()
+        positions = ado_states[sim_indices, 0:2].unsqueeze(dim=1).repeat(1, num_particles, 1)
+        velocities = ado_states[sim_indices, 2:4].unsqueeze(dim=1).repeat(1, num_particles, 1)
+
+        mus = torch.zeros((num_sim, t_horizon, 4))
+        mus[:, 0, :] = ado_states[sim_indices, 0:4]
+        sigmas = torch.zeros((num_sim, t_horizon, 2))
+        sigmas[:, 0, :] = torch.ones((num_sim, 2)) * mantrap.constants.ENV_VAR_INITIAL
+
+        # Derivatives w.r.t. the ego positions at every time-step of the trajectory, with the particle's
+        # coordinates in the third and the ego's coordinates in the last dimension.
+        if with_jacobian:
+            positions_jacobian = torch.zeros((num_sim, num_particles, 2, t_horizon + 1, 2))
+            velocities_jacobian = torch.zeros((num_sim, num_particles, 2, t_horizon + 1, 2))
+            mus_jacobian = torch.zeros((num_sim, t_horizon, 4, t_horizon + 1, 2))
+            sigmas_jacobian = torch.zeros((num_sim, t_horizon, 2, t_horizon + 1, 2))
+            eye = torch.eye(2)
+
+        for t in range(t_horizon - 1):
+            if is_ego:
+                delta = ego_trajectory[t, 0:2] - positions
+
+                # Only consider the effects of the robot, if inside attention angle.
+                theta_self = torch.atan2(velocities[:, :, 1], velocities[:, :, 0])  # particle orientation
+                theta_robot = torch.atan2(delta[:, :, 1], delta[:, :, 0])  # angle to robot
+                is_attentive = (torch.abs(theta_self - theta_robot) < theta_attention).unsqueeze(dim=2).float()
+                exp_delta = torch.exp(- torch.abs(delta)) * is_attentive
+                velocities = velocities - v0 * torch.sign(delta) * exp_delta
+
+                if with_jacobian:
+                    d_impact = (v0 * exp_delta).view(num_sim, num_particles, 2, 1, 1)
+                    velocities_jacobian = velocities_jacobian - d_impact * positions_jacobian
+                    velocities_jacobian[:, :, :, t, :] += d_impact[:, :, :, 0, :] * eye
+
+            # Make the velocities feasible, by scaling them to the particle's speed limit (while keeping their
+            # direction), equivalently to `make_controls_feasible()`.
+            speeds = torch.norm(velocities, dim=2, keepdim=True)
+            is_clipped = torch.gt(speeds, v_max)
+            velocities = torch.div(velocities, speeds.clamp(min=1e-6)) * torch.min(speeds, v_max)
+            if with_jacobian and torch.any(is_clipped):
+                directions = velocities / v_max
+                clip_scale = (v_max / speeds.clamp(min=1e-6)).unsqueeze(dim=3)
+                clip_jacobian = clip_scale * (eye - torch.einsum("ani,anj->anij", directions, directions))
+                clip_jacobian = torch.where(is_clipped.unsqueeze(dim=3), clip_jacobian, eye)
+                velocities_jacobian = torch.einsum("anij,anjkl->anikl", clip_jacobian, velocities_jacobian)
+
+            positions = positions + velocities * self.dt
+            if with_jacobian:
+                positions_jacobian = positions_jacobian + velocities_jacobian * self.dt
+
+            # By adding a tiny amount of white gaussian noise we avoid troubles with zero variance. Then average
+            # the pdf-weighted particles to a uni-modal gaussian (see `ParticleEnvironment`). The noise is
+            # drawn for all ados, in order to be consistent with the particle-based simulation.
+            noise = torch.rand((self.num_ados, num_particles, 2))[sim_indices] * mantrap.constants.ENV_PARTICLE_NOISE
+            velocities_pdf = (velocities + noise) * particle_pdf
+            mus[:, t + 1, 2:4] = torch.mean(velocities_pdf, dim=1)
+            mus[:, t + 1, 0:2] = mus[:, t, 0:2] + mus[:, t, 2:4] * self.dt  # single integrator (!)
+            sigmas[:, t + 1, :] = torch.var(velocities_pdf, dim=1).clamp(min=mantrap.constants.ENV_PARTICLE_VAR_MIN)
+
+            if with_jacobian:
+                velocities_pdf_jacobian = velocities_jacobian * particle_pdf.view(num_sim, num_particles, 1, 1, 1)
+                velocities_pdf_centered = velocities_pdf - torch.mean(velocities_pdf, dim=1, keepdim=True)
+                mus_jacobian[:, t + 1, 2:4] = torch.mean(velocities_pdf_jacobian, dim=1)
+                mus_jacobian[:, t + 1, 0:2] = mus_jacobian[:, t, 0:2] + mus_jacobian[:, t, 2:4] * self.dt
+                sigmas_jacobian[:, t + 1] = 2 / (num_particles - 1) * torch.sum(
+                    velocities_pdf_centered.view(num_sim, num_particles, 2, 1, 1) * velocities_pdf_jacobian, dim=1)
+                is_var_min = torch.le(sigmas[:, t + 1, :], mantrap.constants.ENV_PARTICLE_VAR_MIN)
+                sigmas_jacobian[:, t + 1][is_var_min] = 0.0
+
+        sim_ids = [self.ado_ids[m_ado] for m_ado in sim_indices]
+        if with_jacobian:
+            return mus, sigmas, sim_ids, mus_jacobian, sigmas_jacobian
+        return mus, sigmas, sim_ids
+
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """As there is no interaction between the ados, merely the given ados have to be simulated."""
+        return [ado_id for ado_id in self.ado_ids if ado_id in ado_ids]
+
     ###########################################################################
     # Simulation parameters ###################################################
     ###########################################################################
@@ -44,6 +44,7 @@ class SocialForcesEnvironment(ParticleEnvironment):
                          v0_dict: typing.Dict[str, typing.Tuple[float, float]] = None,
                          sigma_dict: typing.Dict[str, typing.Tuple[float, float]] = None,
                          tau: float = mantrap.constants.SOCIAL_FORCES_DEFAULT_TAU,
+                         ado_ids: typing.List[str] = None,
                          **unused
                          ) -> typing.Tuple[typing.List[typing.List[mantrap.agents.IntegratorDTAgent]], torch.Tensor]:
         """Create particles from internal parameter distribution.
@@ -60,6 +61,7 @@ class SocialForcesEnvironment(ParticleEnvironment):
         :param sigma_dict: parameter sigma gaussian distribution (similar to `v0_dict`).
         :param tau: tau parameter, by default `mantrap.constants.SOCIAL_FORCES_DEFAULT_TAU`,
                     which has to be shared over all agents.
+        :param ado_ids: ids of ados to create particles for, by default all ados in the scene.
         :return: list of N = num_particles for every ado in the scene.
         :return: probability (pdf) of each particle (num_ados, num_particles).
         """
@@ -71,7 +73,8 @@ class SocialForcesEnvironment(ParticleEnvironment):
             sigma_dict = {ado_id: (sigma_default, sigma_variance) for ado_id in self.ado_ids}
         goal_dict = {ado.id: {"goal": ado.params["goal"]} for ado in self.ados}
         return super(SocialForcesEnvironment, self).create_particles(
-            num_particles, param_dicts={"v0": v0_dict, "sigma": sigma_dict}, const_dicts=goal_dict, tau=tau,
+            num_particles, param_dicts={"v0": v0_dict, "sigma": sigma_dict}, const_dicts=goal_dict, ado_ids=ado_ids,
+            tau=tau,
         )
 
     def simulate_particle(self,
@@ -97,6 +100,17 @@ class SocialForcesEnvironment(ParticleEnvironment):
             alpha_velocity: torch.Tensor,
             beta_velocity: torch.Tensor,
         ) -> torch.Tensor:
+            # The potential field is differentiated even if gradient tracking is disabled (e.g. for evaluating
+            # the prediction only), since the force is derived from it.
+            with torch.enable_grad():
+                return _repulsive_force_core(alpha_position, beta_position, alpha_velocity, beta_velocity)
+
+        def _repulsive_force_core(
+            alpha_position: torch.Tensor,
+            beta_position: torch.Tensor,
+            alpha_velocity: torch.Tensor,
+            beta_velocity: torch.Tensor,
+        ) -> torch.Tensor:
 
             # Relative properties and their norms.
             relative_distance = torch.sub(alpha_position, beta_position)
@@ -166,6 +180,22 @@ class SocialForcesEnvironment(ParticleEnvironment):
         particle.update(controls, dt=self.dt)
         return particle
 
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """Next to the given ados all ados in their neighbourhood are simulated, since they are (or are about to be)
+        in the range of the interaction force. Ados further away are assumed to not interact with the given ados
+        within the prediction horizon.
+
+        :param ado_ids: ids of ados to predict.
+        :return: ids of ados to simulate, in the order of the internal ado list.
+        """
+        if len(ado_ids) == 0:
+            return []
+        _, ado_states = self.states()
+        indices = torch.tensor([self.index_ado_id(ado_id) for ado_id in ado_ids])
+        distances = torch.cdist(ado_states[:, 0:2], ado_states[indices, 0:2])  # (num_ados, len(ado_ids))
+        is_neighbour = torch.any(distances < mantrap.constants.SOCIAL_FORCES_NEIGHBOUR_DISTANCE, dim=1)
+        return [ado_id for ado_id, is_neighbour_m in zip(self.ado_ids, is_neighbour) if is_neighbour_m]
+
     ###########################################################################
     # Scene ###################################################################
     ###########################################################################
@@ -0,0 +1,256 @@
+import os
+import typing
+
+import torch
+import torch.distributions
+
+import mantrap.agents
+import mantrap.constants
+import mantrap.utility.io
+import mantrap.utility.maths
+
+from .base import GraphBasedEnvironment
+
+
+_SURROGATE_MODELS = {}  # surrogate models by teacher environment name, shared within process (read-only)
+
+
+class SurrogateModel(torch.nn.Module):
+    """Small multi-layer perceptron approximating the prediction of some (expensive) environment, the teacher.
+
+    The model predicts the velocity distribution of a single ado over a fixed time horizon, as uni-modal
+    gaussian distribution (mean and log-standard-deviation at every time-step), conditioned on the ado's
+    recent velocities and the ego trajectory, relative to the ado's current position (see `features()`).
+    Predicting without ego is encoded by a flag, while the ego features are set to zero. The mean velocity
+    is predicted as difference to the ado's current velocity, so that an untrained model predicts constant
+    velocities. Interactions between ados are not taken into account.
+
+    :param t_horizon: (maximal) prediction horizon.
+    :param num_history: number of (past and current) ado velocities as input.
+    :param hidden_size: number of neurons per hidden layer.
+    """
+
+    def __init__(self, t_horizon: int = mantrap.constants.SURROGATE_HORIZON,
+                 num_history: int = mantrap.constants.SURROGATE_HISTORY,
+                 hidden_size: int = mantrap.constants.SURROGATE_HIDDEN_SIZE):
+        super(SurrogateModel, self).__init__()
+        self.t_horizon = t_horizon
+        self.num_history = num_history
+        self.hidden_size = hidden_size
+
+        num_inputs = 2 * num_history + 1 + 4 * (t_horizon + 1)
+        self.layers = torch.nn.Sequential(torch.nn.Linear(num_inputs, hidden_size), torch.nn.Tanh(),
+                                          torch.nn.Linear(hidden_size, hidden_size), torch.nn.Tanh(),
+                                          torch.nn.Linear(hidden_size, 4 * t_horizon))
+
+        # Input normalization, determined from the training data set.
+        self.register_buffer("input_mean", torch.zeros(num_inputs))
+        self.register_buffer("input_std", torch.ones(num_inputs))
+
+    def forward(self, features: torch.Tensor) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Predict the velocity distributions for the given features (num_samples, num_inputs).
+
+        :returns: mean velocities (num_samples, t_horizon, 2), log-standard-deviations (num_samples, t_horizon, 2).
+        """
+        velocity = features[:, 2 * self.num_history - 2:2 * self.num_history]  # current velocity
+        output = self.layers((features - self.input_mean) / self.input_std).view(-1, self.t_horizon, 4)
+        return velocity.unsqueeze(dim=1) + output[:, :, 0:2], output[:, :, 2:4]
+
+    def features(self, env: GraphBasedEnvironment, ego_trajectory: typing.Union[torch.Tensor, None],
+                 ado_ids: typing.List[str]) -> torch.Tensor:
+        """Build the model's input features for the given ados in the environment's current scene.
+
+        The features consist of the ado's last `num_history` velocities, a flag whether the ego is present
+        and the ego's positions (relative to the ado's current position) and velocities over the time horizon.
+        Shorter ego trajectories are extrapolated with constant velocity.
+
+        :param env: environment describing the scene (surrogate or teacher).
+        :param ego_trajectory: ego trajectory (t_horizon + 1, 5) or None for predicting without ego.
+        :param ado_ids: ids of ados to build features for.
+        :returns: features (num_ados, num_inputs).
+        """
+        num_ados = len(ado_ids)
+        ados = [env.ados[env.index_ado_id(ado_id)] for ado_id in ado_ids]
+        histories = torch.zeros((num_ados, self.num_history, 2))
+        for m_ado, ado in enumerate(ados):
+            velocities = ado.history[-self.num_history:, 2:4].detach()
+            histories[m_ado, -velocities.shape[0]:] = velocities
+            histories[m_ado, :-velocities.shape[0]] = velocities[0]
+        ado_positions = torch.stack([ado.position.detach() for ado in ados]) if num_ados > 0 else torch.zeros((0, 2))
+
+        if ego_trajectory is None:
+            ego_features = torch.zeros((num_ados, 1 + 4 * (self.t_horizon + 1)))
+        else:
+            t_extra = self.t_horizon + 1 - ego_trajectory.shape[0]
+            assert t_extra >= 0
+            positions, velocities = ego_trajectory[:, 0:2], ego_trajectory[:, 2:4]
+            if t_extra > 0:
+                steps = torch.arange(1, t_extra + 1).float().unsqueeze(dim=1) * env.dt
+                positions = torch.cat((positions, positions[-1] + steps * velocities[-1]))
+                velocities = torch.cat((velocities, velocities[-1].repeat(t_extra, 1)))
+            relative_positions = positions.unsqueeze(dim=0) - ado_positions.unsqueeze(dim=1)
+            velocities = velocities.unsqueeze(dim=0).repeat(num_ados, 1, 1)
+            ego_features = torch.cat((torch.ones((num_ados, 1)), relative_positions.reshape(num_ados, -1),
+                                      velocities.reshape(num_ados, -1)), dim=1)
+
+        return torch.cat((histories.view(num_ados, -1), ego_features), dim=1)
+
+    ###########################################################################
+    # Storage #################################################################
+    ###########################################################################
+    def save(self, path: str):
+        torch.save({"state_dict": self.state_dict(), "t_horizon": self.t_horizon, "num_history": self.num_history,
+                    "hidden_size": self.hidden_size}, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'SurrogateModel':
+        checkpoint = torch.load(path, map_location="cpu")
+        model = cls(t_horizon=checkpoint["t_horizon"], num_history=checkpoint["num_history"],
+                    hidden_size=checkpoint["hidden_size"])
+        model.load_state_dict(checkpoint["state_dict"])
+        return model
+
+
+class SurrogateEnvironment(GraphBasedEnvironment):
+    """Environment predicting by a learned surrogate of another (expensive) environment, e.g. Trajectron.
+
+    The surrogate model (see `SurrogateModel`) is distilled from the predictions of the teacher environment
+    in various scenarios (see `mantrap_evaluation.distillation`). It fulfills the same `compute_distributions()`
+    contract, while being much cheaper to evaluate and differentiate, however with some approximation error.
+    Multi-modal predictions are approximated by uni-modal gaussian distributions, and the ados are predicted
+    independently from each other. Therefore the surrogate environment is meant for speeding up parts of the
+    optimization which do not require the full accuracy, such as warm-starting (`WARM_START_SURROGATE`).
+
+    The distilled models are stored by the teacher environment's name, and loaded once per process.
+
+    :param teacher: name of the environment the surrogate model has been distilled from.
+    :param model: surrogate model, by default the registered (or stored) model of the `teacher` environment.
+    """
+    def __init__(
+        self,
+        ego_position: torch.Tensor = None,
+        ego_velocity: torch.Tensor = torch.zeros(2),
+        ego_history: torch.Tensor = None,
+        ego_type: mantrap.agents.base.DTAgent.__class__ = mantrap.agents.DoubleIntegratorDTAgent,
+        teacher: str = mantrap.constants.SURROGATE_TEACHER_DEFAULT,
+        model: SurrogateModel = None,
+        **env_kwargs
+    ):
+        super(SurrogateEnvironment, self).__init__(ego_position, ego_velocity, ego_history, ego_type, **env_kwargs)
+        self._teacher = teacher
+        self._model = model if model is not None else self.load_model(teacher)
+
+    ###########################################################################
+    # Surrogate model #########################################################
+    ###########################################################################
+    @staticmethod
+    def register_model(model: SurrogateModel, teacher: str):
+        """Register the surrogate model for the teacher environment (within the process)."""
+        model.eval()
+        model.requires_grad_(False)
+        _SURROGATE_MODELS[teacher] = model
+
+    @staticmethod
+    def load_model(teacher: str) -> SurrogateModel:
+        """Load the surrogate model of the teacher environment, either the registered model or the model
+        stored in the surrogate directory (see `mantrap_evaluation.distillation.distill()`)."""
+        if teacher not in _SURROGATE_MODELS:
+            directory = mantrap.utility.io.build_os_path(mantrap.constants.SURROGATE_DIRECTORY)
+            path = os.path.join(directory, f"{teacher}.pt")
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f"No surrogate model for {teacher} environment, distill it first !")
+            SurrogateEnvironment.register_model(SurrogateModel.load(path), teacher=teacher)
+        return _SURROGATE_MODELS[teacher]
+
+    ###########################################################################
+    # Simulation graph ########################################################
+    ###########################################################################
+    def _compute_distributions(self, ego_trajectory: typing.Union[typing.List, torch.Tensor],
+                               vel_dist: bool = True, ado_ids: typing.List[str] = None, **kwargs
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
+        """Build a connected graph based on the ego's trajectory.
+
+        Predict the velocity distribution of every ado using the surrogate model, which is differentiable
+        with respect to the ego trajectory. The positional distribution follows from integrating the velocities,
+        assuming independent velocities at every time-step.
+
+        :param ego_trajectory: ego's trajectory (t_horizon, 5).
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to predict, by default all ados in the scene.
+        :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
+        """
+        t_horizon = len(ego_trajectory) - 1  # works for tensor and list !
+        assert t_horizon <= self._model.t_horizon
+        ado_ids = self.ado_ids if ado_ids is None else [ado_id for ado_id in self.ado_ids if ado_id in ado_ids]
+        if all([x is None for x in ego_trajectory]):
+            ego_trajectory = None
+
+        # Without any ado to predict, return an empty distribution, as the other environments do.
+        if len(ado_ids) == 0:
+            zeros = torch.zeros((0, t_horizon, 1, 2))
+            distribution = torch.distributions.Normal(loc=zeros, scale=torch.ones_like(zeros))
+            return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=ado_ids)
+
+        features = self._model.features(self, ego_trajectory=ego_trajectory, ado_ids=ado_ids)
+        mus, log_sigmas = self._model(features)
+        mus, sigmas = mus[:, :t_horizon], torch.exp(log_sigmas[:, :t_horizon])
+        if not vel_dist:
+            # Exclusive sum over the velocities, so that the distribution at t = 0 is the current position
+            # (with initial variance), as for the other environments.
+            ado_positions = torch.stack([self.ados[self.index_ado_id(ado_id)].position for ado_id in ado_ids])
+            zeros = torch.zeros_like(mus[:, :1])
+            mus = ado_positions.unsqueeze(dim=1) + torch.cat((zeros, torch.cumsum(mus * self.dt, dim=1)[:, :-1]), dim=1)
+            variances = torch.cat((zeros, torch.cumsum((sigmas * self.dt) ** 2, dim=1)[:, :-1]), dim=1)
+            sigmas = torch.sqrt(variances + mantrap.constants.ENV_VAR_INITIAL ** 2)
+
+        distribution = torch.distributions.Normal(loc=mus.unsqueeze(dim=2), scale=sigmas.unsqueeze(dim=2))
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=ado_ids)
+
+    def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
+        """Build a dictionary of velocity distributions for every ado as it would be without the presence
+        of a robot in the scene, using the surrogate model (without ego features).
+
+        :param t_horizon: number of prediction time-steps.
+        :param vel_dist: return velocity (True) or positional distribution (False).
+        :kwargs: additional graph building arguments.
+        :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
+        """
+        return self._compute_distributions(ego_trajectory=[None] * (t_horizon + 1), vel_dist=vel_dist, **kwargs)
+
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """As the surrogate model predicts every ado independently, merely the given ados have to be predicted."""
+        return [ado_id for ado_id in self.ado_ids if ado_id in ado_ids]
+
+    ###########################################################################
+    # Operators ###############################################################
+    ###########################################################################
+    def copy(self, env_type: GraphBasedEnvironment.__class__ = None, **env_kwargs) -> GraphBasedEnvironment:
+        """Create copy of environment, which shares the surrogate model (if copied to a surrogate environment)."""
+        if env_type is None or issubclass(env_type, SurrogateEnvironment):
+            env_kwargs.setdefault("teacher", self._teacher)
+            env_kwargs.setdefault("model", self._model)
+        return super(SurrogateEnvironment, self).copy(env_type=env_type, **env_kwargs)
+
+    ###########################################################################
+    # Simulation parameters ###################################################
+    ###########################################################################
+    @property
+    def teacher(self) -> str:
+        return self._teacher
+
+    @property
+    def model(self) -> SurrogateModel:
+        return self._model
+
+    @property
+    def name(self) -> str:
+        return "surrogate"
+
+    @property
+    def num_modes(self) -> int:
+        return 1
+
+    @property
+    def is_differentiable_wrt_ego(self) -> bool:
+        return True
@@ -17,6 +17,9 @@ import mantrap.utility.shaping
 from .base import GraphBasedEnvironment
 
 
+_MODEL_REGISTRARS = {}  # Trajectron models by (model path, iteration), shared within process (read-only)
+
+
 class Trajectron(GraphBasedEnvironment):
     """Trajectron-based environment model (B. Ivanovic, T. Salzmann, M. Pavone).
 
@@ -56,11 +59,11 @@ class Trajectron(GraphBasedEnvironment):
                                                                   is_robot=True,
                                                                   identifier=mantrap.constants.ID_EGO)
 
-        # Create trajectron torch model with loaded configuration.
+        # Create trajectron torch model with loaded configuration. The model weights are shared by all
+        # environments (and their copies), only the scene state is environment-specific.
         from model.online.online_trajectron import OnlineTrajectron
-        from model.model_registrar import ModelRegistrar
-        model_registrar = ModelRegistrar(model_dir=self.config["trajectron_model_path"], device="cpu")
-        model_registrar.load_models(iter_num=self.config["trajectron_model_iteration"])
+        model_registrar = self.load_model_registrar(model_path=self.config["trajectron_model_path"],
+                                                    iteration=self.config["trajectron_model_iteration"])
         self.trajectron = OnlineTrajectron(model_registrar, hyperparams=self.config, device="cpu")
 
         # Create default trajectron scene. The duration of the scene is not known a priori, however a large value
@@ -69,6 +72,7 @@ class Trajectron(GraphBasedEnvironment):
 
         # Add robot to the scene as a first node.
         self._online_env = None
+        self._scene_cache = {}
         self._add_agent_to_graph(agent=self.ego if self.ego is not None else self._pseudo_ego)
 
     ###########################################################################
@@ -141,8 +145,10 @@ class Trajectron(GraphBasedEnvironment):
             self._gt_scene.robot = node
         self._gt_scene.nodes.append(node)
 
-        # Re-Create online environment with recently appended node.
+        # Re-Create online environment with recently appended node. Since the scene has changed, all
+        # scene-dependent (cached) values are outdated.
         self._online_env = self.create_online_env(env=self._gt_env, scene=self._gt_scene)
+        self._scene_cache = {}
 
     @staticmethod
     def agent_id_from_node(node: str) -> str:
@@ -160,8 +166,9 @@ class Trajectron(GraphBasedEnvironment):
     ###########################################################################
     # Simulation Graph ########################################################
     ###########################################################################
-    def _compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True, **kwargs
-                               ) -> typing.Dict[str, torch.distributions.Distribution]:
+    def _compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True,
+                               ado_ids: typing.List[str] = None, **kwargs
+                               ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph based on the ego's trajectory.
 
         The graph should span over the time-horizon of the length of the ego's trajectory and contain the
@@ -181,26 +188,21 @@ class Trajectron(GraphBasedEnvironment):
         mus.shape: (num_ados = 1, 1, t_horizon, num_modes, 2)
         log_pis.shape: (num_ados = 1, 1, t_horizon, num_modes)
 
+        When merely a subset of ados should be predicted (`ado_ids`), the Trajectron scene graph is built from
+        the nodes of these ados (and the robot) only.
+
         :param ego_trajectory: ego's trajectory (t_horizon, 5).
         :param vel_dist: return velocity (True) or positional distribution (False).
+        :param ado_ids: ids of ados to predict, by default all ados in the scene.
         :return: ado_id-keyed velocity distribution dictionary for times [0, t_horizon].
         """
         assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory, pos_and_vel_only=True)
         assert self.num_ados > 0  # trajectron conditioned on ados and ego, so both must be in the scene (!)
         t_horizon = ego_trajectory.shape[0] - 1
-
-        # Create the buffer of agent state histories to pass to environment. As Trajectron is called several
-        # times in each environment step, we do not want it to store agent updates internally, but rather
-        # pass it the full agent histories.
-        pos_dicts = []
-        for t in range(-5, 0):
-            node_state_dict = {}
-            for node in self._gt_scene.nodes:
-                if node.id == mantrap.constants.ID_EGO:
-                    node_state_dict[node] = self.agent_by_id(node.id).position.detach()
-                else:
-                    node_state_dict[node] = self.agent_by_id(node.id).history[t, 0:2].detach()
-            pos_dicts.append(node_state_dict)
+        online_env = self._online_env if ado_ids is None else self._online_env_subset(ado_ids=ado_ids)
+        node_ids = None if ado_ids is None else [mantrap.constants.ID_EGO] + list(ado_ids)
+        pos_dicts = [{node: pos for node, pos in pos_dict.items() if node_ids is None or node.id in node_ids}
+                     for pos_dict in self._history_pos_dicts()]  # do not expose cache to model
 
         # Trajectron requires the ego trajectory to consist of (pos, velocity, acceleration). So compute
         # the accelerations using numerical differentiation. Although the pseudo-ego is used here, it is
@@ -210,7 +212,7 @@ class Trajectron(GraphBasedEnvironment):
 
         # Core trajectron prediction call (returning velocity distribution !).
         trajectron_dist_dict, _ = self.trajectron.forward(
-            init_env=self._online_env,
+            init_env=online_env,
             init_timestep=0,
             pos_dicts=pos_dicts,
             num_predicted_timesteps=t_horizon,
@@ -220,35 +222,40 @@ class Trajectron(GraphBasedEnvironment):
             robot_present_and_future=trajectory_w_acc
         )
 
-        # Build ado-wise dictionary distribution of probability distributions. The Trajectron distribution is a
-        # dictionary mapping the GenTrajectron tag ("{class_id}/{id}") to a distribution object, defined in gmm2d.py
+        # Build a batched distribution over all predicted ados. The Trajectron distribution is a dictionary
+        # mapping the GenTrajectron tag ("{class_id}/{id}") to a distribution object, defined in gmm2d.py
         # in its code base (GMM with n = 25 modes).
-        dist_dict = {}
+        # Re-Map the node-id to the agent tags using within this project during initialization
+        # (enforced to be identical except of type-tag during initialization).
+        node_dists = {self.agent_id_from_node(node): dist for node, dist in trajectron_dist_dict.items()}
+        predicted_ids = [ado_id for ado_id in self.ado_ids if ado_id in node_dists.keys()]
+        num_predicted = len(predicted_ids)
         m = self.num_modes
-        _, ado_states = self.states()
-        for node, dist in trajectron_dist_dict.items():
-            # Re-Map the node-id to the agent tags using within this project during initialization
-            # (enforced to be identical except of type-tag during initialization).
-            ado_id = self.agent_id_from_node(node)
-            i_ado = self.index_ado_id(ado_id=ado_id)
-
-            # Shift (relative) distribution to initial absolute position (if positional distribution).
-            mus = dist.mus.view(t_horizon, m, 2)  # t_horizon, num_modes, num_dims = 2 (= x, y)
-            if not vel_dist:  # positional distribution
-                mus += ado_states[i_ado, 0:2]
-
-            # Convert the distribution into the project-custom definition of a GMM, since some properties
-            # as e.g. mean are not defined in gmm2d.py and since another shape format is used.
-            log_sigmas = dist.log_sigmas.view(t_horizon, m, 2)
-            corrs = dist.corrs.view(t_horizon, m)
-            log_pis = dist.log_pis.view(t_horizon, m)
-            distribution = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=log_sigmas, corrs=corrs)
-            dist_dict[ado_id] = distribution
-
-        return dist_dict
+
+        mus = torch.zeros((num_predicted, t_horizon, m, 2))  # num_ados, t_horizon, num_modes, num_dims = 2
+        log_sigmas = torch.zeros((num_predicted, t_horizon, m, 2))
+        corrs = torch.zeros((num_predicted, t_horizon, m))
+        log_pis = torch.zeros((num_predicted, t_horizon, m))
+        for i_ado, ado_id in enumerate(predicted_ids):
+            dist = node_dists[ado_id]
+            mus[i_ado] = dist.mus.view(t_horizon, m, 2)
+            log_sigmas[i_ado] = dist.log_sigmas.view(t_horizon, m, 2)
+            corrs[i_ado] = dist.corrs.view(t_horizon, m)
+            log_pis[i_ado] = dist.log_pis.view(t_horizon, m)
+
+        # Shift (relative) distribution to initial absolute position (if positional distribution).
+        if not vel_dist:  # positional distribution
+            _, ado_states = self.states()
+            predicted_indices = [self.index_ado_id(ado_id=ado_id) for ado_id in predicted_ids]
+            mus = mus + ado_states[predicted_indices, 0:2].view(num_predicted, 1, 1, 2)
+
+        # Convert the distribution into the project-custom definition of a GMM, since some properties
+        # as e.g. mean are not defined in gmm2d.py and since another shape format is used.
+        distribution = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=log_sigmas, corrs=corrs)
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=predicted_ids)
 
     def _compute_distributions_wo_ego(self, t_horizon: int, vel_dist: bool = True, **kwargs
-                                      ) -> typing.Dict[str, torch.distributions.Distribution]:
+                                      ) -> mantrap.utility.maths.MultiAgentDistribution:
         """Build a connected graph over `t_horizon` time-steps for ados only.
 
         The graph should span over the time-horizon of the inputted number of time-steps and contain the state
@@ -260,12 +267,67 @@ class Trajectron(GraphBasedEnvironment):
         of the agents in the scene if no ego would be there, a "pseudo"-ego-trajectory is built, by shifting it
         to the borders of the environment and having nearly zero velocity.
 
+        As the pseudo-ego-trajectory merely depends on the prediction horizon, the un-conditioned distributions
+        are computed once per scene state and cached afterwards (detached from the computation graph).
+
         :param t_horizon: number of prediction time-steps.
         :param vel_dist: return velocity (True) or positional distribution (False).
         :return: dictionary over every state of every ado in the scene for t in [0, t_horizon].
         """
-        pseudo_trajectory = self._pseudo_ego.unroll_trajectory(torch.zeros((t_horizon, 2)), dt=self.dt)
-        return self._compute_distributions(pseudo_trajectory, vel_dist=vel_dist, **kwargs)
+        cache_key = ("wo_ego", t_horizon, vel_dist)
+        if cache_key not in self._scene_cache:
+            pseudo_trajectory = self._pseudo_ego.unroll_trajectory(torch.zeros((t_horizon, 2)), dt=self.dt)
+            with torch.no_grad():  # independent from ego, cached graph would be freed after first backward pass
+                dist_dict = self._compute_distributions(pseudo_trajectory, vel_dist=vel_dist, **kwargs)
+            self._scene_cache[cache_key] = dist_dict
+        return self._scene_cache[cache_key]
+
+    def _history_pos_dicts(self) -> typing.List[typing.Dict[typing.Any, torch.Tensor]]:
+        """Create the buffer of agent state histories to pass to the Trajectron.
+
+        As Trajectron is called several times in each environment step, we do not want it to store agent updates
+        internally, but rather pass it the full agent histories. Since the histories only change with the scene,
+        but not with the ego trajectory to condition on, the buffer is built once per scene state and cached.
+        """
+        if "pos_dicts" not in self._scene_cache:
+            pos_dicts = []
+            for t in range(-5, 0):
+                node_state_dict = {}
+                for node in self._gt_scene.nodes:
+                    if node.id == mantrap.constants.ID_EGO:
+                        node_state_dict[node] = self.agent_by_id(node.id).position.detach()
+                    else:
+                        node_state_dict[node] = self.agent_by_id(node.id).history[t, 0:2].detach()
+                pos_dicts.append(node_state_dict)
+            self._scene_cache["pos_dicts"] = pos_dicts
+        return self._scene_cache["pos_dicts"]
+
+    def _online_env_subset(self, ado_ids: typing.List[str]):
+        """Create the online environment of the scene containing the robot and the given ados only. As the
+        online environment only depends on the scene state, it is cached for every subset of ados."""
+        cache_key = ("online_env", tuple(ado_ids))
+        if cache_key not in self._scene_cache:
+            scene, env = self.create_env_and_scene()
+            node_ids = [mantrap.constants.ID_EGO] + list(ado_ids)
+            scene.nodes = [node for node in self._gt_scene.nodes if node.id in node_ids]
+            scene.robot = self._gt_scene.robot
+            self._scene_cache[cache_key] = self.create_online_env(env=env, scene=scene)
+        return self._scene_cache[cache_key]
+
+    def interacting_ado_ids(self, ado_ids: typing.List[str]) -> typing.List[str]:
+        """Next to the given ados all ados within the Trajectron's pedestrian attention radius are
+        connected to them in the scene graph, so that they have to be taken into account as well.
+
+        :param ado_ids: ids of ados to predict.
+        :return: ids of ados to simulate, in the order of the internal ado list.
+        """
+        if len(ado_ids) == 0:
+            return []
+        _, ado_states = self.states()
+        indices = torch.tensor([self.index_ado_id(ado_id) for ado_id in ado_ids])
+        distances = torch.cdist(ado_states[:, 0:2], ado_states[indices, 0:2])  # (num_ados, len(ado_ids))
+        is_neighbour = torch.any(distances <= self.config["attention_radius_pp"], dim=1)
+        return [ado_id for ado_id, is_neighbour_m in zip(self.ado_ids, is_neighbour) if is_neighbour_m]
 
     def detach(self):
         """Detaching the whole graph (which is the whole neural network) might be hard. Therefore just rebuilt it
@@ -281,6 +343,22 @@ class Trajectron(GraphBasedEnvironment):
         for ado in self.ados:
             self._add_agent_to_graph(agent=ado)
 
+    def snapshot(self) -> typing.Dict[str, typing.Any]:
+        """Next to the agent states the Trajectron scene representation is stored. Since the scene nodes are
+        never altered but re-created (see `_add_agent_to_graph()` and `detach()`), storing references suffices."""
+        snapshot = super(Trajectron, self).snapshot()
+        snapshot["scene_nodes"] = list(self._gt_scene.nodes)
+        snapshot["scene_robot"] = self._gt_scene.robot
+        snapshot["online_env"] = self._online_env
+        return snapshot
+
+    def restore(self, snapshot: typing.Dict[str, typing.Any]):
+        super(Trajectron, self).restore(snapshot)
+        self._gt_scene.nodes = list(snapshot["scene_nodes"])
+        self._gt_scene.robot = snapshot["scene_robot"]
+        self._online_env = snapshot["online_env"]
+        self._scene_cache = {}
+
     ###########################################################################
     # GenTrajectron ###########################################################
     ###########################################################################
@@ -289,6 +367,26 @@ class Trajectron(GraphBasedEnvironment):
         if Trajectron.module_os_path() not in sys.path:
             sys.path.insert(0, Trajectron.module_os_path())
 
+    @staticmethod
+    def load_model_registrar(model_path: str, iteration: int):
+        """Load the Trajectron model registrar (i.e. the model weights) from the given path and iteration.
+
+        Loading the model from disk is expensive, while the weights are never changed within this project.
+        Therefore every model is loaded lazily only once per process and shared by all Trajectron environments,
+        including copies of them, which then merely hold their own scene state. The cached models must be
+        treated as read-only.
+
+        :param model_path: path to trained Trajectron model directory.
+        :param iteration: training iteration of model to load.
+        """
+        key = (os.path.abspath(model_path), iteration)
+        if key not in _MODEL_REGISTRARS:
+            from model.model_registrar import ModelRegistrar
+            model_registrar = ModelRegistrar(model_dir=model_path, device="cpu")
+            model_registrar.load_models(iter_num=iteration)
+            _MODEL_REGISTRARS[key] = model_registrar
+        return _MODEL_REGISTRARS[key]
+
     def create_env_and_scene(self):
         from data import Environment, Scene
         scene = Scene(timesteps=100, map=None, dt=self.dt)
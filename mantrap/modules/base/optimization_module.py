@@ -69,6 +69,11 @@ class OptimizationModule(abc.ABC):
         if self._env is not None:
             self._env = env
 
+    def reset_cache(self):
+        """Reset cached intermediate results, which are derived from the environment's predictions, e.g. when
+        the environment's prediction model has changed while the scene has not. By default nothing is cached."""
+        pass
+
     ###########################################################################
     # Objective ###############################################################
     ###########################################################################
@@ -199,6 +204,78 @@ class OptimizationModule(abc.ABC):
         """
         return None
 
+    ###########################################################################
+    # Hessian #################################################################
+    ###########################################################################
+    def hessian(self, ego_trajectory: torch.Tensor, grad_wrt: torch.Tensor, ado_ids: typing.List[str], tag: str
+                ) -> np.ndarray:
+        """Determine (approximated) hessian matrix of the objective for passed ego trajectory.
+
+        Back-propagating twice through the computation graph would be very costly, therefore only analytic
+        hessians or approximations thereof (e.g. Gauss-Newton) are taken into account. If none is defined
+        for the module, its hessian is assumed to be zero.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon, 5).
+        :param grad_wrt: vector w.r.t. which the hessian should be determined.
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        """
+        hessian = self.compute_hessian_analytically(ego_trajectory, grad_wrt, ado_ids=ado_ids, tag=tag)
+        if hessian is None:
+            hessian = np.zeros((grad_wrt.numel(), grad_wrt.numel()))
+        return self.weight * self.normalize(hessian)
+
+    def compute_hessian_analytically(
+        self, ego_trajectory: torch.Tensor, grad_wrt: torch.Tensor, ado_ids: typing.List[str], tag: str
+    ) -> typing.Union[np.ndarray, None]:
+        """Compute objective hessian matrix analytically.
+
+        By default the hessian is derived from the stage-wise hessian (if defined) by applying the chain rule.
+        As the ego's dynamics are linear, the second derivative of the trajectory w.r.t. the controls vanishes:
+
+        .. math:: \\nabla^2 J = \\frac{dx}{du}^T \\frac{d^2 J}{dx^2} \\frac{dx}{du}
+
+        When no analytical solution is defined (or too hard to determine) return None.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon, 5).
+        :param grad_wrt: vector w.r.t. which the hessian should be determined.
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        """
+        hessian_stage = self.compute_stage_hessian_analytically(ego_trajectory, ado_ids=ado_ids, tag=tag)
+        if hessian_stage is None or self._env is None:
+            return None
+
+        with torch.no_grad():
+            ego_controls = self._env.ego.roll_trajectory(ego_trajectory, dt=self._env.dt)
+            dx_du = self._env.ego.dx_du(ego_controls, dt=self._env.dt).detach().numpy()
+
+        T, x_size, _ = hessian_stage.shape
+        hessian_x = np.zeros((T * x_size, T * x_size))
+        for t in range(T):
+            hessian_x[t * x_size:(t + 1) * x_size, t * x_size:(t + 1) * x_size] = hessian_stage[t]
+        return np.matmul(dx_du.T, np.matmul(hessian_x, dx_du))
+
+    def compute_stage_hessian_analytically(self, ego_trajectory: torch.Tensor, ado_ids: typing.List[str], tag: str
+                                           ) -> typing.Union[np.ndarray, None]:
+        """Compute stage-wise objective hessian analytically.
+
+        Stage-wise (i.e. block-diagonal) second derivatives of the objective with respect to each state of
+        the ego trajectory, which are used by solvers that exploit the stage-wise structure of the optimization
+        problem (such as iLQR). Cross-terms between different trajectory states are neglected, so for objectives
+        which depend on the whole trajectory at once (such as interaction-based objectives), the hessian blocks
+        merely are an approximation. Equal to the analytic gradient, the hessian is neither weighted nor
+        normalized.
+
+        When no analytical solution is defined (or too hard to determine) return None.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon + 1, 5).
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        :returns: hessian blocks of the objective w.r.t. every trajectory state (t_horizon + 1, 5, 5).
+        """
+        return None
+
     ###########################################################################
     # Constraint ##############################################################
     ###########################################################################
@@ -480,6 +557,19 @@ class OptimizationModule(abc.ABC):
     def _num_constraints(self, ado_ids: typing.List[str]) -> int:
         raise NotImplementedError
 
+    def shift_multipliers(self, multipliers: np.ndarray, ado_ids: typing.List[str]) -> np.ndarray:
+        """Shift the lagrange multipliers of the module's constraints by one time-step, for warm-starting the
+        optimization in the next receding-horizon step (equal to shifting the optimization variables).
+
+        By default the constraints are assumed to not be time-indexed, so that the multipliers are
+        returned unchanged.
+
+        :param multipliers: lagrange multipliers of the module's constraints (num_constraints).
+        :param ado_ids: ghost ids which have been taken into account for computation.
+        """
+        assert multipliers.size == self.num_constraints(ado_ids=ado_ids)
+        return multipliers
+
     ###########################################################################
     # Constraint Violation ####################################################
     ###########################################################################
@@ -51,10 +51,11 @@ class InteractionAccelerationModule(PureObjectiveModule):
             return None
 
         # If more than zero ado agents are taken into account, compute the objective as described.
-        # It is important to take all agents into account during the environment forward prediction step
-        # (`compute_distributions()`) to not introduce possible behavioural changes into the forward prediction,
-        # which occur due to a reduction of the agents in the scene.
-        acceleration = self.summarize_distribution(ego_trajectory)
+        # It is important to take all interacting agents into account during the environment forward prediction
+        # step (`compute_distributions()`) to not introduce possible behavioural changes into the forward
+        # prediction, which occur due to a reduction of the agents in the scene. This is ensured by the
+        # environment when predicting a subset of ados.
+        acceleration = self.summarize_distribution(ego_trajectory, ado_ids=ado_ids)
 
         # Average of all ados that should be taken into account.
         cost = torch.zeros(1)
@@ -67,19 +68,20 @@ class InteractionAccelerationModule(PureObjectiveModule):
         # Clamp maximal value (minimal is zero anyways, due to L2-norm).
         return cost.clamp_max(self._max_value)
 
-    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None]) -> torch.Tensor:
-        """Compute ado-wise accelerations from velocity distribution dict mean values."""
+    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None],
+                               ado_ids: typing.List[str] = None) -> torch.Tensor:
+        """Compute ado-wise accelerations from velocity distribution dict mean values (of all ados, if the
+        `ado_ids` are not given, otherwise the remaining rows are zero)."""
         if ego_trajectory is not None:
-            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=True)
+            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=True, ado_ids=ado_ids)
         else:
             dist_dict = self.env.compute_distributions_wo_ego(t_horizon=self.t_horizon)
 
         sample_length = self.env.num_modes * (self.t_horizon - 1)
         accelerations = torch.zeros((self.env.num_ados, sample_length, 2))
-        for ado_id, distribution in dist_dict.items():
-            m_ado = self.env.index_ado_id(ado_id)
-            acc = mantrap.utility.maths.derivative_numerical(distribution.mean, dt=self.env.dt)
-            accelerations[m_ado, :, :] = acc.view(-1, 2)
+        ado_indices = [self.env.index_ado_id(ado_id) for ado_id in dist_dict.ids]
+        acc = mantrap.utility.maths.derivative_numerical(dist_dict.mean, dt=self.env.dt)
+        accelerations[ado_indices, :, :] = acc.reshape(len(ado_indices), -1, 2)
 
         return accelerations
 
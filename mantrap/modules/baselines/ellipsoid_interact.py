@@ -56,25 +56,26 @@ class InteractionEllipsoidModule(PureConstraintModule):
 
         return constraints.flatten()
 
-    def summarize_distribution(self, pos_dist_dict: typing.Dict[str, torch.distributions.Distribution],
+    def summarize_distribution(self, pos_dist_dict: mantrap.utility.maths.MultiAgentDistribution,
                                num_modes: int) -> typing.Tuple[torch.Tensor, torch.Tensor]:
-        """Compute ado-wise positions from positional distribution dict mean and std values."""
-        _, ado_states = self.env.states()
+        """Compute ado-wise positions from positional distribution mean and std values of the
+        `num_modes` most important modes, sorted by increasing importance. If the distribution does not
+        have more than `num_modes` modes, all of them are used in their original order."""
         pos_means = torch.zeros((self.env.num_ados, self.t_horizon + 1, num_modes, 2))
         pos_sigmas = torch.zeros((self.env.num_ados, self.t_horizon + 1, num_modes, 2))
 
-        for ado_id, distribution in pos_dist_dict.items():
-            m_ado = self.env.index_ado_id(ado_id)
-
-            if self.env.num_modes > num_modes:
-                modes_mi = distribution.modes_sorted()[:, -num_modes:]  # most-important modes
-            else:
-                modes_mi = np.stack([np.arange(0, self.env.num_modes)] * self.t_horizon)
-
-            for t in range(self.t_horizon):
-                pos_means[m_ado, t, :, :] = distribution.mean[t, modes_mi[t, :], :].detach()
-                pos_sigmas[m_ado, t, :, :] = distribution.stddev[t, modes_mi[t, :], :].detach()
-
+        # Gather the most-important modes of every ado and time-step at once.
+        num_ados_dist, _, num_modes_dist, _ = pos_dist_dict.mean.shape
+        if num_modes_dist > num_modes:
+            modes_mi = torch.flip(pos_dist_dict.top_k_modes(k=num_modes)[:, :self.t_horizon], dims=(-1, ))
+        else:
+            modes_mi = torch.arange(num_modes_dist).view(1, 1, -1).repeat(num_ados_dist, self.t_horizon, 1)
+        modes_mi = modes_mi.unsqueeze(dim=-1).repeat(1, 1, 1, 2)
+        ado_indices = [self.env.index_ado_id(ado_id) for ado_id in pos_dist_dict.ids]
+        mean = pos_dist_dict.mean[:, :self.t_horizon].detach()
+        stddev = pos_dist_dict.stddev[:, :self.t_horizon].detach()
+        pos_means[ado_indices, :self.t_horizon] = torch.gather(mean, dim=2, index=modes_mi)
+        pos_sigmas[ado_indices, :self.t_horizon] = torch.gather(stddev, dim=2, index=modes_mi)
         return pos_means, pos_sigmas
 
     def gradient_condition(self) -> bool:
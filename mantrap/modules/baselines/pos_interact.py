@@ -28,17 +28,18 @@ class InteractionPositionModule(InteractionAccelerationModule):
         super(InteractionPositionModule, self).__init__(env=env, t_horizon=t_horizon, weight=weight)
         self._max_value = mantrap.constants.OBJECTIVE_POS_INTERACT_MAX
 
-    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None]) -> torch.Tensor:
-        """Compute ado-wise positions from velocity distribution dict mean values."""
+    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None],
+                               ado_ids: typing.List[str] = None) -> torch.Tensor:
+        """Compute ado-wise positions from velocity distribution dict mean values (of all ados, if the
+        `ado_ids` are not given, otherwise the remaining rows are zero)."""
         if ego_trajectory is not None:
-            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=False)
+            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=False, ado_ids=ado_ids)
         else:
             dist_dict = self.env.compute_distributions_wo_ego(t_horizon=self.t_horizon)
 
         positions = torch.zeros((self.env.num_ados, self.t_horizon, self.env.num_modes, 2))
-        for ado_id, distribution in dist_dict.items():
-            m_ado = self.env.index_ado_id(ado_id)
-            positions[m_ado, :, :, :] = distribution.mean
+        ado_indices = [self.env.index_ado_id(ado_id) for ado_id in dist_dict.ids]
+        positions[ado_indices, :, :, :] = dist_dict.mean
         return positions
 
     ###########################################################################
@@ -29,18 +29,19 @@ class InteractionVelocityModule(InteractionAccelerationModule):
         super(InteractionVelocityModule, self).__init__(env=env, t_horizon=t_horizon, weight=weight)
         self._max_value = mantrap.constants.OBJECTIVE_VEL_INTERACT_MAX
 
-    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None]) -> torch.Tensor:
-        """Compute ado-wise velocities from velocity distribution dict mean values."""
+    def summarize_distribution(self, ego_trajectory: typing.Union[torch.Tensor, None],
+                               ado_ids: typing.List[str] = None) -> torch.Tensor:
+        """Compute ado-wise velocities from velocity distribution dict mean values (of all ados, if the
+        `ado_ids` are not given, otherwise the remaining rows are zero)."""
         if ego_trajectory is not None:
-            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=True)
+            dist_dict = self.env.compute_distributions(ego_trajectory=ego_trajectory, vel_dist=True, ado_ids=ado_ids)
         else:
             dist_dict = self.env.compute_distributions_wo_ego(t_horizon=self.t_horizon)
 
         sample_length = self.env.num_modes * self.t_horizon
         velocities = torch.zeros((self.env.num_ados, sample_length, 2))
-        for ado_id, distribution in dist_dict.items():
-            m_ado = self.env.index_ado_id(ado_id)
-            velocities[m_ado, :, :] = distribution.mean.view(-1, 2)
+        ado_indices = [self.env.index_ado_id(ado_id) for ado_id in dist_dict.ids]
+        velocities[ado_indices, :, :] = dist_dict.mean.reshape(len(ado_indices), -1, 2)
         return velocities
 
     ###########################################################################
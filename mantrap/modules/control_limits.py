@@ -117,6 +117,19 @@ class ControlLimitModule(PureConstraintModule):
     def _num_constraints(self, ado_ids: typing.List[str]) -> int:
         return self.t_horizon * 2
 
+    def shift_multipliers(self, multipliers: np.ndarray, ado_ids: typing.List[str]) -> np.ndarray:
+        """Shift the lagrange multipliers of the module's constraints by one time-step.
+
+        As the constraints are stacked over time, with two constraints (for both control components)
+        per time-step, the multipliers are shifted by one time-step and the last time-step is assumed
+        to be inactive (zero multipliers), equal to the zero controls appended to the shifted controls.
+
+        :param multipliers: lagrange multipliers of the module's constraints (num_constraints).
+        :param ado_ids: ghost ids which have been taken into account for computation.
+        """
+        assert multipliers.size == self.num_constraints(ado_ids=ado_ids)
+        return np.concatenate((multipliers[2:], np.zeros(2)))
+
     ###########################################################################
     # Constraint Properties ###################################################
     ###########################################################################
@@ -104,6 +104,27 @@ class GoalNormModule(PureObjectiveModule):
 
         return np.matmul(dJ_dx.flatten(), dx_du)
 
+    def compute_stage_hessian_analytically(self, ego_trajectory: torch.Tensor, ado_ids: typing.List[str], tag: str
+                                           ) -> typing.Union[np.ndarray, None]:
+        """Compute stage-wise objective hessian analytically.
+
+        As the (mean) squared goal distance is a sum of independent terms for every trajectory state, its
+        hessian is block-diagonal, with constant blocks for every position. The speed-cost however is not
+        quadratic, therefore no analytic solution is returned when it is included in the objective.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon + 1, 5).
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        """
+        assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory)
+        if self._optimize_speed:
+            return None
+
+        T = ego_trajectory.shape[0]
+        hessian = np.zeros((T, 5, 5))
+        hessian[:, 0, 0] = hessian[:, 1, 1] = 1 / T  # 2 / (2D * t_planning)
+        return hessian
+
     def normalize(self, x: typing.Union[np.ndarray, float]) -> typing.Union[np.ndarray, float]:
         """Normalize the objective/constraint value for improved optimization performance.
 
@@ -42,18 +42,39 @@ class InteractionProbabilityModule(PureObjectiveModule):
     Since the distributions itself are constant, while the sampled trajectories vary, the objective is also
     constant regarding the same scenario, which also improves its "optimise-ability".
 
+    For multi-modal distributions with many modes (e.g. Trajectron's 25 modes) most of the probability mass
+    usually is concentrated in a few modes. Optionally the conditioned distribution therefore can be pruned to
+    its most important modes (by number or covered probability mass), which reduces the cost of evaluating the
+    objective and its gradient at the cost of a (usually small) approximation error.
+
     :param env: solver's environment environment for predicting the behaviour without interaction.
+    :param num_modes: number of most important modes to take into account (by default all modes).
+    :param mode_mass: probability mass the modes taken into account have to cover (by default all modes).
     """
 
     def __init__(self, env: mantrap.environment.base.GraphBasedEnvironment, t_horizon: int, weight: float = 1.0,
-                 **unused):
+                 num_modes: int = None, mode_mass: float = None, **unused):
         super(InteractionProbabilityModule, self).__init__(env=env, t_horizon=t_horizon, weight=weight)
+        self._num_modes = num_modes
+        self._mode_mass = mode_mass
+        self._derivatives_cache = {}  # type: typing.Dict[str, typing.Tuple[torch.Tensor, typing.List[str], tuple]]
 
         # Determine mean trajectories and weights of unconditioned distribution. Therefore compute the
         # unconditioned distribution and store the resulting values in an ado-id-keyed dictionary.
         if env.num_ados > 0:
             self._dist_un_conditioned = env.compute_distributions_wo_ego(t_horizon)
 
+    def reset_env(self, env: mantrap.environment.base.GraphBasedEnvironment):
+        """Reset the module's environment. As the scene might have changed, the unconditioned distribution
+        has to be re-computed as well (and cached derivatives are invalid)."""
+        super(InteractionProbabilityModule, self).reset_env(env=env)
+        self.reset_cache()
+        if env.num_ados > 0:
+            self._dist_un_conditioned = env.compute_distributions_wo_ego(self.t_horizon)
+
+    def reset_cache(self):
+        self._derivatives_cache = {}
+
     def _objective_core(self, ego_trajectory: torch.Tensor, ado_ids: typing.List[str], tag: str
                         ) -> typing.Union[torch.Tensor, None]:
         """Determine objective value core method.
@@ -70,13 +91,18 @@ class InteractionProbabilityModule(PureObjectiveModule):
         # Compute the conditioned distribution. Then for every ado in the ado_ids`-list determine the `
         # probability of occurring in this distribution, using the distributions core methods.
         # Note: `log_prob()` already weights the probabilities with the mode weights (if multi-modal) !
-        dist_dict = self.env.compute_distributions(ego_trajectory)
-        objective = torch.zeros(1)
-        for ado_id in ado_ids:
-            # p = self._dist_un_conditioned[ado_id].log_prob(dist_dict[ado_id].mean)
-            p = dist_dict[ado_id].log_prob(self._dist_un_conditioned[ado_id].mean)
-            objective += torch.sum(p)
-        objective = objective / len(ado_ids)  # average over ado-ids
+        # Since both distributions are batched over the ados, this can be evaluated for all ados at once.
+        dist_dict = self.env.compute_distributions(ego_trajectory, ado_ids=ado_ids)
+        means_un_conditioned = self._dist_un_conditioned.mean[self._dist_un_conditioned.index(ado_ids)]
+
+        # The modes of both distributions are compared mode-wise, so prune the un-conditioned means as well.
+        if self._num_modes is not None or self._mode_mass is not None:
+            dist_dict, modes = dist_dict.prune_modes(num_modes=self._num_modes, mass=self._mode_mass)
+            modes = modes.unsqueeze(dim=-1).expand(*modes.shape, 2)
+            means_un_conditioned = torch.gather(means_un_conditioned, dim=2, index=modes)
+
+        p = dist_dict.log_prob(means_un_conditioned)
+        objective = torch.sum(p).view(1) / len(ado_ids)  # average over ado-ids
 
         # We want to maximize the probability of the unconditioned trajectories in the conditioned
         # distribution, so we minimize its negative value.
@@ -85,6 +111,103 @@ class InteractionProbabilityModule(PureObjectiveModule):
         objective = objective.clamp(-max_value, max_value)
         return objective
 
+    def compute_gradient_analytically(
+        self, ego_trajectory: torch.Tensor, grad_wrt: torch.Tensor, ado_ids: typing.List[str], tag: str
+    ) -> typing.Union[np.ndarray, None]:
+        """Compute objective gradient vector analytically.
+
+        If the environment can derive the jacobian of its (uni-modal, gaussian) predictions with respect to
+        the ego's controls in closed form (see `compute_distributions_with_jacobian()`), the objective's gradient
+        follows from the derivatives of the gaussian log-likelihood with respect to its mean and scale:
+
+        .. math:: \\frac{d log p}{d \\mu} = \\frac{x - \\mu}{\\sigma^2}
+        .. math:: \\frac{d log p}{d \\sigma} = \\frac{(x - \\mu)^2}{\\sigma^3} - \\frac{1}{\\sigma}
+
+        Otherwise (or when pruning the distribution's modes) return None.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon, 5).
+        :param grad_wrt: vector w.r.t. which the gradient should be determined.
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        """
+        derivatives = self._compute_derivatives_analytically(ego_trajectory, ado_ids=ado_ids, tag=tag)
+        return derivatives[0] if derivatives is not None else None
+
+    def compute_hessian_analytically(
+        self, ego_trajectory: torch.Tensor, grad_wrt: torch.Tensor, ado_ids: typing.List[str], tag: str
+    ) -> typing.Union[np.ndarray, None]:
+        """Compute objective hessian matrix analytically.
+
+        Similar to the gradient, for (uni-modal) gaussian predictions the hessian can be approximated from the
+        prediction's jacobians, by the Fisher information of the gaussian w.r.t. its mean and scale (i.e. the
+        expected hessian of the negative log-likelihood), which is positive semi-definite by construction:
+
+        .. math:: H \\approx J_{\\mu}^T diag(\\frac{1}{\\sigma^2}) J_{\\mu} +
+                               J_{\\sigma}^T diag(\\frac{2}{\\sigma^2}) J_{\\sigma}
+
+        The jacobians are shared with the gradient computation at the same ego trajectory, so that no further
+        prediction has to be made. Otherwise (or when pruning the distribution's modes) return None.
+
+        :param ego_trajectory: planned ego trajectory (t_horizon, 5).
+        :param grad_wrt: vector w.r.t. which the hessian should be determined.
+        :param ado_ids: ghost ids which should be taken into account for computation.
+        :param tag: name of optimization call (name of the core).
+        """
+        derivatives = self._compute_derivatives_analytically(ego_trajectory, ado_ids=ado_ids, tag=tag)
+        return derivatives[1] if derivatives is not None else None
+
+    def _compute_derivatives_analytically(self, ego_trajectory: torch.Tensor, ado_ids: typing.List[str], tag: str
+                                          ) -> typing.Union[typing.Tuple[np.ndarray, np.ndarray], None]:
+        """Compute the objective's gradient and (Fisher) hessian approximation from the prediction's jacobian.
+
+        As the gradient and hessian usually are requested subsequently for the same ego trajectory, the results
+        are cached (per tag), to evaluate the prediction and its jacobian only once.
+
+        :returns: gradient (2 * t_planning), hessian (2 * t_planning, 2 * t_planning) or None.
+        """
+        if len(ado_ids) == 0 or self.env.num_ados == 0:
+            return None
+        if self._num_modes is not None or self._mode_mass is not None:
+            return None
+
+        if tag in self._derivatives_cache:
+            ego_trajectory_cached, ado_ids_cached, derivatives = self._derivatives_cache[tag]
+            if ado_ids_cached == ado_ids and torch.equal(ego_trajectory_cached, ego_trajectory.detach()):
+                return derivatives
+
+        with torch.no_grad():
+            # Compute controls from trajectory, assuming that the `grad_wrt` are the controls.
+            ego_controls = self.env.ego.roll_trajectory(ego_trajectory, dt=self.env.dt)
+            output = self.env.compute_distributions_with_jacobian(ego_controls, ado_ids=ado_ids)
+            if output is None:
+                return None
+            dist_dict, mean_jacobian, scale_jacobian = output
+            assert isinstance(dist_dict.distribution, torch.distributions.Normal)
+
+            # Within the clamping boundaries the objective is not affected by the ego trajectory.
+            means_un_conditioned = self._dist_un_conditioned.mean[self._dist_un_conditioned.index(ado_ids)]
+            objective = - torch.sum(dist_dict.log_prob(means_un_conditioned)) / len(ado_ids)
+            if torch.abs(objective) > mantrap.constants.OBJECTIVE_PROB_INTERACT_MAX:
+                n = ego_controls.numel()
+                derivatives = (np.zeros(n), np.zeros((n, n)))
+
+            else:
+                delta = means_un_conditioned - dist_dict.mean
+                scale = dist_dict.stddev
+                dlogp_dmean = delta / scale ** 2
+                dlogp_dscale = delta ** 2 / scale ** 3 - 1 / scale
+                gradient = torch.einsum("atmi,atmiu->u", dlogp_dmean, mean_jacobian)
+                gradient += torch.einsum("atmi,atmiu->u", dlogp_dscale, scale_jacobian)
+                gradient = - gradient / len(ado_ids)
+
+                hessian = torch.einsum("atmiu,atmi,atmiv->uv", mean_jacobian, 1 / scale ** 2, mean_jacobian)
+                hessian += torch.einsum("atmiu,atmi,atmiv->uv", scale_jacobian, 2 / scale ** 2, scale_jacobian)
+                hessian = hessian / len(ado_ids)
+                derivatives = (gradient.numpy(), hessian.numpy())
+
+        self._derivatives_cache[tag] = (ego_trajectory.detach().clone(), list(ado_ids), derivatives)
+        return derivatives
+
     def normalize(self, x: typing.Union[np.ndarray, float]) -> typing.Union[np.ndarray, float]:
         """Normalize the objective/constraint value for improved optimization performance.
 
@@ -1,4 +1,8 @@
 import mantrap.solver.base
 import mantrap.solver.baselines
 
+from mantrap.solver.augmented_lagrangian import AugmentedLagrangianSolver
+from mantrap.solver.ilqr import ILQRSolver
 from mantrap.solver.ipopt import IPOPTSolver
+from mantrap.solver.service import PlanningService
+from mantrap.solver.sqp import SQPSolver
@@ -0,0 +1,375 @@
+import contextlib
+import time
+import typing
+
+import numpy as np
+import torch
+
+import mantrap.constants
+import mantrap.modules
+
+from mantrap.solver.base.trajopt import TrajOptSolver
+
+
+class AugmentedLagrangianSolver(TrajOptSolver):
+    """Augmented Lagrangian solver with projected L-BFGS inner loop.
+
+    Solves the same optimization problem as the `IPOPTSolver` (same optimization modules, optimization variables
+    and control bounds), however completely within PyTorch. Thereby the objective and constraints are evaluated
+    in a single computation graph per iterate, instead of converting the optimization variables between numpy
+    and torch and re-building the graph in every callback of an external library.
+
+    All constraints l <= c(z) <= u are posed as inequality constraints g(z) <= 0, which are added to the
+    objective function f(z) using the Powell-Hestenes-Rockafellar augmented Lagrangian
+
+    .. math:: L(z, \\lambda, \\rho) = f(z) + \\frac{1}{2 \\rho} \\sum_i (max(0, \\lambda_i + \\rho g_i(z))^2 - \\lambda_i^2)
+
+    which is minimized within the box of control limits by a projected L-BFGS method. After every inner
+    minimization the multipliers are updated, and the penalty parameter is increased if the constraint
+    violation did not decrease sufficiently.
+
+    Sampling-based predictions (e.g. particle-based environments) would make the merit function noisy, which
+    the line search cannot deal with. Therefore common random numbers are used, i.e. the random number
+    generator is re-seeded identically for every module evaluation within one optimization.
+    """
+
+    def optimize_core(
+        self,
+        z0: torch.Tensor,
+        ado_ids: typing.List[str],
+        tag: str = mantrap.constants.TAG_OPTIMIZATION,
+        max_cpu_time: float = mantrap.constants.AUGLAG_MAX_CPU_TIME_DEFAULT,
+        max_iterations: int = mantrap.constants.AUGLAG_MAX_OUTER_ITERATIONS,
+        **solver_kwargs
+    ) -> typing.Tuple[torch.Tensor, typing.Dict[str, torch.Tensor]]:
+        """Optimization function for single core to find optimal z-vector.
+
+        Given some initial value `z0` find the optimal allocation for z with respect to the internally defined
+        objectives and constraints. This function is executed in every thread in parallel, for different initial
+        values `z0`. To simplify optimization not all agents in the scene have to be taken into account during
+        the optimization but only the ones with ids defined in `ado_ids`.
+
+        :param z0: initial value of optimization variables.
+        :param tag: name of optimization call (name of the core).
+        :param ado_ids: identifiers of ados that should be taken into account during optimization.
+        :param max_cpu_time: maximal cpu time until return.
+        :param max_iterations: maximal number of outer (multiplier update) iterations.
+        :returns: z_opt (optimal values of optimization variable vector)
+                  optimization_log (logging dictionary for this optimization = self.log)
+        """
+        start_time = time.time()
+
+        # Clean up & detaching graph for deleting previous gradients.
+        self._env.detach()
+
+        # The optimization variables are bounded by the control limits (box constraints), which are directly
+        # enforced by projection.
+        lb, ub = self.optimization_variable_bounds()
+        lb, ub = torch.tensor(lb).float(), torch.tensor(ub).float()
+        z = self._optimize_augmented_lagrangian(z0, ado_ids=ado_ids, tag=tag, lb=lb, ub=ub,
+                                                deadline=start_time + max_cpu_time, max_iterations=max_iterations)
+
+        # Return solution as torch tensor.
+        z2_opt = z.double().view(-1, 2)
+        return z2_opt, self.logger.log
+
+    def _optimize_augmented_lagrangian(self, z0: torch.Tensor, ado_ids: typing.List[str], tag: str,
+                                       lb: torch.Tensor, ub: torch.Tensor, deadline: float,
+                                       max_iterations: int = mantrap.constants.AUGLAG_MAX_OUTER_ITERATIONS
+                                       ) -> torch.Tensor:
+        """Minimize the objective subject to the modules' constraints within the box [lb, ub] by the augmented
+        lagrangian method, i.e. by an outer loop of multiplier updates around the inner minimization.
+
+        :param z0: initial value of optimization variables.
+        :param ado_ids: identifiers of ados that should be taken into account during optimization.
+        :param tag: name of optimization call (name of the core).
+        :param lb: lower bounds of optimization variables.
+        :param ub: upper bounds of optimization variables.
+        :param deadline: latest time to return.
+        :param max_iterations: maximal number of outer (multiplier update) iterations.
+        :returns: optimized values of optimization variables (2 * t_planning).
+        """
+        # The constraints are re-formulated as g(z) <= 0, by module.
+        bounds = self._inequality_bounds(ado_ids=ado_ids)
+
+        def inequalities(constraints: typing.List[typing.Union[torch.Tensor, None]]) -> typing.List[torch.Tensor]:
+            return [self._inequality(constraint, lower, upper)
+                    for constraint, (lower, upper) in zip(constraints, bounds)]
+
+        multipliers = [torch.zeros(int(torch.isfinite(lower).sum() + torch.isfinite(upper).sum()))
+                       for lower, upper in bounds]
+        penalty = mantrap.constants.AUGLAG_PENALTY_INITIAL
+        seed = int(torch.randint(0, 2 ** 31 - len(self.modules), size=(1, )))
+
+        def lagrangian(z: torch.Tensor) -> typing.Tuple[float, torch.Tensor]:
+            """Augmented lagrangian value and gradient. As in the module's gradient computation, the gradient
+            is derived analytically if possible, and NaN-gradients are set to zero module-wise (see
+            `OptimizationModule.compute_gradient_auto_grad()`)."""
+            controls, ego_trajectory, objectives, constraints = self._evaluate_torch(z, ado_ids, tag=tag, seed=seed)
+            merit, gradient = 0.0, torch.zeros(z.numel())
+            for i, (module, objective, g, multiplier) in enumerate(zip(self.modules, objectives,
+                                                                       inequalities(constraints), multipliers)):
+                if objective is not None:
+                    merit += float(objective.detach())
+                    with self._random_numbers(seed + i):
+                        gradient += self._gradient_objective(module, objective, ego_trajectory, controls,
+                                                             ado_ids=ado_ids, tag=tag)
+                if g.numel() > 0:
+                    shifted = torch.relu(multiplier + penalty * g)
+                    augmentation = 0.5 / penalty * torch.sum(shifted ** 2 - multiplier ** 2)
+                    merit += float(augmentation.detach())
+                    gradient += self._gradient_auto_grad(augmentation, controls)
+            return merit, gradient
+
+        def lagrangian_hessian(z: torch.Tensor) -> torch.Tensor:
+            """Stage-wise (block-diagonal) approximation of the augmented lagrangian's hessian w.r.t. the ego
+            trajectory states, combining the modules' analytic objective hessians (if defined) and the
+            Gauss-Newton approximation of the augmentation term for the active constraints."""
+            ego_trajectory = self.z_to_ego_trajectory(z.double().numpy()).detach()
+            hessian = torch.zeros((ego_trajectory.shape[0], ego_trajectory.shape[1], ego_trajectory.shape[1]))
+            for module, (lower, upper), multiplier in zip(self.modules, bounds, multipliers):
+                hessian_module = module.compute_stage_hessian_analytically(ego_trajectory, ado_ids=ado_ids, tag=tag)
+                if hessian_module is not None:
+                    hessian += module.weight * module.normalize(torch.from_numpy(hessian_module).float())
+                if multiplier.numel() == 0:
+                    continue
+
+                def constraint_function(x: torch.Tensor) -> torch.Tensor:
+                    constraint = module.compute_constraint(x, ado_ids=ado_ids, tag=tag)
+                    constraint = module.normalize(constraint.flatten()) if constraint is not None else None
+                    return self._inequality(constraint, lower=lower, upper=upper)
+
+                g = constraint_function(ego_trajectory).detach()
+                if g.numel() == 0:
+                    continue
+                g_jacobian = torch.autograd.functional.jacobian(constraint_function, ego_trajectory)
+                g_jacobian = torch.where(torch.isnan(g_jacobian), torch.zeros_like(g_jacobian), g_jacobian)
+                is_active = torch.gt(multiplier + penalty * g, 0).float()
+                hessian += penalty * torch.einsum("cti,c,ctj->tij", g_jacobian, is_active, g_jacobian)
+            return hessian
+
+        z = torch.max(torch.min(z0.flatten().float(), ub), lb)
+        violation_previous = np.inf
+        for _ in range(max_iterations):
+            z = self._minimize(z, function=lagrangian, hessian=lagrangian_hessian, lb=lb, ub=ub,
+                               deadline=deadline)
+            if time.time() > deadline:
+                break
+
+            # Update multipliers (and penalty parameter) based on the constraint values of the new solution.
+            with torch.no_grad():
+                _, _, _, constraints = self._evaluate_torch(z, ado_ids=ado_ids, tag=tag, seed=seed)
+            g = inequalities(constraints)
+            multipliers = [torch.relu(multiplier + penalty * g_m) for multiplier, g_m in zip(multipliers, g)]
+            violation = float(sum([torch.relu(g_m).sum() for g_m in g]))
+
+            if self.logger.is_logging:
+                self.objective(z.double().numpy(), ado_ids=ado_ids, tag=tag)
+                self.constraints(z.double().numpy(), ado_ids=ado_ids, tag=tag)
+
+            if violation < mantrap.constants.SOLVER_CONSTRAINT_LIMIT or time.time() > deadline:
+                break
+            if violation > mantrap.constants.AUGLAG_VIOLATION_DECREASE * violation_previous:
+                penalty *= mantrap.constants.AUGLAG_PENALTY_GROWTH
+            violation_previous = violation
+
+        return z
+
+    def _inequality_bounds(self, ado_ids: typing.List[str]) -> typing.List[typing.Tuple[torch.Tensor, torch.Tensor]]:
+        """Lower and upper boundaries of every module's constraints, with infinite values for missing bounds."""
+        bounds = []
+        for module in self.modules:
+            lower, upper = module.constraint_boundaries(ado_ids=ado_ids)
+            lower = torch.tensor([-np.inf if x is None else x for x in lower]).float()
+            upper = torch.tensor([np.inf if x is None else x for x in upper]).float()
+            bounds.append((lower, upper))
+        return bounds
+
+    @staticmethod
+    def _inequality(constraint: typing.Union[torch.Tensor, None], lower: torch.Tensor, upper: torch.Tensor
+                    ) -> torch.Tensor:
+        """Re-formulate the constraint lower <= c <= upper as inequality g <= 0 (for the finite bounds only)."""
+        if constraint is None:
+            return torch.zeros(0)
+        is_lower, is_upper = torch.isfinite(lower), torch.isfinite(upper)
+        return torch.cat((lower[is_lower] - constraint[is_lower], constraint[is_upper] - upper[is_upper]))
+
+    def _minimize(self, z: torch.Tensor, function: typing.Callable, hessian: typing.Callable, lb: torch.Tensor,
+                  ub: torch.Tensor, deadline: float) -> torch.Tensor:
+        """Minimize the augmented lagrangian for fixed multipliers and penalty parameter within the box [lb, ub].
+
+        :param z: initial value of optimization variables (within bounds).
+        :param function: function to minimize, returning its value and gradient for some z.
+        :param hessian: function returning a stage-wise approximation of the function's hessian w.r.t. the ego
+                        trajectory states for some z (not used by L-BFGS, which approximates the curvature).
+        :param lb: lower bounds of optimization variables.
+        :param ub: upper bounds of optimization variables.
+        :param deadline: latest time to return.
+        """
+        return self._minimize_projected_lbfgs(z, function=function, lb=lb, ub=ub, deadline=deadline)
+
+    def _minimize_projected_lbfgs(self, z: torch.Tensor, function: typing.Callable, lb: torch.Tensor,
+                                  ub: torch.Tensor, deadline: float,
+                                  max_iterations: int = mantrap.constants.AUGLAG_MAX_INNER_ITERATIONS
+                                  ) -> torch.Tensor:
+        """Minimize the function within the box [lb, ub] using a projected L-BFGS method.
+
+        The search direction is computed by the L-BFGS two-loop recursion, restricted to the free variables,
+        i.e. variables which either are not at their bounds or whose gradient points inside the box. Then a
+        backtracking line search along the projected search direction determines the step size.
+
+        :param z: initial value of optimization variables (within bounds).
+        :param function: function to minimize, returning its value and gradient for some z.
+        :param lb: lower bounds of optimization variables.
+        :param ub: upper bounds of optimization variables.
+        :param deadline: latest time to return.
+        :param max_iterations: maximal number of iterations.
+        """
+        history = mantrap.constants.AUGLAG_LBFGS_HISTORY
+        s_list, y_list = [], []
+        f, g = function(z)
+
+        for _ in range(max_iterations):
+            iteration_start_time = time.time()
+            projected_gradient = z - torch.max(torch.min(z - g, ub), lb)
+            if torch.max(torch.abs(projected_gradient)) < mantrap.constants.AUGLAG_OPTIMALITY_TOLERANCE:
+                break
+
+            is_free = ~((torch.le(z, lb) & torch.gt(g, 0)) | (torch.ge(z, ub) & torch.lt(g, 0)))
+            direction = - self._lbfgs_direction(g * is_free, s_list=s_list, y_list=y_list) * is_free
+            if torch.dot(direction, g) >= 0:  # no descent direction, reset curvature information
+                s_list, y_list = [], []
+                direction = - g * is_free
+            if len(s_list) == 0:  # no curvature information, bound the first step to the size of the box
+                direction = direction / max(float(torch.max(torch.abs(direction))), 1.0)
+
+            # Backtracking (Armijo) line search along the projected search direction.
+            # Function evaluations are not started, if they (presumably) would exceed the deadline.
+            step_size, is_accepted, evaluation_time = 1.0, False, 0.0
+            while step_size > mantrap.constants.AUGLAG_MIN_STEP_SIZE and time.time() + evaluation_time < deadline:
+                evaluation_start_time = time.time()
+                z_new = torch.max(torch.min(z + step_size * direction, ub), lb)
+                f_new, g_new = function(z_new)
+                evaluation_time = time.time() - evaluation_start_time
+                if f_new <= f + 1e-4 * float(torch.dot(g, z_new - z)):
+                    is_accepted = True
+                    break
+                step_size *= 0.5
+            if not is_accepted:
+                break
+
+            # Update curvature pairs, if the curvature condition is met (otherwise skip the update).
+            s, y = z_new - z, g_new - g
+            if torch.dot(s, y) > 1e-10:
+                s_list, y_list = (s_list + [s])[-history:], (y_list + [y])[-history:]
+            z, f, g = z_new, f_new, g_new
+
+            # Stop when the next iteration would (presumably, i.e. taking as long as the last one) exceed
+            # the deadline, so that the solver returns in time.
+            if 2 * time.time() - iteration_start_time > deadline:
+                break
+
+        return z
+
+    @staticmethod
+    def _lbfgs_direction(gradient: torch.Tensor, s_list: typing.List[torch.Tensor],
+                         y_list: typing.List[torch.Tensor]) -> torch.Tensor:
+        """L-BFGS two-loop recursion, approximating the product of inverse Hessian and gradient."""
+        q = gradient.clone()
+        alphas = []
+        for s, y in zip(reversed(s_list), reversed(y_list)):
+            alpha = torch.dot(s, q) / torch.dot(y, s)
+            q = q - alpha * y
+            alphas.append(alpha)
+        if len(s_list) > 0:
+            q = q * torch.dot(s_list[-1], y_list[-1]) / torch.dot(y_list[-1], y_list[-1])
+        for (s, y), alpha in zip(zip(s_list, y_list), reversed(alphas)):
+            beta = torch.dot(y, q) / torch.dot(y, s)
+            q = q + (alpha - beta) * s
+        return q
+
+    def _evaluate_torch(self, z: torch.Tensor, ado_ids: typing.List[str], tag: str, seed: int = None
+                        ) -> typing.Tuple[torch.Tensor, torch.Tensor, typing.List[typing.Union[torch.Tensor, None]],
+                                          typing.List[typing.Union[torch.Tensor, None]]]:
+        """Evaluate the (weighted and normalized) objectives and the (normalized) constraints of every module
+        for some optimization vector `z`, within a single computation graph.
+
+        :param z: optimization vector (2 * t_planning).
+        :param ado_ids: identifiers of ados that should be taken into account during optimization.
+        :param tag: name of optimization call (name of the core).
+        :param seed: random seed for module evaluation (common random numbers), None for no re-seeding.
+        :return: leaf controls tensor, ego trajectory, objective value and constraints by module (or None).
+        """
+        ego_controls = z.view(-1, 2).detach().clone()
+        ego_controls.requires_grad = torch.is_grad_enabled()
+        ego_trajectory = self.env.ego.unroll_trajectory(controls=ego_controls, dt=self.env.dt)
+
+        objectives, constraints = [], []
+        for i, module in enumerate(self.modules):
+            with self._random_numbers(seed + i if seed is not None else None):
+                objective = module.compute_objective(ego_trajectory, ado_ids=ado_ids, tag=tag)
+            if objective is not None:
+                objective = module.weight * module.normalize(objective.sum())
+            objectives.append(objective)
+            with self._random_numbers(seed + i if seed is not None else None):
+                constraint = module.compute_constraint(ego_trajectory, ado_ids=ado_ids, tag=tag)
+            if constraint is not None:
+                constraint = module.normalize(constraint.flatten())
+            constraints.append(constraint)
+
+        return ego_controls, ego_trajectory, objectives, constraints
+
+    def _gradient_objective(self, module: mantrap.modules.base.OptimizationModule, objective: torch.Tensor,
+                            ego_trajectory: torch.Tensor, ego_controls: torch.Tensor, ado_ids: typing.List[str],
+                            tag: str) -> torch.Tensor:
+        """Gradient of the (weighted and normalized) module objective w.r.t. the ego controls, analytically
+        if the module defines an analytic solution, otherwise using the computation graph."""
+        gradient = module.compute_gradient_analytically(ego_trajectory, ego_controls, ado_ids=ado_ids, tag=tag)
+        if gradient is not None:
+            return module.weight * module.normalize(torch.from_numpy(gradient).float())
+        if not module.gradient_condition():
+            return torch.zeros(ego_controls.numel())
+        return self._gradient_auto_grad(objective, ego_controls)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _random_numbers(seed: typing.Union[int, None]):
+        """Context with re-seeded random number generator (if a seed is given), without affecting the
+        global random number generator's state."""
+        if seed is None:
+            yield
+            return
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            yield
+
+    @staticmethod
+    def _gradient_auto_grad(x: torch.Tensor, ego_controls: torch.Tensor) -> torch.Tensor:
+        if not x.requires_grad:
+            return torch.zeros(ego_controls.numel())
+        gradient = torch.autograd.grad(x, ego_controls, retain_graph=True, allow_unused=True)[0]
+        if gradient is None:
+            return torch.zeros(ego_controls.numel())
+        gradient = gradient.flatten()
+        return torch.where(torch.isnan(gradient), torch.zeros_like(gradient), gradient)
+
+    ###########################################################################
+    # Optimization formulation - Formulation ##################################
+    ###########################################################################
+    @staticmethod
+    def module_hard() -> typing.Union[typing.List[typing.Tuple], typing.List]:
+        """List of "hard" optimization modules (objectives, constraint). Hard modules are used for
+        warm-starting the trajectory optimization and should therefore be simple to solve while still
+        encoding a good guess of possible solutions.
+
+        As the IPOPT solver, the augmented Lagrangian solver uses the optimization variable boundaries as
+        control limit, therefore only the goal and speed limit modules are required as a hard modules.
+        """
+        return [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+
+    ###########################################################################
+    # Solver properties #######################################################
+    ###########################################################################
+    @property
+    def name(self) -> str:
+        return "augmented_lagrangian"
@@ -1,11 +1,14 @@
 import abc
 import logging
+import math
 import os
+import time
 import typing
 
 import numpy as np
 import torch
 
+import mantrap.agents
 import mantrap.constants
 import mantrap.environment
 import mantrap.attention
@@ -77,6 +80,7 @@ class TrajOptSolver(abc.ABC):
         # representation, the ease of switching between different functions and to simplify logging and
         # visualization.
         modules = self.module_defaults() if modules is None else modules
+        self._modules = modules  # module specification, for building sub-solvers with the same modules
         self._module_dict = {}
         for module_tuple in modules:
             if type(module_tuple) == tuple:
@@ -87,7 +91,8 @@ class TrajOptSolver(abc.ABC):
             else:
                 module = module_tuple
                 module_kwargs = {}
-            module_object = module(t_horizon=self.planning_horizon, goal=self.goal, env=self.env, **module_kwargs)
+            module_object = module(t_horizon=self.planning_horizon, goal=self.goal, env=self._module_env(),
+                                   **module_kwargs)
             self._module_dict[module_object.name] = module_object
 
         # Attention module for "importance" selection of which ados to include into optimization.
@@ -99,6 +104,13 @@ class TrajOptSolver(abc.ABC):
         self._logger = OptimizationLogger(is_logging=is_logging, is_debug=is_debug)
         self.logger.log_reset()
 
+        # Sub-solvers for warm-starting are built lazily, once per solver and warm-starting method, and
+        # synchronized with the solver's environment before every usage (see `_warm_start_optimization()`).
+        self._warm_start_solvers = {}
+
+        # Number of time-steps in which the optimization has missed its deadline (during the last `solve()`).
+        self._deadline_misses = 0
+
         # Sanity checks.
         assert self.num_optimization_variables() > 0
         self.env.sanity_check(check_ego=True)
@@ -106,8 +118,8 @@ class TrajOptSolver(abc.ABC):
     ###########################################################################
     # Solving #################################################################
     ###########################################################################
-    def solve(self, time_steps: int, warm_start_method: str = mantrap.constants.WARM_START_HARD, **kwargs
-              ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+    def solve(self, time_steps: int, warm_start_method: str = mantrap.constants.WARM_START_HARD,
+              step_budget: float = None, **kwargs) -> typing.Tuple[torch.Tensor, torch.Tensor]:
         """Find the ego trajectory given the internal environment with the current scene as initial condition.
         Therefore iteratively solve the problem for the scene at t = t_k, update the scene using the internal simulator
         and the derived ego policy and repeat until t_k = `horizon` or until the goal has been reached.
@@ -116,29 +128,37 @@ class TrajOptSolver(abc.ABC):
 
         :param time_steps: how many time-steps shall be solved (not planning horizon !).
         :param warm_start_method: warm-starting method (see .warm_start()).
+        :param step_budget: wall-clock time budget per time-step [s] for real-time planning (e.g. the
+                            environment's time-step), covering warm-starting, attention and optimization,
+                            by default unlimited (see `optimize()`).
         :return: derived ego trajectory [T, 5] (T <= horizon + 1 in case goal is reached earlier).
         :return: derived actual ado trajectories [T, horizon + 1, 5] (T <= horizon + 1, see above).
         """
         ego_trajectory_opt = torch.zeros((time_steps + 1, 5))
         ado_trajectories = torch.zeros((self.env.num_ados, time_steps + 1, 1, 5))
         self.logger.log_reset()
-        env_copy = self.env.copy()
-        eval_env_copy = self.eval_env.copy()
+        env_snapshot = self.env.snapshot()
+        eval_env_snapshot = self.eval_env.snapshot()
 
         # Initialize trajectories with current state and environment time.
         ego_trajectory_opt[0] = self._env.ego.state_with_time
         for m_ado, ado in enumerate(self.env.ados):
             ado_trajectories[m_ado, 0, 0, :] = ado.state_with_time
 
-        # Warm-start the optimization using a simplified optimization formulation.
+        # Warm-start the optimization using a simplified optimization formulation. In real-time planning
+        # warm-starting is part of the first time-step's budget.
+        self._deadline_misses = 0
+        step_start_time = time.time()
         z_warm_start = self.warm_start(method=warm_start_method)
 
         logging.debug(f"Starting trajectory optimization solving for planning horizon {time_steps} steps ...")
         for k in range(time_steps):
             logging.debug("#" * 30 + f"solver {self.log_name} @k={k}: initializing optimization")
+            step_start_time = time.time() if k > 0 else step_start_time
+            deadline = step_start_time + step_budget if step_budget is not None else None
 
             # Solve optimisation problem.
-            z_k = self.optimize(z_warm_start, tag=mantrap.constants.TAG_OPTIMIZATION, **kwargs)
+            z_k = self.optimize(z_warm_start, tag=mantrap.constants.TAG_OPTIMIZATION, deadline=deadline, **kwargs)
             ego_controls_k = self.z_to_ego_controls(z_k.detach().numpy())
             assert mantrap.utility.shaping.check_ego_controls(ego_controls_k, t_horizon=self.planning_horizon)
 
@@ -182,12 +202,10 @@ class TrajOptSolver(abc.ABC):
         self.env.detach()  # detach environment from computation graph
         self.logger.log_store(csv_name=f"{self.log_name}.{self.env.log_name}")
 
-        # Reset environment to initial state. Some modules are also connected to the old environment,
-        # which has been forward predicted now. Reset these to the original environment copy.
-        self._env = env_copy
-        self._eval_env = eval_env_copy
-        for module in self.modules:
-            module.reset_env(env=self.env)
+        # Reset environment to initial state. As the environments are restored in place, the modules connected
+        # to them do not have to be reset.
+        self.env.restore(env_snapshot)
+        self.eval_env.restore(eval_env_snapshot)
 
         logging.debug(f"solver {self.log_name}: finishing up optimization process")
         return ego_trajectory_opt, ado_trajectories
@@ -195,14 +213,22 @@ class TrajOptSolver(abc.ABC):
     ###########################################################################
     # Optimization ############################################################
     ###########################################################################
-    def optimize(self, z0: torch.Tensor, tag: str, **kwargs) -> torch.Tensor:
+    def optimize(self, z0: torch.Tensor, tag: str, deadline: float = None, **kwargs) -> torch.Tensor:
         """Optimization core wrapper function.
 
         Filter the agents by using the attention module, execute the optimization, log
         the results and return the optimization results.
 
+        For real-time planning a control action has to be available at a (wall-clock) deadline. Then the
+        time remaining after the attention filtering is passed as maximal runtime to the optimization core.
+        If no time is remaining at all, the optimization core is not called, but the initial value, i.e. the
+        previous plan shifted by one time-step (see `solve()`), is returned instead. If the optimization core
+        returns after the deadline nevertheless, this is counted as deadline miss, but its result is returned
+        anyway, since its runtime is bounded by the maximal runtime passed to it.
+
         :param z0: initial value of optimization variable.
         :param tag: name of optimization call (name of the core).
+        :param deadline: wall-clock time (`time.time()`) to return at latest, by default unlimited.
         :param kwargs: additional arguments for optimization core function.
         :returns: z_opt (optimal values of optimization variable vector)
         """
@@ -214,7 +240,24 @@ class TrajOptSolver(abc.ABC):
             ado_ids = self.env.ado_ids  # all ado ids (not filtered)
 
         # Computation is done in `optimize_core()` class that is implemented in child class.
-        z_opt, log_opt = self.optimize_core(z0, ado_ids=ado_ids, tag=tag, **kwargs)
+        if deadline is None:
+            z_opt, log_opt = self.optimize_core(z0, ado_ids=ado_ids, tag=tag, **kwargs)
+
+        # In real-time mode fall back to the initial value if the deadline is (going to be) missed.
+        else:
+            time_remaining = deadline - time.time() - mantrap.constants.SOLVER_DEADLINE_MARGIN
+            if time_remaining > 0:
+                kwargs["max_cpu_time"] = time_remaining
+                z_opt, log_opt = self.optimize_core(z0, ado_ids=ado_ids, tag=tag, **kwargs)
+                is_deadline_missed = time.time() > deadline
+                if is_deadline_missed:
+                    logging.debug(f"solver [{tag}]: missed deadline, returning late result")
+            else:
+                logging.debug(f"solver [{tag}]: missed deadline, falling back to initial value")
+                z_opt, log_opt = z0.detach().view(-1, 2), self.logger.log
+                is_deadline_missed = True
+            self._deadline_misses += int(is_deadline_missed)
+            self.logger.log_append(deadline_miss=float(is_deadline_missed), tag=tag)
 
         # Logging the optimization results.
         if self.logger.is_logging:
@@ -242,6 +285,28 @@ class TrajOptSolver(abc.ABC):
         """
         raise NotImplementedError
 
+    def reset_env(self, env: mantrap.environment.base.GraphBasedEnvironment,
+                  eval_env: mantrap.environment.base.GraphBasedEnvironment = None):
+        """Reset the solver's planning (and evaluation) environment.
+
+        Next to the solver itself the optimization and attention modules are connected to the planning
+        environment, so they are reset as well.
+
+        :param env: new planning environment.
+        :param eval_env: new evaluation environment, if None the evaluation environment is not changed.
+        """
+        self._env = env
+        if eval_env is not None:
+            self._eval_env = eval_env
+        for module in self.modules:
+            module.reset_env(env=self._module_env())
+        if self._attention_module is not None:
+            self._attention_module.reset_env(env=self._module_env())
+
+    def _module_env(self) -> mantrap.environment.base.GraphBasedEnvironment:
+        """Environment the optimization modules are connected to, by default the planning environment."""
+        return self.env
+
     ###########################################################################
     # Problem formulation - Warm-Starting #####################################
     ###########################################################################
@@ -253,18 +318,21 @@ class TrajOptSolver(abc.ABC):
         - soft: solve the same optimization process but use the hard and safety optimization modules.
         - potential: warm-start using full formulation of `PotentialFieldEnvironment`.
         - zeros: no warm-start, assignment to zeros.
+        - straight: closed-form straight-to-goal controls, no optimization (cheapest).
+        - surrogate: solve the same optimization process based on the learned surrogate of the environment
+                     (see `SurrogateEnvironment`), which is then refined using the actual environment.
 
         :param method: method to use.
         :return: initial z values.
         """
         logging.debug(f"solver [warm_start]: method = {method} starting ...")
         if method == mantrap.constants.WARM_START_HARD:
-            z_warm_start = self._warm_start_optimization(env=self.env, modules=self.module_hard())
+            z_warm_start = self._warm_start_optimization(env=self.env, modules=self.module_hard(), cache_key=method)
         elif method == mantrap.constants.WARM_START_ENCODING:
             z_warm_start = self._warm_start_encoding()
         elif method == mantrap.constants.WARM_START_SOFT:
             modules_soft = [*self.module_hard(), mantrap.modules.HJReachabilityModule]
-            z_warm_start = self._warm_start_optimization(env=self.env, modules=modules_soft)
+            z_warm_start = self._warm_start_optimization(env=self.env, modules=modules_soft, cache_key=method)
         elif method == mantrap.constants.WARM_START_POTENTIAL:
             env_warm_start = self.env.copy(env_type=mantrap.environment.PotentialFieldEnvironment)
             z_warm_start = self._warm_start_optimization(env=env_warm_start, modules=self.module_defaults())
@@ -272,13 +340,19 @@ class TrajOptSolver(abc.ABC):
             controls_zeros = torch.zeros((self.planning_horizon, 2))
             z_warm_start = self.ego_controls_to_z(ego_controls=controls_zeros)
             z_warm_start = torch.from_numpy(z_warm_start)
+        elif method == mantrap.constants.WARM_START_STRAIGHT:
+            z_warm_start = self._warm_start_straight()
+        elif method == mantrap.constants.WARM_START_SURROGATE:
+            env_warm_start = self.env.copy(env_type=mantrap.environment.SurrogateEnvironment, teacher=self.env.name)
+            z_warm_start = self._warm_start_optimization(env=env_warm_start, modules=self._modules, cache_key=method)
         else:
             raise ValueError(f"Invalid warm starting-method {method} !")
         logging.debug(f"solver [warm_start]: finished ...")
         return z_warm_start
 
     def _warm_start_optimization(self, env: mantrap.environment.base.GraphBasedEnvironment,
-                                 modules: typing.Union[typing.List[typing.Tuple], typing.List]) -> torch.Tensor:
+                                 modules: typing.Union[typing.List[typing.Tuple], typing.List],
+                                 cache_key: str = None) -> torch.Tensor:
         """Warm-Starting by solving simplified optimization problem.
 
         In order to warm start the optimization solve the same optimization process but use the a part of the
@@ -286,11 +360,26 @@ class TrajOptSolver(abc.ABC):
         be very efficient to solve, e.g. convex, not include the simulation model, etc., but still give
         a good guess for the final actual solution.
 
+        Building the sub-solver is comparably expensive (building the modules, loading module data, etc.).
+        Therefore, if a `cache_key` is given, the sub-solver is built once and re-used in later calls, after
+        its environment has been reset to the (current) environment `env`. Its evaluation environment is reset
+        to the solver's evaluation environment (instead of copying `env` again), which never is the solver's
+        planning environment and is restored after evaluation anyway (see `solve()`).
+
+        :param env: environment the simplified optimization is based on.
         :param modules: list of optimization modules that should be taken into account.
+        :param cache_key: key for re-using the sub-solver, if None the sub-solver is not cached.
         """
-        solver_part = self.__class__(env=env, goal=self.goal, modules=modules,
-                                     t_planning=self.planning_horizon, config_name=self.config_name,
-                                     is_logging=self.logger.is_logging, is_debug=self.logger.is_debug)
+        if cache_key is not None and cache_key in self._warm_start_solvers.keys():
+            solver_part = self._warm_start_solvers[cache_key]
+            solver_part.reset_env(env=env, eval_env=self.eval_env)
+            solver_part.logger.log_reset()
+        else:
+            solver_part = self.__class__(env=env, goal=self.goal, modules=modules,
+                                         t_planning=self.planning_horizon, config_name=self.config_name,
+                                         is_logging=self.logger.is_logging, is_debug=self.logger.is_debug)
+            if cache_key is not None:
+                self._warm_start_solvers[cache_key] = solver_part
 
         # As initial guess for this first optimization, without prior knowledge, going straight
         # from the current position to the goal with maximal control input is chosen.
@@ -305,25 +394,73 @@ class TrajOptSolver(abc.ABC):
         self.logger.log_update(solver_part.logger.log)
         return z_opt_hard
 
-    def _warm_start_encoding(self) -> torch.Tensor:
+    def _warm_start_straight(self) -> torch.Tensor:
+        """Warm-Starting by closed-form straight-to-goal controls.
+
+        Instead of solving an optimization problem, the robot is driven on the straight line towards the goal.
+        At every time-step it accelerates (or decelerates) as much as possible to the largest speed from which
+        it still is able to stop at the goal, while not exceeding its speed limit:
+
+        .. math:: v_{des} = \\min(v_{max}, \\sqrt{2 a_{max} ||x_{goal} - x_t||})
+
+        This equals the solution of the hard optimization problem (goal norm, speed and control limits) for
+        the double integrator robot, up to the discretization of the braking phase, while being computed
+        without any environment interaction or optimization.
+        """
+        assert type(self.env.ego) == mantrap.agents.DoubleIntegratorDTAgent
+        _, u_max = self.env.ego.control_limits()
+        _, v_max = self.env.ego.speed_limits
+        dt = self.env.dt
+
+        position, velocity = self.env.ego.position.detach(), self.env.ego.velocity.detach()
+        ego_controls = torch.zeros((self.planning_horizon, 2))
+        for t in range(self.planning_horizon):
+            dx_goal = self.goal - position
+            dx_goal_length = torch.norm(dx_goal)
+            speed_desired = min(v_max, math.sqrt(2 * u_max * dx_goal_length.item()))
+            velocity_desired = dx_goal / dx_goal_length.clamp(min=1e-6) * speed_desired
+            ego_controls[t, :] = torch.clamp((velocity_desired - velocity) / dt, min=-u_max, max=u_max)
+
+            # Double integrator dynamics (see `DoubleIntegratorDTAgent`).
+            position = position + velocity * dt
+            velocity = velocity + ego_controls[t, :] * dt
+
+        return torch.from_numpy(self.ego_controls_to_z(ego_controls=ego_controls))
+
+    def _warm_start_encoding(self, directory: str = mantrap.constants.WARM_START_PRE_COMPUTATION_DIRECTORY
+                             ) -> torch.Tensor:
         """Warm-Starting by accessing pre-computed solutions.
 
         Query solution trajectory from set of pre-computed scenario, by matching the encoded scene
         to the database of pre-computed scene encodings.
+
+        :param directory: directory of pre-computed database (relative to project's home directory).
         """
         assert self.env.dt == mantrap.constants.ENV_DT_DEFAULT  # pre-computation only for default time-step
-        encoding = self.encode()
+        directory = mantrap.utility.io.build_os_path(directory)
 
         enc_file, db_file = mantrap.constants.WARM_START_PRE_COMPUTATION_FILE
-        enc_file = mantrap.utility.io.build_os_path(os.path.join("third_party", "warm_start", enc_file))
-        db_file = mantrap.utility.io.build_os_path(os.path.join("third_party", "warm_start", db_file))
-        encoding_db = torch.load(enc_file)
-        assert encoding.shape[-1] == encoding.numel()
-        warm_start_db = torch.load(db_file)
+        encoding_db = torch.load(os.path.join(directory, enc_file))
+        warm_start_db = torch.load(os.path.join(directory, db_file))
         assert len(warm_start_db.shape) == 3
         assert warm_start_db.shape[1] >= self.planning_horizon
         assert warm_start_db.shape[2] == 2  # controls
 
+        # The index file stores the meta-data of the database, such as the encoding version used to build it
+        # and the environment type of every pre-computed scenario. Databases without index file have been
+        # built using the first encoding version.
+        index_file = os.path.join(directory, mantrap.constants.WARM_START_PRE_COMPUTATION_INDEX_FILE)
+        index = torch.load(index_file) if os.path.isfile(index_file) else {}
+        encoding = self.encode(version=index.get("encoding_version", 1))
+        assert encoding.shape[-1] == encoding.numel() == encoding_db.shape[1]
+
+        # If the database has been built for several environment types, prefer the scenarios which have been
+        # solved in the same type of environment as the solver's (if there are any).
+        if "env_types" in index.keys():
+            env_mask = torch.tensor([env_type == self.env.name for env_type in index["env_types"]], dtype=torch.bool)
+            if torch.any(env_mask):
+                encoding_db, warm_start_db = encoding_db[env_mask], warm_start_db[env_mask]
+
         # Due to the limited number of pre-computed scenarios (and since it is a single, batched computation)
         # compare matching distance to all encoding (instead of using clustering).
         encoding_distance = torch.norm(encoding_db - encoding, dim=1)
@@ -463,27 +600,39 @@ class TrajOptSolver(abc.ABC):
     ###########################################################################
     # Encoding ################################################################
     ###########################################################################
-    def encode(self) -> torch.Tensor:
-        """Encode the current environment-goal-setup in a four-dimensional continuous space.
+    def encode(self, version: int = mantrap.constants.WARM_START_ENCODING_VERSION) -> torch.Tensor:
+        """Encode the current environment-goal-setup in a fixed-size continuous space.
 
         To represent a given scene completely the following elements have to be taken into
         account: the robot state (position, acceleration, type),  the ado states (position,
         velocity, history, type) and the goal state. However to reduce dimensionality of
         the representation, we simplify the problem to only encode the current states (no
         history) and assume single integrator ado and double integrator robot dynamics.
-        As a consequence the ado's velocity can be ignored as well (since it can change
-        instantly due to the single integrator dynamics).
 
         The most important information with respect to the trajectory optimization surely
         is the relative position of the goal state, in robot coordinates. Therefore as
         an encoding the ado positions are transformed into the coordinate system spanned
-        by the line from the robot's to the goal position (and its orthogonal). The
-        transformed coordinates of the closest pedestrian (w.r.t. the robot) as well as
-        the robot's velocity form the scene encoding.
+        by the line from the robot's to the goal position (and its orthogonal).
+
+        Version 1: The transformed coordinates of the closest pedestrian (w.r.t. the robot) as well as
+        the robot's velocity form the scene encoding. As a consequence the ado's velocity is ignored (since
+        it can change instantly due to the single integrator dynamics).
 
         .. math::\\vec{s} = \\begin{bmatrix} \\eta_P & \\mu_P & vx_R & vy_R \\end{bmatrix}^T
 
-        :return: four-dimensional scene representation.
+        Version 2: In crowded scenes the closest pedestrian is not sufficient to describe the scene, therefore
+        the k = `WARM_START_ENCODING_NUM_ADOS` closest pedestrians are encoded, by their position relative to
+        the robot and their velocity, following the robot's velocity, all transformed to robot-goal-coordinates.
+        Ordering the pedestrians by their distance to the robot makes the encoding invariant to the ordering of
+        the ados in the environment. If there are less than k pedestrians in the scene, the remaining entries are
+        padded by a pedestrian standing far away (`WARM_START_ENCODING_PADDING`). Since both the positions and
+        the velocities are encoded differently, the encoding is not comparable to the first version.
+
+        .. math::\\vec{s} = \\begin{bmatrix} v\\eta_R & v\\mu_R & \\eta_{P1} & \\mu_{P1} & v\\eta_{P1} & v\\mu_{P1}
+                              & \\eta_{P2} & \\mu_{P2} & v\\eta_{P2} & v\\mu_{P2} & ... \\end{bmatrix}^T
+
+        :param version: encoding version (1 = closest pedestrian, 2 = k-closest pedestrians).
+        :return: scene representation (4 for version 1, 4 * k + 2 for version 2).
         """
         with torch.no_grad():
             ego_state, ado_states = self.env.states()
@@ -491,12 +640,31 @@ class TrajOptSolver(abc.ABC):
             # Compute robot-goal-coordinate transformation.
             t = mantrap.utility.maths.rotation_matrix(ego_state[0:2], self.goal)
 
-            # Determine closest pedestrian using L2-norm-distance.
-            ado_distances = torch.norm(ado_states[:, 0:2] - ego_state[0:2], dim=1)
-            i_ado_closest = torch.argmin(ado_distances)
-            ado_pos_t = torch.matmul(t, ado_states[i_ado_closest, 0:2])
+            if version == 1:
+                # Determine closest pedestrian using L2-norm-distance.
+                ado_distances = torch.norm(ado_states[:, 0:2] - ego_state[0:2], dim=1)
+                i_ado_closest = torch.argmin(ado_distances)
+                ado_pos_t = torch.matmul(t, ado_states[i_ado_closest, 0:2])
+                return torch.cat((ado_pos_t, ego_state[2:4]))
+
+            elif version == 2:
+                num_closest = mantrap.constants.WARM_START_ENCODING_NUM_ADOS
+
+                # Determine k-closest pedestrians using L2-norm-distance, sorted by distance.
+                ado_positions = ado_states[:, 0:2] - ego_state[0:2]
+                ado_distances = torch.norm(ado_positions, dim=1)
+                num_ados = min(num_closest, self.env.num_ados)
+                _, i_ados_closest = torch.topk(ado_distances, k=num_ados, largest=False, sorted=True)
+
+                # Transform positions and velocities of all k-closest pedestrians at once (batched).
+                features = torch.zeros((num_closest, 4))
+                features[:, 0:2] = mantrap.constants.WARM_START_ENCODING_PADDING
+                features[:num_ados, 0:2] = torch.matmul(ado_positions[i_ados_closest, :], t.t())
+                features[:num_ados, 2:4] = torch.matmul(ado_states[i_ados_closest, 2:4], t.t())
+                return torch.cat((torch.matmul(t, ego_state[2:4]), features.flatten()))
 
-            return torch.cat((ado_pos_t, ego_state[2:4]))
+            else:
+                raise ValueError(f"Invalid encoding version {version} !")
 
     ###########################################################################
     # Logging #################################################################
@@ -624,6 +792,10 @@ class TrajOptSolver(abc.ABC):
     def planning_horizon(self) -> int:
         return self._solver_params[mantrap.constants.PK_T_PLANNING]
 
+    @property
+    def deadline_misses(self) -> int:
+        return self._deadline_misses
+
     ###########################################################################
     # Optimization formulation parameters #####################################
     ###########################################################################
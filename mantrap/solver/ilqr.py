@@ -0,0 +1,201 @@
+import time
+import typing
+
+import torch
+
+import mantrap.constants
+
+from mantrap.solver.augmented_lagrangian import AugmentedLagrangianSolver
+
+
+class ILQRSolver(AugmentedLagrangianSolver):
+    """Iterative LQR solver exploiting the stage-wise structure of the optimization problem.
+
+    The ego's dynamics are linear (x_{t+1} = A x_t + B u_t), therefore the trajectory optimization problem has
+    a stage-wise structure, which is exploited by iLQR (or DDP without second-order dynamics terms, that vanish
+    for linear dynamics anyway). Instead of treating the problem as a generic non-linear program, in every
+    iteration a quadratic model of the merit function is minimized by a backward Riccati recursion over the
+    planning horizon, followed by a forward roll-out of the resulting closed-loop control law with line search.
+    Thereby the per-iteration cost is linear in the planning horizon.
+
+    The quadratic model is build from the merit function's gradient w.r.t. the controls (as in the
+    `AugmentedLagrangianSolver`, i.e. analytically whenever possible) and the stage-wise hessian blocks w.r.t.
+    the trajectory states, provided by the modules (`compute_stage_hessian_analytically()`) and the Gauss-Newton
+    approximation of the augmented constraint terms. Cross-stage curvature, e.g. of interaction-based
+    objectives, is neglected and compensated by a Levenberg-Marquardt regularization of the control hessian.
+
+    Constraints are handled equally to the `AugmentedLagrangianSolver`, by an outer loop of multiplier updates,
+    while the control limits are enforced within the backward pass (box-constrained QP in every stage) and
+    by clamping in the forward pass.
+    """
+
+    def _minimize(self, z: torch.Tensor, function: typing.Callable, hessian: typing.Callable, lb: torch.Tensor,
+                  ub: torch.Tensor, deadline: float, max_iterations: int = mantrap.constants.ILQR_MAX_ITERATIONS
+                  ) -> torch.Tensor:
+        """Minimize the augmented lagrangian for fixed multipliers and penalty parameter within the box [lb, ub],
+        using iterative LQR.
+
+        :param z: initial value of optimization variables (within bounds).
+        :param function: function to minimize, returning its value and gradient for some z.
+        :param hessian: function returning a stage-wise approximation of the function's hessian w.r.t. the ego
+                        trajectory states for some z.
+        :param lb: lower bounds of optimization variables.
+        :param ub: upper bounds of optimization variables.
+        :param deadline: latest time to return.
+        :param max_iterations: maximal number of iterations.
+        """
+        A, B, T = self.env.ego.dynamics_matrices(dt=self.env.dt)
+        lb, ub = lb.view(-1, 2), ub.view(-1, 2)
+
+        controls = z.view(-1, 2)
+        merit, gradient = function(z)
+        hessian_x = None  # evaluated lazily for every new iterate
+        regularization = mantrap.constants.ILQR_REGULARIZATION_INITIAL
+
+        for _ in range(max_iterations):
+            iteration_start_time = time.time()
+            if hessian_x is None:
+                hessian_x = hessian(controls.flatten())
+            trajectory = self.env.ego.unroll_trajectory(controls, dt=self.env.dt).detach()
+            k, K, expected = self._backward_pass(gradient.view(-1, 2), hessian_x, A=A, B=B, controls=controls,
+                                                 lb=lb, ub=ub, regularization=regularization)
+            if expected[0] > - mantrap.constants.ILQR_CONVERGENCE_TOLERANCE * abs(merit):
+                break  # no (significant) decrease of the merit function predicted by the quadratic model
+
+            # Line search along the closed-loop control update, to ensure a sufficient decrease.
+            # Function evaluations are not started, if they (presumably) would exceed the deadline.
+            is_accepted, evaluation_time = False, 0.0
+            for i in range(mantrap.constants.ILQR_LINE_SEARCH_STEPS):
+                if time.time() + evaluation_time > deadline:
+                    break
+                evaluation_start_time = time.time()
+                step_size = 0.5 ** i
+                controls_new = self._forward_pass(trajectory, controls, k, K, step_size, A=A, B=B, T=T, lb=lb, ub=ub)
+                merit_new, gradient_new = function(controls_new.flatten())
+                evaluation_time = time.time() - evaluation_start_time
+                expected_decrease = step_size * expected[0] + step_size ** 2 * expected[1]
+                if merit_new - merit <= 1e-4 * expected_decrease:
+                    is_accepted = True
+                    break
+
+            # Adapt the regularization, i.e. move towards gradient descent if the step has not been accepted,
+            # and towards Gauss-Newton otherwise.
+            if not is_accepted:
+                regularization *= mantrap.constants.ILQR_REGULARIZATION_FACTOR
+                if regularization > mantrap.constants.ILQR_REGULARIZATION_MAX or time.time() > deadline:
+                    break
+                continue
+            regularization = max(regularization / mantrap.constants.ILQR_REGULARIZATION_FACTOR,
+                                 mantrap.constants.ILQR_REGULARIZATION_MIN)
+
+            improvement = (merit - merit_new) / max(abs(merit), 1e-10)
+            controls, merit, gradient, hessian_x = controls_new, merit_new, gradient_new, None
+            if improvement < mantrap.constants.ILQR_CONVERGENCE_TOLERANCE:
+                break
+            if 2 * time.time() - iteration_start_time > deadline:  # next iteration would exceed the deadline
+                break
+
+        return controls.flatten()
+
+    def _backward_pass(self, gradient: torch.Tensor, hessian: torch.Tensor, A: torch.Tensor, B: torch.Tensor,
+                       controls: torch.Tensor, lb: torch.Tensor, ub: torch.Tensor, regularization: float
+                       ) -> typing.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Backward Riccati recursion over the planning horizon for the quadratic model of the merit function
+
+        .. math:: m(\\delta u) = \\sum_t g_t^T \\delta u_t + 0.5 \\delta x_t^T H_t \\delta x_t
+
+        with the gradient `g_t` w.r.t. the controls and the hessian blocks `H_t` w.r.t. the trajectory states.
+
+        :param gradient: merit function gradient w.r.t. the controls (t_planning, 2).
+        :param hessian: merit function hessian blocks w.r.t. the trajectory states (t_planning + 1, 5, 5).
+        :param A: state dynamics matrix (5, 5).
+        :param B: control input matrix (5, 2).
+        :param controls: current controls (t_planning, 2).
+        :param lb: lower bounds of controls (t_planning, 2).
+        :param ub: upper bounds of controls (t_planning, 2).
+        :param regularization: regularization of control hessian.
+        :returns: feed-forward updates (t_planning, 2), feedback gains (t_planning, 2, 5),
+                  expected merit decrease (linear and quadratic term in step size).
+        """
+        t_planning = controls.shape[0]
+        k = torch.zeros((t_planning, 2))
+        K = torch.zeros((t_planning, 2, 5))
+        expected = torch.zeros(2)
+
+        V_x = torch.zeros(5)
+        V_xx = hessian[-1]
+        for t in reversed(range(t_planning)):
+            Q_x = torch.mv(A.t(), V_x)
+            Q_u = gradient[t] + torch.mv(B.t(), V_x)
+            Q_xx = hessian[t] + torch.mm(A.t(), torch.mm(V_xx, A))
+            Q_ux = torch.mm(B.t(), torch.mm(V_xx, A))
+            Q_uu = torch.mm(B.t(), torch.mm(V_xx, B)) + regularization * torch.eye(2)
+
+            # Solve the control-bounded stage QP, then determine the feedback gains for the free controls only,
+            # since the clamped controls cannot react on state deviations.
+            k[t], is_free = self._box_qp(Q_uu, Q_u, lower=lb[t] - controls[t], upper=ub[t] - controls[t])
+            if torch.any(is_free):
+                K[t, is_free] = - torch.mm(torch.inverse(Q_uu[is_free][:, is_free]), Q_ux[is_free])
+
+            V_x = Q_x + torch.mv(K[t].t(), torch.mv(Q_uu, k[t]) + Q_u) + torch.mv(Q_ux.t(), k[t])
+            V_xx = Q_xx + torch.mm(K[t].t(), torch.mm(Q_uu, K[t]) + Q_ux) + torch.mm(Q_ux.t(), K[t])
+            V_xx = 0.5 * (V_xx + V_xx.t())
+            expected += torch.stack((torch.dot(k[t], Q_u), 0.5 * torch.dot(k[t], torch.mv(Q_uu, k[t]))))
+
+        return k, K, expected
+
+    @staticmethod
+    def _box_qp(H: torch.Tensor, g: torch.Tensor, lower: torch.Tensor, upper: torch.Tensor
+                ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        """Solve the small box-constrained quadratic program min 0.5 x^T H x + g^T x s.t. lower <= x <= upper
+        by a projected Newton method, which converges in few iterations for (two-dimensional) controls.
+
+        :returns: solution of the QP, mask of free (i.e. not clamped) variables.
+        """
+        x = torch.max(torch.min(- torch.mv(torch.inverse(H), g), upper), lower)
+        is_free = torch.ones(x.numel(), dtype=torch.bool)
+        for _ in range(x.numel()):
+            gradient = g + torch.mv(H, x)
+            is_clamped = (torch.le(x, lower) & torch.gt(gradient, 0)) | (torch.ge(x, upper) & torch.lt(gradient, 0))
+            is_free = ~is_clamped
+            if not torch.any(is_free):
+                break
+
+            x_new = x.clone()
+            g_free = g[is_free] + torch.mv(H[is_free][:, is_clamped], x[is_clamped])
+            x_new[is_free] = - torch.mv(torch.inverse(H[is_free][:, is_free]), g_free)
+            x_new = torch.max(torch.min(x_new, upper), lower)
+            if torch.allclose(x_new, x):
+                break
+            x = x_new
+
+        return x, is_free
+
+    @staticmethod
+    def _forward_pass(trajectory: torch.Tensor, controls: torch.Tensor, k: torch.Tensor, K: torch.Tensor,
+                      step_size: float, A: torch.Tensor, B: torch.Tensor, T: torch.Tensor, lb: torch.Tensor,
+                      ub: torch.Tensor) -> torch.Tensor:
+        """Roll-out the closed-loop control law u_t = u_t + alpha * k_t + K_t (x_t_new - x_t), while
+        clamping the updated controls to their bounds.
+
+        :param trajectory: current ego trajectory (t_planning + 1, 5).
+        :param controls: current controls (t_planning, 2).
+        :param k: feed-forward updates (t_planning, 2).
+        :param K: feedback gains (t_planning, 2, 5).
+        :param step_size: step size of feed-forward update.
+        :returns: updated controls (t_planning, 2).
+        """
+        controls_new = torch.zeros_like(controls)
+        x = trajectory[0]
+        for t in range(controls.shape[0]):
+            u = controls[t] + step_size * k[t] + torch.mv(K[t], x - trajectory[t])
+            controls_new[t] = torch.max(torch.min(u, ub[t]), lb[t])
+            x = torch.mv(A, x) + torch.mv(B, controls_new[t]) + T
+        return controls_new
+
+    ###########################################################################
+    # Solver properties #######################################################
+    ###########################################################################
+    @property
+    def name(self) -> str:
+        return "ilqr"
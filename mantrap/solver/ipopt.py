@@ -1,3 +1,5 @@
+import math
+import time
 import typing
 
 import ipopt
@@ -12,6 +14,14 @@ from mantrap.solver.base.trajopt import TrajOptSolver
 
 class IPOPTSolver(TrajOptSolver):
 
+    def __init__(self, *args, **kwargs):
+        super(IPOPTSolver, self).__init__(*args, **kwargs)
+
+        # IPOPT problems are persistent as long as the constraint structure does not change, and the primal-dual
+        # solution of the last optimization is stored for warm-starting the next one, both keyed by tag.
+        self._problems = {}
+        self._multipliers = {}
+
     def optimize_core(
         self,
         z0: torch.Tensor,
@@ -19,6 +29,8 @@ class IPOPTSolver(TrajOptSolver):
         tag: str = mantrap.constants.TAG_OPTIMIZATION,
         max_cpu_time: float = mantrap.constants.IPOPT_MAX_CPU_TIME_DEFAULT,
         approx_jacobian: bool = False,
+        gauss_newton_hessian: bool = False,
+        warm_start_dual: bool = True,
         **solver_kwargs
     ) -> typing.Tuple[torch.Tensor, typing.Dict[str, torch.Tensor]]:
         """Optimization function for single core to find optimal z-vector.
@@ -34,8 +46,12 @@ class IPOPTSolver(TrajOptSolver):
         :param z0: initial value of optimization variables.
         :param tag: name of optimization call (name of the core).
         :param ado_ids: identifiers of ados that should be taken into account during optimization.
-        :param max_cpu_time: maximal cpu time until return.
+        :param max_cpu_time: maximal cpu time until return, additionally enforced as wall-clock time limit.
         :param approx_jacobian: if True automatic approximation of Jacobian based on finite-difference values.
+        :param gauss_newton_hessian: if True use the modules' (Gauss-Newton) hessian approximations instead of
+                                     IPOPT's limited-memory (BFGS) approximation, see `hessian()`.
+        :param warm_start_dual: if True warm-start the lagrange multipliers using the (shifted) multipliers of
+                                the previous optimization, see `warm_start_multipliers()`.
         :returns: z_opt (optimal values of optimization variable vector)
                   objective_opt (optimal objective value)
                   optimization_log (logging dictionary for this optimization = self.log)
@@ -57,11 +73,18 @@ class IPOPTSolver(TrajOptSolver):
         # Formulate optimization problem as in standardized IPOPT format.
         z0_flat = z0.flatten().numpy().tolist()
 
-        # Create ipopt problem with specific tag.
-        problem = IPOPTProblem(self, ado_ids=ado_ids, tag=tag)
+        # Create ipopt problem with specific tag. As the problem's structure solely depends on the ados taken into
+        # account, it is re-used in subsequent optimizations for the same set of ados.
+        if tag in self._problems.keys() and self._problems[tag][0] == ado_ids:
+            _, problem, nlp = self._problems[tag]
+        else:
+            if tag in self._problems.keys():
+                self._problems[tag][2].close()
+            problem = IPOPTProblem(self, ado_ids=ado_ids, tag=tag)
+            nlp = ipopt.problem(n=len(z0_flat), m=len(cl), problem_obj=problem, lb=lb, ub=ub, cl=cl, cu=cu)
+            self._problems[tag] = (list(ado_ids), problem, nlp)
+        problem.reset(deadline=time.time() + max_cpu_time)
 
-        # Use definition above to create IPOPT problem.
-        nlp = ipopt.problem(n=len(z0_flat), m=len(cl), problem_obj=problem, lb=lb, ub=ub, cl=cl, cu=cu)
         nlp.addOption("max_cpu_time", max_cpu_time)
         nlp.addOption("tol", mantrap.constants.IPOPT_OPTIMALITY_TOLERANCE)  # tolerance for optimality error
         # nlp.addOption("acceptable_tol", mantrap.constants.IPOPT_OPTIMALITY_TOLERANCE)
@@ -75,13 +98,21 @@ class IPOPTSolver(TrajOptSolver):
         # that it can approximated as convex (with the interactive cost being the only non-convex module).
         nlp.addOption("mehrotra_algorithm", "yes")
 
+        # As the problem might be re-used, the jacobian approximation option has to be set in every call.
         if approx_jacobian:
             nlp.addOption("jacobian_approximation", mantrap.constants.IPOPT_AUTOMATIC_JACOBIAN)
+        else:
+            nlp.addOption("jacobian_approximation", mantrap.constants.IPOPT_EXACT_JACOBIAN)
         # Due to the generalized automatic differentiation through large graphs the computational bottleneck
         # of the underlying approach clearly is computing computing derivatives. While calculating the Hessian
         # theoretically would be possible, it would introduce the need of a huge amount of additional computational
         # effort (squared size of gradient !), therefore it will be approximated automatically when needed.
-        nlp.addOption("hessian_approximation", mantrap.constants.IPOPT_AUTOMATIC_HESSIAN)
+        # Alternatively the Gauss-Newton approximations, built from the jacobians that are computed for the
+        # gradient anyway, can be used, which usually decreases the number of iterations (and predictions).
+        if gauss_newton_hessian:
+            nlp.addOption("hessian_approximation", mantrap.constants.IPOPT_EXACT_HESSIAN)
+        else:
+            nlp.addOption("hessian_approximation", mantrap.constants.IPOPT_AUTOMATIC_HESSIAN)
 
         # The larger the `print_level` value, the more print output IPOPT will provide.
         nlp.addOption("print_level", 5 if self.logger.is_logging else 0)
@@ -90,14 +121,82 @@ class IPOPTSolver(TrajOptSolver):
             # nlp.addOption("derivative_test", "first-order")
             # nlp.addOption("derivative_test_tol", 1e-4)
 
+        # When the multipliers of the previous optimization are available, warm-start IPOPT with the full primal-dual
+        # point. Then the initial point should not be pushed far into the interior, and the barrier parameter
+        # should start small, since otherwise the warm-started multipliers are not consistent with the barrier
+        # problem. As the problem might be re-used, the options have to be reset when not warm-starting.
+        multipliers = self.warm_start_multipliers(ado_ids=ado_ids, tag=tag) if warm_start_dual else None
+        if multipliers is not None:
+            nlp.addOption("warm_start_init_point", "yes")
+            nlp.addOption("warm_start_bound_push", mantrap.constants.IPOPT_WARM_START_PUSH)
+            nlp.addOption("warm_start_bound_frac", mantrap.constants.IPOPT_WARM_START_PUSH)
+            nlp.addOption("warm_start_slack_bound_push", mantrap.constants.IPOPT_WARM_START_PUSH)
+            nlp.addOption("warm_start_slack_bound_frac", mantrap.constants.IPOPT_WARM_START_PUSH)
+            nlp.addOption("warm_start_mult_bound_push", mantrap.constants.IPOPT_WARM_START_PUSH)
+            nlp.addOption("mu_init", mantrap.constants.IPOPT_WARM_START_MU_INIT)
+        else:
+            nlp.addOption("warm_start_init_point", "no")
+            nlp.addOption("mu_init", mantrap.constants.IPOPT_MU_INIT_DEFAULT)
+
         # Solve optimization problem for "optimal" ego trajectory `x_optimized`.
-        z_opt, info = nlp.solve(z0_flat)
-        nlp.close()
+        if multipliers is not None:
+            lagrange, zl, zu = multipliers
+            z_opt, info = nlp.solve(z0_flat, lagrange=lagrange, zl=zl, zu=zu)
+        else:
+            z_opt, info = nlp.solve(z0_flat)
+
+        # Only the multipliers of a solved optimization are meaningful for warm-starting the next optimization,
+        # otherwise the next optimization should be cold-started.
+        if info["status"] in mantrap.constants.IPOPT_STATUS_SOLVED:
+            self._multipliers[tag] = (list(ado_ids), self.env.time, info["mult_g"], info["mult_x_L"], info["mult_x_U"])
+        else:
+            self._multipliers.pop(tag, None)
+
+        # If IPOPT has not converged, e.g. since it has been stopped at the deadline, its last iterate might
+        # be infeasible, so return the best feasible iterate instead (if there is any).
+        if info["status"] not in mantrap.constants.IPOPT_STATUS_SOLVED and problem.z_best is not None:
+            z_opt = problem.z_best
 
         # Return solution as torch tensor.
         z2_opt = torch.from_numpy(z_opt).view(-1, 2)
         return z2_opt, self.logger.log
 
+    def warm_start_multipliers(self, ado_ids: typing.List[str], tag: str = mantrap.constants.TAG_OPTIMIZATION
+                               ) -> typing.Union[typing.Tuple[np.ndarray, np.ndarray, np.ndarray], None]:
+        """Lagrange multipliers for warm-starting the optimization, based on the last optimization's solution.
+
+        Within the receding-horizon loop (see `solve()`) the optimization variables are warm-started by shifting
+        the previous solution by one time-step. Equally, the multipliers of the constraints (module-wise, see
+        `shift_multipliers()`) and of the variable bounds are shifted, if the environment has proceeded by
+        exactly one time-step since the last optimization. If the environment has not proceeded at all, the
+        multipliers are re-used as they are. Otherwise, or if the ados taken into account have changed, the
+        previous multipliers are meaningless and None is returned.
+
+        :param ado_ids: identifiers of ados that should be taken into account during optimization.
+        :param tag: name of optimization call (name of the core).
+        :returns: constraint multipliers, lower and upper variable bound multipliers or None.
+        """
+        if tag not in self._multipliers.keys():
+            return None
+        ado_ids_previous, time_previous, lagrange, zl, zu = self._multipliers[tag]
+        if ado_ids_previous != ado_ids:
+            return None
+        if math.isclose(self.env.time, time_previous):
+            return lagrange, zl, zu
+        if not math.isclose(self.env.time, time_previous + self.env.dt):
+            return None
+
+        # Shift the multipliers module-wise, in the same order as the constraints have been stacked. The bound
+        # multipliers are shifted like the controls, with zero multipliers for the appended controls.
+        num_constraints = [module.num_constraints(ado_ids=ado_ids) for module in self.module_dict.values()]
+        lagrange_modules = np.split(lagrange, np.cumsum(num_constraints)[:-1])
+        lagrange = [module.shift_multipliers(lagrange_module, ado_ids=ado_ids)
+                    for module, lagrange_module in zip(self.module_dict.values(), lagrange_modules)]
+        lagrange = np.concatenate(lagrange)
+        zl = np.concatenate((zl[2:], np.zeros(2)))
+        zu = np.concatenate((zu[2:], np.zeros(2)))
+        return lagrange, zl, zu
+
     ###########################################################################
     # Optimization formulation - Formulation ##################################
     ###########################################################################
@@ -181,11 +280,39 @@ class IPOPTSolver(TrajOptSolver):
         structure_full_flat = structure_full.astype(int)
         return np.unravel_index(structure_full_flat, dims=(sum(num_constraints), 2 * self.planning_horizon))
 
-    # wrong hessian should just affect rate of convergence, not convergence in general
-    # (given it is semi-positive definite which is the case for the identity matrix)
-    # hessian = np.eye(3*self.O)
-    # def hessian(self, z, lagrange=None, obj_factor=None) -> np.ndarray:
-    #    raise NotImplementedError
+    ###########################################################################
+    # Optimization formulation - Hessian ######################################
+    ###########################################################################
+    def hessian(self, z: np.ndarray, lagrange: np.ndarray = None, obj_factor: float = 1.0,
+                ado_ids: typing.List[str] = None, tag: str = mantrap.constants.TAG_OPTIMIZATION) -> np.ndarray:
+        """Hessian of the lagrangian computation function.
+
+        Compute the (approximated) hessian of the objective for some value of the optimization variable `z`
+        based on the hessian implementations of the objective modules, i.e. exact hessians for quadratic modules
+        and Gauss-Newton (Fisher) approximations for the interaction-based modules, which re-use the jacobians
+        computed for the gradient. Both are positive semi-definite. The curvature of the constraints is
+        neglected (Gauss-Newton), since the constraints either are linear in `z` (e.g. speed limits) or their
+        curvature would require second-order derivatives through the prediction model, therefore the lagrange
+        multipliers do not affect the hessian.
+
+        IPOPT expects the values of the lower triangle of the (symmetric) hessian only, as defined by
+        the `hessian_structure()`.
+        """
+        ado_ids = ado_ids if ado_ids is not None else self.env.ado_ids
+        ego_trajectory, grad_wrt = self.z_to_ego_trajectory(z, return_leaf=True)
+        hessian = [m.hessian(ego_trajectory, grad_wrt=grad_wrt, tag=tag, ado_ids=ado_ids) for m in self.modules]
+        hessian = obj_factor * np.sum(hessian, axis=0)
+
+        rows, columns = self.hessian_structure()
+        return hessian[rows, columns]
+
+    def hessian_structure(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """Sparsity structure of the Hessian matrix.
+
+        As the ego's controls affect all of its future states, the hessian generally is dense, so that its
+        structure is the full lower triangle of the (2 * t_planning, 2 * t_planning) matrix.
+        """
+        return np.tril_indices(2 * self.planning_horizon)
 
     ###########################################################################
     # Solver properties #######################################################
@@ -210,10 +337,23 @@ class IPOPTProblem:
         self.tag = tag
         self.ado_ids = ado_ids
 
+        # Tracking of the best feasible iterate and wall-clock deadline (see `intermediate()`).
+        self.deadline = None
+        self.z_current = None
+        self.z_best = None
+        self.objective_best = math.inf
+
+    def reset(self, deadline: float = None):
+        self.deadline = deadline
+        self.z_current = None
+        self.z_best = None
+        self.objective_best = math.inf
+
     def objective(self, z: np.ndarray) -> float:
         return self.problem.objective(z, tag=self.tag, ado_ids=self.ado_ids)
 
     def gradient(self, z: np.ndarray) -> np.ndarray:
+        self.z_current = z.copy()  # gradient is evaluated at accepted iterates only
         return self.problem.gradient(z, tag=self.tag, ado_ids=self.ado_ids)
 
     def constraints(self, z: np.ndarray) -> np.ndarray:
@@ -225,5 +365,21 @@ class IPOPTProblem:
     # def jacobianstructure(self) -> typing.Tuple[np.ndarray, np.ndarray]:
     #     return self.problem.jacobian_structure(tag=self.tag, ado_ids=self.ado_ids)
 
-    def intermediate(self, alg_mod, iter_count, obj_value, inf_pr, inf_du, mu, d_norm, *args):
-        pass
+    def hessian(self, z: np.ndarray, lagrange: np.ndarray, obj_factor: float) -> np.ndarray:
+        return self.problem.hessian(z, lagrange=lagrange, obj_factor=obj_factor, tag=self.tag, ado_ids=self.ado_ids)
+
+    def hessianstructure(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        return self.problem.hessian_structure()
+
+    def intermediate(self, alg_mod, iter_count, obj_value, inf_pr, inf_du, mu, d_norm, *args) -> bool:
+        """Callback after every IPOPT iteration.
+
+        Keep track of the best feasible iterate, i.e. the current iterate (at which the gradient has been
+        evaluated last) if its primal infeasibility is small enough and its objective is lower than the best
+        one so far. Stop the optimization by returning False, when the wall-clock deadline has passed.
+        """
+        if inf_pr < mantrap.constants.SOLVER_CONSTRAINT_LIMIT and obj_value < self.objective_best:
+            if self.z_current is not None:
+                self.z_best = self.z_current
+                self.objective_best = obj_value
+        return self.deadline is None or time.time() < self.deadline
@@ -0,0 +1,238 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+import typing
+
+import torch
+
+import mantrap.constants
+import mantrap.utility.shaping
+
+from mantrap.solver.base.trajopt import TrajOptSolver
+
+
+class PlanningService:
+    """Long-running real-time planning service around a trajectory optimization solver.
+
+    In contrast to the solver's `solve()` method, which simulates the scene using its own evaluation
+    environment, the service is fed with timestamped observations of the ego and ado states from outside,
+    e.g. a robot's perception or a replayed dataset (see `mantrap_evaluation.replay`). The service consists
+    of three concurrent stages:
+
+    - observation: incoming observations are queued (`observe()`) and applied to the solver's environment
+      incrementally (`step_reset()`), adding new ados as they appear. Ados which are not observed any more
+      are extrapolated with constant velocity, since ados cannot be removed from the environment.
+    - planning: whenever new observations have arrived, the solver's environment is updated and a new plan
+      is computed in a worker thread, warm-started by the previous plan (shifted by the number of time-steps
+      that have passed since then). As the solver is stateful (e.g. warm-starting), planning rounds are
+      executed sequentially in the worker pool, while the event loop continues to receive observations.
+    - publishing: the latest plan is published at a fixed rate to all subscribers (`subscribe()`).
+
+    Since the solver's environment is touched by the worker thread only (observations are applied within
+    the planning round), no locking is required.
+
+    :param solver: trajectory optimization solver, whose environment is updated by the observations.
+    :param publish_rate: rate of publishing the latest plan [Hz], by default one plan per time-step.
+    :param step_budget: wall-clock budget for every planning round (see `TrajOptSolver.optimize()`),
+                        by default the environment's time-step.
+    :param warm_start_method: warm-starting method for the first plan (see `TrajOptSolver.warm_start()`).
+    :param solver_kwargs: additional arguments for the solver's optimization core.
+    """
+
+    def __init__(
+        self,
+        solver: TrajOptSolver,
+        publish_rate: float = None,
+        step_budget: float = None,
+        warm_start_method: str = mantrap.constants.WARM_START_HARD,
+        **solver_kwargs
+    ):
+        self._solver = solver
+        self._publish_rate = publish_rate if publish_rate is not None else 1 / solver.env.dt
+        self._step_budget = step_budget if step_budget is not None else solver.env.dt
+        self._warm_start_method = warm_start_method
+        self._solver_kwargs = solver_kwargs
+
+        # Asyncio objects are bound to the event loop, therefore they are created when the service is run,
+        # as well as the worker pool, which is shut down when the service stops.
+        self._observations = None  # type: typing.Union[asyncio.Queue, None]
+        self._subscribers = []  # type: typing.List[asyncio.Queue]
+        self._executor = None  # type: typing.Union[concurrent.futures.ThreadPoolExecutor, None]
+        self._is_running = False
+
+        # Latest plan (controls), the environment time it starts at and the (wall-clock) time the newest
+        # observation it is based on has been received, for measuring the end-to-end latency.
+        self._plan = None  # type: typing.Union[torch.Tensor, None]
+        self._plan_time = None  # type: typing.Union[float, None]
+        self._plan_observation_time = None  # type: typing.Union[float, None]
+        self._latencies = []  # type: typing.List[float]
+
+    ###########################################################################
+    # Interface ###############################################################
+    ###########################################################################
+    async def run(self, duration: float = None):
+        """Run the service (until `stop()` is called or for a given duration).
+
+        If one of the service's tasks fails, e.g. due to an error while planning, the service is stopped
+        immediately and the error is re-raised.
+
+        :param duration: wall-clock duration to run the service [s], by default until stopped.
+        """
+        self._observations = asyncio.Queue()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._is_running = True
+        tasks = [asyncio.ensure_future(self._planning_loop()), asyncio.ensure_future(self._publishing_loop())]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=duration, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    for task_pending in pending:
+                        task_pending.cancel()
+                    raise task.exception()
+            self.stop()
+            await asyncio.gather(*tasks)
+        finally:
+            self._is_running = False
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=True)
+
+    def stop(self):
+        """Stop the service, i.e. finish the current planning round and stop publishing."""
+        self._is_running = False
+        if self._observations is not None:
+            self._observations.put_nowait(None)  # wake up the planning loop
+
+    async def observe(self, t: float, ego_state: torch.Tensor, ado_states: typing.Dict[str, torch.Tensor]):
+        """Pass a new observation of the scene to the service.
+
+        :param t: time of observation (in the environment's time frame).
+        :param ego_state: ego state (x, y, vx, vy) at time `t`.
+        :param ado_states: ado states (x, y, vx, vy) at time `t`, by ado identifier.
+        """
+        assert mantrap.utility.shaping.check_ego_state(ego_state)
+        await self._observations.put((t, ego_state[0:4].detach(), ado_states, time.time()))
+
+    def subscribe(self) -> asyncio.Queue:
+        """Subscribe to the published plans, which are put into the returned queue as tuple of the controls
+        (t_planning, 2) and the environment time the controls start at."""
+        queue = asyncio.Queue()
+        self._subscribers.append(queue)
+        return queue
+
+    ###########################################################################
+    # Service tasks ###########################################################
+    ###########################################################################
+    async def _planning_loop(self):
+        """Wait for new observations, then update the environment and plan (in the worker pool)."""
+        loop = asyncio.get_event_loop()
+        while self._is_running:
+            observations = [await self._observations.get()]
+            while not self._observations.empty():
+                observations.append(self._observations.get_nowait())
+            observations = [observation for observation in observations if observation is not None]
+            if not self._is_running or len(observations) == 0:
+                break
+
+            plan, plan_time = await loop.run_in_executor(self._executor, self._plan_round, observations)
+            self._plan, self._plan_time = plan, plan_time
+            self._plan_observation_time = max([observation[-1] for observation in observations])
+
+    async def _publishing_loop(self):
+        """Publish the latest plan at a fixed rate, starting with the first plan. The end-to-end latency is
+        measured when a plan is published for the first time."""
+        published_observation_time = None
+        while self._is_running:
+            if self._plan is not None:
+                if self._plan_observation_time != published_observation_time:
+                    self._latencies.append(time.time() - self._plan_observation_time)
+                    published_observation_time = self._plan_observation_time
+                for queue in self._subscribers:
+                    queue.put_nowait((self._plan, self._plan_time))
+            await asyncio.sleep(1 / self._publish_rate)
+
+    ###########################################################################
+    # Planning ################################################################
+    ###########################################################################
+    def _plan_round(self, observations: typing.List[typing.Tuple]) -> typing.Tuple[torch.Tensor, float]:
+        """Apply the observations to the solver's environment and plan, warm-started by the previous plan.
+
+        :returns: planned controls (t_planning, 2), environment time the controls start at.
+        """
+        start_time = time.time()
+        for t, ego_state, ado_states, _ in observations:
+            self._apply_observation(t, ego_state=ego_state, ado_states=ado_states)
+
+        # The modules possibly depend on the scene, e.g. the interaction module depends on the prediction
+        # without ego, which changes with every observation.
+        self._solver.reset_env(self._solver.env)
+
+        # Warm-start by the previous plan, shifted by the number of time-steps that have passed since then,
+        # or by the solver's warm-starting method for the first plan.
+        env = self._solver.env
+        if self._plan is None:
+            z0 = self._solver.warm_start(method=self._warm_start_method)
+        else:
+            num_steps = min(max(round((env.time - self._plan_time) / env.dt), 0), self._plan.shape[0])
+            controls = torch.cat((self._plan[num_steps:, :], torch.zeros((num_steps, 2))))
+            z0 = torch.from_numpy(self._solver.ego_controls_to_z(controls))
+
+        deadline = start_time + self._step_budget
+        z_opt = self._solver.optimize(z0, tag=mantrap.constants.TAG_OPTIMIZATION, deadline=deadline,
+                                      **self._solver_kwargs)
+        controls = self._solver.z_to_ego_controls(z_opt.detach().numpy()).detach()
+        logging.debug(f"service: planned at t = {env.time:.2f} s in {time.time() - start_time:.3f} s")
+        return controls, env.time
+
+    def _apply_observation(self, t: float, ego_state: torch.Tensor, ado_states: typing.Dict[str, torch.Tensor]):
+        """Update the solver's environment by an observation of the scene at time `t`.
+
+        The environment proceeds in steps of its time-step, so the observation is applied as the state after
+        the number of time-steps that are closest to the observation time, while outdated observations are
+        ignored. Ados that have not been observed are extrapolated with constant velocity, new ados are added.
+        """
+        env = self._solver.env
+        num_steps = round((t - env.time) / env.dt)
+        if num_steps < 1:
+            logging.debug(f"service: ignoring outdated observation at t = {t:.2f} s")
+            return
+
+        t_next = env.time + num_steps * env.dt
+        ado_next = torch.zeros((env.num_ados, 5))
+        for m_ado, ado in enumerate(env.ados):
+            if ado.id in ado_states.keys():
+                ado_next[m_ado, 0:4] = ado_states[ado.id][0:4]
+            else:
+                ado_next[m_ado, 0:2] = ado.position + ado.velocity * num_steps * env.dt
+                ado_next[m_ado, 2:4] = ado.velocity
+        ado_next[:, -1] = t_next
+        ego_next = torch.cat((ego_state[0:4].float(), torch.tensor([t_next])))
+
+        for _ in range(num_steps - 1):
+            env.step_reset(ego_next=None, ado_next=None)
+        env.step_reset(ego_next=ego_next, ado_next=ado_next)
+
+        for ado_id, ado_state in ado_states.items():
+            if ado_id not in env.ado_ids:
+                env.add_ado(position=ado_state[0:2].float(), velocity=ado_state[2:4].float(), time=env.time,
+                            identifier=ado_id)
+
+    ###########################################################################
+    # Service properties ######################################################
+    ###########################################################################
+    @property
+    def solver(self) -> TrajOptSolver:
+        return self._solver
+
+    @property
+    def plan(self) -> typing.Union[torch.Tensor, None]:
+        return self._plan
+
+    @property
+    def latencies(self) -> typing.List[float]:
+        return self._latencies
+
+    @property
+    def is_running(self) -> bool:
+        return self._is_running
@@ -0,0 +1,320 @@
+import time
+import typing
+
+import torch
+
+import mantrap.constants
+import mantrap.environment
+import mantrap.utility.maths
+import mantrap.utility.shaping
+
+from mantrap.solver.augmented_lagrangian import AugmentedLagrangianSolver
+
+
+class LinearizedEnvironment:
+    """Environment proxy replacing the environment's prediction by its first-order expansion w.r.t. the ego's
+    controls around some linearization point, while delegating everything else to the environment.
+
+    The distribution parameters are expanded around the predicted distribution at the linearization point, i.e.
+    the means and the log-scales (to keep the scales positive), while further parameters such as the mixture
+    weights or the correlations of a GMM (e.g. Trajectron's output) are kept constant:
+
+    .. math:: \\mu(u) = \\mu(u_0) + J_{\\mu} (u - u_0)
+    .. math:: log \\sigma(u) = log \\sigma(u_0) + J_{log \\sigma} (u - u_0)
+
+    The jacobian is computed once per linearization point (and ados and distribution type requested), either
+    analytically by the environment (`compute_distributions_with_jacobian()`) or by (vectorized) automatic
+    differentiation of a single prediction. Afterwards predictions are cheap, independent from the prediction
+    model, and their jacobian is known analytically as well. Unless linearized, the proxy behaves like the
+    environment itself.
+
+    :param env: environment to linearize.
+    """
+
+    def __init__(self, env: mantrap.environment.base.GraphBasedEnvironment):
+        self._env = env
+        self._controls = None  # type: typing.Union[torch.Tensor, None]
+        self._linearizations = {}  # type: typing.Dict[typing.Tuple[bool, typing.Tuple[str, ...]], tuple]
+
+    ###########################################################################
+    # Linearization ###########################################################
+    ###########################################################################
+    def linearize(self, ego_controls: torch.Tensor):
+        """Linearize the prediction around the given ego controls (t_horizon, 2). The jacobians are computed
+        lazily, i.e. for the ados and distribution types requested by the first prediction."""
+        assert mantrap.utility.shaping.check_ego_controls(ego_controls)
+        self._controls = ego_controls.detach().clone().float()
+        self._linearizations = {}
+
+    def release(self):
+        """Release the linearization, i.e. predict with the environment itself again."""
+        self._controls = None
+        self._linearizations = {}
+
+    def snapshot(self) -> typing.Tuple[typing.Union[torch.Tensor, None], typing.Dict]:
+        """Return the current linearization (linearization point and jacobians), to restore it later on."""
+        return self._controls, self._linearizations.copy()
+
+    def restore(self, snapshot: typing.Tuple[typing.Union[torch.Tensor, None], typing.Dict]):
+        """Restore some linearization (see `snapshot()`)."""
+        self._controls, self._linearizations = snapshot[0], snapshot[1].copy()
+
+    def _linearization(self, vel_dist: bool, ado_ids: typing.List[str]
+                       ) -> typing.Tuple[torch.distributions.Distribution, torch.Tensor, torch.Tensor]:
+        """Distribution at the linearization point, stacked mean and log-scale parameters (2, num_ados,
+        t_horizon, num_modes, 2) and their jacobian w.r.t. the ego controls (..., 2 * t_horizon)."""
+        key = (vel_dist, tuple(ado_ids))
+        if key in self._linearizations:
+            return self._linearizations[key]
+
+        output = self._env.compute_distributions_with_jacobian(self._controls, vel_dist=vel_dist, ado_ids=ado_ids)
+        if output is not None:
+            dist_dict, mean_jacobian, scale_jacobian = output
+            distribution = dist_dict.distribution
+            scale = distribution.stddev
+            parameters = torch.stack((distribution.mean, torch.log(scale)))
+            jacobian = torch.stack((mean_jacobian, scale_jacobian / scale.unsqueeze(dim=-1)))
+
+        else:
+            distributions = []
+
+            def parameters_function(controls: torch.Tensor) -> torch.Tensor:
+                ego_trajectory = self._env.ego.unroll_trajectory(controls, dt=self._env.dt)
+                dist = self._env.compute_distributions(ego_trajectory, vel_dist=vel_dist, ado_ids=ado_ids)
+                distributions.append(dist.distribution)
+                if type(dist.distribution) == mantrap.utility.maths.VGMM2D:
+                    return torch.stack((dist.distribution.mus, dist.distribution.log_sigmas))
+                return torch.stack((dist.distribution.mean, torch.log(dist.distribution.stddev)))
+
+            # The function is evaluated once, while the backward passes are vectorized.
+            with torch.enable_grad():
+                jacobian = torch.autograd.functional.jacobian(parameters_function, self._controls, vectorize=True)
+            jacobian = jacobian.reshape(*jacobian.shape[:-2], -1)
+            jacobian = torch.where(torch.isnan(jacobian), torch.zeros_like(jacobian), jacobian)
+            # Detach the distribution from the computation graph, since its constant parameters are re-used.
+            distribution = distributions[0]
+            if type(distribution) == mantrap.utility.maths.VGMM2D:
+                distribution = mantrap.utility.maths.VGMM2D(mus=distribution.mus.detach(),
+                                                            log_pis=distribution.log_pis.detach(),
+                                                            log_sigmas=distribution.log_sigmas.detach(),
+                                                            corrs=distribution.corrs.detach())
+                parameters = torch.stack((distribution.mus, distribution.log_sigmas))
+            else:
+                distribution = torch.distributions.Normal(loc=distribution.mean.detach(),
+                                                          scale=distribution.stddev.detach())
+                parameters = torch.stack((distribution.mean, torch.log(distribution.stddev)))
+
+        linearization = (distribution, parameters.detach(), jacobian.detach())
+        self._linearizations[key] = linearization
+        return linearization
+
+    ###########################################################################
+    # Simulation graph ########################################################
+    ###########################################################################
+    def compute_distributions(self, ego_trajectory: torch.Tensor, vel_dist: bool = True,
+                              ado_ids: typing.List[str] = None, **kwargs
+                              ) -> mantrap.utility.maths.MultiAgentDistribution:
+        """Predict the ados' distributions conditioned on the ego trajectory using the linearized prediction
+        model (see `GraphBasedEnvironment.compute_distributions()`). The prediction is differentiable w.r.t.
+        the ego trajectory."""
+        if self._controls is None or len(kwargs) > 0 or ego_trajectory.shape[0] != self._controls.shape[0] + 1:
+            return self._env.compute_distributions(ego_trajectory, vel_dist=vel_dist, ado_ids=ado_ids, **kwargs)
+
+        ado_ids = self._env.ado_ids if ado_ids is None else ado_ids
+        ego_controls = self._env.ego.roll_trajectory(ego_trajectory, dt=self._env.dt)
+        distribution, parameters, jacobian = self._linearization(vel_dist=vel_dist, ado_ids=ado_ids)
+        mean, log_scale = parameters + torch.matmul(jacobian, (ego_controls - self._controls).flatten())
+
+        if type(distribution) == mantrap.utility.maths.VGMM2D:
+            distribution = mantrap.utility.maths.VGMM2D(mus=mean, log_pis=distribution.log_pis,
+                                                        log_sigmas=log_scale, corrs=distribution.corrs)
+        else:
+            distribution = torch.distributions.Normal(loc=mean, scale=torch.exp(log_scale))
+        return mantrap.utility.maths.MultiAgentDistribution(distribution, agent_ids=ado_ids)
+
+    def compute_distributions_with_jacobian(self, ego_controls: torch.Tensor, vel_dist: bool = True,
+                                            ado_ids: typing.List[str] = None, **kwargs
+                                            ) -> typing.Union[typing.Tuple[mantrap.utility.maths.MultiAgentDistribution,
+                                                                           torch.Tensor, torch.Tensor], None]:
+        """Predict the ados' distributions using the linearized prediction model, together with the jacobian of
+        their means and scales w.r.t. the ego's controls (see `GraphBasedEnvironment.
+        compute_distributions_with_jacobian()`), for uni-modal gaussian distributions."""
+        if self._controls is None or len(kwargs) > 0 or ego_controls.shape != self._controls.shape:
+            return self._env.compute_distributions_with_jacobian(ego_controls, vel_dist=vel_dist, ado_ids=ado_ids,
+                                                                 **kwargs)
+
+        ado_ids = self._env.ado_ids if ado_ids is None else ado_ids
+        distribution, _, jacobian = self._linearization(vel_dist=vel_dist, ado_ids=ado_ids)
+        if type(distribution) != torch.distributions.Normal:
+            return None
+
+        ego_trajectory = self._env.ego.unroll_trajectory(ego_controls, dt=self._env.dt)
+        dist_dict = self.compute_distributions(ego_trajectory, vel_dist=vel_dist, ado_ids=ado_ids)
+        scale = dist_dict.stddev.unsqueeze(dim=-1)
+        return dist_dict, jacobian[0], jacobian[1] * scale
+
+    def __getattr__(self, name: str):
+        return getattr(self._env, name)
+
+    ###########################################################################
+    # Properties ##############################################################
+    ###########################################################################
+    @property
+    def env(self) -> mantrap.environment.base.GraphBasedEnvironment:
+        return self._env
+
+    @property
+    def is_linearized(self) -> bool:
+        return self._controls is not None
+
+
+class SQPSolver(AugmentedLagrangianSolver):
+    """Trust-region sequential quadratic programming solver with linearized prediction model.
+
+    For complex prediction models (e.g. Trajectron or Social Forces) the prediction dominates the cost of every
+    evaluation of the objective and constraints, while solvers such as IPOPT or the `AugmentedLagrangianSolver`
+    require dozens of evaluations until convergence. Instead the SQP solver linearizes the prediction (means and
+    scales of the distributions) w.r.t. the ego's controls once per outer iteration, using a single jacobian
+    computation (see `LinearizedEnvironment`), and solves the resulting local problem, which is cheap to evaluate,
+    within a trust region around the linearization point. The local problem is solved by the augmented
+    lagrangian method (see `AugmentedLagrangianSolver`), with the trust region as additional box constraints.
+
+    The step is accepted depending on the ratio of the actual decrease of the merit function (objective plus
+    weighted l1 constraint violation) to the decrease predicted by the linearized model. Thereby, the merit
+    function of the next iterate is evaluated by linearizing around it, as at the linearization point the
+    linearized model is exact. Thus, the prediction model is evaluated only once per outer iteration. If the
+    step is rejected the trust region is shrunk, otherwise the prediction model has been re-linearized already.
+
+    The modules are connected to the linearized prediction model instead of the environment itself, which
+    behaves like the environment unless linearized, i.e. outside of the optimization.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._surrogate = None  # type: typing.Union[LinearizedEnvironment, None]
+        super(SQPSolver, self).__init__(*args, **kwargs)
+
+    def optimize_core(
+        self,
+        z0: torch.Tensor,
+        ado_ids: typing.List[str],
+        tag: str = mantrap.constants.TAG_OPTIMIZATION,
+        max_cpu_time: float = mantrap.constants.AUGLAG_MAX_CPU_TIME_DEFAULT,
+        max_iterations: int = mantrap.constants.SQP_MAX_ITERATIONS,
+        **solver_kwargs
+    ) -> typing.Tuple[torch.Tensor, typing.Dict[str, torch.Tensor]]:
+        """Optimization function for single core to find optimal z-vector.
+
+        Given some initial value `z0` find the optimal allocation for z with respect to the internally defined
+        objectives and constraints. This function is executed in every thread in parallel, for different initial
+        values `z0`. To simplify optimization not all agents in the scene have to be taken into account during
+        the optimization but only the ones with ids defined in `ado_ids`.
+
+        :param z0: initial value of optimization variables.
+        :param tag: name of optimization call (name of the core).
+        :param ado_ids: identifiers of ados that should be taken into account during optimization.
+        :param max_cpu_time: maximal cpu time until return.
+        :param max_iterations: maximal number of trust region iterations (linearizations).
+        :returns: z_opt (optimal values of optimization variable vector)
+                  optimization_log (logging dictionary for this optimization = self.log)
+        """
+        start_time = time.time()
+        deadline = start_time + max_cpu_time
+
+        # Clean up & detaching graph for deleting previous gradients.
+        self._env.detach()
+
+        lb, ub = self.optimization_variable_bounds()
+        lb, ub = torch.tensor(lb).float(), torch.tensor(ub).float()
+        bounds = self._inequality_bounds(ado_ids=ado_ids)
+        seed = int(torch.randint(0, 2 ** 31 - len(self.modules), size=(1, )))
+        surrogate = self._module_env()
+
+        z = torch.max(torch.min(z0.flatten().float(), ub), lb)
+        radius = mantrap.constants.SQP_TRUST_REGION_INITIAL
+        try:
+            linearization_start_time = time.time()
+            self._linearize(z)
+            merit = self._merit(z, ado_ids=ado_ids, tag=tag, bounds=bounds, seed=seed)
+            linearization_time = time.time() - linearization_start_time
+
+            for _ in range(max_iterations):
+                # Solve the local problem within the trust region, using the linearized prediction model.
+                lb_k, ub_k = torch.max(lb, z - radius), torch.min(ub, z + radius)
+                z_trial = self._optimize_augmented_lagrangian(z, ado_ids=ado_ids, tag=tag, lb=lb_k, ub=ub_k,
+                                                              deadline=deadline)
+                merit_predicted = self._merit(z_trial, ado_ids=ado_ids, tag=tag, bounds=bounds, seed=seed)
+                predicted_decrease = merit - merit_predicted
+                if predicted_decrease < mantrap.constants.SQP_CONVERGENCE_TOLERANCE * max(abs(merit), 1.0):
+                    break  # no (significant) decrease predicted within the trust region
+                if time.time() + linearization_time > deadline:
+                    break  # next linearization would (presumably) exceed the deadline
+
+                # Evaluate the actual merit at the trial point by linearizing around it, which is exact.
+                linearization = surrogate.snapshot()
+                linearization_start_time = time.time()
+                self._linearize(z_trial)
+                merit_trial = self._merit(z_trial, ado_ids=ado_ids, tag=tag, bounds=bounds, seed=seed)
+                linearization_time = time.time() - linearization_start_time
+                ratio = (merit - merit_trial) / predicted_decrease
+
+                # Update the trust region radius (and the iterate if the step has been accepted).
+                if ratio >= mantrap.constants.SQP_ACCEPTANCE_RATIO:
+                    is_at_boundary = float(torch.max(torch.abs(z_trial - z))) > 0.99 * radius
+                    if ratio > mantrap.constants.SQP_EXPANSION_RATIO and is_at_boundary:
+                        radius = min(2 * radius, mantrap.constants.SQP_TRUST_REGION_MAX)
+                    z, merit = z_trial, merit_trial
+                else:
+                    self._linearize(z, linearization=linearization)
+                    radius = 0.25 * radius
+                    if radius < mantrap.constants.SQP_TRUST_REGION_MIN:
+                        break
+
+                if self.logger.is_logging:
+                    self.objective(z.double().numpy(), ado_ids=ado_ids, tag=tag)
+                    self.constraints(z.double().numpy(), ado_ids=ado_ids, tag=tag)
+                if time.time() > deadline:
+                    break
+
+        finally:
+            surrogate.release()
+            for module in self.modules:
+                module.reset_cache()
+
+        # Return solution as torch tensor.
+        z2_opt = z.double().view(-1, 2)
+        return z2_opt, self.logger.log
+
+    def _linearize(self, z: torch.Tensor, linearization: typing.Tuple = None):
+        """Linearize the prediction model around the controls `z` (or restore a previous linearization), while
+        resetting the modules' caches, which have been derived from the previous linearization."""
+        if linearization is not None:
+            self._module_env().restore(linearization)
+        else:
+            self._module_env().linearize(z.view(-1, 2))
+        for module in self.modules:
+            module.reset_cache()
+
+    def _merit(self, z: torch.Tensor, ado_ids: typing.List[str], tag: str,
+               bounds: typing.List[typing.Tuple[torch.Tensor, torch.Tensor]], seed: int) -> float:
+        """Merit function, i.e. objective plus weighted l1 constraint violation, for some optimization vector."""
+        with torch.no_grad():
+            _, _, objectives, constraints = self._evaluate_torch(z, ado_ids=ado_ids, tag=tag, seed=seed)
+        merit = sum([float(objective) for objective in objectives if objective is not None])
+        for constraint, (lower, upper) in zip(constraints, bounds):
+            violation = float(torch.relu(self._inequality(constraint, lower=lower, upper=upper)).sum())
+            merit += mantrap.constants.SQP_MERIT_PENALTY * violation
+        return merit
+
+    def _module_env(self) -> LinearizedEnvironment:
+        """The modules are connected to the linearized prediction model of the planning environment, which is
+        re-built whenever the planning environment is reset."""
+        if self._surrogate is None or self._surrogate.env is not self.env:
+            self._surrogate = LinearizedEnvironment(self.env)
+        return self._surrogate
+
+    ###########################################################################
+    # Solver properties #######################################################
+    ###########################################################################
+    @property
+    def name(self) -> str:
+        return "sqp"
@@ -1,10 +1,12 @@
 import abc
+import collections.abc
 import math
 import typing
 
 import torch
 import torch.distributions
 
+import mantrap.constants
 import mantrap.utility.shaping
 
 
@@ -35,18 +37,21 @@ class VGMM2D(torch.distributions.Distribution):
 
     Re-Implementation of GMM2D model used in GenTrajectron (B. Ivanovic, M. Pavone).
 
-    :param log_pis: Log Mixing Proportions (t_horizon, num_modes).
-    :param mus: Mixture Components mean (t_horizon, num_modes, 2)
-    :param log_sigmas: Log Standard Deviations (t_horizon, num_modes, 2)
-    :param corrs: Cholesky factor of correlation (t_horizon, num_modes).
+    The parameters may have additional leading batch dimensions, e.g. (num_ados, t_horizon, num_modes), in
+    order to describe the distributions of several agents at once.
+
+    :param log_pis: Log Mixing Proportions (..., t_horizon, num_modes).
+    :param mus: Mixture Components mean (..., t_horizon, num_modes, 2)
+    :param log_sigmas: Log Standard Deviations (..., t_horizon, num_modes, 2)
+    :param corrs: Cholesky factor of correlation (..., t_horizon, num_modes).
     """
     def __init__(self, mus: torch.Tensor, log_pis: torch.Tensor, log_sigmas: torch.Tensor, corrs: torch.Tensor):
         super(VGMM2D, self).__init__()
-        self.t_horizon, self.components = log_pis.shape
+        self.t_horizon, self.components = log_pis.shape[-2:]
         self.dimensions = 2
-        assert mus.shape == (self.t_horizon, self.components, 2)
-        assert log_sigmas.shape == (self.t_horizon, self.components, 2)
-        assert corrs.shape == (self.t_horizon, self.components)
+        assert mus.shape == (*log_pis.shape, 2)
+        assert log_sigmas.shape == (*log_pis.shape, 2)
+        assert corrs.shape == log_pis.shape
 
         # Distribution parameters.
         self.log_pis = log_pis - torch.logsumexp(log_pis, dim=-1, keepdim=True)  # [..., N]
@@ -85,18 +90,36 @@ class VGMM2D(torch.distributions.Distribution):
 
         return torch.logsumexp(self.log_pis + component_log_p, dim=-1)
 
-    def rsample(self, sample_shape=torch.Size()):
+    def rsample(self, sample_shape=torch.Size(), chunk_size: int = mantrap.constants.ENV_GMM_SAMPLE_CHUNK):
         """Generates a sample_shape shaped re-parameterized sample or sample_shape shaped batch of
         re-parameterized  samples if the distribution parameters are batched.
 
+        Instead of sampling from every component and selecting one of them afterwards, first the component
+        of each sample is drawn, then merely the parameters (mean, cholesky factor) of the selected components
+        are gathered and sampled from. For large numbers of samples, the samples are drawn in chunks
+        along the first sample dimension to bound the required memory.
+
         :param sample_shape: Shape of the samples
-        :return: Samples from the GMM in velocity space.
+        :param chunk_size: maximal number of samples drawn at once (along the first sample dimension).
+        :return: Samples from the GMM in velocity space (*sample_shape, ..., t_horizon, 1, 2).
         """
-        samples = torch.randn(size=sample_shape + self.mus.shape).unsqueeze(dim=-1)
-        mvn_samples = self.mus + torch.matmul(self.L, samples).squeeze(dim=-1)
+        sample_shape = torch.Size(sample_shape)
+        if len(sample_shape) > 0 and sample_shape[0] > chunk_size:
+            num_chunks = math.ceil(sample_shape[0] / chunk_size)
+            chunk_sizes = [chunk_size] * (num_chunks - 1) + [sample_shape[0] - chunk_size * (num_chunks - 1)]
+            return torch.cat([self.rsample((n, *sample_shape[1:]), chunk_size=chunk_size) for n in chunk_sizes])
+
+        # Draw the component of every sample, then gather the parameters of the selected components (using
+        # expanded views of the parameters, so that they are not copied for every sample).
         component_cat_samples = self.pis_cat_dist.sample(sample_shape)
-        selector = torch.eye(self.components)[component_cat_samples].unsqueeze(dim=-1)
-        return torch.sum(mvn_samples * selector, dim=-2, keepdim=True)
+        index = component_cat_samples.view(*component_cat_samples.shape, 1, 1)  # (..., t_horizon, 1, 1)
+        mus = self.mus.expand(*sample_shape, *self.mus.shape)
+        L = self.L.expand(*sample_shape, *self.L.shape)
+        mus_selected = torch.gather(mus, dim=-2, index=index.expand(*index.shape[:-1], 2))
+        L_selected = torch.gather(L, dim=-3, index=index.unsqueeze(dim=-1).expand(*index.shape[:-1], 2, 2))
+
+        samples = torch.randn(size=(*mus_selected.shape, 1))
+        return mus_selected + torch.matmul(L_selected, samples).squeeze(dim=-1)
 
     def modes_sorted(self) -> torch.Tensor:
         return torch.argsort(self.log_pis)  # logarithm is strictly monotone!
@@ -115,6 +138,165 @@ class VGMM2D(torch.distributions.Distribution):
         return self.sigmas
 
 
+class MultiAgentDistribution(collections.abc.Mapping):
+    """Batched distribution over the trajectories of multiple agents.
+
+    Instead of storing a separate distribution object for every agent, the parameters of all agents' distributions
+    are stacked along a leading agent dimension, i.e. the underlying distribution has the shape
+    (num_agents, t_horizon, num_modes, 2). Each agent is assigned to a row of it by its identifier. Thereby
+    properties such as the mean or the log probability can be evaluated for all agents at once, instead of
+    looping over the agents and stacking their results.
+
+    For backwards compatibility the object can still be used as an agent-id keyed dictionary of single agent
+    distributions, which are sliced out of the batched distribution lazily.
+
+    :param distribution: batched distribution, either a `VGMM2D` or a `torch.distributions.Normal`,
+                         with mean (num_agents, t_horizon, num_modes, 2).
+    :param agent_ids: agent identifiers in the order of the distribution's rows.
+    """
+    def __init__(self, distribution: torch.distributions.Distribution, agent_ids: typing.List[str]):
+        assert type(distribution) in [VGMM2D, torch.distributions.Normal]
+        assert len(distribution.mean.shape) == 4  # num_agents, t_horizon, num_modes, 2
+        assert distribution.mean.shape[0] == len(agent_ids)
+        assert distribution.mean.shape[-1] == 2
+
+        self._distribution = distribution
+        self._agent_ids = list(agent_ids)
+        self._id_to_row = {agent_id: m for m, agent_id in enumerate(self._agent_ids)}
+        self._agent_distributions = {}  # single agent distributions, sliced on demand
+
+    ###########################################################################
+    # Batched distribution ####################################################
+    ###########################################################################
+    def log_prob(self, value: torch.Tensor) -> torch.Tensor:
+        """Evaluate the log probability of the given values for all agents at once.
+
+        :param value: values to evaluate, broadcastable to the distribution's mean (num_agents, t_horizon, ...).
+        :returns: log probability of these values for every agent (num_agents, t_horizon, ...).
+        """
+        return self._distribution.log_prob(value)
+
+    def sample(self, sample_shape: torch.Size = torch.Size()) -> torch.Tensor:
+        """Draw samples from the distribution of every agent.
+
+        :param sample_shape: number of samples per agent.
+        :returns: samples (num_agents, *sample_shape, t_horizon, num_modes', 2), with num_modes' = 1 for a GMM.
+        """
+        samples = self._distribution.sample(sample_shape)
+        return torch.movedim(samples, len(sample_shape), 0)
+
+    def rsample(self, sample_shape: torch.Size = torch.Size()) -> torch.Tensor:
+        """Draw re-parametrized samples from the distribution of every agent, shaped as in `sample()`."""
+        samples = self._distribution.rsample(sample_shape)
+        return torch.movedim(samples, len(sample_shape), 0)
+
+    def top_k_modes(self, k: int) -> torch.Tensor:
+        """Determine the indices of the `k` most important (i.e. most likely) modes for every agent and time-step.
+
+        :param k: number of modes to return, at most the number of modes of the distribution.
+        :returns: mode indices (num_agents, t_horizon, k), sorted by decreasing importance.
+        """
+        num_agents, t_horizon, num_modes, _ = self.mean.shape
+        assert 0 < k <= num_modes
+        if type(self._distribution) == torch.distributions.Normal:  # uni-modal, all modes equally important
+            return torch.arange(k).view(1, 1, k).repeat(num_agents, t_horizon, 1)
+        return torch.topk(self._distribution.log_pis, k=k, dim=-1)[1]
+
+    def prune_modes(self, num_modes: int = None, mass: float = None
+                    ) -> typing.Tuple['MultiAgentDistribution', torch.Tensor]:
+        """Reduce the distribution to its most important modes for every agent and time-step.
+
+        Either the `num_modes` modes with the largest weights are kept, or the smallest set of modes whose
+        cumulative weight covers at least the probability `mass` (or both, whatever is less). Since the number
+        of modes covering the mass might vary over agents and time-steps, all distributions keep the maximal
+        number of required modes, while the weight of not required modes is set to zero. The weights of the
+        remaining modes are re-normalized.
+
+        :param num_modes: maximal number of modes to keep.
+        :param mass: probability mass that has to be covered by the kept modes, in (0, 1].
+        :returns: pruned distribution, indices of the kept modes in the original distribution (num_agents, t, k).
+        """
+        num_agents, t_horizon, num_modes_all, _ = self.mean.shape
+        if type(self._distribution) == torch.distributions.Normal:  # uni-modal, nothing to prune
+            return self, self.top_k_modes(k=num_modes_all)
+
+        dist = self._distribution
+        k = num_modes_all if num_modes is None else min(num_modes, num_modes_all)
+        log_pis, modes = torch.topk(dist.log_pis, k=k, dim=-1)
+
+        # Modes are required until the mass of all previous (more important) modes covers the desired mass.
+        if mass is not None:
+            assert 0 < mass <= 1
+            pis = torch.exp(log_pis)
+            is_required = (torch.cumsum(pis, dim=-1) - pis) < mass
+            k = int(torch.max(torch.sum(is_required, dim=-1)))
+            log_pis = log_pis.masked_fill(~is_required, -math.inf)[..., :k]
+            modes = modes[..., :k]
+
+        modes_2d = modes.unsqueeze(dim=-1).expand(num_agents, t_horizon, k, 2)
+        distribution = VGMM2D(mus=torch.gather(dist.mus, dim=-2, index=modes_2d),
+                              log_pis=log_pis,
+                              log_sigmas=torch.gather(dist.log_sigmas, dim=-2, index=modes_2d),
+                              corrs=torch.gather(dist.corrs, dim=-1, index=modes))
+        return MultiAgentDistribution(distribution, agent_ids=self._agent_ids), modes
+
+    def subset(self, agent_ids: typing.List[str]) -> 'MultiAgentDistribution':
+        """Restrict the distribution to the given agents, in the given order."""
+        if agent_ids == self._agent_ids:
+            return self
+        return MultiAgentDistribution(self._select(self.index(agent_ids)), agent_ids=agent_ids)
+
+    def index(self, agent_ids: typing.Union[str, typing.List[str]]) -> typing.Union[int, typing.List[int]]:
+        """Row index of the agent (or list of row indices of the agents) with the given identifier(s)."""
+        if type(agent_ids) == str:
+            return self._id_to_row[agent_ids]
+        return [self._id_to_row[agent_id] for agent_id in agent_ids]
+
+    def _select(self, rows: typing.Union[int, typing.List[int]]) -> torch.distributions.Distribution:
+        dist = self._distribution
+        if type(dist) == VGMM2D:
+            return VGMM2D(mus=dist.mus[rows], log_pis=dist.log_pis[rows], log_sigmas=dist.log_sigmas[rows],
+                          corrs=dist.corrs[rows])
+        else:
+            return torch.distributions.Normal(loc=dist.loc[rows], scale=dist.scale[rows])
+
+    ###########################################################################
+    # Dictionary interface ####################################################
+    ###########################################################################
+    def __getitem__(self, agent_id: str) -> torch.distributions.Distribution:
+        if agent_id not in self._agent_distributions:
+            self._agent_distributions[agent_id] = self._select(self._id_to_row[agent_id])
+        return self._agent_distributions[agent_id]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self._agent_ids)
+
+    def __len__(self) -> int:
+        return len(self._agent_ids)
+
+    def __contains__(self, agent_id: str) -> bool:
+        return agent_id in self._id_to_row
+
+    ###########################################################################
+    # Properties ##############################################################
+    ###########################################################################
+    @property
+    def distribution(self) -> torch.distributions.Distribution:
+        return self._distribution
+
+    @property
+    def ids(self) -> typing.List[str]:
+        return self._agent_ids
+
+    @property
+    def mean(self) -> torch.Tensor:
+        return self._distribution.mean
+
+    @property
+    def stddev(self) -> torch.Tensor:
+        return self._distribution.stddev
+
+
 ###########################################################################
 # Numerical Methods #######################################################
 ###########################################################################
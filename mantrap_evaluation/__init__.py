@@ -1,2 +1,2 @@
 import mantrap_evaluation.scenarios
-from mantrap_evaluation.metrics import evaluate
+from mantrap_evaluation.metrics import evaluate, evaluate_batched
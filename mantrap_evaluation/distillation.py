@@ -0,0 +1,248 @@
+import argparse
+import os
+import time
+import typing
+
+import mantrap
+import numpy as np
+import torch
+
+import mantrap_evaluation.scenarios
+
+
+ENVIRONMENTS = {"potential_field": mantrap.environment.PotentialFieldEnvironment,
+                "kalman": mantrap.environment.KalmanEnvironment,
+                "social_forces": mantrap.environment.SocialForcesEnvironment,
+                "trajectron": mantrap.environment.Trajectron,
+                "sgan": mantrap.environment.SGAN}
+
+SCENARIOS = [mantrap_evaluation.scenarios.custom_avoid,
+             mantrap_evaluation.scenarios.custom_haruki,
+             mantrap_evaluation.scenarios.custom_passing,
+             mantrap_evaluation.scenarios.custom_surrounding,
+             mantrap_evaluation.scenarios.custom_swapping]
+
+
+###########################################################################
+# Dataset #################################################################
+###########################################################################
+def build_scenes(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                 seeds: typing.List[int] = None, num_ados: int = 3
+                 ) -> typing.List[mantrap.environment.base.GraphBasedEnvironment]:
+    """Build the scenes for distillation, i.e. all custom scenarios and a random scenario for every seed.
+
+    :param env_type: type of teacher environment.
+    :param seeds: random seeds of random scenarios (if None, merely the custom scenarios are used).
+    :param num_ados: number of pedestrians in random scenarios.
+    """
+    scenes = [scenario(env_type=env_type)[0] for scenario in SCENARIOS]
+    for seed in (seeds if seeds is not None else []):
+        torch.manual_seed(seed)
+        scenes.append(mantrap_evaluation.scenarios.random(env_type=env_type, num_ados=num_ados)[0])
+    return scenes
+
+
+def random_ego_trajectory(env: mantrap.environment.base.GraphBasedEnvironment, t_horizon: int) -> torch.Tensor:
+    """Sample a random ego trajectory, by unrolling controls around a random (constant) control input."""
+    _, u_max = env.ego.control_limits()
+    controls = torch.rand(2) * 2 - 1 + (torch.rand((t_horizon, 2)) * 2 - 1) * 0.3
+    controls = torch.clamp(controls * u_max, min=-u_max, max=u_max)
+    return env.ego.unroll_trajectory(controls, dt=env.dt)
+
+
+def moment_matching(distribution: mantrap.utility.maths.MultiAgentDistribution
+                    ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+    """Approximate the (multi-modal) distribution by a uni-modal gaussian distribution, assuming independent
+    coordinates, with the same mean and variance.
+
+    :returns: mean (num_ados, t_horizon, 2), log-standard-deviation (num_ados, t_horizon, 2).
+    """
+    mus, sigmas = distribution.mean, distribution.stddev  # (num_ados, t_horizon, num_modes, 2)
+    if isinstance(distribution.distribution, mantrap.utility.maths.VGMM2D):
+        weights = torch.exp(distribution.distribution.log_pis).unsqueeze(dim=-1)
+    else:
+        weights = torch.ones_like(mus[..., 0:1]) / mus.shape[-2]
+    mean = torch.sum(weights * mus, dim=-2)
+    variance = torch.sum(weights * (sigmas ** 2 + mus ** 2), dim=-2) - mean ** 2
+    return mean, 0.5 * torch.log(torch.clamp(variance, min=mantrap.constants.ENV_VAR_INITIAL * 1e-4))
+
+
+def generate_dataset(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                     seeds: typing.List[int] = None, num_samples: int = mantrap.constants.SURROGATE_SAMPLES_PER_SCENE,
+                     t_horizon: int = mantrap.constants.SURROGATE_HORIZON,
+                     num_history: int = mantrap.constants.SURROGATE_HISTORY,
+                     ) -> typing.Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Generate the distillation dataset, by predicting the ados in every scene (see `build_scenes()`)
+    using the teacher environment, for several random ego trajectories and without ego.
+
+    Every ado of every prediction results in one sample, consisting of the surrogate model's features
+    (see `SurrogateModel.features()`) and the (moment-matched) velocity distribution of the teacher.
+
+    :param env_type: type of teacher environment.
+    :param seeds: random seeds of random scenarios (also seeding the ego trajectories).
+    :param num_samples: number of random ego trajectories per scene.
+    :param t_horizon: prediction horizon.
+    :param num_history: number of (past and current) ado velocities as input.
+    :returns: features (N, num_inputs), mean velocities (N, t_horizon, 2), log-standard-deviations (N, t_horizon, 2).
+    """
+    model = mantrap.environment.surrogate.SurrogateModel(t_horizon=t_horizon, num_history=num_history)
+    features, means, log_stds = [], [], []
+    for m_scene, env in enumerate(build_scenes(env_type, seeds=seeds)):
+        torch.manual_seed(m_scene if seeds is None else seeds[0] + m_scene)
+
+        ego_trajectories = [random_ego_trajectory(env, t_horizon=t_horizon) for _ in range(num_samples)]
+        for ego_trajectory in [None, *ego_trajectories]:
+            with torch.no_grad():
+                if ego_trajectory is None:
+                    distribution = env.compute_distributions_wo_ego(t_horizon=t_horizon)
+                else:
+                    distribution = env.compute_distributions(ego_trajectory)
+            mean, log_std = moment_matching(distribution)
+            features.append(model.features(env, ego_trajectory=ego_trajectory, ado_ids=distribution.ids))
+            means.append(mean)
+            log_stds.append(log_std)
+
+    return torch.cat(features), torch.cat(means), torch.cat(log_stds)
+
+
+###########################################################################
+# Training ################################################################
+###########################################################################
+def train_surrogate(features: torch.Tensor, means: torch.Tensor, log_stds: torch.Tensor,
+                    model: mantrap.environment.surrogate.SurrogateModel = None,
+                    epochs: int = mantrap.constants.SURROGATE_EPOCHS,
+                    batch_size: int = mantrap.constants.SURROGATE_BATCH_SIZE,
+                    learning_rate: float = mantrap.constants.SURROGATE_LEARNING_RATE, seed: int = 0,
+                    ) -> typing.Tuple[mantrap.environment.surrogate.SurrogateModel, typing.List[float]]:
+    """Train the surrogate model on the distillation dataset (see `generate_dataset()`), on CPU.
+
+    The model is trained to minimize the Kullback-Leibler divergence between the teacher's and the model's
+    velocity distribution, i.e. fitting both its mean and its uncertainty.
+
+    :param features: model input features (N, num_inputs).
+    :param means: teacher mean velocities (N, t_horizon, 2).
+    :param log_stds: teacher log-standard-deviations (N, t_horizon, 2).
+    :param model: model to train, by default a new model with matching time horizon.
+    :param epochs: number of training epochs.
+    :param batch_size: number of samples per training batch.
+    :param learning_rate: learning rate of Adam optimizer.
+    :param seed: random seed for initialization and batching.
+    :returns: trained model, mean training loss of every epoch.
+    """
+    torch.manual_seed(seed)
+    if model is None:
+        model = mantrap.environment.surrogate.SurrogateModel(t_horizon=means.shape[1])
+    assert features.shape[1] == model.input_mean.numel()
+    assert means.shape[1:] == log_stds.shape[1:] == (model.t_horizon, 2)
+
+    model.input_mean.copy_(torch.mean(features, dim=0))
+    input_std = torch.std(features, dim=0)
+    model.input_std.copy_(torch.where(input_std > 1e-6, input_std, torch.ones_like(input_std)))
+
+    model.train()
+    model.requires_grad_(True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    losses = []
+    for _ in range(epochs):
+        permutation = torch.randperm(features.shape[0])
+        epoch_loss = 0.0
+        for batch in torch.split(permutation, batch_size):
+            mean_s, log_std_s = model(features[batch])
+            mean_t, log_std_t = means[batch], log_stds[batch]
+            kl_divergence = log_std_s - log_std_t - 0.5 + \
+                (torch.exp(2 * log_std_t) + (mean_t - mean_s) ** 2) / (2 * torch.exp(2 * log_std_s))
+            loss = torch.mean(kl_divergence)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item() * batch.numel()
+        losses.append(epoch_loss / features.shape[0])
+
+    model.eval()
+    return model, losses
+
+
+###########################################################################
+# Evaluation ##############################################################
+###########################################################################
+def evaluate_surrogate(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                       model: mantrap.environment.surrogate.SurrogateModel, seeds: typing.List[int] = None,
+                       num_samples: int = 10, t_horizon: int = None) -> typing.Dict[str, float]:
+    """Evaluate the surrogate model against its teacher environment, in terms of prediction error and throughput.
+
+    The prediction error is evaluated on a dataset generated from (other) random scenarios, the throughput as
+    the number of predictions (`compute_distributions()` calls, all ados with ego) per second.
+
+    :param env_type: type of teacher environment.
+    :param model: surrogate model to evaluate.
+    :param seeds: random seeds of (test) random scenarios.
+    :param num_samples: number of random ego trajectories per scene.
+    :param t_horizon: prediction horizon, by default the model's horizon.
+    :returns: mean velocity error [m/s], standard deviation error [m/s], teacher and surrogate throughput [1/s].
+    """
+    t_horizon = model.t_horizon if t_horizon is None else t_horizon
+    features, means, log_stds = generate_dataset(env_type, seeds=seeds, num_samples=num_samples,
+                                                 t_horizon=model.t_horizon, num_history=model.num_history)
+    with torch.no_grad():
+        mean_s, log_std_s = model(features)
+    mean_error = torch.mean(torch.norm(mean_s[:, :t_horizon] - means[:, :t_horizon], dim=-1)).item()
+    std_error = torch.mean(torch.norm(torch.exp(log_std_s) - torch.exp(log_stds), dim=-1)[:, :t_horizon]).item()
+
+    throughputs = {}
+    for env in build_scenes(env_type, seeds=seeds):
+        env_surrogate = env.copy(env_type=mantrap.environment.SurrogateEnvironment, teacher=env.name, model=model)
+        ego_trajectories = [random_ego_trajectory(env, t_horizon=t_horizon) for _ in range(num_samples)]
+        for name, env_k in [("teacher", env), ("surrogate", env_surrogate)]:
+            start_time = time.time()
+            with torch.no_grad():
+                for ego_trajectory in ego_trajectories:
+                    env_k.compute_distributions(ego_trajectory)
+            throughputs.setdefault(name, []).append(num_samples / (time.time() - start_time))
+
+    return {"mean_error": mean_error, "std_error": std_error,
+            "teacher_throughput": float(np.mean(throughputs["teacher"])),
+            "surrogate_throughput": float(np.mean(throughputs["surrogate"]))}
+
+
+###########################################################################
+# Distillation pipeline ###################################################
+###########################################################################
+def distill(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__, seeds: typing.List[int] = None,
+            num_samples: int = mantrap.constants.SURROGATE_SAMPLES_PER_SCENE, directory: str = None,
+            **train_kwargs) -> mantrap.environment.surrogate.SurrogateModel:
+    """Distill a surrogate model from the teacher environment, store it in the surrogate directory
+    and register it, so that it is used by every `SurrogateEnvironment` with this teacher.
+
+    :param env_type: type of teacher environment.
+    :param seeds: random seeds of random scenarios in the dataset.
+    :param num_samples: number of random ego trajectories per scene.
+    :param directory: directory to store model in, by default `SURROGATE_DIRECTORY` (if "", it is not stored).
+    :param train_kwargs: additional arguments for training (see `train_surrogate()`).
+    """
+    teacher = build_scenes(env_type)[0].name
+    features, means, log_stds = generate_dataset(env_type, seeds=seeds, num_samples=num_samples)
+    model, _ = train_surrogate(features, means, log_stds, **train_kwargs)
+
+    if directory is None:
+        directory = mantrap.utility.io.build_os_path(mantrap.constants.SURROGATE_DIRECTORY, make_dir=True)
+    if directory:
+        model.save(os.path.join(directory, f"{teacher}.pt"))
+    mantrap.environment.SurrogateEnvironment.register_model(model, teacher=teacher)
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env", type=str, default=mantrap.constants.SURROGATE_TEACHER_DEFAULT,
+                        choices=ENVIRONMENTS.keys())
+    parser.add_argument("--num_scenes", type=int, default=50, help="number of random training scenes")
+    parser.add_argument("--num_samples", type=int, default=mantrap.constants.SURROGATE_SAMPLES_PER_SCENE)
+    parser.add_argument("--epochs", type=int, default=mantrap.constants.SURROGATE_EPOCHS)
+    args = parser.parse_args()
+
+    surrogate = distill(ENVIRONMENTS[args.env], seeds=list(range(args.num_scenes)), num_samples=args.num_samples,
+                        epochs=args.epochs)
+    results = evaluate_surrogate(ENVIRONMENTS[args.env], surrogate, seeds=list(range(1000, 1010)))
+    print(f"{args.env}: mean error = {results['mean_error']:.3f} m/s, std error = {results['std_error']:.3f} m/s, "
+          f"throughput = {results['teacher_throughput']:.1f} -> {results['surrogate_throughput']:.1f} predictions/s")
@@ -1,16 +1,22 @@
+import hashlib
 import inspect
 import logging
+import multiprocessing
+import os
+import random
 import sys
 import time
 import typing
 
 import mantrap
+import numpy as np
 import pandas
 import torch
 
 
 def evaluate(solver: mantrap.solver.base.TrajOptSolver, time_steps: int = 10, label: str = None,
-             num_tests: int = 40, mean_df: bool = True, **solve_kwargs
+             num_tests: int = 40, mean_df: bool = True, num_workers: int = 1, seed: int = 0,
+             results_directory: str = None, **solve_kwargs
              ) -> typing.Tuple[pandas.DataFrame, torch.Tensor, torch.Tensor]:
     """Evaluate the solver performance in current set configuration using MonteCarlo testing.
 
@@ -22,91 +28,294 @@ def evaluate(solver: mantrap.solver.base.TrajOptSolver, time_steps: int = 10, la
     :param label: label of evaluation in resulting data-frame, by default the log-name of the solver.
     :param num_tests: number of monte-carlo tests.
     :param mean_df: return the mean data-frame over all experiments.
+    :param num_workers: number of parallel worker processes (None = number of cores, see `evaluate_multiple()`).
+    :param seed: base random seed, the k-th test is seeded with `seed + k`.
+    :param results_directory: directory to store (and resume from) results of single tests.
     :param solve_kwargs: additional kwargs for `solve()` method.s
     """
     label = solver.log_name if label is None else label
-    logging.info(f"Start evaluation {label} ...")
-
-    # Solve internal optimization problem (measure average run-time).
-    eval_df = pandas.DataFrame()
-    ego_trajectories, ado_trajectories = [], []
-    for k in range(num_tests):
-        logging.info(f"Evaluation {label}: [{k}/{num_tests}] ...")
-
-        start_time = time.time()
-        ego_trajectory_k, _ = solver.solve(time_steps=time_steps, **solve_kwargs)
-        solve_time = time.time() - start_time
-
-        ado_trajectories_k = solver.env.predict_w_trajectory(ego_trajectory_k)
-        ego_trajectories.append(ego_trajectory_k)
-        ado_trajectories.append(ado_trajectories_k)
-
-        # Build a dictionary of all metric functions listed in current file.
-        metrics = {name.replace("metric_", ""): obj for name, obj in inspect.getmembers(sys.modules[__name__])
-                   if (inspect.isfunction(obj) and name.startswith("metric"))}
-
-        # Evaluate these metrics and build output data-frame.
-        eval_dict = {}
-        for name, metric_function in metrics.items():
-            eval_dict[name] = metric_function(ego_trajectory=ego_trajectory_k,
-                                              ado_trajectories=ado_trajectories_k,
-                                              env=solver.env, goal=solver.goal)
-        eval_dict["runtime[s]"] = solve_time / time_steps
-        eval_df = eval_df.append(pandas.DataFrame(eval_dict, index=[k]))
-
-    ego_trajectories = torch.stack(ego_trajectories)
-    ado_trajectories = torch.stack(ado_trajectories).transpose(0, 1)
+    eval_df, ego_trajectories, ado_trajectories = evaluate_multiple(
+        {label: solver}, time_steps=time_steps, num_tests=num_tests, num_workers=num_workers, seed=seed,
+        results_directory=results_directory, **solve_kwargs
+    )
 
     if mean_df:
-        return eval_df.mean().to_frame(name=label).transpose(), ego_trajectories, ado_trajectories
+        return eval_df.loc[label].mean().to_frame(name=label).transpose(), ego_trajectories[label], \
+               ado_trajectories[label]
+    else:
+        return eval_df.loc[label], ego_trajectories[label], ado_trajectories[label]
+
+
+def evaluate_multiple(solvers: typing.Dict[str, mantrap.solver.base.TrajOptSolver], time_steps: int = 10,
+                      num_tests: int = 40, num_workers: int = 1, seed: int = 0, results_directory: str = None,
+                      **solve_kwargs
+                      ) -> typing.Tuple[pandas.DataFrame,
+                                        typing.Dict[str, torch.Tensor],
+                                        typing.Dict[str, torch.Tensor]]:
+    """Evaluate several solvers (e.g. different solvers in different scenarios) using MonteCarlo testing.
+
+    Every (solver, test) pair is an independent job, which is seeded deterministically by `seed + k` for the
+    k-th test, so that the results do not depend on the order or the process in which the jobs are executed
+    and all solvers are evaluated on the same random draws. The jobs are distributed over a pool of worker
+    processes, which inherit the solvers from the parent process (fork), instead of pickling them per job.
+
+    Since a sweep over many solvers and tests can take a long time, every finished job is stored in the
+    `results_directory` (if given). Jobs that have already been stored are loaded instead of being re-computed,
+    so that an interrupted evaluation can be resumed. The result files are keyed by the full configuration of
+    the job (see `_config_hash()`), so that results of another configuration are never re-used.
+
+    :param solvers: solvers to evaluate by label (has to be of `TrajOptSolver` class).
+    :param time_steps: number of time-steps to solve for evaluation.
+    :param num_tests: number of monte-carlo tests per solver.
+    :param num_workers: number of parallel worker processes (None = number of cores, 1 = no multiprocessing).
+    :param seed: base random seed, the k-th test is seeded with `seed + k`.
+    :param results_directory: directory to store (and resume from) results of single tests.
+    :param solve_kwargs: additional kwargs for `solve()` method.
+    :returns: data-frame of metric values, indexed by (label, test).
+    :returns: ego trajectories by label (num_tests, time_steps + 1, 5).
+    :returns: ado trajectories by label.
+    """
+    global _EVAL_SOLVERS
+    _EVAL_SOLVERS = solvers
+
+    # Pre-allocate output data-frame, one row for every job and one column for every metric.
+    columns = list(_metrics().keys()) + ["runtime[s]", "deadline_misses[%]"]
+    index = pandas.MultiIndex.from_product([list(solvers.keys()), range(num_tests)], names=["label", "test"])
+    eval_df = pandas.DataFrame(index=index, columns=columns, dtype=float)
+    ego_trajectories = {label: [None] * num_tests for label in solvers.keys()}
+    ado_trajectories = {label: [None] * num_tests for label in solvers.keys()}
+
+    # Load the results of jobs that have been stored previously, all other jobs are open.
+    jobs = []
+    if results_directory is not None:
+        os.makedirs(results_directory, exist_ok=True)
+    for label, solver in solvers.items():
+        config_hash = _config_hash(label, solver=solver, time_steps=time_steps, solve_kwargs=solve_kwargs)
+        for k in range(num_tests):
+            result_file = None
+            if results_directory is not None:
+                result_file = os.path.join(results_directory, f"{label}_{config_hash}_{seed + k:06d}.pt")
+            if result_file is not None and os.path.isfile(result_file):
+                result = torch.load(result_file)
+                _store_result(result, label, k, eval_df, ego_trajectories, ado_trajectories)
+            else:
+                jobs.append((label, k, seed + k, time_steps, result_file, solve_kwargs))
+    logging.info(f"Start evaluation: {len(jobs)} open jobs ({len(eval_df) - len(jobs)} resumed) ...")
+
+    # Execute open jobs, either sequentially or distributed over a process pool. The pool is terminated
+    # when leaving its context, also when a job raises an error.
+    def store_results(results: typing.Iterable[typing.Tuple[str, int, typing.Dict[str, typing.Any]]]):
+        for n, (label_n, k_n, result_n) in enumerate(results):
+            logging.info(f"Evaluation {label_n}: [{k_n}/{num_tests}] finished ({n + 1}/{len(jobs)}) ...")
+            _store_result(result_n, label_n, k_n, eval_df, ego_trajectories, ado_trajectories)
+
+    if num_workers == 1:
+        store_results(map(_evaluate_job, jobs))
     else:
-        return eval_df, ego_trajectories, ado_trajectories
+        with multiprocessing.get_context("fork").Pool(processes=num_workers) as pool:
+            store_results(pool.imap_unordered(_evaluate_job, jobs))
+
+    ego_trajectories = {label: torch.stack(x) for label, x in ego_trajectories.items()}
+    ado_trajectories = {label: torch.stack(x).transpose(0, 1) for label, x in ado_trajectories.items()}
+    return eval_df, ego_trajectories, ado_trajectories
+
+
+_EVAL_SOLVERS = {}  # solvers to evaluate, shared with worker processes by forking
+
+
+def _evaluate_job(job: typing.Tuple) -> typing.Tuple[str, int, typing.Dict[str, typing.Any]]:
+    """Evaluate a single (solver, test) job, seeded deterministically, and store the result (if demanded)."""
+    label, k, job_seed, time_steps, result_file, solve_kwargs = job
+    solver = _EVAL_SOLVERS[label]
+    random.seed(job_seed)
+    np.random.seed(job_seed)
+    torch.manual_seed(job_seed)
+
+    # Solve internal optimization problem (measure average run-time).
+    start_time = time.time()
+    ego_trajectory, _ = solver.solve(time_steps=time_steps, **solve_kwargs)
+    solve_time = time.time() - start_time
+    ado_trajectories = solver.env.predict_w_trajectory(ego_trajectory).detach()
+
+    # Evaluate all metric functions listed in current file (as batch of a single test).
+    eval_batch = evaluate_metrics(ego_trajectory.detach().unsqueeze(dim=0), ado_trajectories.unsqueeze(dim=0),
+                                  env=solver.env, goal=solver.goal, solver_class=solver.__class__)
+    eval_dict = {name: float(score[0]) for name, score in eval_batch.items()}
+    eval_dict["runtime[s]"] = solve_time / time_steps
+    eval_dict["deadline_misses[%]"] = solver.deadline_misses / (ego_trajectory.shape[0] - 1) * 100
+
+    result = {"eval": eval_dict, "ego_trajectory": ego_trajectory.detach(), "ado_trajectories": ado_trajectories}
+    if result_file is not None:
+        torch.save(result, result_file + ".tmp")
+        os.replace(result_file + ".tmp", result_file)
+    return label, k, result
+
+
+def _config_hash(label: str, solver: mantrap.solver.base.TrajOptSolver, time_steps: int,
+                 solve_kwargs: typing.Dict[str, typing.Any]) -> str:
+    """Hash the configuration of an evaluation job (except of its seed), for keying its result file."""
+    config = (label, solver.log_name, time_steps, sorted(solve_kwargs.items()))
+    return hashlib.sha1(repr(config).encode("utf-8")).hexdigest()[:10]
+
+
+def _store_result(result: typing.Dict[str, typing.Any], label: str, k: int, eval_df: pandas.DataFrame,
+                  ego_trajectories: typing.Dict[str, typing.List], ado_trajectories: typing.Dict[str, typing.List]):
+    eval_df.loc[(label, k), list(result["eval"].keys())] = list(result["eval"].values())
+    ego_trajectories[label][k] = result["ego_trajectory"]
+    ado_trajectories[label][k] = result["ado_trajectories"]
+
+
+def _metrics() -> typing.Dict[str, typing.Callable]:
+    """Build a dictionary of all metric functions listed in current file."""
+    return {name.replace("metric_", ""): obj for name, obj in inspect.getmembers(sys.modules[__name__])
+            if (inspect.isfunction(obj) and name.startswith("metric"))}
+
+
+#######################################################################################################################
+# Batch evaluation ####################################################################################################
+#######################################################################################################################
+def evaluate_metrics(ego_trajectories: torch.Tensor, ado_trajectories: torch.Tensor,
+                     env: mantrap.environment.base.GraphBasedEnvironment, goal: torch.Tensor,
+                     solver_class: mantrap.solver.base.TrajOptSolver.__class__ = mantrap.solver.IPOPTSolver
+                     ) -> typing.Dict[str, torch.Tensor]:
+    """Evaluate all metric functions listed in current file on a batch of tests at once.
+
+    All tests of the batch must be based on the same environment (initial state) and goal, as for example
+    the tests of one solver in `evaluate_multiple()`, and have the same number of time-steps.
+
+    :param ego_trajectories: trajectories of ego (num_tests, t_horizon, 5).
+    :param ado_trajectories: trajectories of ados (num_tests, num_ados, t_horizon, num_modes, 5).
+    :param env: simulation environment the tests are based on.
+    :param goal: optimization goal state (may vary in size, but usually 2D position).
+    :param solver_class: solver for re-solving the simplified task (see `metric_extra_time()`).
+    :returns: metric values by metric name, each (num_tests).
+    """
+    assert ego_trajectories.dim() == 3 and ado_trajectories.dim() == 5
+    assert ego_trajectories.shape[0] == ado_trajectories.shape[0]
+    return {name: metric_function(ego_trajectory=ego_trajectories, ado_trajectories=ado_trajectories,
+                                  env=env, goal=goal, solver_class=solver_class)
+            for name, metric_function in _metrics().items()}
+
+
+def evaluate_batched(env: mantrap.environment.BatchedEnvironment, ego_policy: typing.Callable, goals: torch.Tensor,
+                     time_steps: int = 10, seed: int = 0
+                     ) -> typing.Tuple[pandas.DataFrame, torch.Tensor, torch.Tensor]:
+    """Evaluate an ego policy in many scenes at once, which are simulated in lockstep by the batched environment.
+
+    In contrast to `evaluate()` the ego does not solve an optimization problem in every scene, but follows the
+    given batched policy, e.g. some baseline controller, so that statistics over thousands of random scenes can
+    be computed within minutes. Therefore merely the metrics which do not have to re-solve the scene are evaluated
+    (minimal distance, ego effort, ado effort, directness and final distance), each for all scenes at once. The
+    padded ados of the batched environment are masked, i.e. ignored by the metrics.
+
+    :param env: batched environment of scenes to evaluate (not reset, i.e. stepped from its current state).
+    :param ego_policy: function mapping the batched environment to the ego actions in every scene (num_scenes, 2).
+    :param goals: ego goal position in every scene (num_scenes, 2).
+    :param time_steps: number of time-steps to simulate.
+    :param seed: random seed of the simulation.
+    :returns: data-frame of metric values, indexed by scene.
+    :returns: ego trajectories since initialization of the batched environment (num_scenes, K, 5).
+    :returns: ado trajectories since initialization of the batched environment (num_scenes, num_ados_max, K, 1, 5).
+    """
+    assert goals.shape == (env.num_scenes, 2)
+    torch.manual_seed(seed)
+    ego_trajectories_initial, _ = env.trajectories()
+    ado_paths_wo = env.predict_wo_ego(t_horizon=time_steps)  # current state, before simulating the scenes
+    for _ in range(time_steps):
+        env.step(ego_actions=ego_policy(env))
+    ego_trajectories, ado_trajectories = env.trajectories()
+    ado_mask = env.ado_mask
+
+    # Evaluate the simulated time-steps only, as the ado paths without ego are predicted from the current state.
+    k_start = ego_trajectories_initial.shape[1] - 1
+    ego_trajectories_sim = ego_trajectories[:, k_start:]
+    ado_trajectories_sim = ado_trajectories[:, :, k_start:]
+    v_max = torch.tensor([[ado.speed_limits[1] for ado in ados] + [0.0] * (env.num_ados_max - len(ados))
+                          for ados in env.ados])
+    ado_effort = _ado_effort(ado_trajectories_sim[..., 0:2], ado_paths_wo=ado_paths_wo, v_max=v_max, dt=env.dt,
+                             ados=env.ados, ado_mask=ado_mask)
+    scores = {"minimal_distance": metric_minimal_distance(ego_trajectories_sim, ado_trajectories_sim,
+                                                          ado_mask=ado_mask),
+              "ego_effort": metric_ego_effort(ego_trajectories_sim),
+              "ado_effort": ado_effort,
+              "directness": metric_directness(ego_trajectories_sim, goal=goals),
+              "final_distance": metric_final_distance(ego_trajectories_sim, goal=goals)}
+
+    eval_df = pandas.DataFrame({name: score.numpy() for name, score in scores.items()},
+                               index=pandas.Index(range(env.num_scenes), name="scene"), dtype=float)
+    return eval_df, ego_trajectories, ado_trajectories
+
+
+def _to_batch(x: torch.Tensor, dim_single: int) -> typing.Tuple[torch.Tensor, bool]:
+    """Detach the input tensor and add a batch dimension, if it is a single test (dimension `dim_single`)."""
+    is_batched = x.dim() == dim_single + 1
+    x = x.detach()
+    return (x if is_batched else x.unsqueeze(dim=0)), is_batched
+
+
+def _from_batch(scores: torch.Tensor, is_batched: bool) -> typing.Union[float, torch.Tensor]:
+    """Return the metric scores (num_tests) for batched input and a single float otherwise."""
+    return scores if is_batched else float(scores[0])
 
 
 #######################################################################################################################
 # Metric definitions ##################################################################################################
 #######################################################################################################################
-def metric_minimal_distance(
-    ego_trajectory: torch.Tensor, ado_trajectories: torch.Tensor, num_inter_points: int = 100, **unused
-) -> float:
+def metric_minimal_distance(ego_trajectory: torch.Tensor, ado_trajectories: torch.Tensor,
+                            ado_mask: torch.Tensor = None, **unused) -> typing.Union[float, torch.Tensor]:
     """Determine the minimal distance between the robot and any agent (minimal separation distance).
 
     Therefore the function expects to get a robot trajectory and positions for every ado at every point of time,
     to determine the minimal distance in the continuous time. In order to transform the discrete to continuous time
     trajectories it is assumed that the robot as well as the other agents move linearly, as a single integrator, i.e.
-    neglecting accelerations, from one discrete time-step to another, so that it's positions can be interpolated
-    in between using a first order interpolation method.
-
-    :param ego_trajectory: trajectory of ego (t_horizon, 5).
-    :param ado_trajectories: trajectories of ados (num_ados, num_modes, t_horizon, 5).
-    :param num_inter_points: number of interpolation points between each time-step.
+    neglecting accelerations, from one discrete time-step to another. Then the relative position between robot and
+    ado is moving linearly within each time interval as well, r(s) = r_0 + s * d with s in [0, 1], so that the
+    closest approach within the interval can be determined analytically:
+
+    .. math:: s^* = clip(- \\frac{r_0 \\cdot d}{d \\cdot d}, 0, 1)
+
+    :param ego_trajectory: trajectory of ego (t_horizon, 5) or batch of trajectories (num_tests, t_horizon, 5).
+    :param ado_trajectories: trajectories of ados (num_ados, t_horizon, num_modes, 5) or batch of trajectories
+                             (num_tests, num_ados, t_horizon, num_modes, 5).
+    :param ado_mask: mask of the ados to take into account (num_ados) or (num_tests, num_ados), e.g. to ignore
+                     padded ados.
+    :returns: minimal distance, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ego_trajectory = ego_trajectory.detach()
-    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory, pos_only=True)
-    ado_trajectories = ado_trajectories.detach()
-    t_horizon = ego_trajectory.shape[0]
-    num_ados = ado_trajectories.shape[0]
-    assert mantrap.utility.shaping.check_ado_trajectories(ado_trajectories, t_horizon=t_horizon)
-
-    minimal_distance = float("Inf")
-    for t in range(1, t_horizon):
-        ego_position_t0, ego_position_t1 = ego_trajectory[t - 1, 0:2], ego_trajectory[t, 0:2]
-        ego_dense = mantrap.utility.maths.straight_line(ego_position_t0, ego_position_t1, steps=num_inter_points)
-
-        for m in range(num_ados):
-            ado_position_t0 = ado_trajectories[m, t-1, 0, 0:2]
-            ado_position_t1 = ado_trajectories[m, t, 0, 0:2]
-            ado_dense = mantrap.utility.maths.straight_line(ado_position_t0, ado_position_t1, steps=num_inter_points)
-
-            min_distance_current = torch.min(torch.norm(ego_dense - ado_dense, dim=1)).item()
-            if min_distance_current < minimal_distance:
-                minimal_distance = min_distance_current
-
-    return float(minimal_distance)
+    ego_trajectory, is_batched = _to_batch(ego_trajectory, dim_single=2)
+    ado_trajectories, _ = _to_batch(ado_trajectories, dim_single=4)
+    num_tests, t_horizon, _ = ego_trajectory.shape
+    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory[0], pos_only=True)
+    assert mantrap.utility.shaping.check_ado_trajectories(ado_trajectories[0], t_horizon=t_horizon)
+    if ado_trajectories.shape[1] == 0:
+        return _from_batch(torch.full((num_tests, ), fill_value=float("Inf")), is_batched=is_batched)
+
+    # Relative positions between every ado (first mode) and the robot (num_tests, num_ados, t_horizon, 2).
+    relative = ado_trajectories[:, :, :, 0, 0:2] - ego_trajectory[:, :, 0:2].unsqueeze(dim=1)
+    distances = torch.norm(relative, dim=-1)
+    if ado_mask is not None:
+        ado_mask = ado_mask.view(num_tests, -1, 1)
+        distances = distances.masked_fill(~ado_mask, float("Inf"))
+    distances = distances.flatten(start_dim=1)
+
+    # Closest approach within every time interval, in case the minimum is not at one of the interval bounds.
+    if t_horizon > 1:
+        r0 = relative[:, :, :-1, :]
+        d = relative[:, :, 1:, :] - r0
+        d_squared = torch.sum(d * d, dim=-1)
+        s = - torch.sum(r0 * d, dim=-1) / torch.clamp(d_squared, min=1e-12)
+        s = torch.clamp(s, min=0.0, max=1.0).unsqueeze(dim=-1)
+        distances_ct = torch.norm(r0 + s * d, dim=-1)
+        if ado_mask is not None:
+            distances_ct = distances_ct.masked_fill(~ado_mask, float("Inf"))
+        distances_ct = distances_ct.flatten(start_dim=1)
+        distances = torch.cat((distances, distances_ct), dim=1)
+
+    minimal_distance, _ = torch.min(distances, dim=1)
+    return _from_batch(minimal_distance, is_batched=is_batched)
 
 
 def metric_ego_effort(ego_trajectory: torch.Tensor, max_acceleration: float = mantrap.constants.ROBOT_ACC_MAX, **unused
-                      ) -> float:
+                      ) -> typing.Union[float, torch.Tensor]:
     """Determine the ego's control effort (acceleration).
 
     For calculating the control effort of the ego agent approximate the acceleration by assuming the acceleration
@@ -115,26 +324,25 @@ def metric_ego_effort(ego_trajectory: torch.Tensor, max_acceleration: float = ma
 
     .. math:: score = \\frac{\\sum at}{\\sum a_{max}}
 
-    :param ego_trajectory: trajectory of ego (t_horizon, 5).
+    :param ego_trajectory: trajectory of ego (t_horizon, 5) or batch of trajectories (num_tests, t_horizon, 5).
     :param max_acceleration: maximal (possible) acceleration of ego robot.
+    :returns: effort score, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ego_trajectory = ego_trajectory.detach()
-    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory)
+    ego_trajectory, is_batched = _to_batch(ego_trajectory, dim_single=2)
+    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory[0])
+    t_horizon = ego_trajectory.shape[1]
 
     # Determine integral over ego acceleration (= ego speed). Similarly for single integrator ego type.
-    ego_effort = 0.0
-    max_effort = 0.0
-    for t in range(1, ego_trajectory.shape[0]):
-        dt = float(ego_trajectory[t, -1] - ego_trajectory[t - 1, -1])
-        acc = mantrap.utility.maths.derivative_numerical(ego_trajectory[t-1:t+1, 2:4], dt=dt)
-        ego_effort += torch.norm(acc).item()
-        max_effort += max_acceleration
+    dt = ego_trajectory[:, 1:, -1] - ego_trajectory[:, :-1, -1]
+    acc = (ego_trajectory[:, 1:, 2:4] - ego_trajectory[:, :-1, 2:4]) / dt.unsqueeze(dim=-1)
+    ego_effort = torch.sum(torch.norm(acc, dim=-1), dim=1)
+    max_effort = (t_horizon - 1) * max_acceleration
 
-    return float(ego_effort / max_effort)
+    return _from_batch(ego_effort / max_effort, is_batched=is_batched)
 
 
 def metric_ado_effort(env: mantrap.environment.base.GraphBasedEnvironment, ado_trajectories: torch.Tensor, **unused
-                      ) -> float:
+                      ) -> typing.Union[float, torch.Tensor]:
     """Determine the ado's additional control effort introduced by the ego.
 
     For calculating the additional control effort of the ado agents their acceleration is approximately determined
@@ -146,14 +354,19 @@ def metric_ado_effort(env: mantrap.environment.base.GraphBasedEnvironment, ado_t
     to compute. For this reason the changes in the un-conditioned distribution with each environment step are neglected
     and the accelerations (conditioned vs. un-conditioned) are compared on full trajectory level.
 
-    :param ado_trajectories: trajectories of ados (num_ados, num_modes, t_horizon, 5).
+    The ado velocities are derived from the ado paths using `expand_trajectory()`, i.e. by numerical differentiation,
+    starting and ending at rest. As long as no path exceeds the ado's speed limit, this is computed for all tests,
+    ados and modes at once. Otherwise the path has to be stretched, which changes its length, so that the (few)
+    affected trajectories are evaluated one by one.
+
+    :param ado_trajectories: trajectories of ados (num_ados, t_horizon, num_modes, 5) or batch of trajectories
+                             (num_tests, num_ados, t_horizon, num_modes, 5).
     :param env: simulation environment (is copied within function, so not altered).
+    :returns: effort score, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ado_trajectories = ado_trajectories.detach()
-    t_horizon = ado_trajectories.shape[1]
-    num_ados = ado_trajectories.shape[0]
-    num_modes = ado_trajectories.shape[2]
-    assert mantrap.utility.shaping.check_ado_trajectories(ado_trajectories)  # deterministic (!)
+    ado_trajectories, is_batched = _to_batch(ado_trajectories, dim_single=4)
+    num_tests, num_ados, t_horizon, num_modes, _ = ado_trajectories.shape
+    assert mantrap.utility.shaping.check_ado_trajectories(ado_trajectories[0])  # deterministic (!)
 
     # Copy environment to not alter passed env object when resetting its state. Also check whether the initial
     # state in the environment and the ado trajectory tensor are equal.
@@ -161,46 +374,68 @@ def metric_ado_effort(env: mantrap.environment.base.GraphBasedEnvironment, ado_t
     dt = env_metric.dt
     assert env_metric.same_initial_conditions(other=env)
 
-    # Predicting ado trajectories without interaction for current state.
-    ado_trajectories_wo = env_metric.predict_wo_ego(t_horizon=t_horizon - 1).detach()
-
-    # Accumulate L2 norm of difference of accelerations in metric score.
-    effort_score = 0.0
-    for m in range(num_ados):
-        for m_mode in range(num_modes):
-            ado_trajectory_wo = env.ados[m].expand_trajectory(ado_trajectories_wo[m, :, m_mode, :], dt=dt)
-            ado_trajectory = env.ados[m].expand_trajectory(ado_trajectories[m, :, m_mode, :], dt=dt)
-
-            ado_acc = mantrap.utility.maths.derivative_numerical(ado_trajectory[:, 2:4], dt=dt)
-            ado_acc_wo = mantrap.utility.maths.derivative_numerical(ado_trajectory_wo[:, 2:4], dt=dt)
-            effort_score += (torch.norm(ado_acc - ado_acc_wo)).detach()
-
-    # effort_score = 0.0
-    # for m in range(num_ados):
-    #     for m_mode in range(num_modes):
-    #         ado_trajectory_m = env.ados[m].expand_trajectory(ado_trajectories[m, :, m_mode, :], dt=dt)
-    #
-    #         for t in range(1, t_horizon):
-    #             # Reset environment to last ado states.
-    #             env_metric.step_reset(ego_next=None, ado_next=ado_trajectory_m[t - 1, :])
-    #
-    #             # Predicting ado trajectories without interaction for current state.
-    #             ado_trajectory_wo = env_metric.predict_wo_ego(t_horizon=1).detach()  # mean
-    #             assert mantrap.utility.shaping.check_ado_trajectories(ado_trajectory_wo, ados=num_ados, t_horizon=2)
-    #
-    #             # Determine acceleration difference between actual and without scene w.r.t. ados.
-    #             ado_acc = mantrap.utility.maths.derivative_numerical(ado_trajectory_m[t-1:t+1, 2:4], dt=dt)
-    #             ado_acc = torch.norm(ado_acc)
-    #             ado_acc_wo = mantrap.utility.maths.derivative_numerical(ado_trajectory_wo[m, 0:2, m_mode, 2:4], dt=dt)
-    #             ado_acc_wo = torch.norm(ado_acc_wo)
-    #
-    #             # Accumulate L2 norm of difference in metric score.
-    #             effort_score += (torch.norm(ado_acc - ado_acc_wo)).detach()
-
-    return float(effort_score) / num_ados / num_modes
-
-
-def metric_directness(ego_trajectory: torch.Tensor, goal: torch.Tensor, **unused) -> float:
+    # Predicting ado trajectories without interaction for current state, which is the same for every test.
+    ado_trajectories_wo = env_metric.predict_wo_ego(t_horizon=t_horizon - 1).detach().unsqueeze(dim=0)
+
+    v_max = torch.tensor([ado.speed_limits[1] for ado in env.ados]).view(1, -1)
+    effort_score = _ado_effort(ado_trajectories[..., 0:2], ado_paths_wo=ado_trajectories_wo[..., 0:2], v_max=v_max,
+                               dt=dt, ados=[env.ados] * num_tests)
+    return _from_batch(effort_score, is_batched=is_batched)
+
+
+def _ado_effort(ado_paths: torch.Tensor, ado_paths_wo: torch.Tensor, v_max: torch.Tensor, dt: float,
+                ados: typing.List[typing.List[mantrap.agents.base.DTAgent]], ado_mask: torch.Tensor = None
+                ) -> torch.Tensor:
+    """Ado effort score for a batch of tests, see `metric_ado_effort()`.
+
+    :param ado_paths: ado paths (num_tests, num_ados, t_horizon, num_modes, 2).
+    :param ado_paths_wo: ado paths without ego, for every test or shared by all tests (1, ...).
+    :param v_max: maximal ado speeds (num_tests, num_ados) or shared by all tests (1, num_ados).
+    :param dt: simulation time-step [s].
+    :param ados: ado agents of every test, for expanding infeasible paths.
+    :param ado_mask: mask of the ados to take into account (num_tests, num_ados), e.g. to ignore padded ados.
+    :returns: effort score (num_tests).
+    """
+    num_tests, num_ados, _, num_modes, _ = ado_paths.shape
+    if ado_mask is None:
+        ado_mask = torch.ones((num_tests, num_ados), dtype=torch.bool)
+
+    # Accumulate L2 norm of difference of accelerations in metric score. As the initial and final velocity
+    # is zero for both, the conditioned and un-conditioned trajectories, the difference in accelerations
+    # is equal to the numerical derivative of the (zero-padded) difference in velocities.
+    def padded_velocities(paths: torch.Tensor) -> torch.Tensor:
+        velocities = (paths[:, :, 1:, :, :] - paths[:, :, :-1, :, :]) / dt
+        zeros = torch.zeros_like(paths[:, :, :1, :, :])
+        return torch.cat((zeros, velocities, zeros), dim=2)
+
+    velocities = padded_velocities(ado_paths)
+    velocities_wo = padded_velocities(ado_paths_wo)
+    velocity_diff = velocities - velocities_wo
+    acc_diff = (velocity_diff[:, :, 1:, :, :] - velocity_diff[:, :, :-1, :, :]) / dt
+    effort_score = torch.sqrt(torch.sum(acc_diff ** 2, dim=(2, 4)))  # (num_tests, num_ados, num_modes)
+
+    # Trajectories exceeding the ado's speed limit are stretched by `expand_trajectory()`, so re-evaluate them
+    # on the expanded trajectories, as the vectorized computation above assumes them to be feasible.
+    v_max = v_max.view(v_max.shape[0], -1, 1, 1)
+    is_infeasible = torch.logical_or(torch.any(torch.norm(velocities, dim=-1) > v_max, dim=2),
+                                     torch.any(torch.norm(velocities_wo, dim=-1) > v_max, dim=2))
+    is_infeasible = torch.logical_and(is_infeasible, ado_mask.unsqueeze(dim=2))
+    for i, m, m_mode in torch.nonzero(is_infeasible, as_tuple=False).tolist():
+        i_wo = i if ado_paths_wo.shape[0] > 1 else 0
+        ado_trajectory_wo = ados[i][m].expand_trajectory(ado_paths_wo[i_wo, m, :, m_mode, :], dt=dt)
+        ado_trajectory = ados[i][m].expand_trajectory(ado_paths[i, m, :, m_mode, :], dt=dt)
+
+        ado_acc = mantrap.utility.maths.derivative_numerical(ado_trajectory[:, 2:4], dt=dt)
+        ado_acc_wo = mantrap.utility.maths.derivative_numerical(ado_trajectory_wo[:, 2:4], dt=dt)
+        effort_score[i, m, m_mode] = torch.norm(ado_acc - ado_acc_wo)
+
+    # Padded ados have zero weight, the score is the mean over the actual ados and modes.
+    effort_score = effort_score * ado_mask.unsqueeze(dim=2)
+    num_ados_test = torch.clamp(torch.sum(ado_mask, dim=1), min=1)
+    return torch.sum(effort_score, dim=(1, 2)) / num_ados_test / num_modes
+
+
+def metric_directness(ego_trajectory: torch.Tensor, goal: torch.Tensor, **unused) -> typing.Union[float, torch.Tensor]:
     """Determine how direct the robot is going from start to goal state.
 
     Metrics should be fairly independent to be really meaningful, however measuring the efficiency of the ego trajectory
@@ -210,28 +445,30 @@ def metric_directness(ego_trajectory: torch.Tensor, goal: torch.Tensor, **unused
 
     .. math:: score = \\frac{\\sum_t \\overrightarrow{s}_t * \\overrightarrow{v}_t}{T}
 
-    :param ego_trajectory: trajectory of ego (t_horizon, 5).
-    :param goal: optimization goal state (may vary in size, but usually 2D position).
+    :param ego_trajectory: trajectory of ego (t_horizon, 5) or batch of trajectories (num_tests, t_horizon, 5).
+    :param goal: optimization goal state (usually 2D position) or goal state of every test (num_tests, 2).
+    :returns: directness score, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ego_trajectory = ego_trajectory.detach()
-    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory)
+    ego_trajectory, is_batched = _to_batch(ego_trajectory, dim_single=2)
+    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory[0])
     goal = goal.float()
-    t_horizon = ego_trajectory.shape[0]
 
-    score = 0.0
-    t_horizon_until_goal = 0
-    for t in range(t_horizon):
-        vt = ego_trajectory[t, 2:4]
-        st = (goal - ego_trajectory[t, 0:2])
-        if torch.norm(vt) < 1e-6 or torch.norm(st) < 1e-6:
-            continue
-        score += (vt / torch.norm(vt)).matmul((st / torch.norm(st)))
-        t_horizon_until_goal += 1
+    # Time-steps in which the robot is not moving or already is at the goal are ignored.
+    vt = ego_trajectory[:, :, 2:4]
+    st = goal.unsqueeze(dim=-2) - ego_trajectory[:, :, 0:2]
+    vt_norm = torch.norm(vt, dim=-1)
+    st_norm = torch.norm(st, dim=-1)
+    mask = torch.logical_and(vt_norm >= 1e-6, st_norm >= 1e-6)
+    cosines = torch.sum(vt * st, dim=-1) / torch.clamp(vt_norm * st_norm, min=1e-12)
 
-    return float(score) / t_horizon_until_goal if abs(score) > 1e-3 else 0.0
+    score = torch.sum(cosines * mask, dim=1)
+    t_horizon_until_goal = torch.clamp(torch.sum(mask, dim=1), min=1)
+    score = torch.where(torch.abs(score) > 1e-3, score / t_horizon_until_goal, torch.zeros_like(score))
+    return _from_batch(score, is_batched=is_batched)
 
 
-def metric_final_distance(ego_trajectory: torch.Tensor, goal: torch.Tensor, **unused) -> float:
+def metric_final_distance(ego_trajectory: torch.Tensor, goal: torch.Tensor, **unused
+                          ) -> typing.Union[float, torch.Tensor]:
     """Determine the final distance between ego and its goal position.
 
     For normalize divide the final distance by the initial distance. Scores larger than 1 mean, that
@@ -239,20 +476,22 @@ def metric_final_distance(ego_trajectory: torch.Tensor, goal: torch.Tensor, **un
 
     .. math:: score = ||x_T - g||_2 / ||x_0 - g||_2
 
-    :param ego_trajectory: trajectory of ego (t_horizon, 5).
-    :param goal: optimization goal state (may vary in size, but usually 2D position).
+    :param ego_trajectory: trajectory of ego (t_horizon, 5) or batch of trajectories (num_tests, t_horizon, 5).
+    :param goal: optimization goal state (usually 2D position) or goal state of every test (num_tests, 2).
+    :returns: distance score, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ego_trajectory = ego_trajectory.detach()
-    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory)
+    ego_trajectory, is_batched = _to_batch(ego_trajectory, dim_single=2)
+    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory[0])
     goal = goal.float()
-    distance_init = torch.norm(ego_trajectory[0, 0:2] - goal).item()
-    distance_init = max(distance_init, 1e-6)  # avoid 0 division error
-    distance_final = torch.norm(ego_trajectory[-1, 0:2] - goal).item()
-    return distance_final / distance_init
+    distance_init = torch.norm(ego_trajectory[:, 0, 0:2] - goal, dim=-1)
+    distance_init = torch.clamp(distance_init, min=1e-6)  # avoid 0 division error
+    distance_final = torch.norm(ego_trajectory[:, -1, 0:2] - goal, dim=-1)
+    return _from_batch(distance_final / distance_init, is_batched=is_batched)
 
 
-def metric_extra_time(ego_trajectory: torch.Tensor, env: mantrap.environment.base.GraphBasedEnvironment, **unused
-                      ) -> float:
+def metric_extra_time(ego_trajectory: torch.Tensor, env: mantrap.environment.base.GraphBasedEnvironment,
+                      solver_class: mantrap.solver.base.TrajOptSolver.__class__ = mantrap.solver.IPOPTSolver,
+                      **unused) -> typing.Union[float, torch.Tensor]:
     """Determine extra time to reach goal destination compared to direct path.
 
     Compare the derived ego trajectory travel time with the time it would need to get to the goal, which is
@@ -260,17 +499,23 @@ def metric_extra_time(ego_trajectory: torch.Tensor, env: mantrap.environment.bas
     optimization formulation consisting of goal objective and dynamics constraints only. The parameters
     other than the goal position do not matter for solving this simplified formulation.
 
-    :param ego_trajectory: trajectory of ego (t_horizon, 5).
+    As the direct path has to be solved for every test, this metric cannot be vectorized over a batch of tests.
+
+    :param ego_trajectory: trajectory of ego (t_horizon, 5) or batch of trajectories (num_tests, t_horizon, 5).
     :param env: solver environment for re-solving simplified task.
+    :param solver_class: solver for re-solving simplified task, e.g. the evaluated solver's class.
+    :returns: extra time, as float for a single test or tensor (num_tests) for a batch of tests.
     """
-    ego_trajectory = ego_trajectory.detach()
-    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory)
-
-    goal = ego_trajectory[-1, 0:2]
-    max_time_steps = ego_trajectory.shape[0]
+    ego_trajectory, is_batched = _to_batch(ego_trajectory, dim_single=2)
+    assert mantrap.utility.shaping.check_ego_trajectory(ego_trajectory[0])
+    max_time_steps = ego_trajectory.shape[1]
     modules_hard = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
-    solver_hard = mantrap.solver.IPOPTSolver(env=env, goal=goal, modules=modules_hard)
 
-    ego_trajectory_straight, _ = solver_hard.solve(time_steps=max_time_steps)
-    straight_time_steps = ego_trajectory_straight.shape[0]
-    return (max_time_steps - straight_time_steps) * env.dt
+    extra_time = torch.zeros(ego_trajectory.shape[0])
+    for i, ego_trajectory_i in enumerate(ego_trajectory):
+        goal = ego_trajectory_i[-1, 0:2]
+        solver_hard = solver_class(env=env, goal=goal, modules=modules_hard)
+        ego_trajectory_straight, _ = solver_hard.solve(time_steps=max_time_steps)
+        straight_time_steps = ego_trajectory_straight.shape[0]
+        extra_time[i] = (max_time_steps - straight_time_steps) * env.dt
+    return _from_batch(extra_time, is_batched=is_batched)
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import mantrap
+import mantrap.solver.service
+import numpy as np
+import torch
+
+import mantrap_evaluation.scenarios.eth
+
+
+async def eth_replay(service: mantrap.solver.service.PlanningService, t_dataset: float = 0.0,
+                     duration: float = 20.0, speed: float = 1.0) -> torch.Tensor:
+    """Replay the ETH dataset as observation stream for a planning service (local stand-in sensor feed).
+
+    Starting at the dataset time `t_dataset` (in accordance with the scenario `mantrap_evaluation.scenarios.eth`,
+    which therefore should be the service's environment), the states of all pedestrians present in the scene
+    are sent to the service at every dataset time-step, in real-time (scaled by `speed`). As the ego is not
+    part of the dataset, it is simulated by executing the latest published plan, i.e. the control of the
+    plan that corresponds to the current time. The end-to-end latencies between observations and the
+    publication of the plans based on them are measured by the service itself (`service.latencies`).
+
+    :param service: planning service to send observations to (running in the same event loop).
+    :param t_dataset: dataset time to start replaying at [s].
+    :param duration: dataset duration to replay [s].
+    :param speed: replay speed factor (1 = real-time).
+    :returns: ego trajectory (num_steps + 1, 5).
+    """
+    data, eth_dt = mantrap_evaluation.scenarios.eth.eth_data()
+    plans = service.subscribe()
+    plan, plan_time = None, None
+
+    ego = service.solver.env.ego
+    ego = ego.__class__(position=ego.position, velocity=ego.velocity, time=0.0)
+
+    num_steps = int(duration / eth_dt)
+    for k in range(1, num_steps + 1):
+        step_start_time = time.time()
+
+        # Execute the control of the latest plan, which corresponds to the current time-step (if any).
+        while not plans.empty():
+            plan, plan_time = plans.get_nowait()
+        t = (k - 1) * eth_dt
+        control = torch.zeros(2)
+        if plan is not None:
+            index = round((t - plan_time) / eth_dt)
+            if 0 <= index < plan.shape[0]:
+                control = plan[index, :]
+        ego.update(control, dt=eth_dt)
+
+        # Observe all pedestrians present in the scene at the next time-step.
+        t_data = t_dataset + k * eth_dt
+        rows = data[np.isclose(data[:, 0], t_data), :]
+        ado_states = {str(int(row[1])): torch.tensor([row[2], row[4], row[5], row[7]]).float() for row in rows}
+        await service.observe(k * eth_dt, ego_state=ego.state, ado_states=ado_states)
+
+        await asyncio.sleep(max(eth_dt / speed - (time.time() - step_start_time), 0.0))
+
+    service.stop()
+    return ego.history
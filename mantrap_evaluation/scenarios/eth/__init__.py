@@ -20,26 +20,10 @@ def eth(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__, t_da
     :param env_type: type of created environment.
     :param t_dataset: dataset starting time around which pedestrian should be used [s].
     """
-    # Dataset parameters.
-    eth_dt = 0.4  # [s] time-step.
-
     # Adapt dataset time to be sure that it is evenly dividable by the dataset time-step. Since `eth_dt` is
     # small the scene is not fundamentally changed from the scene that the user originally asked for.
+    data, eth_dt = eth_data()
     t_dataset = np.divide(t_dataset, eth_dt) * eth_dt
-
-    # Read trajectories information file from dataset into numpy array using `loadtxt` function.
-    dataset_file = os.path.join("mantrap_evaluation", "datasets", "eth", "ewap_dataset", "seq_eth", "obsmat.txt")
-    dataset_file = mantrap.utility.io.build_os_path(dataset_file)
-    data = np.loadtxt(dataset_file)
-
-    # Normalize file i.e. shift positions to mean over all position and reset time-step by subtracting the first
-    # time-step. Also convert the frame number column to actual time-steps using the time-step given in the
-    # dataset's documentation. For more information on how to read the dataset file read its README file.
-    data[:, 0] = (data[:, 0] - data[0, 0]) * eth_dt / 6  # 6 frames between annotations
-    mean_pos_x = np.mean(data[:, 2])
-    data[:, 2] -= mean_pos_x
-    mean_pos_y = np.mean(data[:, 4])
-    data[:, 4] -= mean_pos_y
     assert 0 <= t_dataset <= data[-1, 0]  # assert that `t_dataset` is in range at all
 
     # Determine environment axes from min and max values.
@@ -96,3 +80,27 @@ def eth(env_type: mantrap.environment.base.GraphBasedEnvironment.__class__, t_da
     )
 
     return env, ego_goal, ado_ground_truths
+
+
+def eth_data() -> typing.Tuple[np.ndarray, float]:
+    """Read and normalize the ETH dataset (sequence "eth").
+
+    Normalize file i.e. shift positions to mean over all position and reset time-step by subtracting the first
+    time-step. Also convert the frame number column to actual time-steps using the time-step given in the
+    dataset's documentation. For more information on how to read the dataset file read its README file.
+
+    :returns: dataset rows (time, id, px, pz, py, vx, vz, vy), dataset time-step [s].
+    """
+    eth_dt = 0.4  # [s] time-step.
+
+    # Read trajectories information file from dataset into numpy array using `loadtxt` function.
+    dataset_file = os.path.join("mantrap_evaluation", "datasets", "eth", "ewap_dataset", "seq_eth", "obsmat.txt")
+    dataset_file = mantrap.utility.io.build_os_path(dataset_file)
+    data = np.loadtxt(dataset_file)
+
+    data[:, 0] = (data[:, 0] - data[0, 0]) * eth_dt / 6  # 6 frames between annotations
+    mean_pos_x = np.mean(data[:, 2])
+    data[:, 2] -= mean_pos_x
+    mean_pos_y = np.mean(data[:, 4])
+    data[:, 4] -= mean_pos_y
+    return data, eth_dt
@@ -1,22 +1,33 @@
+import itertools
+
 import pytest
 import torch
 
 import mantrap.agents
 import mantrap.constants
 import mantrap.environment
+import mantrap.environment.surrogate
 import mantrap.utility.maths
 import mantrap.utility.shaping
 
+import mantrap_evaluation.distillation
+import mantrap_evaluation.scenarios
+
 
 torch.manual_seed(0)
 
+# Untrained surrogate model for the default teacher, as the distilled model is not part of the repository.
+mantrap.environment.SurrogateEnvironment.register_model(mantrap.environment.surrogate.SurrogateModel(),
+                                                        teacher=mantrap.constants.SURROGATE_TEACHER_DEFAULT)
+
 ###########################################################################
 # Tests - All Environment #################################################
 ###########################################################################
 @pytest.mark.parametrize("environment_class", [mantrap.environment.KalmanEnvironment,
                                                mantrap.environment.PotentialFieldEnvironment,
                                                mantrap.environment.SocialForcesEnvironment,
-                                               mantrap.environment.Trajectron])
+                                               mantrap.environment.Trajectron,
+                                               mantrap.environment.SurrogateEnvironment])
 class TestEnvironment:
 
     @staticmethod
@@ -100,6 +111,43 @@ class TestEnvironment:
 
         assert env.check_distribution(dist_dict, t_horizon=prediction_horizon)
 
+    @staticmethod
+    def test_build_distributions_partial(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+        env = environment_class(ego_type=mantrap.agents.IntegratorDTAgent, ego_position=torch.tensor([-5, 0]))
+        env.add_ado(position=torch.tensor([-8, -8]), velocity=torch.tensor([1, 0]))
+        env.add_ado(position=torch.tensor([8, 8]), velocity=torch.tensor([-1, 0]))
+        env.add_ado(position=torch.tensor([8, -8]), velocity=torch.tensor([0, 1]))
+        ego_trajectory = env.ego.unroll_trajectory(controls=torch.ones((3, 2)), dt=env.dt)
+        ado_ids = [env.ado_ids[0], env.ado_ids[2]]
+
+        # All ados are far away from each other, so that predicting a subset of them should be equal to
+        # predicting all of them (given the same random draws).
+        with torch.random.fork_rng():
+            torch.manual_seed(0)
+            dist_dict = env.compute_distributions(ego_trajectory=ego_trajectory)
+            torch.manual_seed(0)
+            dist_dict_partial = env.compute_distributions(ego_trajectory=ego_trajectory, ado_ids=ado_ids)
+
+        assert set(dist_dict_partial.keys()) == set(ado_ids)
+        for ado_id in ado_ids:
+            assert torch.allclose(dist_dict_partial[ado_id].mean, dist_dict[ado_id].mean, atol=1e-5)
+
+    @staticmethod
+    def test_build_distributions_batched(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+        env = environment_class(ego_type=mantrap.agents.IntegratorDTAgent, ego_position=torch.tensor([-5, 0]))
+        env.add_ado(position=torch.tensor([-2, 0]), velocity=torch.tensor([-1, 0]), goal=torch.tensor([-8, 0]))
+        env.add_ado(position=torch.tensor([4, 4]), velocity=torch.tensor([0, -1]), goal=torch.tensor([4, -4]))
+        ego_trajectory = env.ego.unroll_trajectory(controls=torch.ones((4, 2)), dt=env.dt)
+        ego_trajectories = torch.stack([ego_trajectory, ego_trajectory * 0.5, ego_trajectory])
+
+        # All predictions of the batch are based on common random numbers, so that equal ego trajectories
+        # result in equal distributions.
+        dist_dicts = env.compute_distributions_batched(ego_trajectories, ado_ids=[env.ado_ids[1]])
+        assert len(dist_dicts) == 3
+        assert all([dist_dict.ids == [env.ado_ids[1]] for dist_dict in dist_dicts])
+        assert torch.equal(dist_dicts[0].mean, dist_dicts[2].mean)
+        assert torch.equal(dist_dicts[0].stddev, dist_dicts[2].stddev)
+
     @staticmethod
     def test_detaching(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
         ego_position = torch.rand(2)
@@ -156,6 +204,39 @@ class TestEnvironment:
         assert not torch.all(torch.eq(ego_state_original, ego_state_copy))
         assert not torch.all(torch.eq(ado_states_original, ado_states_copy))
 
+    @staticmethod
+    def test_snapshot_restore(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+        env = environment_class(ego_type=mantrap.agents.IntegratorDTAgent, ego_position=torch.tensor([-5, 0]))
+        env.add_ado(position=torch.tensor([3, 0]), velocity=torch.rand(2), goal=torch.rand(2))
+        env.add_ado(position=torch.tensor([-4, 2]), velocity=torch.ones(2), goal=torch.rand(2))
+        ego_state_init, ado_states_init = env.states()
+        ado_histories_init = [ado.history for ado in env.ados]
+        env_init = env.copy()
+        with torch.random.fork_rng():
+            torch.manual_seed(0)
+            ado_trajectories_init = env.predict_w_controls(ego_controls=torch.ones((2, 2))).detach()
+
+        # Forward simulate the environment and rewind it afterwards, which should result in the initial state.
+        snapshot = env.snapshot()
+        for _ in range(3):
+            env.step(ego_action=torch.ones(2))
+        assert env.time > 0.0
+        env.restore(snapshot)
+
+        assert env.time == env_init.time
+        assert env.same_initial_conditions(other=env_init)
+        ego_state, ado_states = env.states()
+        assert torch.all(torch.eq(ego_state, ego_state_init))
+        assert torch.all(torch.eq(ado_states, ado_states_init))
+        for ado, history in zip(env.ados, ado_histories_init):
+            assert torch.all(torch.eq(ado.history, history))
+
+        # The restored environment should predict the same as before forward simulating it.
+        with torch.random.fork_rng():
+            torch.manual_seed(0)
+            ado_trajectories = env.predict_w_controls(ego_controls=torch.ones((2, 2))).detach()
+        assert torch.allclose(ado_trajectories, ado_trajectories_init)
+
     @staticmethod
     def test_states(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
         ego_position = torch.tensor([-5, 0])
@@ -206,6 +287,60 @@ def test_social_forces_static_ado_pair_prediction():
     assert torch.norm(trajectories[0, -1, 0:1] - trajectories[1, -1, 0:1]) > 1e-3
 
 
+def test_social_forces_finite_difference_jacobian():
+    env = mantrap.environment.SocialForcesEnvironment(torch.tensor([-1.0, 0.1]), ego_velocity=torch.tensor([1.0, 0]),
+                                                      ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([1.0, 0.5]), velocity=torch.tensor([-1.0, 0.0]), goal=torch.tensor([-5, 0.5]))
+    env.add_ado(position=torch.tensor([2.0, -1.0]), velocity=torch.tensor([-1.0, 0.5]), goal=torch.tensor([-5, 0.5]))
+    ego_controls = torch.ones((5, 2)) * 0.5
+
+    # Compare the finite-difference jacobian to the one computed by back-propagating through the prediction,
+    # given the same random draws (common random numbers, drawn from the seed of the batched prediction).
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        dist_dict, mean_jacobian, scale_jacobian = env.compute_jacobian_finite_differences(ego_controls)
+        torch.manual_seed(0)
+        seed = int(torch.randint(2 ** 31, size=(1, )).item())
+
+        def parameters(controls: torch.Tensor) -> torch.Tensor:
+            torch.manual_seed(seed)
+            dist_dict_auto_grad = env.compute_distributions(env.ego.unroll_trajectory(controls, dt=env.dt))
+            return torch.stack((dist_dict_auto_grad.mean, dist_dict_auto_grad.stddev))
+
+        jacobian_auto_grad = torch.autograd.functional.jacobian(parameters, ego_controls)
+        jacobian_auto_grad = jacobian_auto_grad.view(*jacobian_auto_grad.shape[:-2], -1)
+        parameters_auto_grad = parameters(ego_controls)
+
+    assert torch.allclose(dist_dict.mean, parameters_auto_grad[0])
+    assert mean_jacobian.shape == (2, 5, 1, 2, 10)
+    assert torch.any(mean_jacobian != 0)  # ados are interacting with the ego
+    assert torch.allclose(mean_jacobian, jacobian_auto_grad[0], atol=1e-4)
+    assert torch.allclose(scale_jacobian, jacobian_auto_grad[1], atol=1e-4)
+
+    # The jacobian cannot be derived analytically, therefore it is only approximated when demanded.
+    assert env.compute_distributions_with_jacobian(ego_controls) is None
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        _, mean_jacobian_opt_in, _ = env.compute_distributions_with_jacobian(ego_controls, finite_differences=True)
+    assert torch.allclose(mean_jacobian_opt_in, mean_jacobian)
+
+
+def test_batched_predictions_error():
+    env = mantrap.environment.SocialForcesEnvironment(torch.tensor([-1.0, 0.1]),
+                                                      ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([1.0, 0.5]), velocity=torch.tensor([-1.0, 0.0]), goal=torch.tensor([-5, 0.5]))
+    ego_trajectories = torch.stack([env.ego.unroll_trajectory(torch.ones((3, 2)), dt=env.dt)] * 2)
+
+    # The arguments of the batched prediction must not outlive it, even if the prediction fails.
+    def failing_prediction(*args, **kwargs):
+        raise RuntimeError
+
+    env._compute_distributions = failing_prediction
+    with pytest.raises(RuntimeError):
+        env.compute_distributions_batched(ego_trajectories)
+    assert "args" not in mantrap.environment.base.graph_based._BATCH_PREDICTIONS
+
+
 ###########################################################################
 # Test - Potential Field Environment ######################################
 ###########################################################################
@@ -248,6 +383,43 @@ def test_potential_field_forces(pos_1: torch.Tensor, pos_2: torch.Tensor):
                 assert torch.allclose(grads[i, :, k], torch.zeros(t_horizon))
 
 
+@pytest.mark.parametrize("vel_dist", [True, False])
+def test_potential_field_jacobian(vel_dist: bool):
+    env = mantrap.environment.PotentialFieldEnvironment(torch.tensor([1.0, 0.0]), ego_velocity=torch.tensor([-0.5, 0]),
+                                                        ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([-2.0, 0.0]), velocity=torch.tensor([1.0, 0.0]))
+    env.add_ado(position=torch.tensor([-2.5, 0.1]), velocity=torch.tensor([1.0, 0.0]))
+    env.add_ado(position=torch.tensor([5.0, 5.0]), velocity=torch.tensor([0.0, 1.0]))
+    ado_ids = [env.ado_ids[1], env.ado_ids[0]]
+    ego_controls = torch.tensor([[0.1, 0.2], [-0.2, 0.1], [0.0, -0.1], [0.2, 0.0], [0.1, 0.1], [-0.1, 0.0]])
+
+    # Compare the analytic jacobian to the one computed by back-propagating through the prediction, given the
+    # same random draws. Then both the distributions and their jacobian should be (numerically) equal.
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        dist_dict, mean_jacobian, scale_jacobian = env.compute_distributions_with_jacobian(
+            ego_controls, vel_dist=vel_dist, ado_ids=ado_ids)
+        ego_controls.requires_grad = True
+        ego_trajectory = env.ego.unroll_trajectory(ego_controls, dt=env.dt)
+        torch.manual_seed(0)
+        dist_dict_auto_grad = env.compute_distributions(ego_trajectory, vel_dist=vel_dist, ado_ids=ado_ids)
+
+    assert dist_dict.ids == ado_ids
+    assert not dist_dict.mean.requires_grad
+    assert torch.allclose(dist_dict.mean, dist_dict_auto_grad.mean)
+    assert torch.allclose(dist_dict.stddev, dist_dict_auto_grad.stddev)
+    assert mean_jacobian.shape == (2, 6, 1, 2, 12)
+    assert torch.any(mean_jacobian != 0)  # ados are interacting with the ego
+
+    for jacobian, x in [(mean_jacobian, dist_dict_auto_grad.mean), (scale_jacobian, dist_dict_auto_grad.stddev)]:
+        jacobian_auto_grad = torch.zeros(jacobian.shape)
+        for index in itertools.product(*[range(n) for n in x.shape]):
+            if x[index].requires_grad:
+                gradient = torch.autograd.grad(x[index], ego_controls, retain_graph=True)[0]
+                jacobian_auto_grad[index] = gradient.flatten()
+        assert torch.allclose(jacobian, jacobian_auto_grad, atol=1e-5)
+
+
 ###########################################################################
 # Test - Kalman Environment ###############################################
 ###########################################################################
@@ -269,6 +441,40 @@ def test_kalman_distributions():
     assert torch.all(variance_diff >= 0)  # variance is strictly increasing over time
 
 
+def test_kalman_closed_form():
+    env = mantrap.environment.KalmanEnvironment()
+    env.add_ado(position=torch.tensor([3.7, -5.1]), velocity=torch.tensor([-1.0, 0.9]))
+    env.add_ado(position=torch.tensor([-2.0, 1.0]), velocity=torch.tensor([0.5, 0.2]))
+    t_horizon = 6
+    dist_dict = env.compute_distributions_wo_ego(t_horizon=t_horizon, vel_dist=False)
+
+    # Compare to iteratively propagating the Kalman equations for every ado.
+    noise = mantrap.constants.KALMAN_ADDITIVE_NOISE
+    for m_ado, ado in enumerate(env.ados):
+        F, B, _ = ado.dynamics_matrices(dt=env.dt)
+        F, B = F[0:4, 0:4], B[0:4, :]
+        x_k, p_k = ado.state, torch.eye(4) * mantrap.constants.ENV_VAR_INITIAL
+        for t in range(t_horizon):
+            assert torch.allclose(dist_dict.mean[m_ado, t, 0, :], x_k[0:2], atol=1e-5)
+            assert torch.allclose(dist_dict.stddev[m_ado, t, 0, :], p_k.diagonal()[0:2], atol=1e-5)
+            x_k = torch.matmul(F, x_k) + torch.matmul(B, ado.velocity)
+            p_k = torch.matmul(torch.matmul(F, p_k), F.t()) + torch.eye(4) * noise
+
+
+def test_kalman_jacobian():
+    env = mantrap.environment.KalmanEnvironment(torch.zeros(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3.7, -5.1]), velocity=torch.tensor([-1.0, 0.9]))
+    env.add_ado(position=torch.tensor([-2.0, 1.0]), velocity=torch.tensor([0.5, 0.2]))
+    ego_controls = torch.rand((4, 2))
+
+    # The ados are not affected by the ego, so the (not differentiable) prediction's jacobian is zero.
+    dist_dict, mean_jacobian, scale_jacobian = env.compute_distributions_with_jacobian(ego_controls)
+    _, mean_jacobian_fd, scale_jacobian_fd = env.compute_jacobian_finite_differences(ego_controls)
+    assert torch.allclose(dist_dict.mean, env.compute_distributions_wo_ego(t_horizon=4).mean)
+    assert torch.all(mean_jacobian == 0) and torch.all(scale_jacobian == 0)
+    assert torch.allclose(mean_jacobian_fd, mean_jacobian) and torch.allclose(scale_jacobian_fd, scale_jacobian)
+
+
 ###########################################################################
 # Test - Trajectron Environment ###########################################
 ###########################################################################
@@ -285,6 +491,40 @@ def test_trajectron_wo_prediction():
     assert mantrap.utility.shaping.check_ado_samples(samples_with, ados=env.num_ados, num_samples=5)
 
 
+def test_trajectron_shared_model():
+    env = mantrap.environment.Trajectron(ego_type=mantrap.agents.DoubleIntegratorDTAgent,
+                                         ego_position=torch.zeros(2))
+    env.add_ado(position=torch.tensor([4, 4]), velocity=torch.tensor([0, -1]))
+    env_copy = env.copy()
+
+    # The model weights are shared by both environments, while the scene state is not.
+    assert env_copy.trajectron.model_registrar is env.trajectron.model_registrar
+    assert env_copy._gt_scene is not env._gt_scene
+    samples = env_copy.sample_wo_ego(t_horizon=5, num_samples=2)
+    assert mantrap.utility.shaping.check_ado_samples(samples, ados=env.num_ados, num_samples=2)
+
+
+def test_trajectron_scene_cache():
+    env = mantrap.environment.Trajectron(ego_type=mantrap.agents.DoubleIntegratorDTAgent,
+                                         ego_position=torch.zeros(2))
+    env.add_ado(position=torch.tensor([4, 4]), velocity=torch.tensor([0, -1]))
+
+    # The un-conditioned distributions only depend on the scene state, so they are computed once per state.
+    dist_dict = env.compute_distributions_wo_ego(t_horizon=5)
+    assert env.compute_distributions_wo_ego(t_horizon=5) is dist_dict
+    assert env.compute_distributions_wo_ego(t_horizon=4) is not dist_dict
+
+    # Conditioned distributions are based on the cached histories, but are still differentiable w.r.t. the ego.
+    ego_trajectory = env.ego.unroll_trajectory(torch.ones((5, 2)).requires_grad_(), dt=env.dt)
+    for _ in range(2):
+        dist_dict_w = env.compute_distributions(ego_trajectory=ego_trajectory)
+        assert dist_dict_w[env.ado_ids[0]].mean.requires_grad
+
+    # When the scene changes, the cache is reset.
+    env.step(ego_action=torch.ones(2))
+    assert env.compute_distributions_wo_ego(t_horizon=5) is not dist_dict
+
+
 ##########################################################################
 # Test - SGAN Environment #################################################
 ##########################################################################
@@ -294,3 +534,159 @@ def test_sgan_sampling():
 
     samples = sgan.sample_wo_ego(t_horizon=5, num_samples=3)
     assert mantrap.utility.shaping.check_ado_samples(samples,  num_samples=3, t_horizon=6)
+
+
+def test_sgan_sampling_w_ego():
+    sgan = mantrap.environment.SGAN(ego_position=torch.zeros(2), ego_velocity=torch.rand(2))
+    sgan.add_ado(position=torch.tensor([4, 2]), velocity=torch.tensor([-1, -1]))
+    sgan.add_ado(position=torch.tensor([-3, 1]), velocity=torch.tensor([1, 0]))
+    ado_ids = list(sgan.ado_ids)
+
+    # The ego is included as pedestrian for sampling, while the environment's ados remain unchanged.
+    ego_trajectory = sgan.ego.unroll_trajectory(torch.ones((5, 2)), dt=sgan.dt)
+    samples = sgan.sample_w_trajectory(ego_trajectory, num_samples=4)
+    assert mantrap.utility.shaping.check_ado_samples(samples, t_horizon=6, ados=2, num_samples=4)
+    assert sgan.ado_ids == ado_ids
+    assert sgan.num_ados == 2
+
+
+###########################################################################
+# Test - Surrogate Environment ############################################
+###########################################################################
+def test_surrogate_distributions():
+    env = mantrap.environment.SurrogateEnvironment(ego_position=torch.zeros(2), ego_velocity=torch.ones(2))
+    env.add_ado(position=torch.tensor([4, 2]), velocity=torch.tensor([-1, -1]))
+    env.add_ado(position=torch.tensor([-3, 1]), velocity=torch.tensor([1, 0]))
+
+    # The positional distribution is the integrated velocity distribution, starting at the current position.
+    ego_trajectory = env.ego.unroll_trajectory(torch.ones((5, 2)).requires_grad_(), dt=env.dt)
+    dist_vel = env.compute_distributions(ego_trajectory, vel_dist=True)
+    dist_pos = env.compute_distributions(ego_trajectory, vel_dist=False)
+    for m_ado, ado in enumerate(env.ados):
+        positions = ado.position + torch.cumsum(dist_vel.mean[m_ado, :-1, 0, :] * env.dt, dim=0)
+        assert torch.allclose(dist_pos.mean[m_ado, 0, 0, :], ado.position)
+        assert torch.allclose(dist_pos.mean[m_ado, 1:, 0, :], positions, atol=1e-5)
+        assert torch.allclose(dist_pos.stddev[m_ado, 0, 0, :], torch.ones(2) * mantrap.constants.ENV_VAR_INITIAL)
+
+    # Same time indexing as the other environments, e.g. for a model predicting constant velocities.
+    model = mantrap.environment.surrogate.SurrogateModel()
+    torch.nn.init.zeros_(model.layers[-1].weight)
+    torch.nn.init.zeros_(model.layers[-1].bias)
+    env_constant = env.copy(env_type=mantrap.environment.SurrogateEnvironment, model=model)
+    env_kalman = env.copy(env_type=mantrap.environment.KalmanEnvironment)
+    dist_constant = env_constant.compute_distributions(ego_trajectory.detach(), vel_dist=False)
+    dist_kalman = env_kalman.compute_distributions(ego_trajectory.detach(), vel_dist=False)
+    assert torch.allclose(dist_constant.mean, dist_kalman.mean, atol=1e-5)
+
+    # The prediction is differentiable w.r.t. the ego trajectory, but independent for every ado.
+    assert dist_vel.mean.requires_grad
+    dist_partial = env.compute_distributions(ego_trajectory, ado_ids=[env.ado_ids[1]])
+    assert torch.allclose(dist_partial.mean[0], dist_vel.mean[1])
+    assert env.interacting_ado_ids(ado_ids=[env.ado_ids[1]]) == [env.ado_ids[1]]
+
+    # Without any ado to predict the distribution is empty, as for the other environments.
+    for vel_dist in [True, False]:
+        dist_empty = env.compute_distributions(ego_trajectory, vel_dist=vel_dist, ado_ids=[])
+        dist_empty_kalman = env_kalman.compute_distributions(ego_trajectory.detach(), vel_dist=vel_dist, ado_ids=[])
+        assert dist_empty.mean.shape == dist_empty_kalman.mean.shape == (0, 5, 1, 2)
+
+    # Environment copies share the surrogate model.
+    assert env.copy().model is env.model
+
+
+def test_surrogate_distillation():
+    env_type = mantrap.environment.KalmanEnvironment
+    features, means, log_stds = mantrap_evaluation.distillation.generate_dataset(env_type, num_samples=2)
+    assert features.shape[0] == means.shape[0] == log_stds.shape[0]
+    assert means.shape[1:] == (mantrap.constants.SURROGATE_HORIZON, 2)
+
+    model, losses = mantrap_evaluation.distillation.train_surrogate(features, means, log_stds, epochs=20)
+    assert losses[-1] < losses[0]
+
+    # The distilled model is used by surrogate environments with the teacher's name.
+    mantrap.environment.SurrogateEnvironment.register_model(model, teacher="kalman")
+    env = mantrap_evaluation.scenarios.custom_avoid(env_type=env_type)[0]
+    env_surrogate = env.copy(env_type=mantrap.environment.SurrogateEnvironment, teacher=env.name)
+    assert env_surrogate.model is model
+
+    results = mantrap_evaluation.distillation.evaluate_surrogate(env_type, model, num_samples=2, t_horizon=5)
+    assert results["mean_error"] < 0.5
+
+
+###########################################################################
+# Test - Batched Environment ##############################################
+###########################################################################
+@pytest.mark.parametrize("environment_class", [mantrap.environment.KalmanEnvironment,
+                                               mantrap.environment.PotentialFieldEnvironment,
+                                               mantrap.environment.SocialForcesEnvironment])
+@pytest.mark.parametrize("vel_dist", [True, False])
+def test_batched_distributions(environment_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                               vel_dist: bool):
+    # Scenes with a single ado close to the ego, padded to the number of ados of the last scene. As the particles
+    # of a single ado are weighted equally, with (almost) deterministic particle parameters the batched
+    # predictions are equal to the predictions of every scene on its own.
+    envs = []
+    for k in range(3):
+        env = environment_class(ego_position=torch.tensor([-1.0, 0.2 * k]), ego_velocity=torch.tensor([1.0, 0.0]))
+        env.add_ado(position=torch.tensor([1.0, 0.0]), velocity=torch.tensor([-1.0, 0.1]), goal=torch.tensor([-5, 0]))
+        envs.append(env)
+    envs.append(mantrap_evaluation.scenarios.random(env_type=environment_class, num_ados=3)[0])
+    env_batched = mantrap.environment.BatchedEnvironment(envs)
+    assert env_batched.num_scenes == 4 and env_batched.num_ados_max == 3
+    assert torch.all(env_batched.ado_mask.sum(dim=1) == torch.tensor([1, 1, 1, 3]))
+
+    params = {mantrap.environment.KalmanEnvironment: {},
+              mantrap.environment.PotentialFieldEnvironment: {"v0": (2.0, 1e-6)},
+              mantrap.environment.SocialForcesEnvironment: {"v0": (4.0, 1e-6), "sigma": (0.9, 1e-6)}
+              }[environment_class]
+    ego_controls = torch.ones((4, 6, 2)) * 0.3
+    ego_trajectories = env_batched.unroll_trajectories(ego_controls)
+    dist_batched = env_batched.compute_distributions(ego_trajectories, vel_dist=vel_dist, **params)
+    dist_batched_wo = env_batched.compute_distributions_wo_ego(t_horizon=6, vel_dist=vel_dist, **params)
+    assert dist_batched.mean.shape == (4, 3, 6, 1, 2)
+    assert torch.all(dist_batched.mean[0:3, 1:] == 0)  # padded ados
+
+    for s, env in enumerate(envs[:3]):
+        assert torch.allclose(ego_trajectories[s], env.ego.unroll_trajectory(ego_controls[s], dt=env.dt), atol=1e-5)
+        kwargs = {f"{key}_dict": {env.ado_ids[0]: value} for key, value in params.items()}
+        dist = env.compute_distributions(ego_trajectories[s], vel_dist=vel_dist, **kwargs)
+        dist_wo = env.compute_distributions_wo_ego(t_horizon=6, vel_dist=vel_dist, **kwargs)
+        assert torch.allclose(dist_batched.mean[s, 0:1], dist.mean, atol=1e-4)
+        assert torch.allclose(dist_batched.stddev[s, 0:1], dist.stddev, atol=1e-4)
+        assert torch.allclose(dist_batched_wo.mean[s, 0:1], dist_wo.mean, atol=1e-4)
+
+    # The Kalman prediction is deterministic, so that also scenes with multiple ados are equal.
+    if environment_class == mantrap.environment.KalmanEnvironment:
+        dist = envs[3].compute_distributions(ego_trajectories[3], vel_dist=vel_dist)
+        assert torch.allclose(dist_batched.mean[3], dist.mean)
+        assert torch.allclose(dist_batched.stddev[3], dist.stddev)
+
+
+def test_batched_step():
+    env_type = mantrap.environment.KalmanEnvironment
+    envs = [mantrap_evaluation.scenarios.random(env_type=env_type, num_ados=num_ados)[0] for num_ados in [1, 3, 0]]
+    env_batched = mantrap.environment.BatchedEnvironment(envs)
+    ego_states, ado_states = env_batched.states()
+
+    ego_actions = torch.rand((3, 4, 2)) * 2 - 1
+    for t in range(4):
+        ado_states_next, ego_states_next = env_batched.step(ego_actions[:, t, :])
+        assert torch.all(ado_states_next[~env_batched.ado_mask] == 0)  # padded ados
+
+        # The ego moves deterministically, the Kalman ados with (almost) constant velocity.
+        for s, env in enumerate(envs):
+            _, ego_state = env.ego.update(ego_actions[s, t, :], dt=env.dt)
+            assert torch.allclose(ego_states_next[s], ego_state, atol=1e-5)
+        positions = ado_states[:, :, 0:2] + ado_states[:, :, 2:4] * env_batched.dt
+        assert torch.allclose(ado_states_next[:, :, 0:2], positions * env_batched.ado_mask.unsqueeze(dim=2), atol=1e-2)
+        ego_states, ado_states = ego_states_next, ado_states_next
+
+    # The scenes can be converted back to environments, with the executed trajectories as history.
+    ego_trajectories, ado_trajectories = env_batched.trajectories()
+    assert ego_trajectories.shape == (3, 5, 5) and ado_trajectories.shape == (3, 3, 5, 1, 5)
+    for s, env in enumerate(env_batched.environments()):
+        ego_state, ado_states_s = env.states()
+        assert env.num_ados == envs[s].num_ados
+        assert torch.allclose(ego_state, ego_states[s])
+        assert torch.allclose(ado_states_s, ado_states[s, :env.num_ados])
+        assert torch.allclose(env.ego.history, ego_trajectories[s])
@@ -5,6 +5,8 @@ import mantrap.agents
 import mantrap.environment
 import mantrap.utility.maths
 
+import mantrap_evaluation.metrics
+import mantrap_evaluation.scenarios
 from mantrap_evaluation.metrics import *
 
 torch.manual_seed(0)
@@ -123,6 +125,33 @@ def test_ado_effort(env_class: mantrap.environment.base.GraphBasedEnvironment.__
     assert metric_score >= metric_score_wo * 0.5
 
 
+@pytest.mark.parametrize("ado_speed", [1.0, 3.0])
+def test_ado_effort_expanded(ado_speed: float):
+    torch.manual_seed(0)
+    env = mantrap.environment.KalmanEnvironment(ego_type=mantrap.agents.DoubleIntegratorDTAgent,
+                                                ego_position=torch.tensor([5, 0]))
+    env.add_ado(position=torch.zeros(2), velocity=torch.tensor([ado_speed, 0]))
+    env.add_ado(position=torch.tensor([2.0, 2.0]), velocity=torch.tensor([0, -ado_speed]))
+
+    # Perturb the un-conditioned trajectories slightly, so that the infeasible (stretched) trajectories
+    # still are stretched by the same amount, and compare to the per-ado evaluation of the expanded trajectories.
+    ado_trajectories = env.predict_wo_ego(t_horizon=8).detach()
+    ado_trajectories_wo = ado_trajectories.clone()
+    ado_trajectories[:, 1:, :, 0:2] += (torch.rand_like(ado_trajectories[:, 1:, :, 0:2]) - 0.5) * 0.1
+
+    effort_score = 0.0
+    for m in range(env.num_ados):
+        ado_trajectory = env.ados[m].expand_trajectory(ado_trajectories[m, :, 0, 0:2], dt=env.dt)
+        ado_trajectory_wo = env.ados[m].expand_trajectory(ado_trajectories_wo[m, :, 0, 0:2], dt=env.dt)
+        ado_acc = mantrap.utility.maths.derivative_numerical(ado_trajectory[:, 2:4], dt=env.dt)
+        ado_acc_wo = mantrap.utility.maths.derivative_numerical(ado_trajectory_wo[:, 2:4], dt=env.dt)
+        effort_score += float(torch.norm(ado_acc - ado_acc_wo))
+    effort_score = effort_score / env.num_ados
+
+    metric_score = metric_ado_effort(ado_trajectories=ado_trajectories, env=env)
+    assert np.isclose(metric_score, effort_score, rtol=1e-4)
+
+
 def test_final_distance():
     ego_trajectory = torch.rand((10, 5))
     ego_trajectory[0, 0:2] = torch.tensor([0, 0])
@@ -143,3 +172,107 @@ def test_extra_time():
     ego_trajectory_1, _ = solver.solve(time_steps=5)
     score = metric_extra_time(ego_trajectory=ego_trajectory_1, env=env)
     assert np.isclose(score, 0.0)
+
+
+def test_minimal_distance_analytic():
+    # Robot and ado moving in parallel in opposite directions, passing each other in between two time-steps.
+    ego_traj = mantrap.utility.maths.straight_line(torch.tensor([-4.5, 0.0]), torch.tensor([4.5, 0.0]), steps=10)
+    ado_traj = mantrap.utility.maths.straight_line(torch.tensor([4.5, 0.3]), torch.tensor([-4.5, 0.3]), steps=10)
+    ado_traj = ado_traj.view(1, -1, 1, 2)
+    min_distance = metric_minimal_distance(ego_trajectory=ego_traj, ado_trajectories=ado_traj)
+    assert np.isclose(min_distance, 0.3, atol=1e-6)
+
+
+def test_metrics_batch():
+    env = mantrap.environment.PotentialFieldEnvironment(ego_type=mantrap.agents.DoubleIntegratorDTAgent,
+                                                        ego_position=torch.tensor([-5.0, 0.0]))
+    env.add_ado(position=torch.zeros(2), velocity=torch.tensor([1.0, 0.0]))
+    env.add_ado(position=torch.tensor([3.0, 2.0]), velocity=torch.tensor([0.0, -1.0]))
+    goal = torch.tensor([5.0, 0.0])
+
+    ego_trajectories, ado_trajectories = [], []
+    for _ in range(4):
+        ego_controls = torch.rand((5, 2)) * 2 - 1
+        ego_trajectories.append(env.ego.unroll_trajectory(ego_controls, dt=env.dt))
+        ado_trajectories.append(env.predict_w_controls(ego_controls=ego_controls))
+    ego_trajectories = torch.stack(ego_trajectories)
+    ado_trajectories = torch.stack(ado_trajectories)
+
+    # Evaluating a batch of tests at once should be equal to evaluating every test on its own.
+    metrics = [metric_minimal_distance, metric_ego_effort, metric_ado_effort, metric_directness, metric_final_distance]
+    # The environment's predictions might be stochastic, therefore re-seed before every evaluation.
+    for metric_function in metrics:
+        torch.manual_seed(0)
+        scores = metric_function(ego_trajectory=ego_trajectories, ado_trajectories=ado_trajectories, env=env, goal=goal)
+        assert scores.shape == (4, )
+        for i in range(4):
+            torch.manual_seed(0)
+            score = metric_function(ego_trajectory=ego_trajectories[i], ado_trajectories=ado_trajectories[i],
+                                    env=env, goal=goal)
+            assert np.isclose(float(scores[i]), score, atol=1e-5)
+
+
+def test_evaluate_parallel_resume(tmp_path):
+    env = mantrap.environment.PotentialFieldEnvironment(torch.tensor([-5.0, 0.0]),
+                                                        ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([0.0, 1.0]), velocity=torch.tensor([0.0, -1.0]))
+    solver = mantrap.solver.AugmentedLagrangianSolver(env=env, goal=torch.tensor([5.0, 0.0]), t_planning=3,
+                                                      modules=[mantrap.modules.GoalNormModule,
+                                                               mantrap.modules.SpeedLimitModule])
+
+    # Evaluate in parallel, storing the result of every single test.
+    eval_df, ego_trajectories, _ = evaluate(solver, time_steps=3, num_tests=4, mean_df=False, num_workers=2,
+                                            results_directory=str(tmp_path))
+    assert eval_df.shape[0] == 4
+    assert not eval_df.isnull().values.any()
+    assert ego_trajectories.shape[0] == 4
+    assert len(list(tmp_path.iterdir())) == 4
+
+    # When evaluating again, all results should be loaded from the results directory.
+    eval_df_resumed, ego_trajectories_resumed, _ = evaluate(solver, time_steps=3, num_tests=4, mean_df=False,
+                                                            results_directory=str(tmp_path))
+    assert np.allclose(eval_df.values, eval_df_resumed.values)
+    assert torch.allclose(ego_trajectories, ego_trajectories_resumed)
+
+    # Results of another configuration must not be re-used, but evaluated and stored separately.
+    _, ego_trajectories_other, _ = evaluate(solver, time_steps=2, num_tests=4, mean_df=False,
+                                            results_directory=str(tmp_path))
+    assert ego_trajectories_other.shape[1] == 3
+    assert len(list(tmp_path.iterdir())) == 8
+
+
+def test_evaluate_batched():
+    envs, goals = [], []
+    for num_ados in [2, 1, 3]:
+        env, goal, _ = mantrap_evaluation.scenarios.random(env_type=mantrap.environment.SocialForcesEnvironment,
+                                                           num_ados=num_ados)
+        envs.append(env)
+        goals.append(goal)
+    env_batched = mantrap.environment.BatchedEnvironment(envs)
+    goals = torch.stack(goals)
+
+    # Simple controller driving every ego towards its goal.
+    def ego_policy(env_b: mantrap.environment.BatchedEnvironment) -> torch.Tensor:
+        ego_states, _ = env_b.states()
+        return (goals - ego_states[:, 0:2]) - 2 * ego_states[:, 2:4]
+
+    eval_df, ego_trajectories, ado_trajectories = evaluate_batched(env_batched, ego_policy, goals=goals, time_steps=5)
+    assert eval_df.shape[0] == 3
+    assert not eval_df.isnull().values.any()
+    assert np.all(eval_df["directness"].values > 0)
+    assert ego_trajectories.shape == (3, 6, 5)
+    assert ado_trajectories.shape == (3, 3, 6, 1, 5)
+
+    # The metrics are evaluated on the actual (not padded) ados of every scene.
+    torch.manual_seed(0)
+    ado_paths_wo = mantrap.environment.BatchedEnvironment(envs).predict_wo_ego(t_horizon=5)
+    for s, env in enumerate(envs):
+        min_distance = metric_minimal_distance(ego_trajectory=ego_trajectories[s],
+                                               ado_trajectories=ado_trajectories[s, :env.num_ados])
+        assert np.isclose(eval_df.loc[s, "minimal_distance"], min_distance)
+
+        v_max = torch.tensor([[ado.speed_limits[1] for ado in env.ados]])
+        ado_effort = mantrap_evaluation.metrics._ado_effort(ado_trajectories[s:s+1, :env.num_ados, ..., 0:2],
+                                                            ado_paths_wo=ado_paths_wo[s:s+1, :env.num_ados],
+                                                            v_max=v_max, dt=env.dt, ados=[env.ados])
+        assert np.isclose(eval_df.loc[s, "ado_effort"], ado_effort[0].item())
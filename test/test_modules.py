@@ -203,6 +203,69 @@ def test_objective_goal_distribution():
     assert math.isclose(objective, distance, abs_tol=0.1)
 
 
+def test_objective_goal_stage_hessian():
+    env = mantrap.environment.KalmanEnvironment(torch.zeros(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    module = mantrap.modules.GoalNormModule(goal=torch.tensor([4.1, 8.9]), env=env, t_horizon=5)
+    ego_trajectory = env.ego.unroll_trajectory(torch.rand((5, 2)), dt=env.dt)
+    hessian = module.compute_stage_hessian_analytically(ego_trajectory, ado_ids=[], tag="test")
+
+    # Compare to the (block-diagonal) hessian computed using auto-grad.
+    def objective(x: torch.Tensor) -> torch.Tensor:
+        return module.compute_objective(x, ado_ids=[], tag="test")
+    hessian_auto_grad = torch.autograd.functional.hessian(objective, ego_trajectory.detach())
+    hessian_auto_grad = torch.stack([hessian_auto_grad[t, :, t, :] for t in range(ego_trajectory.shape[0])])
+    assert np.allclose(hessian, hessian_auto_grad.numpy(), atol=1e-6)
+
+
+def test_objective_goal_hessian():
+    env = mantrap.environment.KalmanEnvironment(torch.zeros(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    module = mantrap.modules.GoalNormModule(goal=torch.tensor([4.1, 8.9]), env=env, t_horizon=5)
+    ego_controls = torch.rand((5, 2))
+    ego_trajectory = env.ego.unroll_trajectory(ego_controls, dt=env.dt)
+    hessian = module.compute_hessian_analytically(ego_trajectory, grad_wrt=ego_controls, ado_ids=[], tag="test")
+
+    # Compare to the hessian w.r.t. the controls computed using auto-grad.
+    def objective(u: torch.Tensor) -> torch.Tensor:
+        return module.compute_objective(env.ego.unroll_trajectory(u.view(-1, 2), dt=env.dt), ado_ids=[], tag="test")
+    hessian_auto_grad = torch.autograd.functional.hessian(objective, ego_controls.flatten())
+    assert np.allclose(hessian, hessian_auto_grad.numpy(), atol=1e-6)
+
+
+@pytest.mark.parametrize("env_class", [mantrap.environment.KalmanEnvironment,
+                                       mantrap.environment.PotentialFieldEnvironment])
+def test_objective_prob_hessian(env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+    env = env_class(ego_type=mantrap.agents.DoubleIntegratorDTAgent, ego_position=torch.tensor([-5, 0.1]))
+    env.add_ado(position=torch.zeros(2), velocity=torch.tensor([-1.0, 0.0]))
+    module = mantrap.modules.InteractionProbabilityModule(env=env, t_horizon=5)
+    ego_controls = torch.rand((5, 2))
+    ego_trajectory = env.ego.unroll_trajectory(ego_controls, dt=env.dt)
+
+    # The Fisher approximation of the hessian has to be symmetric and positive semi-definite.
+    hessian = module.hessian(ego_trajectory, grad_wrt=ego_controls, ado_ids=env.ado_ids, tag="test")
+    assert hessian.shape == (10, 10)
+    assert np.allclose(hessian, hessian.T)
+    assert np.all(np.linalg.eigvalsh(hessian) >= -1e-8)
+
+
+@pytest.mark.parametrize("env_class", environments)
+def test_objective_prob_mode_pruning(env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+    env = env_class(ego_type=mantrap.agents.IntegratorDTAgent, ego_position=torch.tensor([-5, 0.1]))
+    env.add_ado(position=torch.zeros(2), velocity=torch.tensor([1.0, 0.0]))
+    ego_trajectory = env.ego.unroll_trajectory(torch.ones((5, 2)), dt=env.dt)
+
+    # Pruning without removing any modes should not change the objective, pruning in general should
+    # result in valid objective values.
+    objectives = []
+    for module_kwargs in [{}, {"mode_mass": 1.0}, {"num_modes": env.num_modes}, {"num_modes": 1}]:
+        with torch.random.fork_rng():
+            torch.manual_seed(0)
+            module = mantrap.modules.InteractionProbabilityModule(env=env, t_horizon=5, **module_kwargs)
+            objectives.append(module.objective(ego_trajectory, ado_ids=env.ado_ids, tag="test"))
+    assert np.isclose(objectives[0], objectives[1], atol=1e-5)
+    assert np.isclose(objectives[0], objectives[2], atol=1e-5)
+    assert not np.isnan(objectives[3])
+
+
 ###########################################################################
 # Constraints #############################################################
 ###########################################################################
@@ -258,6 +321,19 @@ class TestConstraints:
         violation = module.compute_violation(ego_trajectory=ego_trajectory, ado_ids=env.ado_ids, tag="test")
         assert violation == 0
 
+    @staticmethod
+    def test_shift_multipliers(module_class: mantrap.modules.base.OptimizationModule.__class__,
+                               env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+        env = env_class(ego_type=mantrap.agents.DoubleIntegratorDTAgent, ego_position=torch.tensor([-5, 0.1]))
+        env.add_ado(position=torch.zeros(2), goal=torch.rand(2) * 10)
+        module = module_class(env=env, t_horizon=5)
+
+        num_constraints = module.num_constraints(ado_ids=env.ado_ids)
+        multipliers = np.random.uniform(0, 1, size=num_constraints)
+        multipliers_shifted = module.shift_multipliers(multipliers, ado_ids=env.ado_ids)
+        assert multipliers_shifted.shape == multipliers.shape
+        assert np.all(multipliers_shifted >= 0)
+
     @staticmethod
     def test_jacobian_analytical(module_class: mantrap.modules.base.OptimizationModule.__class__,
                                  env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
@@ -356,6 +432,26 @@ def test_speed_limit_violation(env_class: mantrap.environment.base.GraphBasedEnv
     assert np.isclose(violation, error)
 
 
+def test_ellipsoid_summarize_modes():
+    env = mantrap.environment.KalmanEnvironment(ego_type=mantrap.agents.DoubleIntegratorDTAgent,
+                                                ego_position=torch.tensor([-5, 0.1]))
+    env.add_ado(position=torch.zeros(2))
+    module = mantrap.modules.baselines.InteractionEllipsoidModule(env=env, t_horizon=3)
+
+    # Distribution with four modes, whose means are their weights' ranks (mode 2 being the most important).
+    log_pis = torch.log_softmax(torch.tensor([1.0, 0.0, 3.0, 2.0]), dim=0).view(1, 1, 4).repeat(1, 4, 1)
+    mus = torch.tensor([1.0, 0.0, 3.0, 2.0]).view(1, 1, 4, 1).repeat(1, 4, 1, 2)
+    gmm = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=torch.zeros((1, 4, 4, 2)),
+                                       corrs=torch.zeros((1, 4, 4)))
+    pos_dist_dict = mantrap.utility.maths.MultiAgentDistribution(gmm, agent_ids=env.ado_ids)
+
+    # The most important modes are sorted by increasing importance, all modes are kept in their original order.
+    pos_means, _ = module.summarize_distribution(pos_dist_dict, num_modes=2)
+    assert torch.equal(pos_means[0, :3, :, 0], torch.tensor([2.0, 3.0]).repeat(3, 1))
+    pos_means, _ = module.summarize_distribution(pos_dist_dict, num_modes=4)
+    assert torch.equal(pos_means[0, :3, :, 0], torch.tensor([1.0, 0.0, 3.0, 2.0]).repeat(3, 1))
+
+
 ###########################################################################
 # Filter ##################################################################
 ###########################################################################
@@ -1,4 +1,8 @@
+import asyncio
 import math
+import os
+import sys
+import time
 
 import numpy as np
 import pytest
@@ -7,11 +11,16 @@ import torch
 import mantrap.constants
 import mantrap.agents
 import mantrap.environment
+import mantrap.environment.surrogate
 import mantrap.attention
 import mantrap.modules
 import mantrap.solver
+import mantrap.utility.io
 import mantrap.utility.shaping
 
+sys.path.append(mantrap.utility.io.build_os_path(mantrap.constants.WARM_START_PRE_COMPUTATION_DIRECTORY))
+import pre_compute  # noqa: E402
+
 torch.manual_seed(0)
 environments = [mantrap.environment.KalmanEnvironment,
                 mantrap.environment.PotentialFieldEnvironment,
@@ -39,6 +48,9 @@ def scenario(
 # Tests - All Solvers #####################################################
 ###########################################################################
 @pytest.mark.parametrize("solver_class", [mantrap.solver.IPOPTSolver,
+                                          mantrap.solver.AugmentedLagrangianSolver,
+                                          mantrap.solver.ILQRSolver,
+                                          mantrap.solver.SQPSolver,
                                           mantrap.solver.baselines.MonteCarloTreeSearch,
                                           mantrap.solver.baselines.RandomSearch])
 @pytest.mark.parametrize("env_class", environments)
@@ -171,6 +183,48 @@ class TestSolvers:
         assert np.all(np.less_equal(z0_flat, upper))
         assert np.all(np.greater_equal(z0_flat, lower))
 
+    @staticmethod
+    def test_warm_start_straight(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
+                                 env_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                                 attention_class: mantrap.attention.AttentionModule.__class__,
+                                 warm_start_method: str):
+        env = env_class(torch.tensor([-2, 0]), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+        env.add_ado(position=torch.tensor([0, 5]), velocity=torch.tensor([-1, 0]))
+        solver = solver_class(env, attention_module=attention_class, goal=torch.zeros(2), t_planning=10,
+                              modules=[mantrap.modules.GoalNormModule])
+
+        # Closed-form warm-start should be within the allowed optimization boundaries.
+        z0 = solver.warm_start(method=mantrap.constants.WARM_START_STRAIGHT).detach()
+        lower, upper = solver.optimization_variable_bounds()
+        assert np.all(np.less_equal(z0.numpy().flatten(), upper))
+        assert np.all(np.greater_equal(z0.numpy().flatten(), lower))
+
+        # The robot should drive on the straight line to the goal, within the speed limits, and stop close to it.
+        ego_trajectory = solver.z_to_ego_trajectory(z0.numpy()).detach()
+        _, v_max = env.ego.speed_limits
+        assert torch.allclose(ego_trajectory[:, 1], torch.zeros(11))
+        assert torch.all(torch.norm(ego_trajectory[:, 2:4], dim=1) <= v_max + 1e-3)
+        assert torch.norm(ego_trajectory[-1, 0:2]) < mantrap.constants.SOLVER_GOAL_END_DISTANCE
+
+    @staticmethod
+    def test_warm_start_cached(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
+                               env_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                               attention_class: mantrap.attention.AttentionModule.__class__,
+                               warm_start_method: str):
+        env = env_class(torch.tensor([-8, 0]), torch.ones(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+        env.add_ado(position=torch.tensor([0, 0]), velocity=torch.tensor([-1, 0]))
+        solver = solver_class(env, attention_module=attention_class, goal=torch.zeros(2), t_planning=5)
+
+        # Warm-starting twice should re-use the same sub-solver, synced to the solver's current environment.
+        solver.warm_start(method=mantrap.constants.WARM_START_HARD)
+        solver_part = solver._warm_start_solvers[mantrap.constants.WARM_START_HARD]
+        z0 = solver.warm_start(method=mantrap.constants.WARM_START_HARD).detach()
+        assert solver._warm_start_solvers[mantrap.constants.WARM_START_HARD] is solver_part
+        assert solver_part.env is solver.env
+        assert solver_part.eval_env is solver.eval_env
+        assert solver_part.eval_env is not solver.env
+        assert z0.numel() == solver.planning_horizon * 2
+
     @staticmethod
     def test_encoding(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
                       env_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
@@ -188,11 +242,49 @@ class TestSolvers:
         solver = solver_class(env, goal=ego_goal, t_planning=5,
                               warm_start_method=warm_start_method, attention_module=attention_class)
 
-        encoding = solver.encode()
+        encoding = solver.encode(version=1)
         assert torch.allclose(encoding[2:4], ego_velocity)
         t = mantrap.utility.maths.rotation_matrix(ego_position, ego_goal)
         assert torch.allclose(encoding[0:2], torch.matmul(t, ado_position))
 
+    @staticmethod
+    def test_encoding_k_closest(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
+                                env_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
+                                attention_class: mantrap.attention.AttentionModule.__class__,
+                                warm_start_method: str):
+        ego_position = torch.tensor([1.0, -2.0])
+        ego_goal = torch.tensor([5.0, 3.0])
+        ado_positions = [torch.tensor([4.0, 5.0]), torch.tensor([2.0, -1.0]), torch.tensor([-6.0, 6.0])]
+        num_encoded = mantrap.constants.WARM_START_ENCODING_NUM_ADOS
+
+        # The encoding should be invariant to the order in which the ados have been added to the scene.
+        ego_velocity = torch.tensor([1.0, 0.5])
+        encodings = []
+        for ado_order in [[0, 1, 2], [2, 0, 1]]:
+            env = env_class(ego_position, ego_velocity=ego_velocity, ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+            for m_ado in ado_order:
+                env.add_ado(position=ado_positions[m_ado], velocity=torch.ones(2) * m_ado)
+            solver = solver_class(env, goal=ego_goal, t_planning=5, attention_module=attention_class,
+                                  modules=[mantrap.modules.GoalNormModule])
+            encodings.append(solver.encode(version=2))
+        assert encodings[0].numel() == 4 * num_encoded + 2
+        assert torch.allclose(encodings[0], encodings[1])
+
+        # The first entries should be the robot's velocity, followed by the position of the closest ado relative
+        # to the robot and its velocity, all in robot-goal coordinates.
+        t = mantrap.utility.maths.rotation_matrix(ego_position, ego_goal)
+        assert torch.allclose(encodings[0][0:2], torch.matmul(t, ego_velocity))
+        assert torch.allclose(encodings[0][2:4], torch.matmul(t, ado_positions[1] - ego_position))
+        assert torch.allclose(encodings[0][4:6], torch.matmul(t, torch.ones(2)))
+
+        # Missing ados (less ados in the scene than encoded) should be padded.
+        env = env_class(ego_position, ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+        env.add_ado(position=ado_positions[0])
+        solver = solver_class(env, goal=ego_goal, t_planning=5, attention_module=attention_class,
+                              modules=[mantrap.modules.GoalNormModule])
+        encoding = solver.encode(version=2)
+        assert torch.all(encoding[6:].view(-1, 4)[:, 0:2] == mantrap.constants.WARM_START_ENCODING_PADDING)
+
     @staticmethod
     def test_log_query(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
                        env_class: mantrap.environment.base.GraphBasedEnvironment.__class__,
@@ -321,6 +413,363 @@ class TestIPOPTSolvers:
         assert torch.le(goal_distance, mantrap.constants.SOLVER_GOAL_END_DISTANCE * 2)
 
 
+def test_ipopt_hessian():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.IPOPTSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+
+    z = solver.ego_controls_to_z(torch.rand((solver.planning_horizon, 2)))
+    num_constraints = sum([m.num_constraints(ado_ids=env.ado_ids) for m in solver.modules])
+    hessian = solver.hessian(z, lagrange=np.ones(num_constraints), obj_factor=0.5, ado_ids=env.ado_ids, tag="test")
+    rows, columns = solver.hessian_structure()
+    assert hessian.size == rows.size == columns.size == 10 * 11 / 2
+    assert np.all(rows >= columns)  # lower triangle
+
+    # The hessian of the goal module only is exact (and scaled by the objective factor).
+    hessian_full = np.zeros((10, 10))
+    hessian_full[rows, columns] = hessian
+    hessian_full = hessian_full + np.tril(hessian_full, k=-1).T
+    ego_trajectory, grad_wrt = solver.z_to_ego_trajectory(z, return_leaf=True)
+    hessian_modules = [m.hessian(ego_trajectory, grad_wrt=grad_wrt, ado_ids=env.ado_ids, tag="test")
+                       for m in solver.modules]
+    assert np.allclose(hessian_full, 0.5 * np.sum(hessian_modules, axis=0))
+    assert np.all(np.linalg.eigvalsh(hessian_full) >= -1e-8)
+
+
+def test_ipopt_warm_start_multipliers():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.IPOPTSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    assert solver.warm_start_multipliers(ado_ids=env.ado_ids, tag="test") is None
+
+    # Multipliers of an optimization at the same time-step are re-used, one time-step ago are shifted, while
+    # multipliers of other ados or time-steps are not used at all.
+    lagrange = np.arange(12, dtype=float)
+    zl, zu = np.arange(10, dtype=float), np.arange(10, dtype=float) + 10
+    solver._multipliers["test"] = (env.ado_ids, env.time, lagrange, zl, zu)
+    lagrange_ws, zl_ws, zu_ws = solver.warm_start_multipliers(ado_ids=env.ado_ids, tag="test")
+    assert np.allclose(lagrange_ws, lagrange) and np.allclose(zl_ws, zl) and np.allclose(zu_ws, zu)
+
+    solver._multipliers["test"] = (env.ado_ids, env.time - env.dt, lagrange, zl, zu)
+    lagrange_ws, zl_ws, zu_ws = solver.warm_start_multipliers(ado_ids=env.ado_ids, tag="test")
+    assert np.allclose(lagrange_ws, np.concatenate((lagrange[2:], np.zeros(2))))
+    assert np.allclose(zl_ws, np.concatenate((zl[2:], np.zeros(2))))
+    assert np.allclose(zu_ws, np.concatenate((zu[2:], np.zeros(2))))
+
+    assert solver.warm_start_multipliers(ado_ids=[], tag="test") is None
+    solver._multipliers["test"] = (env.ado_ids, env.time - 2 * env.dt, lagrange, zl, zu)
+    assert solver.warm_start_multipliers(ado_ids=env.ado_ids, tag="test") is None
+
+
+def test_ipopt_best_feasible_fallback():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.IPOPTSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    z_feasible = np.ones(10) * 0.1
+    z_last = np.ones(10) * 0.5
+
+    class NLPMock:
+        """Mock of an IPOPT problem, which iterates through a feasible and an infeasible iterate."""
+        def __init__(self, status: int):
+            self.status = status
+
+        def addOption(self, *args):
+            pass
+
+        @staticmethod
+        def solve(z0, **kwargs):
+            problem.gradient(z_feasible)
+            problem.intermediate(0, 1, 1.0, 0.0, 0.0, 0.1, 0.0)
+            problem.gradient(z_last)
+            problem.intermediate(0, 2, 0.5, 10.0, 0.0, 0.1, 0.0)
+            return z_last, {"status": nlp.status, "mult_g": np.zeros(0), "mult_x_L": np.ones(10),
+                            "mult_x_U": np.ones(10)}
+
+    # If IPOPT has not converged, the best feasible iterate is returned and the next optimization is
+    # cold-started, otherwise IPOPT's solution is returned and its multipliers are stored for warm-starting.
+    problem = mantrap.solver.ipopt.IPOPTProblem(solver, ado_ids=env.ado_ids, tag="test")
+    for status, z_expected, is_warm_started in [(0, z_last, True), (-4, z_feasible, False)]:
+        nlp = NLPMock(status=status)
+        solver._problems["test"] = (env.ado_ids, problem, nlp)
+        z_opt, _ = solver.optimize_core(torch.zeros((5, 2)), ado_ids=env.ado_ids, tag="test")
+        assert np.allclose(z_opt.flatten().numpy(), z_expected)
+        assert ("test" in solver._multipliers.keys()) == is_warm_started
+
+
+###########################################################################
+# Test - Augmented Lagrangian Solver ######################################
+###########################################################################
+@pytest.mark.parametrize("solver_class", [mantrap.solver.AugmentedLagrangianSolver,
+                                          mantrap.solver.ILQRSolver,
+                                          mantrap.solver.SQPSolver])
+@pytest.mark.parametrize("env_class", [mantrap.environment.KalmanEnvironment,
+                                       mantrap.environment.PotentialFieldEnvironment])
+class TestAugmentedLagrangianSolver:
+
+    @staticmethod
+    def test_output(solver_class: mantrap.solver.base.TrajOptSolver.__class__,
+                    env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+        env = env_class(torch.tensor([-5, 0.1]), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+        env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+        modules = [mantrap.modules.GoalNormModule, mantrap.modules.InteractionProbabilityModule,
+                   mantrap.modules.SpeedLimitModule]
+        solver = solver_class(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+
+        z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+        z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids, tag="test", max_cpu_time=5.0)
+        assert z_opt.dtype == torch.float64
+        assert z_opt.shape == (solver.planning_horizon, 2)
+
+        # Optimized controls must be within the control bounds and feasible. Since the interaction objective
+        # is stochastic for some environments, only the (deterministic) goal objective is compared.
+        lb, ub = solver.optimization_variable_bounds()
+        assert np.all(z_opt.flatten().numpy() >= np.array(lb) - 1e-6)
+        assert np.all(z_opt.flatten().numpy() <= np.array(ub) + 1e-6)
+        _, violation_opt = solver.constraints(z_opt.flatten().numpy(), ado_ids=env.ado_ids, return_violation=True)
+        assert violation_opt < mantrap.constants.SOLVER_CONSTRAINT_LIMIT
+
+        ego_trajectory_0 = solver.z_to_ego_trajectory(z0.detach().numpy())
+        ego_trajectory_opt = solver.z_to_ego_trajectory(z_opt.flatten().numpy())
+        goal_distance_0 = torch.norm(ego_trajectory_0[:, 0:2] - solver.goal, dim=1).sum()
+        goal_distance_opt = torch.norm(ego_trajectory_opt[:, 0:2] - solver.goal, dim=1).sum()
+        assert goal_distance_opt < goal_distance_0
+
+
+def test_deadline():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.AugmentedLagrangianSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+
+    # With a large enough budget no deadline should be missed.
+    _ = solver.solve(time_steps=3, warm_start_method=mantrap.constants.WARM_START_ZEROS, step_budget=10.0)
+    assert solver.deadline_misses == 0
+
+    # Without any budget every deadline is missed, so the solver falls back to the (shifted) warm-start,
+    # i.e. zero controls, at every time-step.
+    ego_trajectory, _ = solver.solve(time_steps=3, warm_start_method=mantrap.constants.WARM_START_ZEROS,
+                                     step_budget=0.0)
+    assert solver.deadline_misses == 3
+    ego_trajectory_zeros = env.ego.unroll_trajectory(torch.zeros((3, 2)), dt=env.dt)
+    assert torch.allclose(ego_trajectory[:, 0:4], ego_trajectory_zeros[:, 0:4], atol=1e-5)
+
+    # When the optimization core returns after the deadline, the deadline is missed, but as its runtime is
+    # bounded anyway its result is returned nevertheless.
+    def optimize_core_late(z0, max_cpu_time: float, **unused):
+        time.sleep(max_cpu_time + mantrap.constants.SOLVER_DEADLINE_MARGIN + 0.01)
+        return torch.ones_like(z0).view(-1, 2), solver.logger.log
+
+    solver.optimize_core = optimize_core_late
+    deadline = time.time() + mantrap.constants.SOLVER_DEADLINE_MARGIN + 0.01
+    z_opt = solver.optimize(torch.zeros((5, 2)), tag="test", deadline=deadline)
+    assert solver.deadline_misses == 4
+    assert torch.allclose(z_opt, torch.ones((5, 2)))
+
+
+def test_warm_start_surrogate():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.AugmentedLagrangianSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    model = mantrap.environment.surrogate.SurrogateModel()
+    mantrap.environment.SurrogateEnvironment.register_model(model, teacher=env.name)
+
+    # The warm-start optimization is solved with the same modules, based on the surrogate of the environment.
+    z0 = solver.warm_start(method=mantrap.constants.WARM_START_SURROGATE).detach()
+    solver_part = solver._warm_start_solvers[mantrap.constants.WARM_START_SURROGATE]
+    assert isinstance(solver_part.env, mantrap.environment.SurrogateEnvironment)
+    assert solver_part.env.model is model
+    assert solver_part.module_names == solver.module_names
+    lower, upper = solver.optimization_variable_bounds()
+    assert np.all(np.less_equal(z0.numpy().flatten(), upper))
+    assert np.all(np.greater_equal(z0.numpy().flatten(), lower))
+
+
+def test_planning_service():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]), identifier="a")
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.AugmentedLagrangianSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    service = mantrap.solver.PlanningService(solver, publish_rate=20.0, step_budget=0.2,
+                                             warm_start_method=mantrap.constants.WARM_START_ZEROS)
+
+    async def client():
+        plans = service.subscribe()
+        ego_state = env.ego.state
+        controls = None
+        for k in range(1, 4):
+            ado_states = {"a": torch.tensor([3 - k * env.dt, 0, -1, 0])}
+            if k > 1:  # new ado appearing in the scene
+                ado_states["b"] = torch.tensor([0, 3 - k * env.dt, 0, -1])
+            await service.observe(k * env.dt, ego_state=ego_state, ado_states=ado_states)
+
+            # Wait for the plan based on the observation.
+            plan_time = -1.0
+            while plan_time < k * env.dt - 1e-4:
+                controls, plan_time = await asyncio.wait_for(plans.get(), timeout=10.0)
+        service.stop()
+        return controls
+
+    async def main():
+        _, controls_final = await asyncio.gather(service.run(duration=30.0), client())
+        return controls_final
+
+    controls = asyncio.run(main())
+
+    # The environment should have been updated by the observations (including the new ado), and a plan
+    # should have been published for every observation, with one latency measurement per plan.
+    env = solver.env
+    assert math.isclose(env.time, 3 * env.dt, abs_tol=1e-4)
+    assert env.ado_ids == ["a", "b"]
+    assert torch.allclose(env.ados[0].position, torch.tensor([3 - 3 * env.dt, 0]))
+    assert mantrap.utility.shaping.check_ego_controls(controls, t_horizon=5)
+    assert len(service.latencies) == 3
+    assert not service.is_running
+
+
+def test_planning_service_error():
+    env = mantrap.environment.KalmanEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.AugmentedLagrangianSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    service = mantrap.solver.PlanningService(solver, warm_start_method=mantrap.constants.WARM_START_ZEROS)
+
+    async def client():
+        await asyncio.sleep(0.1)
+        await service.observe(env.dt, ego_state=env.ego.state, ado_states={"a": torch.tensor([1.0])})
+
+    async def main():
+        # The invalid ado state fails when applying the observation in the planning round, which should
+        # stop the service immediately, although it would run forever otherwise.
+        await asyncio.wait_for(asyncio.gather(service.run(), client()), timeout=10.0)
+
+    with pytest.raises(AssertionError):
+        asyncio.run(main())
+    assert not service.is_running
+
+
+###########################################################################
+# Test - iLQR Solver ######################################################
+###########################################################################
+def test_ilqr_quadratic():
+    env = mantrap.environment.KalmanEnvironment(torch.zeros(2), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    solver = mantrap.solver.ILQRSolver(env, goal=torch.tensor([0.2, 0.1]), t_planning=5,
+                                       modules=[mantrap.modules.GoalNormModule])
+    z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+    z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids, tag="test")
+
+    # For the goal objective only the problem is an (unconstrained) linear least-squares problem, since the
+    # control bounds are not active for the close goal, which can be solved in closed form.
+    dx_du = env.ego.dx_du(z0.view(-1, 2), dt=env.dt).view(-1, 5, 10)[:, 0:2, :].reshape(-1, 10)
+    positions_0 = env.ego.unroll_trajectory(torch.zeros((5, 2)), dt=env.dt)[:, 0:2].flatten()
+    residuals = (solver.goal.repeat(6) - positions_0).view(-1, 1)
+    z_ls = torch.mm(torch.pinverse(dx_du), residuals).view(-1, 2)
+    assert torch.allclose(z_opt.float(), z_ls, atol=1e-2)
+
+
+###########################################################################
+# Test - SQP Solver #######################################################
+###########################################################################
+@pytest.mark.parametrize("env_class", [mantrap.environment.PotentialFieldEnvironment,
+                                       mantrap.environment.SocialForcesEnvironment])
+def test_sqp_linearized_environment(env_class: mantrap.environment.base.GraphBasedEnvironment.__class__):
+    env = env_class(torch.tensor([-5, 0.1]), torch.tensor([1, 0]), ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    env.add_ado(position=torch.tensor([0, 3]), velocity=torch.tensor([0, -1]))
+    env_linearized = mantrap.solver.sqp.LinearizedEnvironment(env)
+    ego_controls = torch.rand((4, 2))
+    ego_trajectory = env.ego.unroll_trajectory(ego_controls, dt=env.dt)
+
+    # At the linearization point, the linearized prediction must be equal to the environment's prediction
+    # (for the same random numbers), while the environment is used directly unless linearized.
+    assert not env_linearized.is_linearized
+    env_linearized.linearize(ego_controls)
+    torch.manual_seed(0)
+    dist_dict_linearized = env_linearized.compute_distributions(ego_trajectory, ado_ids=env.ado_ids)
+    torch.manual_seed(0)
+    dist_dict = env.compute_distributions(ego_trajectory, ado_ids=env.ado_ids)
+    assert dist_dict_linearized.ids == dist_dict.ids
+    assert torch.allclose(dist_dict_linearized.mean, dist_dict.mean, atol=1e-5)
+    assert torch.allclose(dist_dict_linearized.stddev, dist_dict.stddev, atol=1e-5)
+
+    # The linearized prediction's jacobian is constant, and for small control deviations the prediction should
+    # be close to the environment's prediction (re-using the same random numbers).
+    ego_controls_delta = ego_controls + 1e-3 * torch.ones_like(ego_controls)
+    ego_trajectory_delta = env.ego.unroll_trajectory(ego_controls_delta, dt=env.dt)
+    dist_dict_linearized = env_linearized.compute_distributions(ego_trajectory_delta, ado_ids=env.ado_ids)
+    torch.manual_seed(0)
+    dist_dict = env.compute_distributions(ego_trajectory_delta, ado_ids=env.ado_ids)
+    assert torch.allclose(dist_dict_linearized.mean, dist_dict.mean, atol=1e-4)
+
+    _, mean_jacobian, scale_jacobian = env_linearized.compute_distributions_with_jacobian(ego_controls_delta)
+    assert mean_jacobian.shape == scale_jacobian.shape == (2, 4, 1, 2, 8)
+
+    env_linearized.release()
+    assert not env_linearized.is_linearized
+
+
+def test_sqp_prediction_calls():
+    env = mantrap.environment.PotentialFieldEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                        ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+
+    # The particle-based predictions are re-sampled in every prediction, so that the local optimum the solvers
+    # converge to depends on the random draws. Therefore both solvers are based on the same random numbers.
+    objectives, num_calls = {}, {}
+    for solver_class in [mantrap.solver.AugmentedLagrangianSolver, mantrap.solver.SQPSolver]:
+        torch.manual_seed(1)
+        solver = solver_class(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+        z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+
+        num_calls[solver.name] = 0
+        compute_distributions_with_jacobian = solver.env.compute_distributions_with_jacobian
+
+        def count_calls(*args, **kwargs):
+            num_calls[solver.name] += 1
+            return compute_distributions_with_jacobian(*args, **kwargs)
+
+        solver.env.compute_distributions_with_jacobian = count_calls
+        z_opt, _ = solver.optimize_core(z0, ado_ids=env.ado_ids, tag="test", max_cpu_time=10.0)
+        del solver.env.compute_distributions_with_jacobian
+        objectives[solver.name] = solver.objective(z_opt.flatten().numpy(), ado_ids=env.ado_ids)
+
+    # The linearized prediction model requires much fewer evaluations of the prediction model (here using
+    # analytic jacobians), while converging to a solution that is at least as good.
+    assert num_calls["sqp"] < num_calls["augmented_lagrangian"] / 5
+    assert objectives["sqp"] <= objectives["augmented_lagrangian"] * 1.05
+
+
+def test_sqp_release_linearization():
+    env = mantrap.environment.PotentialFieldEnvironment(torch.tensor([-5, 0.1]), torch.tensor([1, 0]),
+                                                        ego_type=mantrap.agents.DoubleIntegratorDTAgent)
+    env.add_ado(position=torch.tensor([3, 0]), velocity=torch.tensor([-1, 0]))
+    modules = [mantrap.modules.GoalNormModule, mantrap.modules.InteractionProbabilityModule,
+               mantrap.modules.SpeedLimitModule]
+    solver = mantrap.solver.SQPSolver(env, goal=torch.tensor([5, 0]), t_planning=5, modules=modules)
+    z0 = solver.warm_start(method=mantrap.constants.WARM_START_ZEROS)
+
+    # The modules are predicting using the linearized environment, which is released after the optimization,
+    # so that the modules are predicting using the environment itself again.
+    env_linearized = solver.modules[1].env
+    assert isinstance(env_linearized, mantrap.solver.sqp.LinearizedEnvironment)
+    solver.optimize_core(z0, ado_ids=env.ado_ids, tag="test", max_cpu_time=10.0)
+    assert solver.modules[1].env is env_linearized
+    assert not env_linearized.is_linearized
+
+
 ###########################################################################
 # Test - RRT Solver #######################################################
 ###########################################################################
@@ -340,3 +789,73 @@ class TestRRTSolver:
         z_opt = solver.optimize(z0=torch.tensor([]), tag="test")
         ego_trajectory = solver.z_to_ego_trajectory(z_opt.detach().numpy())
         assert torch.allclose(ego_trajectory[0, 0:2], env.ego.position)
+
+
+###########################################################################
+# Test - Warm-Start Pre-Computation #######################################
+###########################################################################
+def solve_scenario_fake(seed: int, solution_horizon: int, **unused):
+    """Replace solving the scenario (by IPOPT), depending on the seed only."""
+    encoding = torch.ones(4 * mantrap.constants.WARM_START_ENCODING_NUM_ADOS + 2) * seed
+    return encoding, torch.ones((solution_horizon, 2)) * seed
+
+
+def test_pre_compute_shards():
+    # Every configuration has its own range of seeds, independent from the other configurations.
+    seeds_pf = pre_compute.scenario_seeds("potential_field", num_ados=1)
+    seeds_kalman = pre_compute.scenario_seeds("kalman", num_ados=1)
+    seeds_pf_2 = pre_compute.scenario_seeds("potential_field", num_ados=2)
+    assert len(set(seeds_pf[:100]) & set(seeds_kalman[:100])) == 0
+    assert len(set(seeds_pf[:100]) & set(seeds_pf_2[:100])) == 0
+
+    # The shards cover every scenario exactly once and are keyed by their full configuration, so that the same
+    # configuration results in the same shards, independent from the other configurations of the run.
+    jobs = pre_compute.shard_jobs("shards", num_scenarios=5, num_ados=[2, 1], env_types=["potential_field"],
+                                  solution_horizon=3, shard_size=2)
+    assert [len(job[1]) for job in jobs] == [2, 2, 1, 2, 2, 1]
+    assert sorted([seed for job in jobs for seed in job[1]]) == sorted(list(seeds_pf[:5]) + list(seeds_pf_2[:5]))
+    jobs_single = pre_compute.shard_jobs("shards", num_scenarios=5, num_ados=[1], env_types=["potential_field"],
+                                         solution_horizon=3, shard_size=2)
+    assert [job[0] for job in jobs_single] == [job[0] for job in jobs[3:]]
+    jobs_horizon = pre_compute.shard_jobs("shards", num_scenarios=5, num_ados=[1], env_types=["potential_field"],
+                                          solution_horizon=4, shard_size=2)
+    assert not set(job[0] for job in jobs_horizon) & set(job[0] for job in jobs_single)
+
+
+def test_pre_compute_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(pre_compute, "solve_random_scenario", solve_scenario_fake)
+    kwargs = {"num_scenarios": 5, "num_ados": [1, 2], "env_types": ["kalman"], "solution_horizon": 3,
+              "shard_size": 2, "num_workers": 1, "output_directory": str(tmp_path)}
+    shard_directory = os.path.join(str(tmp_path), f"shards_v{mantrap.constants.WARM_START_ENCODING_VERSION}")
+    enc_file, solution_file = mantrap.constants.WARM_START_PRE_COMPUTATION_FILE
+    index_file = os.path.join(str(tmp_path), mantrap.constants.WARM_START_PRE_COMPUTATION_INDEX_FILE)
+
+    # The database contains every scenario, sorted by seed.
+    pre_compute.pre_compute(**kwargs)
+    encodings = torch.load(os.path.join(str(tmp_path), enc_file))
+    solutions = torch.load(os.path.join(str(tmp_path), solution_file))
+    index = torch.load(index_file)
+    assert encodings.shape[0] == solutions.shape[0] == 10
+    assert solutions.shape[1:] == (3, 2)
+    assert torch.equal(index["seeds"], torch.sort(index["seeds"])[0])
+    assert torch.equal(solutions[:, 0, 0], index["seeds"].float())
+    assert index["env_types"] == ["kalman"] * 10
+
+    # A second run only solves the missing shards, while the solved shards are re-used.
+    shard_files = sorted(os.listdir(shard_directory))
+    modified_times = {f: os.stat(os.path.join(shard_directory, f)).st_mtime_ns for f in shard_files}
+    os.remove(os.path.join(shard_directory, shard_files[0]))
+    pre_compute.pre_compute(**kwargs)
+    assert sorted(os.listdir(shard_directory)) == shard_files
+    for f in shard_files[1:]:
+        assert os.stat(os.path.join(shard_directory, f)).st_mtime_ns == modified_times[f]
+    assert torch.equal(torch.load(os.path.join(str(tmp_path), solution_file)), solutions)
+
+    # Merging only builds the database from the solved shards of the configuration.
+    os.remove(os.path.join(shard_directory, shard_files[0]))
+    pre_compute.pre_compute(**kwargs, merge_only=True)
+    assert torch.load(index_file)["seeds"].numel() < 10
+    for f in shard_files[1:]:
+        os.remove(os.path.join(shard_directory, f))
+    with pytest.raises(FileNotFoundError):
+        pre_compute.pre_compute(**kwargs, merge_only=True)
@@ -56,3 +56,93 @@ def test_circle_intersection():
     # These circles do intersect, since the distance between the centers is smaller than 3 + 2 = 5.
     circle_is = mantrap.utility.maths.Circle(center=torch.tensor([2, 3]), radius=3.0)
     assert circle.does_intersect(circle_is)
+
+
+###########################################################################
+# Distributions Testing ###################################################
+###########################################################################
+def test_multi_agent_distribution_gmm():
+    num_agents, t_horizon, num_modes = 3, 4, 5
+    mus = torch.rand((num_agents, t_horizon, num_modes, 2))
+    log_pis = torch.rand((num_agents, t_horizon, num_modes))
+    log_sigmas = torch.rand((num_agents, t_horizon, num_modes, 2))
+    corrs = torch.rand((num_agents, t_horizon, num_modes)) * 0.5
+    gmm = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=log_sigmas, corrs=corrs)
+    distribution = mantrap.utility.maths.MultiAgentDistribution(gmm, agent_ids=["a", "b", "c"])
+
+    # The batched distribution should be equivalent to separate distributions for every agent.
+    values = torch.rand((num_agents, t_horizon, num_modes, 2))
+    log_probs = distribution.log_prob(values)
+    for m, agent_id in enumerate(["a", "b", "c"]):
+        gmm_m = mantrap.utility.maths.VGMM2D(mus[m], log_pis=log_pis[m], log_sigmas=log_sigmas[m], corrs=corrs[m])
+        assert torch.allclose(distribution[agent_id].mean, gmm_m.mean)
+        assert torch.allclose(log_probs[m], gmm_m.log_prob(values[m]))
+    assert list(distribution.keys()) == ["a", "b", "c"]
+    assert distribution.sample((7, )).shape == (num_agents, 7, t_horizon, 1, 2)
+
+    # The most important modes should be the ones with the largest weights.
+    top_modes = distribution.top_k_modes(k=2)
+    assert top_modes.shape == (num_agents, t_horizon, 2)
+    assert torch.equal(top_modes[:, :, 0], torch.argmax(log_pis, dim=-1))
+
+    # Sub-distributions follow the given order of agents.
+    distribution_sub = distribution.subset(["c", "a"])
+    assert distribution_sub.ids == ["c", "a"]
+    assert torch.allclose(distribution_sub.mean, mus[[2, 0]])
+    assert distribution.subset(["a", "b", "c"]) is distribution
+
+
+def test_multi_agent_distribution_normal():
+    loc = torch.rand((2, 4, 1, 2))
+    scale = torch.rand((2, 4, 1, 2)) + 0.1
+    normal = torch.distributions.Normal(loc=loc, scale=scale)
+    distribution = mantrap.utility.maths.MultiAgentDistribution(normal, agent_ids=["a", "b"])
+
+    assert torch.allclose(distribution["b"].log_prob(loc[1]), distribution.log_prob(loc)[1])
+    assert torch.equal(distribution.top_k_modes(k=1), torch.zeros((2, 4, 1), dtype=torch.long))
+    assert distribution.sample((3, 2)).shape == (2, 3, 2, 4, 1, 2)
+
+
+def test_gmm_rsample_selected_component():
+    t_horizon, num_modes = 3, 25
+    mus = torch.rand((t_horizon, num_modes, 2)) * 10
+    log_sigmas = torch.ones((t_horizon, num_modes, 2)) * (-5)  # tiny variance, samples ~ component means
+    corrs = torch.zeros((t_horizon, num_modes))
+    log_pis = torch.ones((t_horizon, num_modes)) * (-100)
+    log_pis[:, 7] = 0.0  # all weight in one single component
+    gmm = mantrap.utility.maths.VGMM2D(mus=mus, log_pis=log_pis, log_sigmas=log_sigmas, corrs=corrs)
+
+    samples = gmm.rsample((50, ))
+    assert samples.shape == (50, t_horizon, 1, 2)
+    assert torch.allclose(samples, mus[:, 7:8, :].unsqueeze(dim=0).expand(50, -1, -1, -1), atol=0.1)
+
+    # Sampling in chunks should result in the same shape as sampling at once.
+    samples_chunked = gmm.rsample((50, 2), chunk_size=8)
+    assert samples_chunked.shape == (50, 2, t_horizon, 1, 2)
+    assert torch.allclose(samples_chunked[:, 0], samples, atol=0.1)
+
+
+def test_multi_agent_distribution_prune_modes():
+    num_agents, t_horizon, num_modes = 2, 3, 25
+    log_pis = torch.ones((num_agents, t_horizon, num_modes)) * (-10)
+    log_pis[:, :, 3] = 0.0
+    log_pis[:, :, 11] = -1.0
+    gmm = mantrap.utility.maths.VGMM2D(mus=torch.rand((num_agents, t_horizon, num_modes, 2)),
+                                       log_pis=log_pis,
+                                       log_sigmas=torch.rand((num_agents, t_horizon, num_modes, 2)),
+                                       corrs=torch.rand((num_agents, t_horizon, num_modes)) * 0.5)
+    distribution = mantrap.utility.maths.MultiAgentDistribution(gmm, agent_ids=["a", "b"])
+
+    # Keeping the most important modes re-normalizes their weights.
+    distribution_k, modes = distribution.prune_modes(num_modes=2)
+    assert distribution_k.mean.shape == (num_agents, t_horizon, 2, 2)
+    assert torch.all(modes[:, :, 0] == 3) and torch.all(modes[:, :, 1] == 11)
+    assert torch.allclose(torch.logsumexp(distribution_k.distribution.log_pis, dim=-1), torch.zeros(1))
+
+    # Both dominant modes cover more than 99 % of the probability mass, while the first one does not.
+    distribution_mass, modes = distribution.prune_modes(mass=0.99)
+    assert modes.shape == (num_agents, t_horizon, 2)
+    values = torch.gather(distribution.mean, dim=2, index=modes.unsqueeze(dim=-1).expand(-1, -1, -1, 2))
+    log_prob_full = distribution.log_prob(distribution.mean)
+    log_prob_pruned = distribution_mass.log_prob(values)
+    assert torch.all(torch.abs(log_prob_full - log_prob_pruned) < 0.1)
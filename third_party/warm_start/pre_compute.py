@@ -1,67 +1,246 @@
+import argparse
+import multiprocessing
 import os
 import typing
 
 import mantrap
+import numpy as np
 import torch
 
 
-def generate_random_scene(pos_bounds: typing.Tuple[float, float], vel_bounds: typing.Tuple[float, float]
-                          ) -> typing.Tuple[mantrap.environment.PotentialFieldEnvironment, torch.Tensor]:
-    """Generate random scenario with one pedestrian and the robot.
+ENVIRONMENTS = {"potential_field": mantrap.environment.PotentialFieldEnvironment,
+                "kalman": mantrap.environment.KalmanEnvironment,
+                "social_forces": mantrap.environment.SocialForcesEnvironment}
+MAX_NUM_ADOS = 100  # maximal number of ados per scenario, for assigning seed ranges to configurations.
+MAX_NUM_SCENARIOS = 10 ** 6  # maximal number of scenarios per configuration (size of seed range).
+
+
+def generate_random_scene(pos_bounds: typing.Tuple[float, float], vel_bounds: typing.Tuple[float, float],
+                          num_ados: int = 1, env_type: str = "potential_field",
+                          ) -> typing.Tuple[mantrap.environment.base.GraphBasedEnvironment, torch.Tensor]:
+    """Generate random scenario with `num_ados` pedestrians and the robot.
 
     :param pos_bounds: bounds of position sampling, both for robot position, goal and pedestrian position.
     :param vel_bounds: bounds of velocity sampling for robot.
-    :returns random one-pedestrian environment (PotentialField), robot goal position
+    :param num_ados: number of pedestrians in the scene.
+    :param env_type: name of environment type (key of `ENVIRONMENTS`).
+    :returns random environment (of type `env_type`), robot goal position
     """
     ego_position = pos_bounds[0] + torch.rand(2) * (pos_bounds[1] - pos_bounds[0])
     ego_velocity = vel_bounds[0] + torch.rand(2) * (vel_bounds[1] - vel_bounds[0])
-    ado_position = pos_bounds[0] + torch.rand(2) * (pos_bounds[1] - pos_bounds[0])
     ego_goal = pos_bounds[0] + torch.rand(2) * (pos_bounds[1] - pos_bounds[0])
 
-    env = mantrap.environment.PotentialFieldEnvironment(ego_position=ego_position, ego_velocity=ego_velocity,
-                                                        dt=mantrap.constants.ENV_DT_DEFAULT)
-    env.add_ado(position=ado_position, velocity=torch.rand(2))
+    env = ENVIRONMENTS[env_type](ego_position=ego_position, ego_velocity=ego_velocity,
+                                 dt=mantrap.constants.ENV_DT_DEFAULT)
+    for _ in range(num_ados):
+        ado_position = pos_bounds[0] + torch.rand(2) * (pos_bounds[1] - pos_bounds[0])
+        ado_goal = pos_bounds[0] + torch.rand(2) * (pos_bounds[1] - pos_bounds[0])
+        env.add_ado(position=ado_position, velocity=torch.rand(2), goal=ado_goal)
     return env, ego_goal
 
 
-def solve_random_scenario(num_scenarios: int = mantrap.constants.WARM_START_PRE_COMPUTATION_NUM,
-                          solution_horizon: int = mantrap.constants.WARM_START_PRE_COMPUTATION_HORIZON
+def solve_random_scenario(seed: int, num_ados: int = 1, env_type: str = "potential_field",
+                          solution_horizon: int = mantrap.constants.WARM_START_PRE_COMPUTATION_HORIZON,
+                          encoding_version: int = mantrap.constants.WARM_START_ENCODING_VERSION,
                           ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
-    """Randomly sample and solve scenarios, based on `IPOPTSolver` and `PotentialFieldEnvironment`.
+    """Randomly sample and solve a single scenario, based on `IPOPTSolver` and the given environment type.
 
-    The simplified simulation environment `PotentialFieldEnvironment` is used in order to trade-off between
-    the number of pre-computed scenarios (and therefore quality of match) and the meaningfulness of the
+    The scenario only depends on the `seed`, so that every entry of the database can be re-produced
+    independently from the order in which the scenarios are solved (and from the process solving it).
+    By default the simplified simulation environment `PotentialFieldEnvironment` is used in order to trade-off
+    between the number of pre-computed scenarios (and therefore quality of match) and the meaningfulness of the
     pre-computed solution.
+
+    :param seed: random seed determining the scenario.
+    :param num_ados: number of pedestrians in the scene.
+    :param env_type: name of environment type (key of `ENVIRONMENTS`).
+    :param solution_horizon: number of pre-computed robot control inputs.
+    :param encoding_version: version of scene encoding (see `TrajOptSolver.encode()`).
+    :returns: scenario encoding, robot controls solution (solution_horizon, 2).
     """
-    encodings = torch.zeros(num_scenarios, 4)  # 4 = encoding lengths
-    solutions = torch.zeros(num_scenarios, solution_horizon, 2)  # 2 = robot control input size
+    torch.manual_seed(seed)
+    np.random.seed(seed)
 
     pos_bounds = mantrap.constants.ENV_X_AXIS_DEFAULT  # assuming isotropic bounds (x = y)
     vel_bounds = (0.0, mantrap.constants.ROBOT_SPEED_MAX)  # assuming isotropic bounds (vx = vy)
-    for n in range(num_scenarios):
-        print(f"Pre-Computation step = {n} / {num_scenarios}")
-        env, ego_goal = generate_random_scene(pos_bounds=pos_bounds, vel_bounds=vel_bounds)
-        solver = mantrap.solver.IPOPTSolver(env=env, goal=ego_goal, is_logging=False, is_debug=False)
-        ego_trajectory, _ = solver.solve(time_steps=solution_horizon)
+    env, ego_goal = generate_random_scene(pos_bounds, vel_bounds=vel_bounds, num_ados=num_ados, env_type=env_type)
+    solver = mantrap.solver.IPOPTSolver(env=env, goal=ego_goal, is_logging=False, is_debug=False)
+    encoding = solver.encode(version=encoding_version)
+    ego_trajectory, _ = solver.solve(time_steps=solution_horizon)
+
+    # Store solution in database. In case the robot arrived earlier than expected, stack
+    # zeros at the remaining entries of the database.
+    ego_controls = env.ego.roll_trajectory(ego_trajectory, dt=env.dt)
+    diff_length = solution_horizon - ego_controls.shape[0]
+    if diff_length > 0:
+        ego_controls = torch.cat((ego_controls, torch.zeros((diff_length, 2))))
+    return encoding, ego_controls[:solution_horizon, :]
 
-        # Store scenario encoding in database.
-        encodings[n, :] = solver.encode()
 
-        # Store solution in database. In case the robot arrived earlier than expected, stack
-        # zeros at the remaining entries of the database.
-        ego_controls = env.ego.roll_trajectory(ego_trajectory, dt=env.dt)
-        diff_length = solution_horizon - ego_controls.shape[0]
-        if diff_length > 0:
-            ego_controls = torch.cat((ego_controls, torch.zeros((diff_length, 2))))
-        solutions[n, :, :] = ego_controls
+###########################################################################
+# Sharding ################################################################
+###########################################################################
+def solve_shard(shard_file: str, seeds: typing.List[int], num_ados: int, env_type: str, solution_horizon: int,
+                encoding_version: int) -> str:
+    """Solve all scenarios of one shard and checkpoint the results to the `shard_file`.
 
-    return encodings, solutions
+    When the shard file already exists, the shard has been solved in a previous (interrupted) run, so
+    it is skipped. The results are written to a temporary file first and renamed afterwards, so that
+    a process killed while writing never leaves a partial shard behind.
+    """
+    if os.path.isfile(shard_file):
+        return shard_file
+    torch.set_num_threads(1)  # one process per core, avoid thread over-subscription
 
+    encodings, solutions = [], []
+    for seed in seeds:
+        encoding, solution = solve_random_scenario(seed, num_ados=num_ados, env_type=env_type,
+                                                   solution_horizon=solution_horizon,
+                                                   encoding_version=encoding_version)
+        encodings.append(encoding)
+        solutions.append(solution)
 
-if __name__ == '__main__':
-    encodings_db, solutions_db = solve_random_scenario()
+    shard = {"encodings": torch.stack(encodings),
+             "solutions": torch.stack(solutions),
+             "seeds": torch.tensor(seeds, dtype=torch.long),
+             "num_ados": torch.ones(len(seeds), dtype=torch.long) * num_ados,
+             "env_types": [env_type] * len(seeds),
+             "solution_horizon": solution_horizon,
+             "encoding_version": encoding_version}
+    torch.save(shard, shard_file + ".tmp")
+    os.replace(shard_file + ".tmp", shard_file)
+    return shard_file
+
+
+def _solve_shard_star(args: typing.Tuple) -> str:
+    return solve_shard(*args)
+
+
+def scenario_seeds(env_type: str, num_ados: int) -> range:
+    """Range of scenario seeds of a configuration (env_type, num_ados).
+
+    Every configuration gets its own, non-overlapping range of seeds, which only depends on the configuration
+    itself (not e.g. on the order of configurations or the number of scenarios), so that shards solved in
+    different runs can be re-used as long as their configuration matches.
+    """
+    assert env_type in ENVIRONMENTS.keys()
+    assert 0 < num_ados < MAX_NUM_ADOS
+    config_index = list(ENVIRONMENTS.keys()).index(env_type) * MAX_NUM_ADOS + num_ados
+    return range(config_index * MAX_NUM_SCENARIOS, (config_index + 1) * MAX_NUM_SCENARIOS)
+
+
+def shard_jobs(shard_directory: str,
+               num_scenarios: int = mantrap.constants.WARM_START_PRE_COMPUTATION_NUM,
+               num_ados: typing.List[int] = (1, ),
+               env_types: typing.List[str] = ("potential_field", ),
+               solution_horizon: int = mantrap.constants.WARM_START_PRE_COMPUTATION_HORIZON,
+               encoding_version: int = mantrap.constants.WARM_START_ENCODING_VERSION,
+               shard_size: int = mantrap.constants.WARM_START_PRE_COMPUTATION_SHARD_SIZE
+               ) -> typing.List[typing.Tuple]:
+    """Split the pre-computation into shards of `shard_size` scenarios (arguments of `solve_shard()`).
+
+    The shard files are keyed by the full configuration of the shard, i.e. the environment type, the number
+    of ados, the solution horizon and the seeds of its scenarios (the encoding version is the directory), so
+    that a shard file is only re-used by a run with the same configuration.
+    """
+    assert num_scenarios <= MAX_NUM_SCENARIOS
+    jobs = []
+    for env_type in env_types:
+        for n_ados in num_ados:
+            seeds = scenario_seeds(env_type, num_ados=n_ados)[:num_scenarios]
+            for seed_start in range(0, num_scenarios, shard_size):
+                shard_seeds = list(seeds[seed_start:seed_start + shard_size])
+                shard_name = f"shard_{env_type}_{n_ados}_h{solution_horizon}_{shard_seeds[0]}-{shard_seeds[-1]}.pt"
+                shard_file = os.path.join(shard_directory, shard_name)
+                jobs.append((shard_file, shard_seeds, n_ados, env_type, solution_horizon, encoding_version))
+    return jobs
+
+
+def merge_shards(shard_files: typing.List[str], output_directory: str):
+    """Merge the given shards to the indexed warm-start database.
+
+    The database consists of the encodings (N, encoding_size) and solutions (N, horizon, 2) tensors, as
+    queried by `TrajOptSolver._warm_start_encoding()`, and an index file storing the meta-data of every
+    entry (environment type, number of ados, seed), sorted by seed so that the database is independent
+    from the order in which the shards have been solved. Since encodings of different versions cannot be
+    compared, all shards must have been built with the same encoding version, which is stored in the index.
+    """
+    assert len(shard_files) > 0
+    assert all(os.path.isfile(shard_file) for shard_file in shard_files)
+    shards = [torch.load(shard_file) for shard_file in shard_files]
+    encoding_version = shards[0]["encoding_version"]
+    assert all(shard["encoding_version"] == encoding_version for shard in shards)
+    assert all(shard["solutions"].shape[1:] == shards[0]["solutions"].shape[1:] for shard in shards)
+
+    seeds = torch.cat([shard["seeds"] for shard in shards])
+    seeds, order = torch.sort(seeds)
+    assert torch.unique(seeds).numel() == seeds.numel()  # every scenario only once
+    encodings = torch.cat([shard["encodings"] for shard in shards])[order]
+    solutions = torch.cat([shard["solutions"] for shard in shards])[order]
+    num_ados = torch.cat([shard["num_ados"] for shard in shards])[order]
+    env_types = [env_type for shard in shards for env_type in shard["env_types"]]
+    env_types = [env_types[i] for i in order.tolist()]
 
     enc_file, solution_file = mantrap.constants.WARM_START_PRE_COMPUTATION_FILE
-    output_directory = mantrap.utility.io.build_os_path(os.path.join("third_party", "warm_start"))
-    torch.save(encodings_db, os.path.join(output_directory, enc_file))
-    torch.save(solutions_db, os.path.join(output_directory, solution_file))
+    torch.save(encodings, os.path.join(output_directory, enc_file))
+    torch.save(solutions, os.path.join(output_directory, solution_file))
+    index = {"seeds": seeds, "num_ados": num_ados, "env_types": env_types, "encoding_version": encoding_version}
+    torch.save(index, os.path.join(output_directory, mantrap.constants.WARM_START_PRE_COMPUTATION_INDEX_FILE))
+
+
+def pre_compute(num_scenarios: int = mantrap.constants.WARM_START_PRE_COMPUTATION_NUM,
+                num_ados: typing.List[int] = (1, ),
+                env_types: typing.List[str] = ("potential_field", ),
+                solution_horizon: int = mantrap.constants.WARM_START_PRE_COMPUTATION_HORIZON,
+                encoding_version: int = mantrap.constants.WARM_START_ENCODING_VERSION,
+                shard_size: int = mantrap.constants.WARM_START_PRE_COMPUTATION_SHARD_SIZE,
+                num_workers: int = None,
+                output_directory: str = None,
+                merge_only: bool = False):
+    """Build the warm-start database by solving `num_scenarios` scenarios for every combination of
+    environment type and number of ados, distributed over a pool of worker processes.
+
+    The scenario seeds are split into shards of `shard_size` scenarios, every shard is solved by one worker
+    and checkpointed to disk once solved. Re-running the pre-computation therefore resumes from the already
+    solved shards. Finally the shards of this configuration (only) are merged into the database.
+
+    :param merge_only: only merge the (already solved) shards, without solving the open ones, i.e. build the
+                       database from a partially solved pre-computation.
+    """
+    if output_directory is None:
+        output_directory = mantrap.utility.io.build_os_path(mantrap.constants.WARM_START_PRE_COMPUTATION_DIRECTORY)
+    shard_directory = os.path.join(output_directory, f"shards_v{encoding_version}")
+    os.makedirs(shard_directory, exist_ok=True)
+
+    jobs = shard_jobs(shard_directory, num_scenarios=num_scenarios, num_ados=num_ados, env_types=env_types,
+                      solution_horizon=solution_horizon, encoding_version=encoding_version, shard_size=shard_size)
+    jobs_open = [job for job in jobs if not os.path.isfile(job[0])]
+    print(f"Pre-Computation: {len(jobs) - len(jobs_open)} / {len(jobs)} shards already solved")
+    if merge_only:
+        shard_files = [job[0] for job in jobs if os.path.isfile(job[0])]
+        if len(shard_files) == 0:
+            raise FileNotFoundError(f"No solved shards of this configuration in {shard_directory} !")
+    else:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            for n, shard_file in enumerate(pool.imap_unordered(_solve_shard_star, jobs_open)):
+                print(f"Pre-Computation: shard {n + 1} / {len(jobs_open)} solved ({os.path.basename(shard_file)})")
+        shard_files = [job[0] for job in jobs]
+
+    merge_shards(shard_files, output_directory=output_directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-compute warm-start database.")
+    parser.add_argument("--num", type=int, default=mantrap.constants.WARM_START_PRE_COMPUTATION_NUM)
+    parser.add_argument("--num_ados", type=int, nargs="+", default=[1])
+    parser.add_argument("--env_types", type=str, nargs="+", default=["potential_field"], choices=ENVIRONMENTS.keys())
+    parser.add_argument("--horizon", type=int, default=mantrap.constants.WARM_START_PRE_COMPUTATION_HORIZON)
+    parser.add_argument("--encoding_version", type=int, default=mantrap.constants.WARM_START_ENCODING_VERSION)
+    parser.add_argument("--shard_size", type=int, default=mantrap.constants.WARM_START_PRE_COMPUTATION_SHARD_SIZE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--merge_only", action="store_true")
+    args = parser.parse_args()
+
+    pre_compute(args.num, num_ados=args.num_ados, env_types=args.env_types, solution_horizon=args.horizon,
+                encoding_version=args.encoding_version, shard_size=args.shard_size, num_workers=args.workers,
+                merge_only=args.merge_only)